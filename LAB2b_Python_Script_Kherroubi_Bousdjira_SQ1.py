@@ -15,26 +15,58 @@ import libvirt
 import os
 import sys
 import logging
+import time
 from datetime import datetime
 
+import vm_domxml
+import vm_events
+import vm_instrument
+import vm_inventory
+import vm_lazy
+import vm_oplog
+import vm_ratelimit
+import vm_tui
+
+vm_tui.mark("imported")
+
+# Subsystems behind menu entries are imported on first use
+vm_agent = vm_lazy.LazyModule("vm_agent")
+vm_boot = vm_lazy.LazyModule("vm_boot")
+vm_cpusched = vm_lazy.LazyModule("vm_cpusched")
+vm_disklatency = vm_lazy.LazyModule("vm_disklatency")
+vm_diskmaint = vm_lazy.LazyModule("vm_diskmaint")
+vm_hibernate = vm_lazy.LazyModule("vm_hibernate")
+vm_images = vm_lazy.LazyModule("vm_images")
+vm_ioqos = vm_lazy.LazyModule("vm_ioqos")
+vm_jobs = vm_lazy.LazyModule("vm_jobs")
+vm_netqos = vm_lazy.LazyModule("vm_netqos")
+vm_reconcile = vm_lazy.LazyModule("vm_reconcile")
+vm_resize = vm_lazy.LazyModule("vm_resize")
+vm_select = vm_lazy.LazyModule("vm_select")
+vm_shutdown = vm_lazy.LazyModule("vm_shutdown")
+vm_storagemove = vm_lazy.LazyModule("vm_storagemove")
+vm_watch = vm_lazy.LazyModule("vm_watch")
+vm_watchdog = vm_lazy.LazyModule("vm_watchdog")
+
 # =============================================================================
 # CONFIGURATION
 # =============================================================================
 
+LIBVIRT_URI = os.environ.get('VM_MANAGER_URI', 'qemu:///system')
 LOG_FILE = 'vm_manager.log'
+RPC_REPORT_FILE = 'vm_rpc_stats.json'
 DISK_IMAGE_DIR = '/var/lib/libvirt/images'
 DEFAULT_BRIDGE = 'kvmbr0'
 QEMU_EMULATOR = '/usr/libexec/qemu-kvm'
+SHUTDOWN_TIMEOUT = 120
 
 # =============================================================================
 # LOGGING SETUP
 # =============================================================================
 
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# JSON lines written by a background thread, rotated by size
+# (query with vm_logquery.py)
+vm_oplog.setup_logging(LOG_FILE)
 
 # =============================================================================
 # CONSTANTS
@@ -133,29 +165,61 @@ class VMManager(object):
         """Initialize the VM manager"""
         self.conn = None
         self.connected = False
+        self.hostname = None
+        self.metrics_server = None
     
     # -------------------------------------------------------------------------
     # CONNECTION MANAGEMENT
     # -------------------------------------------------------------------------
     
+    def open_connection(self, uri=LIBVIRT_URI):
+        """
+        Connect to the hypervisor without any terminal output
+        
+        Args:
+            uri: libvirt connection URI
+            
+        Raises:
+            libvirt.libvirtError: The connection failed
+        """
+        # Lifecycle events are only delivered if the loop exists first
+        vm_events.start_event_loop()
+        
+        # Returns the raw connection unless VM_MANAGER_INSTRUMENT=1 or
+        # VM_MANAGER_RPC_LIMIT=1; limiting wraps instrumentation so only
+        # the RPCs actually sent are timed
+        self.conn = vm_ratelimit.limit(vm_instrument.instrument(libvirt.open(uri)))
+        if not self.conn:
+            raise libvirt.libvirtError("Failed to establish connection")
+        
+        self.connected = True
+        self.hostname = self.conn.getHostname()
+        if vm_ratelimit.ENABLED:
+            vm_instrument.register_metrics(
+                vm_ratelimit.limiter_of(self.conn).render_metrics)
+        if vm_instrument.ENABLED:
+            self.metrics_server = vm_instrument.start_metrics_server()
+        
+        vm_oplog.log_event("connect", host=self.hostname)
+    
+    
     def connect(self):
         """Establish connection to the KVM hypervisor"""
         clear_screen()
         print_header("KVM Hypervisor Connection", Colors.BLUE)
         
-        print_info("Attempting to connect to qemu:///system...")
+        print_info("Attempting to connect to %s..." % LIBVIRT_URI)
         
         try:
-            self.conn = libvirt.open("qemu:///system")
-            if not self.conn:
-                print_error("Failed to establish connection!")
-                sys.exit(1)
-            
-            self.connected = True
+            self.open_connection()
             print_success("Successfully connected to KVM hypervisor")
-            print_info("Hostname: %s" % self.conn.getHostname())
+            print_info("Hostname: %s" % self.hostname)
             
-            logging.info("Connected to hypervisor: %s", self.conn.getHostname())
+            if vm_instrument.ENABLED:
+                print_info("libvirt call instrumentation enabled")
+                if self.metrics_server:
+                    print_info("Metrics served on 127.0.0.1:%d/metrics" %
+                               vm_instrument.METRICS_PORT)
             
         except libvirt.libvirtError as e:
             print_error("Connection failed: %s" % str(e))
@@ -170,14 +234,21 @@ class VMManager(object):
         if self.conn and self.connected:
             self.conn.close()
             self.connected = False
-            logging.info("Connection closed")
+            vm_oplog.log_event("disconnect", host=self.hostname)
+            if vm_instrument.ENABLED:
+                vm_instrument.write_report(RPC_REPORT_FILE)
     
     # -------------------------------------------------------------------------
     # MENU SYSTEM
     # -------------------------------------------------------------------------
     
-    def show_menu(self):
-        """Display the main menu"""
+    def show_menu(self, embedded=False):
+        """
+        Display the main menu
+        
+        Args:
+            embedded: The menu was opened from the full-screen interface
+        """
         clear_screen()
         print_header("KVM Virtual Machine Manager", Colors.BLUE)
         
@@ -194,11 +265,38 @@ class VMManager(object):
         print("  [7] Resume VM")
         print("  [8] Delete VM")
         
+        print("\n" + Colors.BOLD + "  FLEET OPERATIONS" + Colors.ENDC)
+        print("  [a] Shut down all running VMs")
+        print("  [h] Hibernate all running VMs (managed save)")
+        print("  [r] Restore hibernated VMs")
+        print("  [b] Boot managed-autostart VMs in order")
+        print("  [u] Managed autostart settings")
+        print("  [g] Run guest agent command on VMs")
+        print("  [w] Crash watchdog (restart crashed VMs)")
+        print("  [d] Reconcile with desired state (vm_fleet.json)")
+        
+        print("\n" + Colors.BOLD + "  PERFORMANCE TUNING" + Colors.ENDC)
+        print("  [c] CPU scheduling classes")
+        print("  [i] Disk I/O limits")
+        print("  [m] Disk image maintenance")
+        print("  [v] Move VM storage (live)")
+        print("  [n] Network bandwidth and multiqueue")
+        print("  [z] Resize VMs (vCPUs / memory)")
+        
         print("\n" + Colors.BOLD + "  CONSOLE" + Colors.ENDC)
         print("  [9] View VM console (requires virt-viewer)")
         
+        print("\n" + Colors.BOLD + "  DIAGNOSTICS" + Colors.ENDC)
+        print("  [e] Watch domain events (live)")
+        print("  [l] Disk latency (slowest disks and guests)")
+        print("  [j] In-flight jobs (abort hung operations)")
+        print("  [s] libvirt call statistics")
+        
         print("\n" + Colors.BOLD + "  SYSTEM" + Colors.ENDC)
-        print("  [q] Quit")
+        if embedded:
+            print("  [q] Back to the full-screen view")
+        else:
+            print("  [q] Quit")
         
         print("\n" + Colors.BLUE + "=" * 70 + Colors.ENDC)
     
@@ -253,6 +351,145 @@ class VMManager(object):
         
         pause()
     
+    # -------------------------------------------------------------------------
+    # DIAGNOSTICS
+    # -------------------------------------------------------------------------
+    
+    def watch_events(self):
+        """Print domain events as they happen until Ctrl-C"""
+        clear_screen()
+        print_header("Domain Events", Colors.BLUE)
+        
+        path = safe_input("Also append events to file (empty for none): ")
+        stream = vm_watch.EventStream(self.conn)
+        try:
+            stream.add_sink(vm_watch.ConsoleSink())
+            if path:
+                stream.add_sink(vm_watch.FileSink(path))
+            subscribed = stream.start()
+        except (IOError, OSError, RuntimeError) as e:
+            print_error("Cannot watch events: %s" % str(e))
+            stream.stop()
+            pause()
+            return
+        
+        print_info("Watching %d event types, press Ctrl-C to stop\n" % subscribed)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stream.stop()
+        
+        print("")
+        for line in stream.format_stats():
+            print("  " + line)
+        pause()
+    
+    
+    def show_disk_latency(self):
+        """Rank the disks and guests of running VMs by I/O latency"""
+        clear_screen()
+        print_header("Disk Latency", Colors.BLUE)
+        
+        try:
+            print_info("Sampling disk counters for %.0f seconds..." %
+                       vm_disklatency.SAMPLE_INTERVAL)
+            first = vm_disklatency.sample(self.conn)
+            time.sleep(vm_disklatency.SAMPLE_INTERVAL)
+            interval = vm_disklatency.analyze(first,
+                                              vm_disklatency.sample(self.conn))
+            
+            print("\n" + Colors.BOLD + "Slowest disks" + Colors.ENDC)
+            for line in vm_disklatency.format_report(interval, 10):
+                print("  " + line)
+            print("\n" + Colors.BOLD + "Slowest guests" + Colors.ENDC)
+            for line in vm_disklatency.format_report(
+                    vm_disklatency.by_guest(interval), 10, label="Guest"):
+                print("  " + line)
+            print("")
+            print_info("Disks averaging %.0f ms or more are marked slow" %
+                       vm_disklatency.SLOW_MS)
+            
+        except libvirt.libvirtError as e:
+            print_error("Failed to read disk statistics: %s" % str(e))
+        
+        pause()
+    
+    
+    def show_jobs(self):
+        """Show supervised and running jobs of all domains, abort hung ones"""
+        clear_screen()
+        print_header("In-flight Jobs", Colors.BLUE)
+        
+        supervisor = self.jobs()
+        try:
+            supervisor.adopt()
+        except libvirt.libvirtError as e:
+            print_warning("Could not scan domains for jobs: %s" % str(e))
+        
+        jobs = supervisor.jobs()
+        if not jobs:
+            print_info("No jobs running")
+            pause()
+            return
+        for line in vm_jobs.format_jobs(jobs):
+            print("  " + line)
+        
+        if not any(job.status == "running" for job in jobs):
+            pause()
+            return
+        job_id = safe_input("\nJob ID to abort (empty to go back): ")
+        if not job_id:
+            return
+        try:
+            if supervisor.abort(int(job_id)):
+                print_success("Abort requested for job %s" % job_id)
+            else:
+                print_warning("Job %s is not running or cannot be aborted" % job_id)
+        except ValueError:
+            print_error("Invalid job ID")
+        
+        pause()
+    
+    
+    def show_rpc_stats(self):
+        """Display per-method libvirt call counts and latencies"""
+        clear_screen()
+        print_header("libvirt Call Statistics", Colors.BLUE)
+        
+        limiter = vm_ratelimit.limiter_of(self.conn)
+        if limiter is not None:
+            print(Colors.BOLD + "Client-side limiter" + Colors.ENDC)
+            for line in vm_ratelimit.format_report(limiter):
+                print("  " + line)
+            print("")
+        
+        if not vm_instrument.ENABLED:
+            print_warning("Instrumentation is disabled")
+            print_info("Restart with VM_MANAGER_INSTRUMENT=1 to record calls")
+            pause()
+            return
+        
+        lines = vm_instrument.format_report()
+        if len(lines) <= 2:
+            print_info("No libvirt calls recorded yet")
+        else:
+            print(Colors.BOLD + lines[0] + Colors.ENDC)
+            for line in lines[1:]:
+                print(line)
+            print("\nTotal calls: %d" % vm_instrument.STATS.total_calls())
+        
+        if safe_input("\nSave report to %s? (y/N): " % RPC_REPORT_FILE).lower() == "y":
+            try:
+                vm_instrument.write_report(RPC_REPORT_FILE)
+                print_success("Report written to %s" % RPC_REPORT_FILE)
+            except IOError as e:
+                print_error("Failed to write report: %s" % str(e))
+        
+        pause()
+    
     # -------------------------------------------------------------------------
     # VM LISTING
     # -------------------------------------------------------------------------
@@ -268,6 +505,7 @@ class VMManager(object):
             domains = self.conn.listAllDomains()
         except libvirt.libvirtError as e:
             print_error("Failed to list VMs: %s" % str(e))
+            logging.error("VM listing failed: %s", str(e))
             return []
         
         if not domains:
@@ -363,53 +601,81 @@ class VMManager(object):
             vcpus = int(safe_input("Virtual CPUs [1]: ") or "1")
             disk_size = int(safe_input("Disk Size (GB) [10]: ") or "10")
             
-            iso_path = safe_input("Installation ISO path: ")
-            if not iso_path or not os.path.exists(iso_path):
-                print_error("ISO file not found: %s" % iso_path)
-                pause()
-                return
-                
         except ValueError:
             print_error("Invalid numeric input!")
             pause()
             return
         
-        # Create disk image
-        print_info("Creating disk image...")
-        disk_path = "%s/%s.qcow2" % (DISK_IMAGE_DIR, vm_name)
-        
-        cmd = "qemu-img create -f qcow2 %s %dG" % (disk_path, disk_size)
-        if os.system(cmd) != 0:
-            print_error("Failed to create disk image!")
+        # Pick the base image and ISO from the image library
+        try:
+            images = vm_images.load_index()
+            if images:
+                print("\n" + Colors.BOLD + "Image library:" + Colors.ENDC)
+                for line in vm_images.format_images(images)[2:]:
+                    print("  " + line)
+            else:
+                print_info("Image library is empty; index it with "
+                           "'python vm_images.py update'")
+            
+            base = safe_input("\nBase image (name, empty for a blank disk): ")
+            base_image = (vm_images.resolve(images, base, "base")
+                          if base else None)
+            iso = safe_input("Installation ISO (name or path%s): " %
+                             (", empty for none" if base_image else ""))
+            if not iso and not base_image:
+                print_error("An installation ISO or a base image is required")
+                pause()
+                return
+            iso_path = vm_images.resolve(images, iso, "iso") if iso else None
+            
+        except ValueError as e:
+            print_error(str(e))
             pause()
             return
         
-        print_success("Disk image created: %s" % disk_path)
-        
-        # Generate VM XML definition
-        xml = self._generate_vm_xml(vm_name, memory, vcpus, disk_path, iso_path)
-        
-        # Define and optionally start VM
+        # Create disk image and define the VM
+        print_info("Creating disk image...")
         try:
-            dom = self.conn.defineXML(xml)
+            dom = self.define_domain(vm_name, memory, vcpus, disk_size, iso_path,
+                                     base_image)
+            print_success("Disk image created: %s" %
+                          self.disk_image_path(vm_name))
             print_success("VM '%s' created successfully!" % vm_name)
-            logging.info("VM created: %s (Memory: %dMB, vCPUs: %d)", 
-                        vm_name, memory, vcpus)
             
             # Ask to start VM
             start_now = safe_input("\nStart VM now? (y/N): ").lower()
             if start_now == "y":
-                dom.create()
+                self.start_domain(dom)
                 print_success("VM '%s' started!" % vm_name)
-                logging.info("VM started: %s", vm_name)
             
+        except OSError as e:
+            print_error("Failed to create disk image: %s" % str(e))
         except libvirt.libvirtError as e:
             print_error("Failed to create VM: %s" % str(e))
-            logging.error("VM creation failed: %s - %s", vm_name, str(e))
         
         pause()
     
     
+    def _create_disk_image(self, disk_path, size_gb, backing_file=None):
+        """
+        Create a qcow2 disk image
+        
+        Args:
+            disk_path: Path of the image to create
+            size_gb: Virtual size in GB
+            backing_file: Optional base image; the new image is an overlay
+            
+        Returns:
+            True on success
+        """
+        backing = ""
+        if backing_file:
+            fmt = "qcow2" if vm_diskmaint.read_qcow2_header(backing_file) else "raw"
+            backing = "-b %s -F %s " % (backing_file, fmt)
+        cmd = "qemu-img create -f qcow2 %s%s %dG" % (backing, disk_path, size_gb)
+        return os.system(cmd) == 0
+    
+    
     def _generate_vm_xml(self, name, memory, vcpus, disk_path, iso_path):
         """
         Generate XML definition for a new VM
@@ -419,15 +685,27 @@ class VMManager(object):
             memory: Memory in MB
             vcpus: Number of virtual CPUs
             disk_path: Path to disk image
-            iso_path: Path to installation ISO
+            iso_path: Path to installation ISO, or None for an empty drive
             
         Returns:
             XML string for VM definition
         """
+        # Leave room to grow vCPUs and memory without redefining the VM
+        max_vcpus, max_memory = vm_resize.headroom(vcpus, memory,
+                                                   self.conn.getInfo()[2])
+        
+        # One virtio-net queue pair per vCPU
+        queues = vm_netqos.queues_for(vcpus)
+        driver = ("\n      <driver name='vhost' queues='%d'/>" % queues
+                  if queues > 1 else "")
+        iso_source = ("\n      <source file='%s'/>" % iso_path
+                      if iso_path else "")
+        
         xml = """<domain type='kvm'>
   <name>%s</name>
   <memory unit='MiB'>%d</memory>
-  <vcpu>%d</vcpu>
+  <currentMemory unit='MiB'>%d</currentMemory>
+  <vcpu current='%d'>%d</vcpu>
   <os>
     <type arch='x86_64'>hvm</type>
     <boot dev='cdrom'/>
@@ -441,30 +719,141 @@ class VMManager(object):
   <devices>
     <emulator>%s</emulator>
     <disk type='file' device='disk'>
-      <driver name='qemu' type='qcow2'/>
+      <driver name='qemu' type='qcow2' discard='unmap'/>
       <source file='%s'/>
       <target dev='vda' bus='virtio'/>
     </disk>
     <disk type='file' device='cdrom'>
-      <driver name='qemu' type='raw'/>
-      <source file='%s'/>
+      <driver name='qemu' type='raw'/>%s
       <target dev='hdc' bus='ide'/>
       <readonly/>
     </disk>
     <interface type='bridge'>
       <source bridge='%s'/>
-      <model type='virtio'/>
+      <model type='virtio'/>%s
     </interface>
     <graphics type='vnc' port='-1' autoport='yes'/>
     <console type='pty'/>
     <input type='mouse' bus='ps2'/>
     <input type='keyboard' bus='ps2'/>
   </devices>
-</domain>""" % (name, memory, vcpus, QEMU_EMULATOR, disk_path, 
-               iso_path, DEFAULT_BRIDGE)
+</domain>""" % (name, max_memory, memory, vcpus, max_vcpus, QEMU_EMULATOR, disk_path, 
+               iso_source, DEFAULT_BRIDGE, driver)
         
         return xml
     
+    # -------------------------------------------------------------------------
+    # CORE OPERATIONS
+    # -------------------------------------------------------------------------
+    # Non-interactive building blocks shared by the menu and the full-screen
+    # interface. They raise libvirt.libvirtError (or OSError for files).
+    
+    def disk_image_path(self, name):
+        """Return the path of the disk image created for a new VM"""
+        return "%s/%s.qcow2" % (DISK_IMAGE_DIR, name)
+    
+    
+    def define_domain(self, name, memory, vcpus, disk_gb, iso_path=None,
+                      base_image=None):
+        """
+        Create the disk image of a new VM and define it (not started)
+        
+        Args:
+            name: VM name
+            memory: Memory in MB
+            vcpus: Number of virtual CPUs
+            disk_gb: Disk size in GB
+            iso_path: Installation ISO, or None
+            base_image: Base image the disk is an overlay of, or None
+            
+        Returns:
+            The defined libvirt domain
+            
+        Raises:
+            OSError: The disk image could not be created
+        """
+        disk_path = self.disk_image_path(name)
+        if not self._create_disk_image(disk_path, disk_gb, base_image):
+            raise OSError("qemu-img failed to create %s" % disk_path)
+        xml = self._generate_vm_xml(name, memory, vcpus, disk_path, iso_path)
+        with vm_oplog.operation("create", host=self.hostname, name=name,
+                                memory_mb=memory, vcpus=vcpus):
+            return self.conn.defineXML(xml)
+    
+    
+    def start_domain(self, dom):
+        """Start a stopped domain"""
+        with vm_oplog.operation("start", dom, self.hostname):
+            dom.create()
+    
+    
+    def jobs(self):
+        """Return the job supervisor of the connection"""
+        return vm_jobs.get_supervisor(self.conn, self.hostname)
+    
+    
+    def shutdown_domain(self, dom):
+        """Ask a running domain to shut down (ACPI)"""
+        with vm_oplog.operation("shutdown", dom, self.hostname):
+            dom.shutdown()
+        self.jobs().watch("shutdown", dom)
+    
+    
+    def destroy_domain(self, dom):
+        """Force off a running domain"""
+        with vm_oplog.operation("destroy", dom, self.hostname):
+            dom.destroy()
+    
+    
+    def suspend_domain(self, dom):
+        """Pause a running domain"""
+        with vm_oplog.operation("suspend", dom, self.hostname):
+            # abortJob cannot cancel a suspend; a hang is only reported
+            with self.jobs().track("suspend", dom, abortable=False):
+                dom.suspend()
+    
+    
+    def resume_domain(self, dom):
+        """Resume a paused domain"""
+        with vm_oplog.operation("resume", dom, self.hostname):
+            with self.jobs().track("resume", dom, abortable=False):
+                dom.resume()
+    
+    
+    def disk_paths(self, dom):
+        """Return the qcow2 disk image paths of a domain"""
+        return [d["source"] for d in vm_domxml.disks(dom.XMLDesc(0))
+                if d["device"] == "disk" and d["format"] == "qcow2" and d["source"]]
+    
+    
+    def remove_disk(self, disk_path):
+        """Delete a disk image file"""
+        with vm_oplog.operation("delete_disk", host=self.hostname, path=disk_path):
+            os.remove(disk_path)
+    
+    
+    def delete_domain(self, dom, delete_disks=False):
+        """
+        Undefine a stopped domain
+        
+        Args:
+            dom: libvirt domain
+            delete_disks: Also remove its qcow2 disk images
+            
+        Returns:
+            List of removed disk paths
+        """
+        disk_paths = self.disk_paths(dom)
+        with vm_oplog.operation("delete", dom, self.hostname):
+            dom.undefine()
+        removed = []
+        if delete_disks:
+            for disk_path in disk_paths:
+                if os.path.exists(disk_path):
+                    self.remove_disk(disk_path)
+                    removed.append(disk_path)
+        return removed
+    
     # -------------------------------------------------------------------------
     # VM LIFECYCLE OPERATIONS
     # -------------------------------------------------------------------------
@@ -488,9 +877,8 @@ class VMManager(object):
             state = dom.state()[0]
             
             if state == libvirt.VIR_DOMAIN_SHUTOFF:
-                dom.create()
+                self.start_domain(dom)
                 print_success("VM '%s' started successfully!" % vm_name)
-                logging.info("VM started: %s", vm_name)
             elif state == libvirt.VIR_DOMAIN_RUNNING:
                 print_warning("VM '%s' is already running." % vm_name)
             elif state == libvirt.VIR_DOMAIN_PAUSED:
@@ -501,7 +889,6 @@ class VMManager(object):
                 
         except libvirt.libvirtError as e:
             print_error("Failed to start VM: %s" % str(e))
-            logging.error("VM start failed: %s - %s", vm_name, str(e))
         
         pause()
     
@@ -533,22 +920,31 @@ class VMManager(object):
             print("\n" + Colors.BOLD + "Shutdown Method:" + Colors.ENDC)
             print("  [1] Graceful shutdown (ACPI)")
             print("  [2] Force stop (destroy)")
+            print("  [3] Graceful shutdown, force stop after %ds" % SHUTDOWN_TIMEOUT)
             
             choice = safe_input("\nChoice [1]: ") or "1"
             
-            if choice == "2":
-                dom.destroy()
+            if choice == "3":
+                print_info("Waiting for '%s' to shut down..." % vm_name)
+                coordinator = vm_shutdown.ShutdownCoordinator(
+                    self.conn, SHUTDOWN_TIMEOUT, host=self.hostname)
+                result = coordinator.run([dom])[0]
+                if result.outcome == "shutdown":
+                    print_success("VM '%s' shut down in %.1fs" % (vm_name, result.seconds))
+                elif result.outcome == "destroyed":
+                    print_warning("VM '%s' did not shut down, forcefully stopped" % vm_name)
+                else:
+                    print_error("Failed to stop VM: %s" % result.error)
+            elif choice == "2":
+                self.destroy_domain(dom)
                 print_success("VM '%s' forcefully stopped!" % vm_name)
-                logging.info("VM force stopped: %s", vm_name)
             else:
-                dom.shutdown()
+                self.shutdown_domain(dom)
                 print_success("VM '%s' shutdown initiated..." % vm_name)
                 print_info("VM will shutdown gracefully")
-                logging.info("VM shutdown: %s", vm_name)
                 
         except libvirt.libvirtError as e:
             print_error("Failed to stop VM: %s" % str(e))
-            logging.error("VM stop failed: %s - %s", vm_name, str(e))
         
         pause()
     
@@ -572,9 +968,8 @@ class VMManager(object):
             state = dom.state()[0]
             
             if state == libvirt.VIR_DOMAIN_RUNNING:
-                dom.suspend()
+                self.suspend_domain(dom)
                 print_success("VM '%s' suspended!" % vm_name)
-                logging.info("VM suspended: %s", vm_name)
             elif state == libvirt.VIR_DOMAIN_PAUSED:
                 print_warning("VM '%s' is already suspended." % vm_name)
             else:
@@ -582,7 +977,6 @@ class VMManager(object):
                 
         except libvirt.libvirtError as e:
             print_error("Failed to suspend VM: %s" % str(e))
-            logging.error("VM suspend failed: %s - %s", vm_name, str(e))
         
         pause()
     
@@ -606,9 +1000,8 @@ class VMManager(object):
             state = dom.state()[0]
             
             if state == libvirt.VIR_DOMAIN_PAUSED:
-                dom.resume()
+                self.resume_domain(dom)
                 print_success("VM '%s' resumed!" % vm_name)
-                logging.info("VM resumed: %s", vm_name)
             elif state == libvirt.VIR_DOMAIN_RUNNING:
                 print_warning("VM '%s' is already running." % vm_name)
             else:
@@ -616,7 +1009,6 @@ class VMManager(object):
                 
         except libvirt.libvirtError as e:
             print_error("Failed to resume VM: %s" % str(e))
-            logging.error("VM resume failed: %s - %s", vm_name, str(e))
         
         pause()
     
@@ -644,7 +1036,7 @@ class VMManager(object):
                 stop_first = safe_input("Stop VM before deletion? (y/N): ").lower()
                 if stop_first == "y":
                     try:
-                        dom.destroy()
+                        self.destroy_domain(dom)
                         print_info("VM stopped")
                     except libvirt.libvirtError as e:
                         print_error("Failed to stop VM: %s" % str(e))
@@ -656,15 +1048,7 @@ class VMManager(object):
                     return
             
             # Get disk paths before undefining
-            disk_paths = []
-            try:
-                xml_desc = dom.XMLDesc(0)
-                # Simple XML parsing to find disk paths
-                import re
-                disk_matches = re.findall(r"<source file='([^']*\.qcow2)'/>", xml_desc)
-                disk_paths = disk_matches
-            except Exception:
-                pass
+            disk_paths = self.disk_paths(dom)
             
             # Confirm deletion
             print("\n" + Colors.YELLOW + Colors.BOLD + "WARNING: This will permanently delete the VM!" + Colors.ENDC)
@@ -681,12 +1065,10 @@ class VMManager(object):
             
             # Undefine (delete) the VM
             try:
-                dom.undefine()
+                self.delete_domain(dom)
                 print_success("VM '%s' deleted from hypervisor!" % vm_name)
-                logging.info("VM deleted: %s", vm_name)
             except libvirt.libvirtError as e:
                 print_error("Failed to delete VM: %s" % str(e))
-                logging.error("VM deletion failed: %s - %s", vm_name, str(e))
                 pause()
                 return
             
@@ -697,12 +1079,10 @@ class VMManager(object):
                     for disk_path in disk_paths:
                         if os.path.exists(disk_path):
                             try:
-                                os.remove(disk_path)
+                                self.remove_disk(disk_path)
                                 print_success("Deleted disk: %s" % disk_path)
-                                logging.info("Deleted disk: %s", disk_path)
                             except OSError as e:
                                 print_error("Failed to delete disk %s: %s" % (disk_path, str(e)))
-                                logging.error("Disk deletion failed: %s - %s", disk_path, str(e))
                         else:
                             print_warning("Disk not found: %s" % disk_path)
                 else:
@@ -710,6 +1090,729 @@ class VMManager(object):
             
         except libvirt.libvirtError as e:
             print_error("VM not found: %s" % str(e))
+            logging.error("VM delete lookup failed: %s - %s", vm_name, str(e))
+        
+        pause()
+    
+    # -------------------------------------------------------------------------
+    # FLEET OPERATIONS
+    # -------------------------------------------------------------------------
+    
+    def shutdown_all_vms(self):
+        """Gracefully shut down every running VM, e.g. before a host reboot"""
+        clear_screen()
+        print_header("Shut Down All Virtual Machines", Colors.RED)
+        
+        try:
+            domains = self.conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        except libvirt.libvirtError as e:
+            print_error("Failed to list VMs: %s" % str(e))
+            logging.error("VM listing failed: %s", str(e))
+            pause()
+            return
+        
+        if not domains:
+            print_info("No running virtual machines.")
+            pause()
+            return
+        
+        print_info("%d running VM(s) will be shut down" % len(domains))
+        try:
+            timeout = int(safe_input("Seconds per VM before escalating [%d]: " %
+                                     SHUTDOWN_TIMEOUT) or SHUTDOWN_TIMEOUT)
+        except ValueError:
+            print_error("Invalid numeric input!")
+            pause()
+            return
+        
+        print("\n" + Colors.BOLD + "After the deadline:" + Colors.ENDC)
+        print("  [1] Force stop (destroy)")
+        print("  [2] Managed save (state is restored on next start)")
+        escalation = vm_shutdown.ESCALATE_SAVE if safe_input("\nChoice [1]: ") == "2" \
+            else vm_shutdown.ESCALATE_DESTROY
+        
+        if safe_input("\nShut down %d VM(s) now? (y/N): " % len(domains)).lower() != "y":
+            print_info("Cancelled")
+            pause()
+            return
+        
+        def progress(result):
+            print("  %-30s %-10s %.1fs" % (result.name, result.outcome, result.seconds))
+        
+        print("")
+        coordinator = vm_shutdown.ShutdownCoordinator(
+            self.conn, timeout, escalation, host=self.hostname)
+        results = coordinator.run(domains, progress)
+        
+        print("")
+        for line in vm_shutdown.format_results(results):
+            print(line)
+        failed = [r for r in results if r.outcome == "failed"]
+        if failed:
+            print_error("%d VM(s) could not be stopped" % len(failed))
+        else:
+            print_success("All VMs stopped")
+        
+        pause()
+    
+    def hibernate_vms(self):
+        """Managed-save all running VMs so their state survives a host reboot"""
+        clear_screen()
+        print_header("Hibernate Virtual Machines", Colors.YELLOW)
+        
+        print_info("Save image format: %s" % vm_hibernate.read_save_image_format())
+        try:
+            concurrency = int(safe_input("Parallel saves [%d]: " %
+                                         vm_hibernate.SAVE_CONCURRENCY)
+                              or vm_hibernate.SAVE_CONCURRENCY)
+        except ValueError:
+            print_error("Invalid numeric input!")
+            pause()
+            return
+        if concurrency < 1:
+            print_error("Parallel saves must be at least 1!")
+            pause()
+            return
+        
+        if safe_input("\nSave and stop all running VMs? (y/N): ").lower() != "y":
+            print_info("Cancelled")
+            pause()
+            return
+        
+        def progress(result):
+            print("  %-30s %-9s %.1fs" % (result.name, result.outcome, result.seconds))
+        
+        print("")
+        try:
+            results = vm_hibernate.hibernate(self.conn, concurrency,
+                                             host=self.hostname, progress=progress)
+        except libvirt.libvirtError as e:
+            print_error("Hibernation failed: %s" % str(e))
+            logging.error("Hibernation failed: %s", str(e))
+            pause()
+            return
+        
+        if not results:
+            print_info("No running virtual machines.")
+        else:
+            print("")
+            for line in vm_hibernate.format_results(results):
+                print(line)
+            print_success("State saved; restore with option [r] after the reboot")
+        
+        pause()
+    
+    
+    def restore_vms(self):
+        """Restore hibernated VMs in priority order"""
+        clear_screen()
+        print_header("Restore Hibernated Virtual Machines", Colors.GREEN)
+        
+        def progress(result):
+            print("  [%3d] %-30s %-9s %.1fs" % (result.priority, result.name,
+                                               result.outcome, result.seconds))
+        
+        try:
+            results = vm_hibernate.restore(self.conn, host=self.hostname,
+                                           progress=progress)
+        except (libvirt.libvirtError, IOError, ValueError) as e:
+            print_error("Restore failed: %s" % str(e))
+            logging.error("Restore failed: %s", str(e))
+            pause()
+            return
+        
+        if not results:
+            print_info("No VMs with a managed save image.")
+        else:
+            print("")
+            for line in vm_hibernate.format_results(results):
+                print(line)
+        
+        pause()
+    
+    def boot_vms(self):
+        """Start managed-autostart VMs by priority wave with throttling"""
+        clear_screen()
+        print_header("Boot Virtual Machines In Order", Colors.GREEN)
+        
+        try:
+            cfg = vm_boot.boot_config()
+            names = [d.name() for d in self.conn.listAllDomains()
+                     if vm_boot.is_managed(d.name())]
+            waves = vm_boot.plan_boot(names, cfg["depends"])
+        except (libvirt.libvirtError, ValueError) as e:
+            print_error("Failed to plan boot order: %s" % str(e))
+            logging.error("Boot planning failed: %s", str(e))
+            pause()
+            return
+        
+        if not waves:
+            print_warning("No VMs under managed autostart (see option [u])")
+            pause()
+            return
+        
+        print(Colors.BOLD + "Boot plan:" + Colors.ENDC)
+        for wave, wave_names in waves:
+            print("  Wave %-4d %s" % (wave, ", ".join(wave_names)))
+        print("\nUp to %d VMs start at once, readiness: %s" %
+              (cfg["max_concurrent"], cfg["readiness"]))
+        
+        if safe_input("\nStart now? (y/N): ").lower() != "y":
+            print_info("Cancelled")
+            pause()
+            return
+        
+        def progress(result):
+            print("  [%3d] %-30s %s" % (result.wave, result.name, result.outcome))
+        
+        print("")
+        orchestrator = vm_boot.BootOrchestrator(
+            self.conn, cfg["max_concurrent"], cfg["readiness"],
+            cfg["ready_timeout"], self.hostname)
+        results = orchestrator.run(waves, cfg["depends"], progress)
+        
+        print("")
+        for line in vm_boot.format_results(results):
+            print(line)
+        
+        pause()
+    
+    
+    def manage_autostart(self):
+        """Add or remove VMs from managed autostart"""
+        clear_screen()
+        print_header("Managed Autostart", Colors.BLUE)
+        
+        domains = self.list_vms()
+        if not domains:
+            pause()
+            return
+        
+        managed = [d.name() for d in domains if vm_boot.is_managed(d.name())]
+        print("\n" + Colors.BOLD + "Managed autostart:" + Colors.ENDC + " %s" %
+              (", ".join(managed) or "none"))
+        
+        print("\n  [1] Enable managed autostart for a VM")
+        print("  [2] Disable managed autostart for a VM")
+        print("  [3] Take over all libvirt autostart VMs")
+        choice = safe_input("\nChoice: ")
+        
+        try:
+            if choice in ("1", "2"):
+                vm_name = safe_input(Colors.BOLD + "VM name: " + Colors.ENDC)
+                if not vm_name:
+                    return
+                vm_boot.set_managed(self.conn, vm_name, choice == "1")
+                print_success("Managed autostart %s for '%s'" %
+                              ("enabled" if choice == "1" else "disabled", vm_name))
+            elif choice == "3":
+                taken = vm_boot.take_over_autostart(self.conn)
+                print_success("Took over %d VM(s): %s" % (len(taken), ", ".join(taken)))
+        except (libvirt.libvirtError, IOError) as e:
+            print_error("Failed to update autostart: %s" % str(e))
+            logging.error("Autostart update failed: %s", str(e))
+        
+        pause()
+    
+    
+    def run_agent_command(self):
+        """Run a guest agent command on several running VMs at once"""
+        clear_screen()
+        print_header("Guest Agent Command", Colors.BLUE)
+        
+        domains = self.list_vms()
+        if not domains:
+            pause()
+            return
+        
+        selector = safe_input("\n" + Colors.BOLD + "VMs (name, pattern or all): "
+                              + Colors.ENDC)
+        if not selector:
+            return
+        command = safe_input("Command [%s]: " % ", ".join(sorted(vm_agent.COMMANDS)))
+        if not command:
+            return
+        program = None
+        if command == "exec":
+            program = safe_input("Program and arguments: ").split()
+        
+        try:
+            selected = vm_select.select(self.conn, selector + " state=running")
+            if not selected:
+                print_warning("No running VMs match '%s'" % selector)
+                pause()
+                return
+            
+            print("")
+            failed = 0
+            for result in vm_agent.run(selected, command, program,
+                                       health=vm_agent.AgentHealth(),
+                                       host=self.hostname):
+                for line in vm_agent.format_result(result):
+                    print("  " + line)
+                if result.outcome != "ok":
+                    failed += 1
+            
+            if failed:
+                print_warning("\n%d of %d VM(s) did not succeed" %
+                              (failed, len(selected)))
+            else:
+                print_success("\nCommand succeeded on %d VM(s)" % len(selected))
+            
+        except ValueError as e:
+            print_error("Invalid input: %s" % str(e))
+        except libvirt.libvirtError as e:
+            print_error("Agent command failed: %s" % str(e))
+        
+        pause()
+    
+    
+    def watch_crashes(self):
+        """Run the crash watchdog in the foreground until Ctrl-C"""
+        clear_screen()
+        print_header("Crash Watchdog", Colors.RED)
+        
+        cfg = vm_watchdog.watchdog_config()
+        print("  Watched VMs:   %s" % ", ".join(cfg["vms"]))
+        print("  Core dumps:    %s" % (", ".join(cfg["core_dump"]) or "none"))
+        print("  Flap limit:    %d restarts in %d s" %
+              (cfg["max_restarts"], cfg["flap_window"]))
+        
+        def report(result):
+            line = vm_watchdog.format_result(result)
+            if result.outcome == "restarted":
+                print_success(line)
+            else:
+                print_error(line)
+        
+        watchdog = vm_watchdog.Watchdog(self.conn, host=self.hostname,
+                                        on_result=report)
+        try:
+            watchdog.start()
+        except (RuntimeError, libvirt.libvirtError) as e:
+            print_error("Cannot start the watchdog: %s" % str(e))
+            pause()
+            return
+        
+        print_info("\nWatching for crashes, press Ctrl-C to stop\n")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watchdog.stop()
+        
+        print("\n%d recoveries" % len(watchdog.history))
+        pause()
+    
+    
+    def reconcile_fleet(self):
+        """Show and apply the changes needed to match the desired-state file"""
+        clear_screen()
+        print_header("Reconcile Desired State", Colors.BLUE)
+        
+        path = safe_input("Desired-state file [%s]: " %
+                          vm_reconcile.FLEET_FILE) or vm_reconcile.FLEET_FILE
+        inventory = vm_inventory.Inventory(self.conn)
+        reconciler = vm_reconcile.Reconciler(self, inventory, path)
+        try:
+            reconciler.load()
+            inventory.refresh()
+            actions = reconciler.plan()
+        except (IOError, OSError, ValueError, libvirt.libvirtError) as e:
+            print_error("Cannot plan: %s" % str(e))
+            inventory.stop()
+            pause()
+            return
+        
+        print("")
+        for line in vm_reconcile.format_plan(actions):
+            print(line)
+        
+        if actions and safe_input("\nApply these changes? (y/N): ").lower() == "y":
+            print("")
+            failed = 0
+            for action, error in reconciler.apply(actions):
+                print(vm_reconcile.format_step(action, error))
+                if error:
+                    failed += 1
+            if failed:
+                print_warning("\n%d step(s) failed" % failed)
+            else:
+                print_success("\nFleet reconciled")
+        
+        inventory.stop()
+        pause()
+    
+    # -------------------------------------------------------------------------
+    # PERFORMANCE TUNING
+    # -------------------------------------------------------------------------
+    
+    def set_cpu_classes(self):
+        """Apply CPU scheduling classes and show CPU use against entitlement"""
+        clear_screen()
+        print_header("CPU Scheduling", Colors.BLUE)
+        
+        print("  [1] Apply a class to VMs")
+        print("  [2] Apply configured classes to all VMs")
+        print("  [3] CPU use vs entitlement")
+        choice = safe_input("\nChoice: ")
+        
+        try:
+            if choice == "3":
+                print_info("Sampling for 5 seconds...")
+                for line in vm_cpusched.format_report(
+                        vm_cpusched.report(self.conn)):
+                    print("  " + line)
+                pause()
+                return
+            if choice == "1":
+                domains = self.list_vms()
+                if not domains:
+                    pause()
+                    return
+                selector = safe_input("\n" + Colors.BOLD + "VMs (name, pattern or all): "
+                                      + Colors.ENDC)
+                if not selector:
+                    return
+                class_name = safe_input("Class [%s]: " %
+                                        ", ".join(sorted(vm_cpusched.classes())))
+                if not class_name:
+                    return
+            elif choice == "2":
+                selector, class_name = "all", None
+            else:
+                return
+            
+            for name, cls, error in vm_cpusched.apply(
+                    vm_select.select(self.conn, selector), class_name,
+                    self.hostname):
+                if error:
+                    print_error("%s (%s): %s" % (name, cls, error))
+                elif cls:
+                    print_success("%s: %s" % (name, cls))
+            
+        except ValueError as e:
+            print_error("Invalid input: %s" % str(e))
+        except libvirt.libvirtError as e:
+            print_error("Failed to update CPU scheduling: %s" % str(e))
+        
+        pause()
+    
+    
+    def set_io_limits(self):
+        """Show and change the disk I/O limits and blkio weight of a VM"""
+        clear_screen()
+        print_header("Disk I/O Limits", Colors.BLUE)
+        
+        domains = self.list_vms()
+        if not domains:
+            pause()
+            return
+        
+        vm_name = safe_input("\n" + Colors.BOLD + "VM name: " + Colors.ENDC)
+        if not vm_name:
+            return
+        
+        try:
+            dom = self.conn.lookupByName(vm_name)
+            qos = vm_ioqos.get_qos(dom)
+            
+            print("\n" + Colors.BOLD + "Current settings:" + Colors.ENDC)
+            print("  blkio weight: %s" % qos["weight"])
+            for disk, limits in sorted(qos["disks"].items()):
+                print("  %-6s %s" % (disk, ", ".join("%s=%s" % kv for kv in
+                                                   sorted(limits.items())) or "no limits"))
+            
+            disk = safe_input("\nDisk [%s]: " % ", ".join(sorted(qos["disks"])))
+            if disk and disk not in qos["disks"]:
+                print_error("Unknown disk: %s" % disk)
+                pause()
+                return
+            
+            print_info("Leave empty to keep, 0 to remove a limit")
+            limits = {}
+            for key, prompt in (("total_iops_sec", "Max IOPS"),
+                                ("total_iops_sec_max", "Burst IOPS"),
+                                ("total_iops_sec_max_length", "Burst length (s)"),
+                                ("total_bytes_sec", "Max bandwidth (MB/s)")):
+                value = safe_input("%s: " % prompt)
+                if value:
+                    limits[key] = int(value) * (1048576 if key == "total_bytes_sec" else 1)
+            weight = safe_input("blkio weight (%d-%d): " %
+                                (vm_ioqos.MIN_WEIGHT, vm_ioqos.MAX_WEIGHT))
+            
+            with vm_oplog.operation("io_qos", dom, self.hostname):
+                if weight:
+                    vm_ioqos.set_weight(dom, weight)
+                if limits:
+                    for target in ([disk] if disk else sorted(qos["disks"])):
+                        vm_ioqos.set_limits(dom, target, limits)
+            print_success("I/O settings of '%s' updated" % vm_name)
+            
+        except ValueError as e:
+            print_error("Invalid input: %s" % str(e))
+        except libvirt.libvirtError as e:
+            print_error("Failed to update I/O settings: %s" % str(e))
+        
+        pause()
+    
+    
+    def maintain_disks(self):
+        """Survey disk images and reclaim space from bloated ones"""
+        clear_screen()
+        print_header("Disk Image Maintenance", Colors.BLUE)
+        
+        try:
+            entries = vm_diskmaint.survey(self.conn)
+            for line in vm_diskmaint.format_survey(entries):
+                print("  " + line)
+            
+            candidates = [e for e in entries if e["reason"]]
+            if not candidates:
+                print_success("\nNo image needs maintenance")
+                pause()
+                return
+            
+            print("\n  [1] Trim running VMs (guest agent)")
+            print("  [2] Compact images of stopped VMs")
+            print("  [3] Compact images of stopped VMs (compressed)")
+            choice = safe_input("\nChoice: ")
+            
+            if choice == "1":
+                names = sorted(set(e["domain"] for e in candidates
+                                   if e["active"]))
+                results = [vm_diskmaint.trim(self.conn.lookupByName(n),
+                                             self.hostname) for n in names]
+            elif choice in ("2", "3"):
+                print_info("Compacting in the background at idle priority...")
+                results = vm_diskmaint.compact_candidates(
+                    self.conn, entries, compress=(choice == "3"),
+                    progress=lambda r: print_info("Done: %s" % r.path))
+            else:
+                return
+            
+            print("")
+            for line in vm_diskmaint.format_results(results):
+                print("  " + line)
+            
+        except libvirt.libvirtError as e:
+            print_error("Disk maintenance failed: %s" % str(e))
+        
+        pause()
+    
+    
+    def move_storage(self):
+        """Move the disks of a VM, or rebalance disk I/O across locations"""
+        clear_screen()
+        print_header("Move VM Storage", Colors.BLUE)
+        
+        print("  [1] Move a VM's disks to another directory or pool")
+        print("  [2] Rebalance disk I/O across directories or pools")
+        choice = safe_input("\nChoice: ")
+        if choice not in ("1", "2"):
+            return
+        
+        def show(result, cur, end):
+            if end:
+                sys.stdout.write("\r  %s %s: %5.1f%%" %
+                                 (result.name, result.target, 100.0 * cur / end))
+                sys.stdout.flush()
+        
+        try:
+            if choice == "1":
+                domains = self.list_vms()
+                if not domains:
+                    pause()
+                    return
+                vm_name = safe_input("\n" + Colors.BOLD + "VM name: " + Colors.ENDC)
+                location = safe_input("Destination directory or pool: ")
+                if not vm_name or not location:
+                    return
+                bandwidth = safe_input("Bandwidth MB/s [%d, 0 = unlimited]: " %
+                                       vm_storagemove.BANDWIDTH_MBPS)
+                directory = vm_storagemove.resolve_location(self.conn, location)
+                results = vm_storagemove.move_domain(
+                    self.conn, self.conn.lookupByName(vm_name), directory,
+                    bandwidth_mbps=float(bandwidth or vm_storagemove.BANDWIDTH_MBPS),
+                    progress=show, host=self.hostname)
+                if not results:
+                    print_info("No disk to move")
+                    pause()
+                    return
+            else:
+                locations = safe_input("Directories or pools (space separated): ")
+                if len(locations.split()) < 2:
+                    print_warning("Give at least two locations")
+                    pause()
+                    return
+                directories = [vm_storagemove.resolve_location(self.conn, l)
+                               for l in locations.split()]
+                print_info("Sampling disk I/O for %.0f seconds..." %
+                           vm_storagemove.SAMPLE_INTERVAL)
+                moves = vm_storagemove.plan_rebalance(
+                    vm_storagemove.sample_disk_io(self.conn), directories)
+                if not moves:
+                    print_success("Locations are balanced")
+                    pause()
+                    return
+                print("")
+                for s, src, dest in moves:
+                    print("  %-24s %-5s %8.0f IOPS  %s -> %s" %
+                          (s["name"][:24], s["target"], s["iops"], src, dest))
+                confirm = safe_input("\nMove these disks? (y/N): ").lower()
+                if confirm != "y":
+                    return
+                results = vm_storagemove.run_moves(
+                    self.conn, [(s["name"], s["target"], dest)
+                                for s, _, dest in moves],
+                    progress=show, host=self.hostname)
+            
+            print("\n")
+            for line in vm_storagemove.format_results(results):
+                print("  " + line)
+            
+        except ValueError as e:
+            print_error("Invalid input: %s" % str(e))
+        except (libvirt.libvirtError, OSError) as e:
+            print_error("Storage move failed: %s" % str(e))
+        
+        pause()
+    
+    
+    def set_network_qos(self):
+        """Show and change the bandwidth limits and multiqueue of a VM"""
+        clear_screen()
+        print_header("Network Bandwidth", Colors.BLUE)
+        
+        print("  [1] Set limits of a VM")
+        print("  [2] Enable multiqueue for a VM")
+        print("  [3] Apply configured classes to all VMs")
+        print("  [4] Measure interface rates")
+        choice = safe_input("\nChoice: ")
+        
+        try:
+            if choice == "3":
+                for name, class_name, error in vm_netqos.apply_configured(
+                        self.conn, self.hostname):
+                    if error:
+                        print_error("%s (%s): %s" % (name, class_name, error))
+                    else:
+                        print_success("%s: %s" % (name, class_name))
+                pause()
+                return
+            if choice == "4":
+                print_info("Sampling for 5 seconds...")
+                for line in vm_netqos.rate_report(self.conn):
+                    print("  " + line)
+                pause()
+                return
+            if choice not in ("1", "2"):
+                return
+            
+            domains = self.list_vms()
+            if not domains:
+                pause()
+                return
+            vm_name = safe_input("\n" + Colors.BOLD + "VM name: " + Colors.ENDC)
+            if not vm_name:
+                return
+            dom = self.conn.lookupByName(vm_name)
+            
+            if choice == "2":
+                with vm_oplog.operation("net_multiqueue", dom, self.hostname):
+                    changed = vm_netqos.set_multiqueue(self.conn, dom)
+                if changed:
+                    print_success("Multiqueue set on %d interface(s); "
+                                  "takes effect at next start" % changed)
+                else:
+                    print_info("Multiqueue already matches the vCPU count")
+                pause()
+                return
+            
+            print("\n" + Colors.BOLD + "Current limits:" + Colors.ENDC)
+            for mac, limits in sorted(vm_netqos.get_bandwidth(dom).items()):
+                print("  %s %s" % (mac, ", ".join("%s=%s" % kv for kv in
+                                               sorted(limits.items())) or "no limits"))
+            
+            classes = sorted(vm_netqos.classes())
+            class_name = safe_input("\nClass [%s] or empty for custom: " %
+                                    ", ".join(classes))
+            with vm_oplog.operation("net_qos", dom, self.hostname,
+                                    net_class=class_name or "custom"):
+                if class_name:
+                    vm_netqos.apply_class(dom, class_name)
+                else:
+                    print_info("Rates in KB/s, burst in KB; empty keeps, 0 removes")
+                    params = {}
+                    for key in vm_netqos.BANDWIDTH_KEYS:
+                        value = safe_input("%s: " % key)
+                        if value:
+                            params[key] = int(value)
+                    vm_netqos.set_all_interfaces(dom, params)
+            print_success("Network limits of '%s' updated" % vm_name)
+            
+        except ValueError as e:
+            print_error("Invalid input: %s" % str(e))
+        except libvirt.libvirtError as e:
+            print_error("Failed to update network settings: %s" % str(e))
+        
+        pause()
+    
+    
+    def resize_vms(self):
+        """Change the vCPUs and memory of one or more VMs without a restart"""
+        clear_screen()
+        print_header("Resize VMs", Colors.BLUE)
+        
+        domains = self.list_vms()
+        if not domains:
+            pause()
+            return
+        
+        print_info("Select by name or pattern, e.g. web*,db1 or all state=running")
+        selector = safe_input("\n" + Colors.BOLD + "VMs: " + Colors.ENDC)
+        if not selector:
+            return
+        vcpus = safe_input("vCPUs (N, +N, -N, empty keeps): ") or None
+        memory = safe_input("Memory MB (N, +N, -N, empty keeps): ") or None
+        if not vcpus and not memory:
+            return
+        
+        try:
+            planned = vm_resize.plan(self.conn,
+                                     vm_select.select(self.conn, selector),
+                                     vcpus, memory)
+            if not planned:
+                print_warning("No VMs match '%s'" % selector)
+                pause()
+                return
+            print("")
+            for line in vm_resize.format_results([r for _, r in planned]):
+                print("  " + line)
+            
+            confirm = safe_input("\nApply? (y/N): ").lower()
+            if confirm != "y":
+                print_info("Resize cancelled")
+                pause()
+                return
+            
+            results = vm_resize.apply(planned, self.hostname)
+            print("")
+            for line in vm_resize.format_results(results):
+                print("  " + line)
+            
+            failed = [r for r in results if r.error]
+            if failed:
+                print_warning("%d VM(s) not resized" % len(failed))
+            else:
+                print_success("Resize complete")
+            
+        except ValueError as e:
+            print_error("Invalid input: %s" % str(e))
+        except libvirt.libvirtError as e:
+            print_error("Failed to resize: %s" % str(e))
         
         pause()
     
@@ -747,6 +1850,7 @@ class VMManager(object):
             
         except libvirt.libvirtError as e:
             print_error("Failed to open console: %s" % str(e))
+            logging.error("Console launch failed: %s - %s", vm_name, str(e))
         
         pause()
     
@@ -803,11 +1907,13 @@ class VMManager(object):
                     
             except libvirt.libvirtError as e:
                 print_error("Unable to retrieve IP address")
+                logging.error("Guest agent query failed: %s - %s", vm_name, str(e))
                 print_info("Ensure qemu-guest-agent is installed and running in the VM")
                 print_info("Install with: yum install qemu-guest-agent")
                 
         except libvirt.libvirtError as e:
             print_error("VM not found: %s" % str(e))
+            logging.error("VM IP lookup failed: %s - %s", vm_name, str(e))
         
         pause()
 
@@ -816,28 +1922,18 @@ class VMManager(object):
 # MAIN PROGRAM
 # =============================================================================
 
-def main():
-    """Main program entry point"""
-    
-    # Print banner
-    clear_screen()
-    print(Colors.BLUE + Colors.BOLD)
-    print("")
-    print("    KVM VIRTUAL MACHINE MANAGER")
-    print("    RHEL 7.2 - Python 2.7")
-    print("")
-    print(Colors.ENDC)
-    
-    pause()
-    
-    # Initialize manager
-    manager = VMManager()
-    manager.connect()
+def run_classic_menu(manager, embedded=False):
+    """
+    Run the numbered menu until the user quits
     
-    # Main menu loop
+    Args:
+        manager: Connected VMManager
+        embedded: Opened from the full-screen interface; quitting returns
+            to it and leaves the connection open
+    """
     while True:
         try:
-            manager.show_menu()
+            manager.show_menu(embedded)
             choice = safe_input("\n" + Colors.BOLD + "Enter choice: " + Colors.ENDC)
             
             if choice == "0":
@@ -863,6 +1959,44 @@ def main():
                 manager.delete_vm()
             elif choice == "9":
                 manager.view_vm_console()
+            elif choice == "a":
+                manager.shutdown_all_vms()
+            elif choice == "h":
+                manager.hibernate_vms()
+            elif choice == "r":
+                manager.restore_vms()
+            elif choice == "b":
+                manager.boot_vms()
+            elif choice == "u":
+                manager.manage_autostart()
+            elif choice == "g":
+                manager.run_agent_command()
+            elif choice == "w":
+                manager.watch_crashes()
+            elif choice == "d":
+                manager.reconcile_fleet()
+            elif choice == "c":
+                manager.set_cpu_classes()
+            elif choice == "i":
+                manager.set_io_limits()
+            elif choice == "m":
+                manager.maintain_disks()
+            elif choice == "v":
+                manager.move_storage()
+            elif choice == "n":
+                manager.set_network_qos()
+            elif choice == "z":
+                manager.resize_vms()
+            elif choice == "e":
+                manager.watch_events()
+            elif choice == "l":
+                manager.show_disk_latency()
+            elif choice == "j":
+                manager.show_jobs()
+            elif choice == "s":
+                manager.show_rpc_stats()
+            elif embedded and choice in ("q", "Q"):
+                return
             elif choice == "q" or choice == "Q":
                 clear_screen()
                 print_header("Shutting Down", Colors.YELLOW)
@@ -871,18 +2005,51 @@ def main():
                 print_success("Goodbye!")
                 sys.exit(0)
             else:
-                print_error("Invalid choice! Please select 0-9 or q.")
+                print_error("Invalid choice! Please select an option from the menu.")
                 pause()
                 
         except KeyboardInterrupt:
+            if embedded:
+                return
             print("\n" + Colors.YELLOW + "Interrupted by user" + Colors.ENDC)
             manager.close()
             sys.exit(0)
         except Exception as e:
             print_error("Unexpected error: %s" % str(e))
-            logging.error("Unexpected error: %s", str(e))
+            logging.exception("Unexpected error: %s", str(e))
             pause()
 
 
+def main():
+    """Main program entry point"""
+    
+    # Full-screen interface unless asked for the menu or not on a terminal;
+    # it draws the cached inventory first and connects in the background
+    if "--classic" not in sys.argv[1:] and vm_tui.available():
+        manager = VMManager()
+        try:
+            vm_tui.run(manager, LIBVIRT_URI,
+                       lambda: run_classic_menu(manager, embedded=True))
+        finally:
+            manager.close()
+        return
+    
+    # Print banner
+    clear_screen()
+    print(Colors.BLUE + Colors.BOLD)
+    print("")
+    print("    KVM VIRTUAL MACHINE MANAGER")
+    print("    RHEL 7.2 - Python 2.7")
+    print("")
+    print(Colors.ENDC)
+    
+    # Initialize manager
+    manager = VMManager()
+    manager.connect()
+    
+    # Main menu loop
+    run_classic_menu(manager)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Consolidation planning on synthetic fleets"""
+
+import unittest
+
+try:
+    import vm_consolidate
+except ImportError:     # libvirt binding not installed
+    vm_consolidate = None
+
+
+@unittest.skipIf(vm_consolidate is None, "libvirt python binding not installed")
+class PlanConsolidationTest(unittest.TestCase):
+
+    def fleet(self, hosts=12, vms=300, seed=1):
+        return vm_consolidate.synthetic_fleet(hosts, vms, seed, {})
+
+    def placement(self, hosts):
+        return dict((vm.uuid, host.uri) for host in hosts
+                    for vm in host.vms.values())
+
+    def test_drains_hosts(self):
+        hosts = self.fleet()
+        before = self.placement(hosts)
+        migrations, drained = vm_consolidate.plan_consolidation(hosts)
+        self.assertTrue(drained)
+        for host in drained:
+            self.assertEqual(host.vms, {})
+        # Every VM is still placed exactly once
+        self.assertEqual(set(self.placement(hosts)), set(before))
+        sources = set(h.uri for h in drained)
+        for m in migrations:
+            self.assertIn(m.source.uri, sources)
+            self.assertNotIn(m.target.uri, sources)
+            self.assertEqual(before[m.vm.uuid], m.source.uri)
+            self.assertIs(m.vm.host, m.target)
+
+    def test_respects_capacity_and_anti_affinity(self):
+        hosts = self.fleet()
+        vm_consolidate.plan_consolidation(hosts)
+        for host in hosts:
+            self.assertLessEqual(host.used_memory, host.memory_cap)
+            self.assertLessEqual(host.used_cpu, host.cpu_cap + 1e-9)
+            self.assertEqual(host.used_memory,
+                             sum(v.memory_mb for v in host.vms.values()))
+            for count in host.tags.values():
+                self.assertLessEqual(count, 1)
+
+    def test_vm_migrated_once(self):
+        hosts = self.fleet()
+        migrations, _ = vm_consolidate.plan_consolidation(hosts)
+        uuids = [m.vm.uuid for m in migrations]
+        self.assertEqual(len(uuids), len(set(uuids)))
+
+    def test_max_migrations(self):
+        hosts = self.fleet()
+        migrations, drained = vm_consolidate.plan_consolidation(hosts, 40)
+        self.assertLessEqual(len(migrations), 40)
+        self.assertEqual(len(migrations),
+                         sum(1 for m in migrations if m.source in drained))
+
+    def test_deterministic(self):
+        first = [m.to_dict() for m in
+                 vm_consolidate.plan_consolidation(self.fleet())[0]]
+        second = [m.to_dict() for m in
+                  vm_consolidate.plan_consolidation(self.fleet())[0]]
+        self.assertEqual(first, second)
+
+    def test_empty_host_not_counted(self):
+        cfg = vm_consolidate.consolidate_config({})
+        busy = vm_consolidate.Host("test:///busy", "busy", 32, 262144, cfg)
+        idle = vm_consolidate.Host("test:///idle", "idle", 32, 262144, cfg)
+        busy.add(vm_consolidate.VM("vm1", "uuid1", 2, 4096, 0.5))
+        migrations, drained = vm_consolidate.plan_consolidation([busy, idle])
+        self.assertEqual((migrations, drained), ([], []))
+        self.assertEqual(list(busy.vms), ["uuid1"])
+
+    def test_full_fleet_untouched(self):
+        # Hosts packed so tightly that no host can be drained
+        hosts = vm_consolidate.synthetic_fleet(3, 3000, 2, {})
+        before = self.placement(hosts)
+        migrations, drained = vm_consolidate.plan_consolidation(hosts)
+        self.assertEqual((migrations, drained), ([], []))
+        self.assertEqual(self.placement(hosts), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
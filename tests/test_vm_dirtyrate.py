@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Pre-copy migration prediction from dirty rates"""
+
+import unittest
+
+try:
+    import vm_dirtyrate
+except ImportError:     # libvirt binding not installed
+    vm_dirtyrate = None
+
+
+@unittest.skipIf(vm_dirtyrate is None, "libvirt python binding not installed")
+class PredictTest(unittest.TestCase):
+
+    def test_fits_in_downtime(self):
+        p = vm_dirtyrate.predict(256, 500, bandwidth_mbps=1000, downtime_ms=300)
+        self.assertEqual((p.seconds, p.passes, p.converges, p.advice),
+                         (0.3, 1, True, 'precopy'))
+
+    def test_idle_guest_single_pass(self):
+        p = vm_dirtyrate.predict(4096, 0, bandwidth_mbps=1024)
+        self.assertEqual((p.seconds, p.passes, p.converges, p.advice),
+                         (4.0, 1, True, 'precopy'))
+
+    def test_converging_guest(self):
+        # 4096 * 0.25**2 = 256 MB fits in 300 ms at 1000 MB/s: 3 passes
+        p = vm_dirtyrate.predict(4096, 250, bandwidth_mbps=1000,
+                                 downtime_ms=300)
+        self.assertEqual((p.passes, p.converges, p.advice),
+                         (3, True, 'precopy'))
+        self.assertAlmostEqual(p.seconds, 4096 * (1 + 0.25 + 0.0625) / 1000,
+                               places=2)
+
+    def test_high_ratio_needs_auto_converge(self):
+        p = vm_dirtyrate.predict(4096, 600, bandwidth_mbps=1000)
+        self.assertTrue(p.converges)
+        self.assertEqual(p.advice, 'auto-converge')
+
+    def test_dirty_faster_than_bandwidth(self):
+        p = vm_dirtyrate.predict(8192, 2000, bandwidth_mbps=1000)
+        self.assertEqual((p.seconds, p.converges, p.advice),
+                         (8.19, False, 'post-copy'))
+
+    def test_too_many_passes(self):
+        p = vm_dirtyrate.predict(65536, 990, bandwidth_mbps=1000,
+                                 max_passes=10)
+        self.assertEqual((p.passes, p.converges, p.advice),
+                         (10, False, 'post-copy'))
+
+    def test_time_grows_with_dirty_rate(self):
+        times = [vm_dirtyrate.predict(8192, rate, bandwidth_mbps=1000).seconds
+                 for rate in (0, 100, 300, 600)]
+        self.assertEqual(times, sorted(times))
+
+    def test_bandwidth_must_be_positive(self):
+        self.assertRaises(ValueError, vm_dirtyrate.predict, 1024, 10, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
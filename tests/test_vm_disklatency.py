@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""Disk latency analysis on recorded timing samples"""
+
+import os
+import tempfile
+import unittest
+
+try:
+    import vm_disklatency
+except ImportError:     # libvirt binding not installed
+    vm_disklatency = None
+
+MS = 1000000    # nanoseconds
+
+
+def timing_sample(ts, disks):
+    """
+    Build a sample from {key: {field: value}}; missing fields are 0
+    """
+    sample = vm_disklatency.empty_sample(ts)
+    for key in sorted(disks):
+        sample['keys'].append(key)
+        for field in vm_disklatency.FIELDS:
+            sample['columns'][field].append(disks[key].get(field, 0))
+    return sample
+
+
+def counters(reads, read_ms, writes=0, write_ms=0, flushes=0, flush_ms=0):
+    """Cumulative counters for a disk with the given average latencies"""
+    return {'rd.reqs': reads, 'rd.times': reads * read_ms * MS,
+            'wr.reqs': writes, 'wr.times': writes * write_ms * MS,
+            'fl.reqs': flushes, 'fl.times': flushes * flush_ms * MS}
+
+
+@unittest.skipIf(vm_disklatency is None, "libvirt python binding not installed")
+class AnalyzeTest(unittest.TestCase):
+
+    def test_latency_and_iops(self):
+        prev = timing_sample(0.0, {'db/vda': counters(1000, 2, 500, 4)})
+        cur = timing_sample(10.0, {'db/vda': {
+            'rd.reqs': 1100, 'rd.times': 1000 * 2 * MS + 100 * 8 * MS,
+            'wr.reqs': 600, 'wr.times': 500 * 4 * MS + 100 * 12 * MS,
+            'fl.reqs': 10, 'fl.times': 10 * 30 * MS}})
+        interval = vm_disklatency.analyze(prev, cur)
+        self.assertEqual(interval.keys, ['db/vda'])
+        self.assertEqual(interval.seconds, 10.0)
+        self.assertAlmostEqual(interval.read_ms[0], 8.0)
+        self.assertAlmostEqual(interval.write_ms[0], 12.0)
+        self.assertAlmostEqual(interval.flush_ms[0], 30.0)
+        self.assertAlmostEqual(interval.avg_ms[0], 10.0)
+        self.assertAlmostEqual(interval.iops[0], 20.0)
+
+    def test_idle_disk_has_zero_latency(self):
+        prev = timing_sample(0.0, {'idle/vda': counters(5, 1)})
+        cur = timing_sample(5.0, {'idle/vda': counters(5, 1)})
+        interval = vm_disklatency.analyze(prev, cur)
+        self.assertEqual(list(interval.avg_ms), [0.0])
+        self.assertEqual(list(interval.iops), [0.0])
+
+    def test_new_and_restarted_disks_left_out(self):
+        prev = timing_sample(0.0, {'a/vda': counters(100, 1),
+                                   'restarted/vda': counters(1000, 1)})
+        cur = timing_sample(5.0, {'a/vda': counters(200, 1),
+                                  'restarted/vda': counters(10, 1),
+                                  'new/vda': counters(50, 1)})
+        interval = vm_disklatency.analyze(prev, cur)
+        self.assertEqual(interval.keys, ['a/vda'])
+        self.assertAlmostEqual(interval.iops[0], 20.0)
+
+    def test_samples_out_of_order(self):
+        sample = timing_sample(5.0, {'a/vda': counters(1, 1)})
+        self.assertIsNone(vm_disklatency.analyze(sample, sample))
+
+    def test_by_guest_sums_disks(self):
+        prev = timing_sample(0.0, {'vm/vda': counters(0, 0),
+                                   'vm/vdb': counters(0, 0)})
+        cur = timing_sample(1.0, {'vm/vda': counters(100, 2),
+                                  'vm/vdb': counters(300, 6)})
+        guest = vm_disklatency.by_guest(vm_disklatency.analyze(prev, cur))
+        self.assertEqual(guest.keys, ['vm'])
+        self.assertAlmostEqual(guest.read_ms[0], 5.0)
+        self.assertAlmostEqual(guest.iops[0], 400.0)
+
+    def test_rank_slowest_first(self):
+        prev = timing_sample(0.0, {'fast/vda': counters(0, 0),
+                                   'slow/vda': counters(0, 0),
+                                   'quiet/vda': counters(0, 0)})
+        cur = timing_sample(10.0, {'fast/vda': counters(1000, 1),
+                                   'slow/vda': counters(1000, 40),
+                                   'quiet/vda': counters(2, 500)})
+        interval = vm_disklatency.analyze(prev, cur)
+        ranked = [interval.keys[i] for i in
+                  vm_disklatency.rank(interval, top=5, min_iops=1.0)]
+        self.assertEqual(ranked, ['slow/vda', 'fast/vda'])
+
+
+@unittest.skipIf(vm_disklatency is None, "libvirt python binding not installed")
+class MergeTest(unittest.TestCase):
+
+    def recorded(self):
+        """Three samples: vdb is hot-plugged in the last one"""
+        return [
+            timing_sample(0.0, {'vm/vda': counters(0, 0)}),
+            timing_sample(10.0, {'vm/vda': counters(100, 2)}),
+            timing_sample(20.0, {'vm/vda': counters(400, 5),
+                                 'vm/vdb': counters(50, 1)}),
+        ]
+
+    def test_merge_recorded_samples(self):
+        samples = self.recorded()
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for sample in samples:
+                    f.write(vm_disklatency.to_json(sample) + "\n")
+            loaded = vm_disklatency.load_samples(path)
+        finally:
+            os.remove(path)
+        intervals = [vm_disklatency.analyze(p, c)
+                     for p, c in zip(loaded, loaded[1:])]
+        merged = vm_disklatency.merge(intervals)
+        self.assertEqual(merged.keys, ['vm/vda'])
+        self.assertEqual(merged.seconds, 20.0)
+        # 400 reads taking 2000 ms in total
+        self.assertAlmostEqual(merged.read_ms[0], 5.0)
+        self.assertAlmostEqual(merged.iops[0], 20.0)
+        self.assertEqual(merged.deltas['rd.reqs'][0], 400)
+
+    def test_merge_matches_single_interval(self):
+        samples = self.recorded()
+        merged = vm_disklatency.merge([vm_disklatency.analyze(p, c)
+                                       for p, c in zip(samples, samples[1:])])
+        direct = vm_disklatency.analyze(samples[0], samples[2])
+        for field in vm_disklatency.FIELDS:
+            self.assertEqual(list(merged.deltas[field]),
+                             list(direct.deltas[field]))
+
+    def test_merge_skips_missing_intervals(self):
+        self.assertIsNone(vm_disklatency.merge([]))
+        self.assertIsNone(vm_disklatency.merge([None]))
+        samples = self.recorded()
+        interval = vm_disklatency.analyze(samples[0], samples[1])
+        merged = vm_disklatency.merge([None, interval])
+        self.assertEqual(merged.keys, interval.keys)
+
+
+if __name__ == '__main__':
+    unittest.main()
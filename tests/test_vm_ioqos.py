@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Fair-share throttling decisions replayed from recorded block stats"""
+
+import json
+import os
+import tempfile
+import unittest
+
+try:
+    import vm_ioqos
+except ImportError:     # libvirt binding not installed
+    vm_ioqos = None
+
+
+def block_sample(ts, reqs):
+    """Sample with the given cumulative read requests per disk"""
+    return {'ts': ts, 'disks': dict((key, [n, 0, n * 4096, 0])
+                                    for key, n in reqs.items())}
+
+
+def recorded(iops, intervals, interval=5.0):
+    """Samples of disks running at constant IOPS"""
+    return [block_sample(i * interval,
+                         dict((k, int(v * interval * i)) for k, v in iops.items()))
+            for i in range(intervals + 1)]
+
+
+@unittest.skipIf(vm_ioqos is None, "libvirt python binding not installed")
+class FairShareThrottlerTest(unittest.TestCase):
+
+    POLICY = {'sustain': 2, 'hold': 10.0, 'share_factor': 2.0,
+              'min_iops': 200.0, 'busy_iops': 10.0}
+
+    def decide_all(self, samples, policy=None):
+        throttler = vm_ioqos.FairShareThrottler(policy or self.POLICY)
+        return [throttler.decide(prev, cur)
+                for prev, cur in zip(samples, samples[1:])]
+
+    def test_noisy_disk_throttled_after_sustain(self):
+        samples = recorded({'noisy/vda': 1000, 'a/vda': 100, 'b/vda': 100}, 2)
+        decisions = self.decide_all(samples)
+        self.assertEqual(decisions[0], [])
+        # Fair share 400 IOPS, capped at twice that
+        self.assertEqual(decisions[1], [('throttle', 'noisy/vda', 800)])
+
+    def test_released_after_hold(self):
+        samples = recorded({'noisy/vda': 1000, 'a/vda': 100, 'b/vda': 100}, 5)
+        decisions = self.decide_all(samples)
+        self.assertEqual(decisions[1], [('throttle', 'noisy/vda', 800)])
+        self.assertEqual(decisions[2], [])
+        self.assertEqual(decisions[3], [('release', 'noisy/vda', None)])
+
+    def test_short_burst_not_throttled(self):
+        # 1000 IOPS for one interval only, then idle
+        samples = [block_sample(0.0, {'noisy/vda': 0, 'a/vda': 0, 'b/vda': 0}),
+                   block_sample(5.0, {'noisy/vda': 5000, 'a/vda': 500,
+                                      'b/vda': 500}),
+                   block_sample(10.0, {'noisy/vda': 5000, 'a/vda': 1000,
+                                       'b/vda': 1000})]
+        self.assertEqual(sum(self.decide_all(samples), []), [])
+
+    def test_single_busy_disk_not_throttled(self):
+        samples = recorded({'noisy/vda': 5000, 'idle/vda': 1}, 4)
+        self.assertEqual(sum(self.decide_all(samples), []), [])
+
+    def test_min_iops_floor(self):
+        samples = recorded({'noisy/vda': 150, 'a/vda': 10, 'b/vda': 10}, 2)
+        self.assertEqual(sum(self.decide_all(samples), []), [])
+
+    def test_counter_reset_ignored(self):
+        samples = recorded({'noisy/vda': 1000, 'a/vda': 100, 'b/vda': 100}, 2)
+        samples[1]['disks']['noisy/vda'] = [10 ** 9, 0, 0, 0]
+        self.assertEqual(self.decide_all(samples)[1], [])
+
+    def test_replay_recorded_file(self):
+        samples = recorded({'noisy/vda': 1000, 'a/vda': 100, 'b/vda': 100}, 5)
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for sample in samples:
+                    f.write(json.dumps(sample) + "\n")
+            decisions = vm_ioqos.replay(path, self.POLICY)
+        finally:
+            os.remove(path)
+        # Still noisy after the release: throttled again after sustain
+        self.assertEqual(decisions, [(10.0, 'throttle', 'noisy/vda', 800),
+                                     (20.0, 'release', 'noisy/vda', None),
+                                     (25.0, 'throttle', 'noisy/vda', 800)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Guest Agent Runner
+------------------
+Run the same qemu-guest-agent command on many running VMs at once
+
+Commands are sent with libvirt_qemu.qemuAgentCommand to a selector of
+running domains by a pool of workers, each with its own timeout. Results
+are yielded as each domain finishes, so a slow guest never holds up the
+others. Freeze and thaw go through the libvirt API instead, so libvirt
+knows which domains have frozen filesystems.
+
+A small health cache (vm_agent_cache.json) remembers which agents did
+not respond; those domains are skipped without waiting until DEAD_TTL
+has passed, or until the next --probe.
+
+Commands:
+    ping      guest-ping
+    freeze    virDomainFSFreeze (guest-fsfreeze-freeze)
+    thaw      virDomainFSThaw (guest-fsfreeze-thaw)
+    fstrim    guest-fstrim
+    timesync  guest-set-time (from the guest's hardware clock)
+    exec      guest-exec of a program, waiting for its output
+
+Examples:
+    python vm_agent.py "web*" fstrim
+    python vm_agent.py "all" exec -- uptime
+"""
+
+import argparse
+import base64
+import json
+import math
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import libvirt
+
+import vm_instrument
+import vm_oplog
+import vm_select
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+CACHE_FILE = 'vm_agent_cache.json'
+
+AGENT_TIMEOUT = 10
+AGENT_WORKERS = 16
+# Seconds a non-responding agent is skipped before it is tried again
+DEAD_TTL = 300
+EXEC_POLL_INTERVAL = 0.5
+
+COMMANDS = {
+    'ping': 'guest-ping',
+    'freeze': 'guest-fsfreeze-freeze',
+    'thaw': 'guest-fsfreeze-thaw',
+    'fstrim': 'guest-fstrim',
+    'timesync': 'guest-set-time',
+    'exec': 'guest-exec',
+}
+# Commands run through domain methods that track the guest state
+DOMAIN_METHODS = {
+    'freeze': 'fsFreeze',
+    'thaw': 'fsThaw',
+}
+
+# =============================================================================
+# HEALTH CACHE
+# =============================================================================
+
+class AgentHealth(object):
+    """
+    Per-domain record of whether the guest agent last responded
+
+    Entries are keyed by domain UUID and stored with the time they were
+    recorded; the cache is saved to disk so repeated runs benefit.
+    """
+
+    def __init__(self, path=CACHE_FILE, dead_ttl=DEAD_TTL):
+        self.path = path
+        self.dead_ttl = dead_ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._entries = json.load(f)
+            except ValueError:
+                self._entries = {}
+
+    def is_dead(self, uuid):
+        """True when the agent failed recently enough to be skipped"""
+        with self._lock:
+            entry = self._entries.get(uuid)
+        return bool(entry and not entry['alive'] and
+                    time.time() - entry['ts'] < self.dead_ttl)
+
+    def record(self, uuid, alive):
+        """Remember whether the agent of a domain responded"""
+        with self._lock:
+            self._entries[uuid] = {'alive': bool(alive), 'ts': time.time()}
+
+    def forget(self):
+        """Clear all entries"""
+        with self._lock:
+            self._entries = {}
+
+    def save(self):
+        """Write the cache to disk"""
+        if not self.path:
+            return
+        with self._lock:
+            data = dict(self._entries)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, self.path)
+
+
+# =============================================================================
+# AGENT COMMANDS
+# =============================================================================
+
+class AgentResult(object):
+    """Outcome of an agent command on one domain"""
+
+    def __init__(self, name):
+        self.name = name
+        self.outcome = None      # ok, failed, timeout or skipped
+        self.output = None
+        self.error = None
+        self.seconds = None
+
+
+def agent_command(dom, execute, arguments=None, timeout=AGENT_TIMEOUT):
+    """
+    Send one guest agent command and return its "return" value
+
+    Args:
+        dom: libvirt domain
+        execute: Agent command name (guest-ping, ...)
+        arguments: Optional arguments dict
+        timeout: Seconds to wait for the agent, rounded up to whole
+            seconds (0 would mean "do not wait")
+
+    Returns:
+        Decoded "return" value
+
+    Raises:
+        libvirt.libvirtError: The agent is unreachable or the command failed
+    """
+    import libvirt_qemu
+    request = {'execute': execute}
+    if arguments:
+        request['arguments'] = arguments
+    reply = libvirt_qemu.qemuAgentCommand(
+        vm_instrument.unwrap(dom), json.dumps(request),
+        max(1, int(math.ceil(timeout))), 0)
+    return json.loads(reply).get('return')
+
+
+def guest_exec(dom, argv, timeout=AGENT_TIMEOUT):
+    """
+    Run a program in the guest and wait for it to exit
+
+    Args:
+        dom: libvirt domain
+        argv: Program and arguments
+        timeout: Seconds to wait for the program
+
+    Returns:
+        Dict with exitcode, stdout and stderr
+
+    Raises:
+        libvirt.libvirtError: The agent failed
+        RuntimeError: The program did not exit within the timeout
+    """
+    pid = agent_command(dom, 'guest-exec',
+                        {'path': argv[0], 'arg': list(argv[1:]),
+                         'capture-output': True}, timeout)['pid']
+    deadline = time.time() + timeout
+    while True:
+        status = agent_command(dom, 'guest-exec-status', {'pid': pid}, timeout)
+        if status.get('exited'):
+            return {
+                'exitcode': status.get('exitcode'),
+                'stdout': base64.b64decode(status.get('out-data', '')).decode(
+                    'utf-8', 'replace'),
+                'stderr': base64.b64decode(status.get('err-data', '')).decode(
+                    'utf-8', 'replace'),
+            }
+        if time.time() >= deadline:
+            raise RuntimeError("timed out after %d s" % timeout)
+        time.sleep(EXEC_POLL_INTERVAL)
+
+
+def _is_timeout(error):
+    """True when a libvirt error means the agent did not answer"""
+    message = str(error).lower()
+    return ('not responding' in message or 'timeout' in message or
+            'not connected' in message or 'timed out' in message)
+
+
+def run(domains, command, argv=None, timeout=AGENT_TIMEOUT,
+        workers=AGENT_WORKERS, health=None, host=None):
+    """
+    Run an agent command on many domains, yielding results as they finish
+
+    Args:
+        domains: libvirt domains; inactive ones are skipped
+        command: Key of COMMANDS
+        argv: Program and arguments for "exec"
+        timeout: Per-domain timeout in seconds
+        workers: Domains contacted at once
+        health: AgentHealth cache, or None to contact every agent
+        host: Hypervisor hostname for operation events
+
+    Yields:
+        AgentResult
+    """
+    if command not in COMMANDS:
+        raise ValueError("Unknown agent command: %s" % command)
+    if command == 'exec' and not argv:
+        raise ValueError("exec needs a program to run")
+
+    def execute(dom):
+        result = AgentResult(dom.name())
+        uuid = dom.UUIDString()
+        if not dom.isActive():
+            result.outcome = 'skipped'
+            result.error = 'not running'
+            return result
+        if health is not None and health.is_dead(uuid):
+            result.outcome = 'skipped'
+            result.error = 'agent did not respond recently'
+            return result
+
+        start = time.time()
+        try:
+            if command == 'exec':
+                result.output = guest_exec(dom, argv, timeout)
+            elif command in DOMAIN_METHODS:
+                # Number of frozen or thawed filesystems
+                result.output = getattr(dom, DOMAIN_METHODS[command])()
+            else:
+                result.output = agent_command(dom, COMMANDS[command],
+                                              timeout=timeout)
+            result.outcome = 'ok'
+            alive = True
+        except libvirt.libvirtError as e:
+            alive = not _is_timeout(e)
+            result.outcome = 'failed' if alive else 'timeout'
+            result.error = str(e)
+        except RuntimeError as e:
+            alive = True
+            result.outcome = 'timeout'
+            result.error = str(e)
+        result.seconds = round(time.time() - start, 3)
+        if health is not None:
+            health.record(uuid, alive)
+        vm_oplog.log_event('agent_' + command, dom, host, result.seconds,
+                           'ok' if result.outcome == 'ok' else 'error',
+                           result.error)
+        return result
+
+    domains = list(domains)
+    if not domains:
+        return
+    pool = ThreadPool(min(workers, len(domains)))
+    try:
+        for result in pool.imap_unordered(execute, domains):
+            yield result
+    finally:
+        pool.close()
+        if health is not None:
+            health.save()
+
+
+def format_result(result):
+    """
+    Format one result for streaming output
+
+    Returns:
+        List of lines
+    """
+    seconds = "%.2fs" % result.seconds if result.seconds is not None else "-"
+    lines = ["%-30s %-8s %7s  %s" % (result.name[:30], result.outcome,
+                                     seconds, result.error or "")]
+    output = result.output
+    if isinstance(output, dict) and 'exitcode' in output:
+        lines[0] += "exit %s" % output['exitcode']
+        for stream in ('stdout', 'stderr'):
+            for line in output[stream].splitlines():
+                lines.append("    %s" % line)
+    elif output:
+        lines.append("    %s" % json.dumps(output, sort_keys=True))
+    return lines
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Run a guest agent command on many VMs")
+    parser.add_argument("selector", help='e.g. "web*", "all"')
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    parser.add_argument("program", nargs="*", help="Program for exec")
+    parser.add_argument("--uri", default="qemu:///system")
+    parser.add_argument("--timeout", type=float, default=AGENT_TIMEOUT)
+    parser.add_argument("--workers", type=int, default=AGENT_WORKERS)
+    parser.add_argument("--probe", action="store_true",
+                        help="Ignore the dead-agent cache")
+    args = parser.parse_args(argv)
+
+    try:
+        conn = vm_instrument.instrument(libvirt.open(args.uri))
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        return 1
+
+    health = AgentHealth()
+    if args.probe:
+        health.forget()
+
+    status = 0
+    start = time.time()
+    count = 0
+    try:
+        domains = vm_select.select(conn, args.selector + " state=running")
+        for result in run(domains, args.command, args.program,
+                          args.timeout, args.workers, health,
+                          conn.getHostname()):
+            count += 1
+            for line in format_result(result):
+                print(line)
+            if result.outcome != 'ok':
+                status = 1
+    except (ValueError, libvirt.libvirtError) as e:
+        print("Error: %s" % e)
+        status = 1
+    finally:
+        conn.close()
+    print("\n%d VMs in %.1f s" % (count, time.time() - start))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,567 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+VM Manager Benchmarks
+---------------------
+Reproducible benchmarks of VMManager against the libvirt test driver
+
+For each fleet size a custom test-driver node XML with that many domains
+is generated and every size runs in a fresh worker process, so peak
+memory is measured per size. Each case records wall time, the number of
+libvirt calls (via vm_instrument) and the peak RSS of the worker.
+
+Examples:
+    # Default sizes, results written to vm_bench_results.json
+    python vm_bench.py
+
+    # Quick run against the stock test driver
+    python vm_bench.py --uri test:///default
+
+    # Startup time from process start to first render, cold and warm
+    python vm_bench.py --startup --sizes 100,1000
+
+    # Compare two result files, exit status 1 on regression
+    python vm_bench.py --compare old.json new.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import pty
+import random
+import resource
+import select
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import libvirt
+
+import vm_history
+import vm_instrument
+import vm_inventory
+import vm_reconcile
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+DEFAULT_SIZES = (10, 100, 1000, 5000)
+DEFAULT_OUTPUT = 'vm_bench_results.json'
+MAIN_MODULE = 'LAB2b_Python_Script_Kherroubi_Bousdjira_SQ1'
+RESULT_SCHEMA = 1
+
+# Lifecycle actions sample this many domains per case
+ACTION_SAMPLES = 5
+LOOKUP_SAMPLES = 200
+
+# Startup runs per fleet size and phase (cold and warm snapshot)
+STARTUP_RUNS = 3
+STARTUP_TIMEOUT = 120
+STARTUP_MILESTONES = ('imported', 'first_render', 'connected', 'reconciled')
+
+# Comparison thresholds
+WALL_TIME_TOLERANCE = 0.20
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+# =============================================================================
+# TEST DRIVER FLEET
+# =============================================================================
+
+DOMAIN_TEMPLATE = """  <domain type='test' xmlns:test='http://libvirt.org/schemas/domain/test'>
+    <name>%(name)s</name>
+    <uuid>%(uuid)s</uuid>
+    <memory unit='MiB'>%(memory)d</memory>
+    <vcpu>%(vcpus)d</vcpu>
+    <os><type arch='x86_64'>hvm</type></os>
+    <devices>
+      <disk type='file' device='disk'>
+        <source file='/var/lib/libvirt/images/%(name)s.qcow2'/>
+        <target dev='vda' bus='virtio'/>
+      </disk>
+    </devices>
+    <test:runstate>%(runstate)d</test:runstate>
+  </domain>
+"""
+
+
+def bench_name(index):
+    """Return the name of the index-th generated domain"""
+    return "bench-%05d" % index
+
+
+def generate_node_xml(count, path, seed=0):
+    """
+    Write a test-driver node XML file with count domains
+
+    Half of the domains are running and half are shut off; sizes are
+    drawn from a seeded generator so runs are reproducible.
+
+    Args:
+        count: Number of domains
+        path: Output file
+        seed: Random seed
+    """
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write("<node>\n")
+        f.write("  <cpu><mhz>2400</mhz><model>x86_64</model><nodes>1</nodes>"
+                "<sockets>2</sockets><cores>8</cores><threads>2</threads>"
+                "</cpu>\n")
+        f.write("  <memory>268435456</memory>\n")
+        for i in range(count):
+            f.write(DOMAIN_TEMPLATE % {
+                'name': bench_name(i),
+                'uuid': "00000000-0000-4000-8000-%012d" % i,
+                'memory': rng.choice((512, 1024, 2048, 4096)),
+                'vcpus': rng.choice((1, 2, 4)),
+                'runstate': (libvirt.VIR_DOMAIN_RUNNING if i % 2 == 0
+                             else libvirt.VIR_DOMAIN_SHUTOFF),
+            })
+        f.write("</node>\n")
+
+
+# =============================================================================
+# WORKER
+# =============================================================================
+
+class ScriptedInput(object):
+    """Replacement for safe_input that returns queued answers"""
+
+    def __init__(self):
+        self.answers = []
+
+    def __call__(self, prompt=""):
+        return self.answers.pop(0) if self.answers else ""
+
+
+def _peak_rss_kb():
+    """Return the peak resident set size of this process in KiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+class Worker(object):
+    """Run all benchmark cases against one connection"""
+
+    def __init__(self, uri, size):
+        """
+        Initialize the worker
+
+        Args:
+            uri: libvirt URI of the test driver
+            size: Number of domains in the fleet
+        """
+        main = __import__(MAIN_MODULE)
+        self.main = main
+        self.stats = vm_instrument.RPCStats()
+        self.input = ScriptedInput()
+
+        # Drive the interactive methods without a terminal
+        main.safe_input = self.input
+        main.pause = lambda: None
+        main.clear_screen = lambda: None
+
+        class BenchManager(main.VMManager):
+            def _create_disk_image(self, disk_path, size_gb, backing_file=None):
+                return True
+
+            def _generate_vm_xml(self, *args):
+                xml = main.VMManager._generate_vm_xml(self, *args)
+                return xml.replace("<domain type='kvm'>",
+                                   "<domain type='test'>", 1)
+
+        self.manager = BenchManager()
+        raw = libvirt.open(uri)
+        self.manager.conn = vm_instrument.instrument(raw, self.stats, True)
+        self.manager.connected = True
+        self.manager.hostname = raw.getHostname()
+        self.size = size or len(raw.listAllDomains())
+        self.iso_path = tempfile.mkstemp(suffix='.iso')[1]
+        self.results = []
+
+    def measure(self, case, func, iterations=1):
+        """
+        Run func iterations times and record one result
+
+        Args:
+            case: Case name
+            func: Callable taking the iteration index
+            iterations: Number of calls
+        """
+        self.stats.reset()
+        devnull = open(os.devnull, 'w')
+        saved = sys.stdout
+        sys.stdout = devnull
+        try:
+            start = _timer()
+            for i in range(iterations):
+                func(i)
+            wall = _timer() - start
+        finally:
+            sys.stdout = saved
+            devnull.close()
+        calls = self.stats.snapshot()
+        self.results.append({
+            'size': self.size,
+            'case': case,
+            'iterations': iterations,
+            'wall_ms': round(wall * 1000.0, 3),
+            'wall_ms_per_op': round(wall * 1000.0 / iterations, 3),
+            'rpc_calls': sum(c['count'] for c in calls.values()),
+            'rpc_by_method': dict((k, c['count']) for k, c in calls.items()),
+            'peak_rss_kb': _peak_rss_kb(),
+        })
+
+    def _names(self, active):
+        """Return domain names in the given activity state"""
+        conn = vm_instrument.unwrap(self.manager.conn)
+        flag = (libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE if active
+                else libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE)
+        names = sorted(d.name() for d in conn.listAllDomains(flag))
+        return names[:ACTION_SAMPLES]
+
+    def _action(self, method, names, *answers):
+        """Build a case function answering the prompts of a menu method"""
+        def run(i):
+            self.input.answers = [names[i]] + list(answers)
+            method()
+        return run
+
+    def run(self):
+        """Run every case and return the result list"""
+        m = self.manager
+        conn = m.conn
+
+        self.measure('list', lambda i: m.list_vms())
+        self.measure('hypervisor_info', lambda i: m.show_hypervisor_info())
+
+        names = [d.name() for d in vm_instrument.unwrap(conn).listAllDomains()]
+        rng = random.Random(1)
+        sample = [rng.choice(names) for _ in range(LOOKUP_SAMPLES)]
+        self.measure('lookup', lambda i: conn.lookupByName(sample[i]),
+                     len(sample))
+
+        inventory = vm_inventory.Inventory(conn)
+        self.measure('inventory_refresh', lambda i: inventory.refresh())
+        specs = self._desired(inventory.rows())
+        self.measure('reconcile_plan', lambda i: vm_reconcile.plan(
+            specs, inventory.rows()))
+
+        history_dir = tempfile.mkdtemp()
+        exporter = vm_history.HistoryExporter(
+            conn, vm_history.connect(os.path.join(history_dir, 'history.db')))
+        self.measure('history_sync_full', lambda i: exporter.sync(True))
+        self.measure('history_sync', lambda i: exporter.sync())
+        exporter.db.close()
+        shutil.rmtree(history_dir)
+
+        stopped = self._names(False)
+        self.measure('start', self._action(m.start_vm, stopped), len(stopped))
+        self.measure('suspend', self._action(m.suspend_vm, stopped),
+                     len(stopped))
+        self.measure('resume', self._action(m.resume_vm, stopped),
+                     len(stopped))
+        self.measure('stop', self._action(m.stop_vm, stopped, "2"),
+                     len(stopped))
+
+        created = ["bench-new-%d" % i for i in range(ACTION_SAMPLES)]
+        self.measure('create', self._action(
+            m.create_vm, created, "1024", "1", "10", "", self.iso_path, "n"),
+            len(created))
+        self.measure('delete', lambda i: self._delete(created[i]),
+                     len(created))
+
+        os.remove(self.iso_path)
+        return self.results
+
+    @staticmethod
+    def _desired(rows):
+        """Desired state matching the fleet except for every tenth VM"""
+        specs = {}
+        for i, row in enumerate(rows):
+            spec = dict(vm_reconcile.DEFAULTS, vcpus=row.vcpus,
+                        memory_mb=row.memory_mb,
+                        state='running' if row.state ==
+                        libvirt.VIR_DOMAIN_RUNNING else 'shutoff')
+            if i % 10 == 0:
+                spec['vcpus'] += 1
+            specs[row.name] = spec
+        return specs
+
+    def _delete(self, name):
+        """Answer the delete prompts: name, confirmation, keep disks"""
+        self.input.answers = [name, name, "n"]
+        self.manager.delete_vm()
+
+
+def run_worker(uri, size):
+    """Benchmark entry point of a worker process; prints JSON results"""
+    results = Worker(uri, size).run()
+    sys.stdout.write(json.dumps(results))
+    return 0
+
+
+# =============================================================================
+# DRIVER
+# =============================================================================
+
+def run_size(size, uri=None, seed=0):
+    """
+    Benchmark one fleet size in a fresh worker process
+
+    Args:
+        size: Number of domains (ignored when uri is given)
+        uri: Existing test driver URI to use instead of a generated fleet
+        seed: Random seed for the generated fleet
+
+    Returns:
+        List of result dicts
+    """
+    node_file = None
+    if uri is None:
+        node_file = _fleet_file(size, seed)
+        uri = "test://" + node_file
+    try:
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__),
+             '--worker', str(size), '--uri', uri])
+    finally:
+        if node_file:
+            os.remove(node_file)
+    return json.loads(output.decode('utf-8'))
+
+
+def _fleet_file(size, seed):
+    """Generate a temporary test-driver node file and return its path"""
+    fd, node_file = tempfile.mkstemp(suffix='.xml', prefix='vm_bench_')
+    os.close(fd)
+    generate_node_xml(size, node_file, seed)
+    return node_file
+
+
+# =============================================================================
+# STARTUP
+# =============================================================================
+
+def _run_on_pty(argv, env, cwd, timeout=STARTUP_TIMEOUT):
+    """
+    Run a program on a pseudo-terminal, discarding what it draws
+
+    Returns:
+        Exit status from waitpid
+    """
+    pid, fd = pty.fork()
+    if pid == 0:
+        try:
+            os.chdir(cwd)
+            os.execve(argv[0], argv, env)
+        finally:
+            os._exit(127)
+
+    deadline = time.time() + timeout
+    try:
+        while True:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                return status
+            if time.time() > deadline:
+                os.kill(pid, signal.SIGKILL)
+            if select.select([fd], [], [], 0.05)[0]:
+                try:
+                    os.read(fd, 65536)
+                except OSError:
+                    pass
+    finally:
+        os.close(fd)
+
+
+def measure_startup(uri, workdir):
+    """
+    Start the full-screen interface once and time its milestones
+
+    The interface runs on a pseudo-terminal in workdir, so the inventory
+    snapshot it reads and writes lives there.
+
+    Args:
+        uri: libvirt URI
+        workdir: Working directory of the run
+
+    Returns:
+        Dict of milestone -> ms since the process was started
+    """
+    report = os.path.join(workdir, 'startup.json')
+    if os.path.exists(report):
+        os.remove(report)
+    env = dict(os.environ, VM_MANAGER_URI=uri,
+               VM_MANAGER_STARTUP_REPORT=report, TERM='xterm',
+               LINES='40', COLUMNS='120')
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          MAIN_MODULE + '.py')
+    start = time.time()
+    _run_on_pty([sys.executable, script], env, workdir)
+    with open(report) as f:
+        marks = json.load(f)
+    return dict((m, (marks[m] - start) * 1000.0)
+                for m in STARTUP_MILESTONES if m in marks)
+
+
+def run_startup(size, uri=None, seed=0, runs=STARTUP_RUNS):
+    """
+    Benchmark startup without (cold) and with (warm) an inventory snapshot
+
+    Args:
+        size: Number of domains (ignored when uri is given)
+        uri: Existing test driver URI to use instead of a generated fleet
+        seed: Random seed for the generated fleet
+        runs: Runs per phase; the median is reported
+
+    Returns:
+        List of result dicts, one per phase and milestone
+    """
+    node_file = None
+    if uri is None:
+        node_file = _fleet_file(size, seed)
+        uri = "test://" + node_file
+    workdir = tempfile.mkdtemp(prefix='vm_bench_startup_')
+    results = []
+    try:
+        for phase in ('cold', 'warm'):
+            samples = []
+            for _ in range(runs):
+                if phase == 'cold':
+                    for name in os.listdir(workdir):
+                        os.remove(os.path.join(workdir, name))
+                samples.append(measure_startup(uri, workdir))
+            for milestone in STARTUP_MILESTONES:
+                values = sorted(s[milestone] for s in samples if milestone in s)
+                if not values:
+                    continue
+                median = round(values[len(values) // 2], 3)
+                results.append({
+                    'size': size,
+                    'case': 'startup_%s_%s' % (phase, milestone),
+                    'iterations': len(values),
+                    'wall_ms': median,
+                    'wall_ms_per_op': median,
+                    'rpc_calls': 0,
+                    'rpc_by_method': {},
+                    'peak_rss_kb': resource.getrusage(
+                        resource.RUSAGE_CHILDREN).ru_maxrss,
+                })
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if node_file:
+            os.remove(node_file)
+    return results
+
+
+def collect_meta():
+    """Describe the environment the benchmark ran in"""
+    meta = {
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'libvirt': libvirt.getVersion(),
+    }
+    try:
+        meta['git_rev'] = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return meta
+
+
+def compare(base_path, new_path, tolerance=WALL_TIME_TOLERANCE):
+    """
+    Compare two result files and report regressions
+
+    A case regresses when its per-operation wall time grows by more than
+    tolerance or when it makes more libvirt calls than before.
+
+    Returns:
+        Number of regressions found
+    """
+    def index(path):
+        with open(path) as f:
+            data = json.load(f)
+        return dict(((r['size'], r['case']), r) for r in data['results'])
+
+    base = index(base_path)
+    new = index(new_path)
+    regressions = 0
+    print("%-6s %-16s %12s %12s %8s %10s %10s" %
+          ("Size", "Case", "Base ms/op", "New ms/op", "Change",
+           "Base RPC", "New RPC"))
+    print("-" * 80)
+    for key in sorted(set(base) & set(new)):
+        b, n = base[key], new[key]
+        change = ((n['wall_ms_per_op'] - b['wall_ms_per_op']) /
+                  b['wall_ms_per_op']) if b['wall_ms_per_op'] else 0.0
+        flag = ""
+        if change > tolerance or n['rpc_calls'] > b['rpc_calls']:
+            regressions += 1
+            flag = "  REGRESSION"
+        print("%-6d %-16s %12.3f %12.3f %+7.1f%% %10d %10d%s" %
+              (key[0], key[1], b['wall_ms_per_op'], n['wall_ms_per_op'],
+               change * 100.0, b['rpc_calls'], n['rpc_calls'], flag))
+    return regressions
+
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark VMManager against the libvirt test driver")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="Comma-separated fleet sizes")
+    parser.add_argument("--uri", help="Use an existing test driver URI, "
+                                      "e.g. test:///default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"))
+    parser.add_argument("--startup", action="store_true",
+                        help="Measure startup to first render instead")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker is not None:
+        return run_worker(args.uri, args.worker)
+
+    if args.compare:
+        return 1 if compare(*args.compare) else 0
+
+    sizes = [0] if args.uri else [int(s) for s in args.sizes.split(",")]
+    results = []
+    for size in sizes:
+        label = args.uri or "%d domains" % size
+        sys.stderr.write("Benchmarking %s...\n" % label)
+        if args.startup:
+            results.extend(run_startup(size, args.uri, args.seed))
+        else:
+            results.extend(run_size(size, args.uri, args.seed))
+
+    with open(args.output, 'w') as f:
+        json.dump({'schema': RESULT_SCHEMA, 'meta': collect_meta(),
+                   'results': results}, f, indent=2, sort_keys=True)
+
+    print("%-6s %-16s %12s %10s %12s" %
+          ("Size", "Case", "ms/op", "RPC calls", "Peak RSS KB"))
+    print("-" * 60)
+    for r in results:
+        print("%-6d %-16s %12.3f %10d %12d" %
+              (r['size'], r['case'], r['wall_ms_per_op'], r['rpc_calls'],
+               r['peak_rss_kb']))
+    print("\nResults written to %s" % args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
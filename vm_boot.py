@@ -0,0 +1,486 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Boot Orchestrator
+-----------------
+Ordered, throttled fleet start-up replacing libvirt autostart
+
+VMs under managed autostart have libvirt's own autostart flag cleared so
+libvirtd does not start them all at once after a host reboot. Instead,
+run "python vm_boot.py boot" once libvirtd is up (e.g. from a systemd
+unit ordered after libvirtd.service).
+
+Start order:
+  - VMs are grouped into waves by priority ("priorities" section); a wave
+    starts only when every VM of the previous wave is ready
+  - within a wave, a VM starts after the VMs it depends on are ready
+  - a VM whose dependency failed or timed out, in any wave, is not
+    started and is reported as blocked
+  - at most max_concurrent VMs are starting (not yet ready) at once
+  - a VM is ready when its guest agent answers, it reports an IP address,
+    or immediately, depending on the readiness setting
+
+Configuration (vm_manager.json):
+    "boot": {
+        "autostart": ["db*", "app1"],
+        "depends": {"app1": ["db1"]},
+        "exclude": ["db-scratch"],
+        "max_concurrent": 3,
+        "readiness": "agent",
+        "ready_timeout": 180
+    }
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import libvirt
+
+try:
+    import libvirt_qemu
+except ImportError:
+    libvirt_qemu = None
+
+import vm_config
+import vm_events
+import vm_instrument
+import vm_oplog
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+MAX_CONCURRENT = 3
+READY_TIMEOUT = 180
+READY_POLL_INTERVAL = 2.0
+
+READINESS_AGENT = 'agent'
+READINESS_IP = 'ip'
+READINESS_NONE = 'none'
+
+# =============================================================================
+# MANAGED AUTOSTART
+# =============================================================================
+
+def boot_config(config=None):
+    """Return the boot section with defaults filled in"""
+    cfg = dict(vm_config.section('boot', config))
+    cfg.setdefault('autostart', [])
+    cfg.setdefault('exclude', [])
+    cfg.setdefault('depends', {})
+    cfg.setdefault('max_concurrent', MAX_CONCURRENT)
+    cfg.setdefault('readiness', READINESS_AGENT)
+    cfg.setdefault('ready_timeout', READY_TIMEOUT)
+    return cfg
+
+
+def is_managed(name, config=None):
+    """
+    Return True when a VM is under managed autostart
+
+    Entries of "exclude" override "autostart"; an excluded exact name wins
+    over an autostart pattern.
+    """
+    cfg = boot_config(config)
+    mapping = dict.fromkeys(cfg['autostart'], True)
+    mapping.update(dict.fromkeys(cfg['exclude'], False))
+    return vm_config.match_name(name, mapping, False)
+
+
+def set_managed(conn, name, enabled):
+    """
+    Put a VM under (or release it from) managed autostart
+
+    While managed, libvirt's own autostart flag is cleared. When released,
+    the VM is left with autostart disabled. Releasing a VM that matches an
+    autostart pattern adds its name to the "exclude" list.
+
+    Args:
+        conn: libvirt connection
+        name: VM name
+        enabled: True to manage the VM
+    """
+    dom = conn.lookupByName(name)
+    config = vm_config.load_config()
+    boot = config.setdefault('boot', {})
+    autostart = boot.setdefault('autostart', [])
+    exclude = boot.setdefault('exclude', [])
+    if name in exclude:
+        exclude.remove(name)
+    if name in autostart:
+        autostart.remove(name)
+    if enabled:
+        if not is_managed(name, config):
+            autostart.append(name)
+    elif is_managed(name, config):
+        exclude.append(name)
+    dom.setAutostart(0)
+    vm_config.save_config(config)
+
+
+def take_over_autostart(conn):
+    """
+    Move every VM with libvirt autostart enabled under managed autostart
+
+    Args:
+        conn: libvirt connection
+
+    Returns:
+        List of VM names taken over
+    """
+    taken = []
+    for dom in conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_PERSISTENT):
+        if dom.autostart():
+            set_managed(conn, dom.name(), True)
+            taken.append(dom.name())
+    return taken
+
+
+# =============================================================================
+# PLANNING
+# =============================================================================
+
+def plan_boot(names, depends, priority=vm_config.vm_priority):
+    """
+    Group VMs into start waves
+
+    A VM never starts in an earlier wave than a VM it depends on, so a
+    dependency on a lower-priority VM pulls the dependent into that wave.
+    Dependencies on VMs outside names are ignored.
+
+    Args:
+        names: VM names to start
+        depends: Dict of name -> list of names it depends on
+        priority: Callable returning the priority of a name
+
+    Returns:
+        List of (priority, [names]) sorted by priority
+
+    Raises:
+        ValueError: The dependencies contain a cycle
+    """
+    names = set(names)
+    deps = dict((n, [d for d in depends.get(n, []) if d in names and d != n])
+                for n in names)
+    effective = {}
+    visiting = set()
+
+    def resolve(name):
+        if name in effective:
+            return effective[name]
+        if name in visiting:
+            raise ValueError("Dependency cycle involving %s" % name)
+        visiting.add(name)
+        value = priority(name)
+        for dep in deps[name]:
+            value = max(value, resolve(dep))
+        visiting.discard(name)
+        effective[name] = value
+        return value
+
+    waves = {}
+    for name in names:
+        waves.setdefault(resolve(name), []).append(name)
+    return [(p, sorted(waves[p])) for p in sorted(waves)]
+
+
+# =============================================================================
+# ORCHESTRATION
+# =============================================================================
+
+class BootResult(object):
+    """Outcome of starting one VM"""
+
+    def __init__(self, name, wave):
+        self.name = name
+        self.wave = wave
+        self.outcome = None      # ready, timeout, failed or blocked
+        self.start_seconds = None
+        self.ready_seconds = None
+        self.error = None
+
+
+class BootOrchestrator(object):
+    """Start VMs wave by wave with dependency and concurrency limits"""
+
+    def __init__(self, conn, max_concurrent=MAX_CONCURRENT,
+                 readiness=READINESS_AGENT, ready_timeout=READY_TIMEOUT,
+                 host=None):
+        """
+        Initialize the orchestrator
+
+        Args:
+            conn: libvirt connection
+            max_concurrent: Maximum VMs starting at once
+            readiness: READINESS_AGENT, READINESS_IP or READINESS_NONE
+            ready_timeout: Seconds to wait for a VM to become ready
+            host: Hypervisor hostname for operation events
+        """
+        self.conn = conn
+        self.max_concurrent = max(1, max_concurrent)
+        self.readiness = readiness
+        self.ready_timeout = ready_timeout
+        self.host = host
+        self._agent_up = {}
+        self._lock = threading.Lock()
+
+    def run(self, waves, depends, progress=None):
+        """
+        Start all waves
+
+        Args:
+            waves: Output of plan_boot()
+            depends: Dict of name -> list of dependencies
+            progress: Optional callable(result) invoked as VMs finish
+
+        Returns:
+            List of BootResult
+        """
+        dispatcher = vm_events.get_dispatcher(self.conn)
+        token = None
+        if dispatcher is not None and self.readiness == READINESS_AGENT:
+            try:
+                token = dispatcher.subscribe(
+                    libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE, self._on_agent)
+            except libvirt.libvirtError:
+                # Older libvirt: readiness falls back to periodic pings
+                pass
+
+        results = []
+        # Results of earlier waves, for dependencies across waves
+        finished = {}
+        try:
+            for wave, names in waves:
+                results.extend(self._run_wave(wave, names, depends, finished,
+                                              progress))
+        finally:
+            if token is not None:
+                dispatcher.unsubscribe(token)
+        return results
+
+    def _on_agent(self, dom, state, reason):
+        """Agent lifecycle event: wake the readiness wait of that VM"""
+        with self._lock:
+            flag = self._agent_up.get(dom.UUIDString())
+        if flag is not None and \
+                state == libvirt.VIR_CONNECT_DOMAIN_EVENT_AGENT_LIFECYCLE_STATE_CONNECTED:
+            flag.set()
+
+    def _run_wave(self, wave, names, depends, finished, progress):
+        """
+        Start one wave and wait until every VM in it is finished
+
+        Args:
+            finished: Dict of name -> BootResult of earlier waves, updated
+                with the results of this wave
+        """
+        pending = list(names)
+        done = queue.Queue()
+        running = 0
+
+        while pending or running:
+            # Start every VM whose dependencies are ready, up to the limit
+            for name in list(pending):
+                if running >= self.max_concurrent:
+                    break
+                deps = [d for d in depends.get(name, [])
+                        if d != name and (d in names or d in finished)]
+                if any(d not in finished for d in deps):
+                    continue
+                pending.remove(name)
+                result = BootResult(name, wave)
+                failed = [d for d in deps if finished[d].outcome != 'ready']
+                if failed:
+                    result.outcome = 'blocked'
+                    result.error = "dependency not ready: %s" % ", ".join(failed)
+                    done.put(result)
+                else:
+                    thread = threading.Thread(target=self._boot,
+                                              args=(result, done))
+                    thread.daemon = True
+                    thread.start()
+                running += 1
+
+            result = done.get()
+            running -= 1
+            finished[result.name] = result
+            if progress:
+                progress(result)
+        return [finished[n] for n in names]
+
+    def _boot(self, result, done):
+        """Worker thread: start one VM and wait until it is ready"""
+        begin = time.time()
+        dom = None
+        try:
+            dom = self.conn.lookupByName(result.name)
+            if not dom.isActive():
+                dom.create()
+            result.start_seconds = round(time.time() - begin, 3)
+            if self._wait_ready(dom, begin):
+                result.outcome = 'ready'
+                result.ready_seconds = round(time.time() - begin, 3)
+            else:
+                result.outcome = 'timeout'
+        except Exception as e:
+            # Anything else would leave the wave waiting for this VM forever
+            result.outcome = 'failed'
+            result.error = str(e) or e.__class__.__name__
+        finally:
+            try:
+                vm_oplog.log_event(
+                    'boot', dom, self.host, time.time() - begin,
+                    'error' if result.outcome == 'failed' else 'ok',
+                    result.error, name=result.name, wave=result.wave,
+                    outcome=result.outcome)
+            finally:
+                done.put(result)
+
+    def _wait_ready(self, dom, begin):
+        """Block until the VM is ready or the timeout expires"""
+        if self.readiness == READINESS_NONE:
+            return True
+        uuid = dom.UUIDString()
+        flag = threading.Event()
+        with self._lock:
+            self._agent_up[uuid] = flag
+        try:
+            while time.time() - begin < self.ready_timeout:
+                if self._check_ready(dom):
+                    return True
+                flag.wait(READY_POLL_INTERVAL)
+            return False
+        finally:
+            with self._lock:
+                self._agent_up.pop(uuid, None)
+
+    def _check_ready(self, dom):
+        """
+        Run one readiness probe
+
+        Raises:
+            RuntimeError: The agent probe needs libvirt_qemu, which is not
+                installed
+        """
+        if self.readiness == READINESS_AGENT and libvirt_qemu is None:
+            raise RuntimeError("readiness probe unavailable: "
+                               "libvirt_qemu is not installed")
+        try:
+            if self.readiness == READINESS_IP:
+                ifaces = dom.interfaceAddresses(
+                    libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT, 0)
+                return any(addr['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4
+                           for name, data in ifaces.items() if name != 'lo'
+                           for addr in (data.get('addrs') or []))
+            libvirt_qemu.qemuAgentCommand(
+                vm_instrument.unwrap(dom), '{"execute": "guest-ping"}', 5, 0)
+            return True
+        except libvirt.libvirtError:
+            return False
+
+
+def boot_fleet(conn, host=None, progress=None, config=None):
+    """
+    Start every VM under managed autostart
+
+    Args:
+        conn: libvirt connection
+        host: Hypervisor hostname for operation events
+        progress: Optional callable(result)
+        config: Configuration dict, defaults to the loaded file
+
+    Returns:
+        List of BootResult
+    """
+    cfg = boot_config(config)
+    names = [d.name() for d in conn.listAllDomains(
+        libvirt.VIR_CONNECT_LIST_DOMAINS_PERSISTENT)
+        if is_managed(d.name(), config)]
+    waves = plan_boot(names, cfg['depends'])
+    orchestrator = BootOrchestrator(conn, cfg['max_concurrent'],
+                                    cfg['readiness'], cfg['ready_timeout'],
+                                    host)
+    return orchestrator.run(waves, cfg['depends'], progress)
+
+
+def format_results(results):
+    """
+    Format boot results as a text table
+
+    Returns:
+        List of lines
+    """
+    lines = ["%-30s %5s %-8s %9s %9s" %
+             ("Name", "Wave", "Outcome", "Start s", "Ready s")]
+    lines.append("-" * 66)
+    for r in results:
+        lines.append("%-30s %5d %-8s %9s %9s" % (
+            r.name[:30], r.wave, r.outcome,
+            "%.2f" % r.start_seconds if r.start_seconds is not None else "-",
+            "%.2f" % r.ready_seconds if r.ready_seconds is not None else "-"))
+        if r.error:
+            lines.append("    %s" % r.error)
+    return lines
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Ordered and throttled start of managed-autostart VMs")
+    parser.add_argument("action",
+                        choices=["boot", "plan", "enable", "disable",
+                                 "takeover"])
+    parser.add_argument("names", nargs="*", help="VM names for enable/disable")
+    parser.add_argument("--uri", default="qemu:///system")
+    args = parser.parse_args(argv)
+
+    vm_events.start_event_loop()
+    try:
+        conn = vm_instrument.instrument(libvirt.open(args.uri))
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        return 1
+
+    try:
+        if args.action in ("enable", "disable"):
+            for name in args.names:
+                set_managed(conn, name, args.action == "enable")
+                print("%s: managed autostart %sd" % (name, args.action))
+        elif args.action == "takeover":
+            for name in take_over_autostart(conn):
+                print("%s: taken over from libvirt autostart" % name)
+        elif args.action == "plan":
+            cfg = boot_config()
+            names = [d.name() for d in conn.listAllDomains()
+                     if is_managed(d.name())]
+            print(json.dumps(plan_boot(names, cfg['depends']), indent=2))
+        else:
+            start = time.time()
+            results = boot_fleet(conn, conn.getHostname())
+            for line in format_results(results):
+                print(line)
+            print("\n%d VMs in %.1f s" % (len(results), time.time() - start))
+            if any(r.outcome != 'ready' for r in results):
+                return 1
+    except (libvirt.libvirtError, ValueError) as e:
+        print("Error: %s" % e)
+        return 1
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Configuration
+-------------
+Fleet configuration shared by the VM manager subsystems
+
+The configuration is a JSON file (vm_manager.json in the working
+directory, or the path in VM_MANAGER_CONFIG) with one section per
+subsystem, for example:
+
+    {
+        "priorities": {"db*": 10, "app*": 50}
+    }
+
+A missing file is treated as an empty configuration.
+"""
+
+import fnmatch
+import json
+import os
+
+CONFIG_FILE = os.environ.get('VM_MANAGER_CONFIG', 'vm_manager.json')
+DEFAULT_PRIORITY = 100
+
+_cache = {}
+
+
+def load_config(path=None, reload=False):
+    """
+    Load the configuration file
+
+    Args:
+        path: Configuration file, defaults to CONFIG_FILE
+        reload: Re-read the file even if it was loaded before
+
+    Returns:
+        Configuration dict
+
+    Raises:
+        ValueError: The file is not valid JSON
+    """
+    path = path or CONFIG_FILE
+    if reload or path not in _cache:
+        if os.path.exists(path):
+            with open(path) as f:
+                _cache[path] = json.load(f)
+        else:
+            _cache[path] = {}
+    return _cache[path]
+
+
+def save_config(config, path=None):
+    """
+    Atomically write the configuration file
+
+    Args:
+        config: Configuration dict
+        path: Configuration file, defaults to CONFIG_FILE
+    """
+    path = path or CONFIG_FILE
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+    _cache[path] = config
+
+
+def section(name, config=None):
+    """Return a configuration section, or an empty dict"""
+    if config is None:
+        config = load_config()
+    return config.get(name) or {}
+
+
+def match_name(name, mapping, default=None):
+    """
+    Look up a VM name in a mapping whose keys may be glob patterns
+
+    An exact key wins over patterns; among patterns the longest wins.
+
+    Args:
+        name: VM name
+        mapping: Dict of name or pattern -> value
+        default: Value when nothing matches
+
+    Returns:
+        The matching value or default
+    """
+    if name in mapping:
+        return mapping[name]
+    matches = [p for p in mapping if fnmatch.fnmatchcase(name, p)]
+    if not matches:
+        return default
+    return mapping[max(matches, key=len)]
+
+
+def vm_priority(name, config=None):
+    """
+    Return the start priority of a VM (lower starts first)
+
+    Args:
+        name: VM name
+        config: Configuration dict, defaults to the loaded file
+
+    Returns:
+        Integer priority
+    """
+    return int(match_name(name, section('priorities', config),
+                          DEFAULT_PRIORITY))
@@ -0,0 +1,457 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Consolidation Planner
+---------------------
+Propose live migrations across several hypervisors
+
+Inventory and measured usage are read from each libvirt URI (one bulk
+stats call at the start and the end of a short interval). Two planners
+work on that snapshot:
+
+    consolidate  First-fit decreasing: try to drain the least loaded
+                 hosts, placing their VMs (largest memory first) on the
+                 fullest hosts that can take them. A host is only
+                 drained when all of its VMs fit elsewhere.
+    balance      Move VMs from the busiest to the least busy host until
+                 CPU load is within a tolerance or the move limit is hit.
+
+Every placement respects the constraints:
+
+    - memory: assigned memory stays below (1 - memory_headroom) of host RAM
+    - CPU: measured usage stays below cpu_limit of the host's CPUs
+    - anti-affinity: two VMs with the same tag never share a host
+
+The result is an ordered list of migrations; applying them in order
+never overfills a host. Nothing is migrated by this module.
+
+Configuration ("consolidate" section of vm_manager.json):
+
+    "consolidate": {
+        "memory_headroom": 0.1,
+        "cpu_limit": 0.8,
+        "balance_tolerance": 0.1,
+        "max_migrations": 200,
+        "anti_affinity": {"db*": "db", "web*": "web"}
+    }
+
+Examples:
+    python vm_consolidate.py qemu+ssh://h1/system qemu+ssh://h2/system
+    python vm_consolidate.py --mode balance URI...
+    python vm_consolidate.py --synthetic 50,4000     # synthetic fleet
+"""
+
+import argparse
+import random
+import sys
+import time
+
+import libvirt
+
+import vm_config
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+MEMORY_HEADROOM = 0.1
+CPU_LIMIT = 0.8
+BALANCE_TOLERANCE = 0.1
+MAX_MIGRATIONS = 200
+SAMPLE_INTERVAL = 5.0
+
+STATS = (libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_BALLOON |
+         libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL)
+
+
+def consolidate_config(config=None):
+    """Return the "consolidate" section with defaults filled in"""
+    cfg = vm_config.section('consolidate', config)
+    return {
+        'memory_headroom': float(cfg.get('memory_headroom', MEMORY_HEADROOM)),
+        'cpu_limit': float(cfg.get('cpu_limit', CPU_LIMIT)),
+        'balance_tolerance': float(cfg.get('balance_tolerance',
+                                           BALANCE_TOLERANCE)),
+        'max_migrations': int(cfg.get('max_migrations', MAX_MIGRATIONS)),
+        'anti_affinity': dict(cfg.get('anti_affinity', {})),
+    }
+
+
+# =============================================================================
+# MODEL
+# =============================================================================
+
+class VM(object):
+    """A running domain and the resources it needs on any host"""
+
+    __slots__ = ('name', 'uuid', 'vcpus', 'memory_mb', 'cpu', 'tag', 'host')
+
+    def __init__(self, name, uuid, vcpus, memory_mb, cpu, tag=None):
+        self.name = name
+        self.uuid = uuid
+        self.vcpus = vcpus
+        self.memory_mb = memory_mb
+        self.cpu = cpu              # measured usage in CPUs
+        self.tag = tag
+        self.host = None
+
+
+class Host(object):
+    """One hypervisor with capacity limits and the VMs placed on it"""
+
+    def __init__(self, uri, name, cpus, memory_mb, cfg):
+        """
+        Initialize the host
+
+        Args:
+            uri: libvirt URI
+            name: Hostname
+            cpus: Number of CPUs
+            memory_mb: Physical memory in MB
+            cfg: Output of consolidate_config()
+        """
+        self.uri = uri
+        self.name = name
+        self.cpus = cpus
+        self.memory_mb = memory_mb
+        self.memory_cap = memory_mb * (1.0 - cfg['memory_headroom'])
+        self.cpu_cap = cpus * cfg['cpu_limit']
+        self.vms = {}
+        self.used_memory = 0
+        self.used_cpu = 0.0
+        self.tags = {}
+
+    @property
+    def load(self):
+        """Measured CPU usage as a fraction of the host's CPUs"""
+        return self.used_cpu / self.cpus if self.cpus else 0.0
+
+    def fits(self, vm):
+        """Return True when vm can be added without breaking a constraint"""
+        return (self.used_memory + vm.memory_mb <= self.memory_cap and
+                self.used_cpu + vm.cpu <= self.cpu_cap and
+                not (vm.tag and self.tags.get(vm.tag)))
+
+    def add(self, vm):
+        """Place a VM on the host"""
+        self.vms[vm.uuid] = vm
+        self.used_memory += vm.memory_mb
+        self.used_cpu += vm.cpu
+        if vm.tag:
+            self.tags[vm.tag] = self.tags.get(vm.tag, 0) + 1
+        vm.host = self
+
+    def remove(self, vm):
+        """Take a VM off the host"""
+        del self.vms[vm.uuid]
+        self.used_memory -= vm.memory_mb
+        self.used_cpu -= vm.cpu
+        if vm.tag:
+            self.tags[vm.tag] -= 1
+        vm.host = None
+
+
+class Migration(object):
+    """One step of a plan"""
+
+    def __init__(self, vm, source, target, reason):
+        self.vm = vm
+        self.source = source
+        self.target = target
+        self.reason = reason
+
+    def to_dict(self):
+        """Return the migration as a plain dict"""
+        return {'name': self.vm.name, 'uuid': self.vm.uuid,
+                'source': self.source.uri, 'target': self.target.uri,
+                'memory_mb': self.vm.memory_mb, 'cpu': round(self.vm.cpu, 2),
+                'reason': self.reason}
+
+
+def _tag_for(name, cfg):
+    return vm_config.match_name(name, cfg['anti_affinity'])
+
+
+# =============================================================================
+# COLLECTION
+# =============================================================================
+
+def collect(uris, interval=SAMPLE_INTERVAL, config=None):
+    """
+    Read capacity, running VMs and their CPU usage from several hosts
+
+    Args:
+        uris: libvirt URIs
+        interval: Seconds between the two CPU samples
+        config: Configuration dict
+
+    Returns:
+        List of Host with their VMs placed
+    """
+    cfg = consolidate_config(config)
+    conns = []
+    try:
+        for uri in uris:
+            conns.append((uri, libvirt.openReadOnly(uri)))
+        first = [c.getAllDomainStats(
+            STATS, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_RUNNING)
+            for _, c in conns]
+        start = time.time()
+        time.sleep(interval)
+        hosts = []
+        for (uri, conn), before in zip(conns, first):
+            after = conn.getAllDomainStats(
+                STATS, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_RUNNING)
+            elapsed = time.time() - start
+            info = conn.getInfo()
+            host = Host(uri, conn.getHostname(), info[2], info[1], cfg)
+            cpu_before = dict((d.UUIDString(), s.get('cpu.time', 0))
+                              for d, s in before)
+            for dom, values in after:
+                uuid = dom.UUIDString()
+                used = 0.0
+                if uuid in cpu_before and elapsed > 0:
+                    used = max(0.0, (values.get('cpu.time', 0) -
+                                     cpu_before[uuid]) / 1e9 / elapsed)
+                memory = values.get('balloon.current',
+                                    values.get('balloon.maximum', 0)) // 1024
+                name = dom.name()
+                host.add(VM(name, uuid, values.get('vcpu.current', 1),
+                            memory, used, _tag_for(name, cfg)))
+            hosts.append(host)
+        return hosts
+    finally:
+        for _, conn in conns:
+            conn.close()
+
+
+def synthetic_fleet(host_count, vm_count, seed=0, config=None):
+    """
+    Build a random fleet for testing and benchmarking
+
+    Hosts have 32-64 CPUs and 256-512 GB. VMs get random sizes and
+    usage, about a tenth of them tagged, and are placed on a random host
+    that can take them; VMs that fit nowhere are left out.
+
+    Returns:
+        List of Host
+    """
+    cfg = consolidate_config(config)
+    rng = random.Random(seed)
+    hosts = [Host("test:///host%03d" % i, "host%03d" % i,
+                  rng.choice((32, 48, 64)), rng.choice((262144, 393216, 524288)),
+                  cfg) for i in range(host_count)]
+    for i in range(vm_count):
+        vcpus = rng.choice((1, 2, 4, 8))
+        vm = VM("vm%05d" % i, "00000000-0000-4000-8000-%012d" % i, vcpus,
+                rng.choice((1024, 2048, 4096, 8192, 16384)),
+                round(vcpus * rng.random() * 0.5, 2),
+                "group%d" % (i % 50) if i % 10 == 0 else None)
+        first = rng.randrange(host_count)
+        for j in range(host_count):
+            host = hosts[(first + j) % host_count]
+            if host.fits(vm):
+                host.add(vm)
+                break
+    return hosts
+
+
+# =============================================================================
+# PLANNING
+# =============================================================================
+
+def plan_consolidation(hosts, max_migrations=None):
+    """
+    Drain as many hosts as possible with first-fit decreasing
+
+    Hosts are tried least loaded first. Their VMs, largest memory first,
+    go to the first target (fullest memory first) that fits. A host that
+    cannot be drained completely is left untouched. Hosts that are
+    already empty are neither counted as drained nor used as targets,
+    since filling one to empty another frees nothing.
+
+    Args:
+        hosts: List of Host (modified to the planned placement)
+        max_migrations: Stop before exceeding this many migrations
+
+    Returns:
+        (migrations, drained hosts)
+    """
+    migrations = []
+    drained = []
+    draining = set()
+    received = set()
+    empty = set(h.uri for h in hosts if not h.vms)
+    for source in sorted(hosts, key=lambda h: (h.used_memory, h.used_cpu)):
+        if source.uri in received or source.uri in empty:
+            # Draining it would migrate the VMs it just received again, or
+            # free nothing
+            continue
+        vms = sorted(source.vms.values(), key=lambda v: (-v.memory_mb, -v.cpu))
+        if max_migrations is not None and \
+                len(migrations) + len(vms) > max_migrations:
+            continue
+        draining.add(source.uri)
+        targets = sorted((h for h in hosts
+                          if h.uri not in draining and h.uri not in empty),
+                         key=lambda h: -h.used_memory)
+        moved = []
+        for vm in vms:
+            target = next((t for t in targets if t.fits(vm)), None)
+            if target is None:
+                break
+            source.remove(vm)
+            target.add(vm)
+            moved.append(Migration(vm, source, target, "drain %s" % source.name))
+        if len(moved) < len(vms):
+            # Roll back: this host stays in service
+            for m in moved:
+                m.target.remove(m.vm)
+                source.add(m.vm)
+            draining.discard(source.uri)
+            continue
+        migrations.extend(moved)
+        received.update(m.target.uri for m in moved)
+        drained.append(source)
+    return migrations, drained
+
+
+def plan_balance(hosts, tolerance=BALANCE_TOLERANCE,
+                 max_migrations=MAX_MIGRATIONS):
+    """
+    Even out CPU load by moving VMs from the busiest to the idlest host
+
+    Each step moves the VM whose usage is closest to half the load gap
+    and that the idlest host can take.
+
+    Args:
+        hosts: List of Host (modified to the planned placement)
+        tolerance: Stop when max and min load differ by less than this
+        max_migrations: Upper bound on migrations
+
+    Returns:
+        List of Migration
+    """
+    migrations = []
+    moved = set()
+    while len(migrations) < max_migrations and len(hosts) > 1:
+        busiest = max(hosts, key=lambda h: h.load)
+        idlest = min(hosts, key=lambda h: h.load)
+        gap = busiest.load - idlest.load
+        if gap <= tolerance:
+            break
+        # CPU that would put both hosts at the same load
+        ideal = gap * busiest.cpus * idlest.cpus / (busiest.cpus + idlest.cpus)
+        best = None
+        for vm in busiest.vms.values():
+            if vm.uuid in moved or vm.cpu <= 0 or vm.cpu >= 2 * ideal:
+                continue
+            if idlest.fits(vm) and (best is None or
+                                    abs(vm.cpu - ideal) < abs(best.cpu - ideal)):
+                best = vm
+        if best is None:
+            break
+        busiest.remove(best)
+        idlest.add(best)
+        moved.add(best.uuid)
+        migrations.append(Migration(best, busiest, idlest,
+                                    "balance %.0f%% -> %.0f%%" %
+                                    (gap * 100, abs(busiest.load - idlest.load) * 100)))
+    return migrations
+
+
+def format_hosts(hosts):
+    """
+    Format host usage as a table
+
+    Returns:
+        List of lines
+    """
+    lines = ["%-20s %5s %6s %9s %7s %7s" %
+             ("Host", "VMs", "CPUs", "Mem used", "Mem %", "CPU %")]
+    lines.append("-" * 60)
+    for h in sorted(hosts, key=lambda h: h.name):
+        lines.append("%-20s %5d %6d %8.0fG %6.0f%% %6.0f%%" % (
+            h.name[:20], len(h.vms), h.cpus, h.used_memory / 1024.0,
+            100.0 * h.used_memory / h.memory_mb if h.memory_mb else 0,
+            100.0 * h.load))
+    return lines
+
+
+def format_plan(migrations):
+    """
+    Format an ordered plan with the virsh commands to carry it out
+
+    Returns:
+        List of lines
+    """
+    if not migrations:
+        return ["No migrations proposed"]
+    lines = []
+    for i, m in enumerate(migrations, 1):
+        lines.append("%4d. %-24s %-14s -> %-14s %s" % (
+            i, m.vm.name[:24], m.source.name[:14], m.target.name[:14], m.reason))
+        lines.append("      virsh -c %s migrate --live --persistent "
+                     "--undefinesource %s %s" % (m.source.uri, m.vm.name,
+                                                 m.target.uri))
+    return lines
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Propose migrations that free hosts or even out load")
+    parser.add_argument("uris", nargs="*", help="libvirt URIs of the hosts")
+    parser.add_argument("--mode", choices=("consolidate", "balance"),
+                        default="consolidate")
+    parser.add_argument("--interval", type=float, default=SAMPLE_INTERVAL,
+                        help="CPU sampling interval in seconds")
+    parser.add_argument("--synthetic", metavar="HOSTS,VMS",
+                        help="Plan for a random fleet instead of real hosts")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    cfg = consolidate_config()
+    try:
+        if args.synthetic:
+            host_count, vm_count = [int(x) for x in args.synthetic.split(',')]
+            hosts = synthetic_fleet(host_count, vm_count, args.seed)
+        elif args.uris:
+            hosts = collect(args.uris, args.interval)
+        else:
+            parser.error("give host URIs or --synthetic")
+    except (ValueError, libvirt.libvirtError) as e:
+        print("Error: %s" % e)
+        return 1
+
+    print("Before:")
+    for line in format_hosts(hosts):
+        print("  " + line)
+
+    start = time.time()
+    if args.mode == "consolidate":
+        migrations, drained = plan_consolidation(hosts, cfg['max_migrations'])
+    else:
+        migrations = plan_balance(hosts, cfg['balance_tolerance'],
+                                  cfg['max_migrations'])
+        drained = []
+    elapsed = time.time() - start
+
+    print("\nPlan:")
+    for line in format_plan(migrations):
+        print("  " + line)
+    print("\nAfter:")
+    for line in format_hosts(hosts):
+        print("  " + line)
+    print("\n%d migration(s), %d host(s) freed, %d VMs planned in %.2f s" %
+          (len(migrations), len(drained), sum(len(h.vms) for h in hosts),
+           elapsed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
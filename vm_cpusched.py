@@ -0,0 +1,306 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+CPU Scheduling
+--------------
+CPU shares and bandwidth quotas per VM class
+
+Each class sets cgroup scheduler parameters with setSchedulerParametersFlags:
+cpu_shares (relative weight under contention), and vcpu_period/vcpu_quota
+and emulator_period/emulator_quota (hard caps in microseconds per period;
+-1 means no cap). Classes are assigned per VM or by pattern.
+
+The report compares what each running domain consumed (getCPUStats) with
+its entitlement: its share of the host CPUs by cpu_shares, limited by its
+quota cap.
+
+Configuration (vm_manager.json):
+    "cpu_sched": {
+        "classes": {"gold": {"cpu_shares": 4096}, ...},
+        "vms": {"db*": "gold", "build*": "batch"}
+    }
+
+Examples:
+    python vm_cpusched.py apply "build*" --class batch
+    python vm_cpusched.py apply all          # configured classes
+    python vm_cpusched.py report --interval 5
+"""
+
+import argparse
+import sys
+import time
+
+import libvirt
+
+import vm_config
+import vm_instrument
+import vm_oplog
+import vm_select
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+SCHED_KEYS = ('cpu_shares', 'vcpu_period', 'vcpu_quota',
+              'emulator_period', 'emulator_quota')
+
+DEFAULT_SHARES = 1024
+
+# Built-in classes; the "classes" config section overrides or adds to them
+DEFAULT_CLASSES = {
+    'gold': {'cpu_shares': 4096, 'vcpu_quota': -1, 'emulator_quota': -1},
+    'silver': {'cpu_shares': 1024, 'vcpu_quota': -1, 'emulator_quota': -1},
+    'batch': {'cpu_shares': 256, 'vcpu_period': 100000, 'vcpu_quota': 50000,
+              'emulator_period': 100000, 'emulator_quota': 20000},
+}
+
+# =============================================================================
+# CLASSES
+# =============================================================================
+
+def classes(config=None):
+    """Return all scheduling classes (built-in merged with configured)"""
+    result = dict(DEFAULT_CLASSES)
+    result.update(vm_config.section('cpu_sched', config).get('classes', {}))
+    return result
+
+
+def class_for(name, config=None):
+    """Return the configured class name of a VM, or None"""
+    return vm_config.match_name(
+        name, vm_config.section('cpu_sched', config).get('vms', {}))
+
+
+def set_params(dom, params):
+    """
+    Set scheduler parameters of a domain, live and persistent
+
+    Args:
+        dom: libvirt domain
+        params: Dict of SCHED_KEYS -> value
+
+    Raises:
+        ValueError: Unknown parameter name
+    """
+    unknown = set(params) - set(SCHED_KEYS)
+    if unknown:
+        raise ValueError("Unknown scheduler parameters: %s" %
+                         ", ".join(sorted(unknown)))
+    flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+    if dom.isActive():
+        flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+    dom.setSchedulerParametersFlags(dict((k, int(v))
+                                         for k, v in params.items()), flags)
+
+
+def apply(domains, class_name=None, host=None, config=None):
+    """
+    Apply a class, or each domain's configured class, to many domains
+
+    Args:
+        domains: libvirt domains
+        class_name: Class for all of them; None uses the configured class
+        host: Hypervisor hostname for operation events
+        config: Configuration dict
+
+    Returns:
+        List of (name, class or None, error or None); domains without a
+        class are skipped
+    """
+    all_classes = classes(config)
+    if class_name and class_name not in all_classes:
+        raise ValueError("Unknown CPU class: %s" % class_name)
+
+    results = []
+    for dom in domains:
+        name = dom.name()
+        cls = class_name or class_for(name, config)
+        if not cls:
+            results.append((name, None, None))
+            continue
+        try:
+            if cls not in all_classes:
+                raise ValueError("Unknown CPU class: %s" % cls)
+            with vm_oplog.operation('cpu_sched', dom, host, cpu_class=cls):
+                set_params(dom, all_classes[cls])
+            results.append((name, cls, None))
+        except (libvirt.libvirtError, ValueError) as e:
+            results.append((name, cls, str(e)))
+    return results
+
+
+# =============================================================================
+# ENTITLEMENT REPORT
+# =============================================================================
+
+def quota_cap(vcpus, period, quota):
+    """
+    Return the CPU cap implied by a vCPU quota, in CPUs
+
+    Returns:
+        CPUs, or None when uncapped
+    """
+    if quota is None or quota <= 0 or not period:
+        return None
+    return vcpus * float(quota) / period
+
+
+def entitlements(domains, host_cpus):
+    """
+    Compute each domain's CPU entitlement under full contention
+
+    Shares divide the host CPUs proportionally; a domain can never get
+    more than its vCPU count or its quota cap, and what it cannot use is
+    redistributed to the others.
+
+    Args:
+        domains: Dict of name -> {"shares", "vcpus", "period", "quota"}
+        host_cpus: Number of host CPUs
+
+    Returns:
+        Dict of name -> entitled CPUs
+    """
+    limits = {}
+    for name, d in domains.items():
+        cap = quota_cap(d['vcpus'], d.get('period'), d.get('quota'))
+        limits[name] = d['vcpus'] if cap is None else min(cap, d['vcpus'])
+
+    result = dict((name, 0.0) for name in domains)
+    open_set = set(domains)
+    remaining = float(host_cpus)
+    while open_set and remaining > 1e-9:
+        total_shares = float(sum(domains[n]['shares'] for n in open_set))
+        if total_shares <= 0:
+            break
+        saturated = set()
+        for name in open_set:
+            offer = remaining * domains[name]['shares'] / total_shares
+            if result[name] + offer >= limits[name]:
+                saturated.add(name)
+        if not saturated:
+            for name in open_set:
+                result[name] += remaining * domains[name]['shares'] / total_shares
+            break
+        for name in saturated:
+            remaining -= limits[name] - result[name]
+            result[name] = limits[name]
+        open_set -= saturated
+    return result
+
+
+def _cpu_time(dom):
+    """Return total CPU time of a domain in nanoseconds"""
+    return dom.getCPUStats(True, 0)[0]['cpu_time']
+
+
+def report(conn, interval=5.0, config=None):
+    """
+    Measure CPU consumption of running domains against their entitlement
+
+    Args:
+        conn: libvirt connection
+        interval: Seconds between the two samples
+        config: Configuration dict
+
+    Returns:
+        List of dicts with name, class, shares, cap, entitled and used
+    """
+    domains = conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+    info = {}
+    first = {}
+    for dom in list(domains):
+        try:
+            params = dom.schedulerParametersFlags(libvirt.VIR_DOMAIN_AFFECT_LIVE)
+            info[dom.name()] = {
+                'shares': params.get('cpu_shares', DEFAULT_SHARES),
+                'vcpus': dom.vcpusFlags(libvirt.VIR_DOMAIN_AFFECT_LIVE),
+                'period': params.get('vcpu_period'),
+                'quota': params.get('vcpu_quota'),
+            }
+            first[dom.name()] = (time.time(), _cpu_time(dom))
+        except libvirt.libvirtError:
+            # Stopped since it was listed
+            info.pop(dom.name(), None)
+            domains.remove(dom)
+
+    time.sleep(interval)
+
+    entitled = entitlements(info, conn.getInfo()[2])
+    rows = []
+    for dom in domains:
+        name = dom.name()
+        start, cpu_start = first[name]
+        try:
+            used = (_cpu_time(dom) - cpu_start) / 1e9 / (time.time() - start)
+        except libvirt.libvirtError:
+            continue
+        d = info[name]
+        rows.append({'name': name, 'class': class_for(name, config),
+                     'shares': d['shares'],
+                     'cap': quota_cap(d['vcpus'], d['period'], d['quota']),
+                     'entitled': entitled[name], 'used': max(used, 0.0)})
+    return sorted(rows, key=lambda r: -r['used'])
+
+
+def format_report(rows):
+    """
+    Format the entitlement report as a text table
+
+    Returns:
+        List of lines
+    """
+    lines = ["%-28s %-7s %7s %6s %9s %7s %6s" %
+             ("Name", "Class", "Shares", "Cap", "Entitled", "Used", "Use %")]
+    lines.append("-" * 76)
+    for r in rows:
+        cap = "%.2f" % r['cap'] if r['cap'] is not None else "-"
+        pct = 100.0 * r['used'] / r['entitled'] if r['entitled'] else 0.0
+        lines.append("%-28s %-7s %7d %6s %9.2f %7.2f %5.0f%%" %
+                     (r['name'][:28], r['class'] or "-", r['shares'], cap,
+                      r['entitled'], r['used'], pct))
+    return lines
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="CPU scheduling classes")
+    parser.add_argument("action", choices=["apply", "report"])
+    parser.add_argument("selector", nargs="?", default="all",
+                        help='VMs for apply, e.g. "build*" (default: all)')
+    parser.add_argument("--uri", default="qemu:///system")
+    parser.add_argument("--class", dest="class_name",
+                        help="Class to apply (default: configured class)")
+    parser.add_argument("--interval", type=float, default=5.0)
+    args = parser.parse_args(argv)
+
+    try:
+        conn = vm_instrument.instrument(libvirt.open(args.uri))
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        return 1
+
+    status = 0
+    try:
+        if args.action == "apply":
+            for name, cls, error in apply(vm_select.select(conn, args.selector),
+                                          args.class_name, conn.getHostname()):
+                print("%-30s %-8s %s" % (name, cls or "-",
+                                         error or ("ok" if cls else "no class")))
+                status = 1 if error else status
+        else:
+            for line in format_report(report(conn, args.interval)):
+                print(line)
+    except (ValueError, libvirt.libvirtError) as e:
+        print("Error: %s" % e)
+        status = 1
+    finally:
+        conn.close()
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
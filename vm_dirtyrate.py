@@ -0,0 +1,302 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Dirty Rate and Migration Prediction
+-----------------------------------
+Predict how long each running guest takes to live-migrate
+
+The memory dirty rate of every running domain is measured at once: a
+calculation is started on each domain (startDirtyRateCalc) by a pool
+of workers, and the results are collected with one bulk stats call
+(dirtyrate.* fields).
+
+predict() is a pure pre-copy model: the first pass sends all memory,
+every further pass resends what was dirtied during the previous one,
+and the guest is paused for the last pass once it fits in the allowed
+downtime. With dirty rate D and bandwidth B each pass is D/B times the
+previous one, so guests with D >= B never converge. Guests that need
+many passes are flagged for auto-converge (vCPU throttling), guests
+that cannot converge for post-copy.
+
+Configuration ("migration" section of vm_manager.json):
+
+    "migration": {"bandwidth_mbps": 1100, "downtime_ms": 300}
+
+bandwidth_mbps is in MB/s (a 10 GbE link carries about 1100 MB/s).
+
+Examples:
+    python vm_dirtyrate.py measure --record samples.jsonl
+    python vm_dirtyrate.py replay samples.jsonl --bandwidth 110
+"""
+
+import argparse
+import json
+import math
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+import libvirt
+
+import vm_config
+import vm_instrument
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+CALC_SECONDS = 1
+CALC_WORKERS = 16
+# Extra seconds to wait for calculations to finish
+CALC_GRACE = 5
+POLL_INTERVAL = 0.2
+
+BANDWIDTH_MBPS = 1100
+DOWNTIME_MS = 300
+MAX_PASSES = 30
+# Above this dirty/bandwidth ratio pre-copy needs many passes
+AUTO_CONVERGE_RATIO = 0.5
+
+# dirtyrate.calc_status values
+CALC_MEASURED = 2
+
+STATS_DIRTYRATE = getattr(libvirt, 'VIR_DOMAIN_STATS_DIRTYRATE', 1 << 9)
+STATS_BALLOON = libvirt.VIR_DOMAIN_STATS_BALLOON
+
+
+def migration_config(config=None):
+    """Return the "migration" section with defaults filled in"""
+    cfg = vm_config.section('migration', config)
+    return {
+        'bandwidth_mbps': float(cfg.get('bandwidth_mbps', BANDWIDTH_MBPS)),
+        'downtime_ms': float(cfg.get('downtime_ms', DOWNTIME_MS)),
+    }
+
+
+# =============================================================================
+# PREDICTION MODEL
+# =============================================================================
+
+class Prediction(object):
+    """Predicted pre-copy migration of one guest"""
+
+    def __init__(self, seconds, passes, converges, advice):
+        self.seconds = seconds        # post-copy time when not converging
+        self.passes = passes
+        self.converges = converges
+        self.advice = advice          # precopy, auto-converge or post-copy
+
+    def to_dict(self):
+        """Return the prediction as a plain dict"""
+        return dict(self.__dict__)
+
+
+def predict(memory_mb, dirty_mbps, bandwidth_mbps=BANDWIDTH_MBPS,
+            downtime_ms=DOWNTIME_MS, max_passes=MAX_PASSES):
+    """
+    Predict a pre-copy live migration
+
+    Args:
+        memory_mb: Guest memory in MB
+        dirty_mbps: Measured dirty rate in MB/s
+        bandwidth_mbps: Migration bandwidth in MB/s
+        downtime_ms: Longest acceptable pause of the guest
+        max_passes: Passes QEMU is given before the migration is
+            considered stuck
+
+    Returns:
+        Prediction; for guests that do not converge, seconds is the
+        post-copy estimate (one pass over all memory)
+    """
+    if bandwidth_mbps <= 0:
+        raise ValueError("bandwidth must be positive")
+    # Integer arguments must not truncate the times under Python 2
+    bandwidth_mbps = float(bandwidth_mbps)
+    ratio = dirty_mbps / bandwidth_mbps
+    # Data that can be sent while paused
+    final_mb = bandwidth_mbps * downtime_ms / 1000.0
+    if memory_mb <= final_mb:
+        return Prediction(downtime_ms / 1000.0, 1, True, 'precopy')
+
+    if ratio > 0 and ratio < 1:
+        # memory * ratio**n <= final_mb
+        passes = int(math.ceil(math.log(final_mb / memory_mb) /
+                               math.log(ratio))) + 1
+    else:
+        passes = 1 if ratio <= 0 else None
+
+    if passes is None or passes > max_passes:
+        return Prediction(round(memory_mb / bandwidth_mbps, 2),
+                          max_passes, False, 'post-copy')
+
+    # Geometric series: memory * (1 + r + ... + r**(passes-1)) / bandwidth
+    if ratio > 0:
+        sent = memory_mb * (1 - ratio ** passes) / (1 - ratio)
+    else:
+        sent = memory_mb
+    seconds = round(sent / bandwidth_mbps, 2)
+    advice = 'auto-converge' if ratio > AUTO_CONVERGE_RATIO else 'precopy'
+    return Prediction(seconds, passes, True, advice)
+
+
+# =============================================================================
+# MEASUREMENT
+# =============================================================================
+
+class DirtyRateSample(object):
+    """Measured dirty rate of one domain"""
+
+    def __init__(self, name, uuid, memory_mb):
+        self.name = name
+        self.uuid = uuid
+        self.memory_mb = memory_mb
+        self.dirty_mbps = None
+        self.error = None
+
+    def to_dict(self):
+        """Return the sample as a plain dict"""
+        return dict(self.__dict__)
+
+
+def measure(conn, domains=None, seconds=CALC_SECONDS, workers=CALC_WORKERS):
+    """
+    Measure the dirty rate of many running domains in parallel
+
+    Args:
+        conn: libvirt connection
+        domains: Domains to measure, defaults to all running domains
+        seconds: Length of each calculation
+        workers: Calculations started at once
+
+    Returns:
+        List of DirtyRateSample
+    """
+    if domains is None:
+        domains = conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_RUNNING)
+    if not domains:
+        return []
+    samples = dict((d.UUIDString(), DirtyRateSample(d.name(), d.UUIDString(), 0))
+                   for d in domains)
+
+    def start(dom):
+        try:
+            dom.startDirtyRateCalc(int(seconds), 0)
+        except (libvirt.libvirtError, AttributeError) as e:
+            samples[dom.UUIDString()].error = str(e)
+
+    pool = ThreadPool(min(workers, len(domains)))
+    try:
+        pool.map(start, domains)
+    finally:
+        pool.close()
+
+    started = [d for d in domains if samples[d.UUIDString()].error is None]
+    time.sleep(seconds)
+    deadline = time.time() + CALC_GRACE
+    waiting = set(d.UUIDString() for d in started)
+    while waiting:
+        # The binding only accepts real virDomain objects in the list
+        for dom, values in conn.domainListGetStats(
+                [vm_instrument.unwrap(d) for d in started],
+                STATS_DIRTYRATE | STATS_BALLOON, 0):
+            sample = samples[dom.UUIDString()]
+            sample.memory_mb = values.get('balloon.current',
+                                          values.get('balloon.maximum', 0)) // 1024
+            if values.get('dirtyrate.calc_status') == CALC_MEASURED:
+                sample.dirty_mbps = values.get('dirtyrate.megabytes_per_second', 0)
+                waiting.discard(sample.uuid)
+        if not waiting or time.time() >= deadline:
+            break
+        time.sleep(POLL_INTERVAL)
+
+    for uuid in waiting:
+        samples[uuid].error = "calculation did not finish"
+    return [samples[d.UUIDString()] for d in domains]
+
+
+def format_report(samples, bandwidth_mbps, downtime_ms):
+    """
+    Format samples and their predictions: guests that do not converge
+    first, then slowest migration first
+
+    Returns:
+        List of lines
+    """
+    rows = []
+    for s in samples:
+        p = (predict(s.memory_mb, s.dirty_mbps, bandwidth_mbps, downtime_ms)
+             if s.error is None and s.dirty_mbps is not None else None)
+        rows.append((s, p))
+    rows.sort(key=lambda r: (r[1] is None, r[1] is not None and r[1].converges,
+                             -(r[1].seconds if r[1] else 0)))
+
+    lines = ["%-28s %8s %10s %7s %9s  %s" %
+             ("Name", "Mem MB", "Dirty MB/s", "Passes", "Seconds", "Advice")]
+    lines.append("-" * 80)
+    for s, p in rows:
+        if p is None:
+            lines.append("%-28s %8d %10s %7s %9s  %s" %
+                         (s.name[:28], s.memory_mb, "-", "-", "-", s.error))
+            continue
+        lines.append("%-28s %8d %10d %7s %9.1f  %s" % (
+            s.name[:28], s.memory_mb, s.dirty_mbps,
+            p.passes if p.converges else ">%d" % p.passes, p.seconds,
+            p.advice))
+    return lines
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Measure dirty rates and predict live migration times")
+    parser.add_argument("action", choices=["measure", "replay"])
+    parser.add_argument("file", nargs="?", help="Recorded samples for replay")
+    parser.add_argument("--uri", default="qemu:///system")
+    parser.add_argument("--seconds", type=int, default=CALC_SECONDS)
+    parser.add_argument("--bandwidth", type=float,
+                        help="Migration bandwidth in MB/s")
+    parser.add_argument("--downtime", type=float, help="Allowed downtime in ms")
+    parser.add_argument("--record", help="Append samples to this file")
+    args = parser.parse_args(argv)
+
+    cfg = migration_config()
+    bandwidth = args.bandwidth or cfg['bandwidth_mbps']
+    downtime = args.downtime or cfg['downtime_ms']
+
+    if args.action == "replay":
+        if not args.file:
+            parser.error("replay needs a samples file")
+        samples = []
+        with open(args.file) as f:
+            for line in f:
+                sample = DirtyRateSample(None, None, 0)
+                sample.__dict__.update(json.loads(line))
+                samples.append(sample)
+    else:
+        try:
+            conn = vm_instrument.instrument(libvirt.open(args.uri))
+        except libvirt.libvirtError as e:
+            print("Error: %s" % e)
+            return 1
+        try:
+            samples = measure(conn, seconds=args.seconds)
+        finally:
+            conn.close()
+        if args.record:
+            now = time.time()
+            with open(args.record, 'a') as f:
+                for s in samples:
+                    f.write(json.dumps(dict(s.to_dict(), ts=now)) + "\n")
+
+    for line in format_report(samples, bandwidth, downtime):
+        print(line)
+    print("\nBandwidth %.0f MB/s, downtime %.0f ms" % (bandwidth, downtime))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
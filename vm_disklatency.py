@@ -0,0 +1,309 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Disk Latency Analyzer
+---------------------
+Per-disk I/O latency and IOPS of all running guests
+
+The timing counters of every disk (rd/wr/fl total_times, in ns, and
+request counts) are read with one bulk stats call. Two samples give
+the average latency of each kind of request over the interval:
+
+    latency = delta(total_times) / delta(requests)
+
+Samples are stored column-wise (one array per counter, one slot per
+disk), so an interval is analyzed with a few passes over flat arrays
+instead of per-disk dicts. Samples can be recorded to a file and the
+analysis replayed offline.
+
+Examples:
+    python vm_disklatency.py sample --interval 5 --count 12 --record io.jsonl
+    python vm_disklatency.py replay io.jsonl --by guest --top 10
+"""
+
+import argparse
+import json
+import operator
+import sys
+import time
+from array import array
+
+import libvirt
+
+import vm_instrument
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# Counters read from the bulk block stats, in column order
+FIELDS = ('rd.reqs', 'rd.times', 'wr.reqs', 'wr.times', 'fl.reqs', 'fl.times')
+
+SAMPLE_INTERVAL = 5.0
+TOP = 15
+# Disks below this many IOPS are not ranked: a single slow request on an
+# idle disk says little about the storage
+MIN_IOPS = 1.0
+# Average latency at which a disk is flagged as slow
+SLOW_MS = 20.0
+
+# =============================================================================
+# SAMPLING
+# =============================================================================
+
+def empty_sample(ts=None):
+    """Return a sample with no disks"""
+    return {'ts': time.time() if ts is None else ts, 'keys': [],
+            'columns': dict((f, array('d')) for f in FIELDS)}
+
+
+def sample(conn):
+    """
+    Read the timing counters of all disks of all running domains
+
+    Args:
+        conn: libvirt connection
+
+    Returns:
+        Dict with "ts", "keys" ("<vm>/<disk>") and "columns": field ->
+        array of counter values aligned with keys
+    """
+    stats = conn.getAllDomainStats(
+        libvirt.VIR_DOMAIN_STATS_BLOCK,
+        libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+    result = empty_sample()
+    keys = result['keys']
+    columns = [result['columns'][f] for f in FIELDS]
+    for dom, values in stats:
+        name = dom.name()
+        for i in range(values.get('block.count', 0)):
+            prefix = 'block.%d.' % i
+            target = values.get(prefix + 'name')
+            if target is None:
+                continue
+            keys.append('%s/%s' % (name, target))
+            for field, column in zip(FIELDS, columns):
+                column.append(values.get(prefix + field, 0))
+    return result
+
+
+def to_json(sample):
+    """Serialize a sample as one line of JSON"""
+    return json.dumps({'ts': sample['ts'], 'keys': sample['keys'],
+                       'columns': dict((f, c.tolist())
+                                       for f, c in sample['columns'].items())})
+
+
+def from_json(line):
+    """Load a sample written by to_json()"""
+    data = json.loads(line)
+    return {'ts': data['ts'], 'keys': data['keys'],
+            'columns': dict((f, array('d', data['columns'].get(f, [0] * len(data['keys']))))
+                            for f in FIELDS)}
+
+
+def load_samples(path):
+    """Read recorded samples, oldest first"""
+    with open(path) as f:
+        return [from_json(line) for line in f if line.strip()]
+
+
+# =============================================================================
+# ANALYSIS
+# =============================================================================
+
+def _latency_ms(times, reqs):
+    return times / reqs / 1e6 if reqs > 0 else 0.0
+
+
+class Interval(object):
+    """
+    Latency and IOPS of every disk between two samples
+
+    Attributes are arrays aligned with keys: read_ms, write_ms, flush_ms,
+    avg_ms (reads and writes together), iops, and the raw counter deltas
+    in deltas[field].
+    """
+
+    def __init__(self, keys, seconds, deltas):
+        self.keys = keys
+        self.seconds = seconds
+        self.deltas = deltas
+        d = deltas
+        self.read_ms = array('d', map(_latency_ms, d['rd.times'], d['rd.reqs']))
+        self.write_ms = array('d', map(_latency_ms, d['wr.times'], d['wr.reqs']))
+        self.flush_ms = array('d', map(_latency_ms, d['fl.times'], d['fl.reqs']))
+        reqs = array('d', map(operator.add, d['rd.reqs'], d['wr.reqs']))
+        times = array('d', map(operator.add, d['rd.times'], d['wr.times']))
+        self.avg_ms = array('d', map(_latency_ms, times, reqs))
+        self.iops = array('d', [r / seconds for r in reqs])
+
+
+def analyze(prev, cur):
+    """
+    Compare two samples
+
+    Disks missing from the earlier sample, and disks whose counters went
+    backwards (the domain restarted), are left out.
+
+    Args:
+        prev: Earlier sample
+        cur: Later sample
+
+    Returns:
+        Interval, or None when the samples are not in order
+    """
+    seconds = float(cur['ts'] - prev['ts'])
+    if seconds <= 0:
+        return None
+    index = dict((k, i) for i, k in enumerate(prev['keys']))
+    pos = [index.get(k, -1) for k in cur['keys']]
+
+    deltas = {}
+    valid = [j >= 0 for j in pos]
+    for f in FIELDS:
+        c, p = cur['columns'][f], prev['columns'][f]
+        delta = array('d', [c[i] - p[j] if j >= 0 else 0.0
+                            for i, j in enumerate(pos)])
+        valid = [ok and v >= 0 for ok, v in zip(valid, delta)]
+        deltas[f] = delta
+
+    if all(valid):
+        return Interval(list(cur['keys']), seconds, deltas)
+    keep = [i for i, ok in enumerate(valid) if ok]
+    return Interval([cur['keys'][i] for i in keep], seconds,
+                    dict((f, array('d', [d[i] for i in keep]))
+                         for f, d in deltas.items()))
+
+
+def by_guest(interval):
+    """
+    Sum the disks of each guest into one row
+
+    Returns:
+        Interval keyed by guest name
+    """
+    rows = {}
+    for i, key in enumerate(interval.keys):
+        rows.setdefault(key.rsplit('/', 1)[0], []).append(i)
+    names = sorted(rows)
+    deltas = dict((f, array('d', [sum(d[i] for i in rows[n]) for n in names]))
+                  for f, d in interval.deltas.items())
+    return Interval(names, interval.seconds, deltas)
+
+
+def rank(interval, top=TOP, min_iops=MIN_IOPS):
+    """
+    Return the indexes of the slowest rows, worst first
+
+    Args:
+        interval: Interval from analyze() or by_guest()
+        top: Number of rows
+        min_iops: Ignore rows with less traffic
+    """
+    busy = [i for i, iops in enumerate(interval.iops) if iops >= min_iops]
+    busy.sort(key=lambda i: interval.avg_ms[i], reverse=True)
+    return busy[:top]
+
+
+def merge(intervals):
+    """
+    Combine consecutive intervals into one covering all of them
+
+    Disks are kept if they appear in every interval.
+
+    Returns:
+        Interval, or None for an empty list
+    """
+    intervals = [i for i in intervals if i is not None]
+    if not intervals:
+        return None
+    present = [set(i.keys) for i in intervals[1:]]
+    keys = [k for k in intervals[0].keys if all(k in p for p in present)]
+    deltas = dict((f, array('d', [0.0] * len(keys))) for f in FIELDS)
+    for interval in intervals:
+        index = dict((k, i) for i, k in enumerate(interval.keys))
+        pos = [index[k] for k in keys]
+        for f in FIELDS:
+            src = interval.deltas[f]
+            deltas[f] = array('d', map(operator.add, deltas[f],
+                                       [src[j] for j in pos]))
+    return Interval(keys, sum(i.seconds for i in intervals), deltas)
+
+
+def format_report(interval, top=TOP, min_iops=MIN_IOPS, label="Disk"):
+    """
+    Format the slowest rows of an interval
+
+    Returns:
+        List of lines
+    """
+    lines = ["%-32s %9s %9s %9s %9s %9s" %
+             (label, "IOPS", "Avg ms", "Read ms", "Write ms", "Flush ms")]
+    lines.append("-" * 82)
+    for i in rank(interval, top, min_iops):
+        flag = "  slow" if interval.avg_ms[i] >= SLOW_MS else ""
+        lines.append("%-32s %9.1f %9.2f %9.2f %9.2f %9.2f%s" % (
+            interval.keys[i][:32], interval.iops[i], interval.avg_ms[i],
+            interval.read_ms[i], interval.write_ms[i], interval.flush_ms[i],
+            flag))
+    if len(lines) == 2:
+        lines.append("Nothing above %.0f IOPS" % min_iops)
+    return lines
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Rank disks by I/O latency")
+    parser.add_argument("action", choices=["sample", "replay"])
+    parser.add_argument("file", nargs="?", help="Recorded samples for replay")
+    parser.add_argument("--uri", default="qemu:///system")
+    parser.add_argument("--interval", type=float, default=SAMPLE_INTERVAL)
+    parser.add_argument("--count", type=int, default=1,
+                        help="Intervals to sample")
+    parser.add_argument("--record", help="Append samples to this file")
+    parser.add_argument("--by", choices=["disk", "guest"], default="disk")
+    parser.add_argument("--top", type=int, default=TOP)
+    args = parser.parse_args(argv)
+
+    if args.action == "replay":
+        if not args.file:
+            parser.error("replay needs a samples file")
+        samples = load_samples(args.file)
+    else:
+        try:
+            conn = vm_instrument.instrument(libvirt.open(args.uri))
+        except libvirt.libvirtError as e:
+            print("Error: %s" % e)
+            return 1
+        try:
+            samples = [sample(conn)]
+            for _ in range(max(args.count, 1)):
+                time.sleep(args.interval)
+                samples.append(sample(conn))
+        finally:
+            conn.close()
+        if args.record:
+            with open(args.record, 'a') as f:
+                for s in samples:
+                    f.write(to_json(s) + "\n")
+
+    interval = merge([analyze(p, c) for p, c in zip(samples, samples[1:])])
+    if interval is None:
+        print("Need at least two samples")
+        return 1
+    if args.by == "guest":
+        interval = by_guest(interval)
+    for line in format_report(interval, args.top,
+                              label=args.by.capitalize()):
+        print(line)
+    print("\n%d %ss over %.1f s" % (len(interval.keys), args.by, interval.seconds))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,670 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Disk Maintenance
+----------------
+Find bloated qcow2 images and reclaim their space
+
+survey() lists every image used by a domain (sizes from blockInfo) and
+every unattached image in the image directory (sizes from the qcow2
+header and the file's allocated blocks), and flags candidates whose host
+footprint is large compared with their data or virtual size.
+
+Reclaiming is done in two steps:
+    trim     - fstrim inside running guests through the guest agent, so
+               freed blocks are discarded in the image (disks need
+               discard='unmap', which new VMs get)
+    compact  - "qemu-img convert" of images of stopped domains to a fresh
+               copy, optionally compressed, run under ionice/nice in a
+               bounded background queue
+
+Overlay chains can be flattened into standalone images or rebased onto
+another backing image, live (blockPull/blockRebase) or offline
+(qemu-img).
+
+Examples:
+    python vm_diskmaint.py survey
+    python vm_diskmaint.py trim
+    python vm_diskmaint.py compact --compress
+    python vm_diskmaint.py flatten web1
+"""
+
+import argparse
+import os
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import libvirt
+
+import vm_domxml
+import vm_instrument
+import vm_jobs
+import vm_oplog
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+DISK_IMAGE_DIR = '/var/lib/libvirt/images'
+
+# Host bytes over guest-allocated bytes above which an image is bloated
+WASTE_RATIO = 1.3
+# Host bytes over virtual size above which a trim is worth trying
+FULL_RATIO = 0.8
+# Images smaller than this are not worth the work
+MIN_IMAGE_BYTES = 1 << 30
+
+QUEUE_SIZE = 16
+QUEUE_WORKERS = 1
+
+NICE_PREFIX = ['ionice', '-c', '3', 'nice', '-n', '19']
+
+QCOW2_MAGIC = b'QFI\xfb'
+_QCOW2_HEADER = struct.Struct('>4sIQIIQ')
+# Header length of version 2 images; version 3 stores it at offset 100
+_QCOW2_V2_LENGTH = 72
+_QCOW2_EXTENSION = struct.Struct('>II')
+_EXT_END = 0
+_EXT_BACKING_FORMAT = 0xE2792ACA
+_MAX_EXTENSIONS = 64
+
+# =============================================================================
+# SURVEY
+# =============================================================================
+
+def read_qcow2_header(path):
+    """
+    Read the virtual size and backing file from a qcow2 header
+
+    Args:
+        path: Image path
+
+    Returns:
+        Dict with virtual_size, backing_file and backing_format (from the
+        header extension, None when absent), or None if not qcow2
+    """
+    with open(path, 'rb') as f:
+        data = f.read(_QCOW2_HEADER.size)
+        if len(data) < _QCOW2_HEADER.size:
+            return None
+        magic, version, backing_offset, backing_size, _, size = \
+            _QCOW2_HEADER.unpack(data)
+        if magic != QCOW2_MAGIC:
+            return None
+        backing = None
+        backing_format = None
+        if backing_offset and backing_size:
+            f.seek(backing_offset)
+            backing = f.read(backing_size).decode('utf-8', 'replace')
+            backing_format = _read_backing_format(f, version)
+    return {'virtual_size': size, 'backing_file': backing,
+            'backing_format': backing_format}
+
+
+def _read_backing_format(f, version):
+    """Return the backing format header extension of an open qcow2 file"""
+    offset = _QCOW2_V2_LENGTH
+    if version >= 3:
+        f.seek(100)
+        data = f.read(4)
+        if len(data) < 4:
+            return None
+        offset = struct.unpack('>I', data)[0]
+    for _ in range(_MAX_EXTENSIONS):
+        f.seek(offset)
+        data = f.read(_QCOW2_EXTENSION.size)
+        if len(data) < _QCOW2_EXTENSION.size:
+            return None
+        ext_type, length = _QCOW2_EXTENSION.unpack(data)
+        if ext_type == _EXT_END:
+            return None
+        if ext_type == _EXT_BACKING_FORMAT:
+            return f.read(length).decode('ascii', 'replace')
+        # Extension data is padded to 8 bytes
+        offset += _QCOW2_EXTENSION.size + (length + 7) // 8 * 8
+    return None
+
+
+def image_format(path):
+    """Return "qcow2" or "raw", the formats base images are created with"""
+    return 'qcow2' if read_qcow2_header(path) else 'raw'
+
+
+def _backing_path(path, backing_file):
+    """Resolve a backing file name relative to the overlay"""
+    return os.path.join(os.path.dirname(path), backing_file)
+
+
+def backing_format(path, header=None):
+    """
+    Return the format of an overlay's backing file
+
+    The format recorded in the overlay wins; otherwise it is detected
+    from the backing file itself.
+
+    Args:
+        path: Overlay image path
+        header: Output of read_qcow2_header(path), if already read
+
+    Returns:
+        Format name, or None when the image has no backing file
+    """
+    header = header or read_qcow2_header(path) or {}
+    if not header.get('backing_file'):
+        return None
+    return header.get('backing_format') or image_format(
+        _backing_path(path, header['backing_file']))
+
+
+def backing_chain(path):
+    """
+    Return every backing file under an image, nearest first
+
+    Unreadable images end the chain.
+    """
+    chain = []
+    while True:
+        try:
+            header = read_qcow2_header(path)
+        except (IOError, OSError):
+            return chain
+        if not header or not header['backing_file']:
+            return chain
+        path = _backing_path(path, header['backing_file'])
+        if path in chain:
+            return chain
+        chain.append(path)
+
+
+def host_bytes(path):
+    """Return the bytes an image actually occupies on the host"""
+    return os.stat(path).st_blocks * 512
+
+
+def is_candidate(entry):
+    """
+    Decide whether an image is worth trimming or compacting
+
+    Args:
+        entry: Survey entry with capacity, allocation and physical
+
+    Returns:
+        Reason string, or None
+    """
+    physical = entry['physical']
+    if physical < MIN_IMAGE_BYTES:
+        return None
+    if entry['allocation'] and physical >= entry['allocation'] * WASTE_RATIO:
+        return 'fragmented'
+    if entry['capacity'] and physical >= entry['capacity'] * FULL_RATIO:
+        return 'grown'
+    return None
+
+
+def survey(conn, image_dir=DISK_IMAGE_DIR):
+    """
+    List disk images with their sizes and whether they need maintenance
+
+    Args:
+        conn: libvirt connection
+        image_dir: Directory searched for unattached images
+
+    Returns:
+        List of dicts with domain, target, path, active, capacity,
+        allocation, physical and reason
+    """
+    entries = []
+    attached = set()
+    for dom in conn.listAllDomains():
+        active = dom.isActive()
+        for disk in vm_domxml.disks(dom.XMLDesc(0)):
+            if disk['device'] != 'disk' or not disk['source']:
+                continue
+            # Backing images of an overlay are in use as much as the overlay
+            attached.add(disk['source'])
+            attached.update(backing_chain(disk['source']))
+            try:
+                capacity, allocation, physical = dom.blockInfo(disk['target'], 0)
+            except libvirt.libvirtError:
+                continue
+            entries.append({'domain': dom.name(), 'target': disk['target'],
+                            'path': disk['source'], 'active': bool(active),
+                            'format': disk['format'], 'capacity': capacity,
+                            'allocation': allocation, 'physical': physical})
+
+    if os.path.isdir(image_dir):
+        for name in sorted(os.listdir(image_dir)):
+            path = os.path.join(image_dir, name)
+            if path in attached or not os.path.isfile(path):
+                continue
+            try:
+                header = read_qcow2_header(path)
+                physical = host_bytes(path)
+            except (IOError, OSError):
+                continue
+            if header is None:
+                continue
+            entries.append({'domain': None, 'target': None, 'path': path,
+                            'active': False, 'format': 'qcow2',
+                            'capacity': header['virtual_size'],
+                            'allocation': physical, 'physical': physical})
+
+    for entry in entries:
+        entry['reason'] = is_candidate(entry)
+    return entries
+
+
+def format_survey(entries):
+    """
+    Format survey entries as a text table
+
+    Returns:
+        List of lines
+    """
+    gb = 1073741824.0
+    lines = ["%-20s %-5s %9s %9s %9s  %-10s %s" %
+             ("Domain", "Disk", "Virt GB", "Data GB", "Host GB", "Status", "Path")]
+    lines.append("-" * 100)
+    for e in sorted(entries, key=lambda e: -e['physical']):
+        lines.append("%-20s %-5s %9.1f %9.1f %9.1f  %-10s %s" %
+                     ((e['domain'] or "(none)")[:20], e['target'] or "-",
+                      e['capacity'] / gb, e['allocation'] / gb,
+                      e['physical'] / gb, e['reason'] or "ok", e['path']))
+    return lines
+
+
+# =============================================================================
+# MAINTENANCE ACTIONS
+# =============================================================================
+
+class MaintResult(object):
+    """Outcome of one maintenance action"""
+
+    def __init__(self, action, domain, path):
+        self.action = action
+        self.domain = domain
+        self.path = path
+        self.before = None
+        self.after = None
+        self.seconds = None
+        self.error = None
+        self.job = None         # vm_jobs.Job of a running block job
+
+    @property
+    def reclaimed(self):
+        """Bytes freed on the host (0 if unknown)"""
+        if self.before is None or self.after is None:
+            return 0
+        return max(self.before - self.after, 0)
+
+
+def _run(cmd):
+    """Run a command at idle I/O and CPU priority, raising OSError on failure"""
+    proc = subprocess.Popen(NICE_PREFIX + cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise OSError("%s failed: %s" % (" ".join(cmd[:2]),
+                                         output.decode('utf-8', 'replace').strip()))
+
+
+def _image_bytes(paths):
+    """Return the host bytes of a set of image paths"""
+    total = 0
+    for path in paths:
+        try:
+            total += host_bytes(path)
+        except OSError:
+            pass
+    return total
+
+
+def trim(dom, host=None):
+    """
+    Discard unused blocks of a running guest's file systems
+
+    Args:
+        dom: Running libvirt domain with a guest agent
+        host: Hypervisor hostname for operation events
+
+    Returns:
+        MaintResult
+    """
+    paths = [d['source'] for d in vm_domxml.disks(dom.XMLDesc(0))
+             if d['device'] == 'disk' and d['source']]
+    result = MaintResult('trim', dom.name(), ", ".join(paths))
+    result.before = _image_bytes(paths)
+    start = time.time()
+    try:
+        with vm_oplog.operation('fstrim', dom, host):
+            dom.fSTrim(None, 0, 0)
+    except libvirt.libvirtError as e:
+        result.error = str(e)
+    result.seconds = round(time.time() - start, 3)
+    result.after = _image_bytes(paths)
+    return result
+
+
+def compact(path, compress=False, backing_file=None, domain=None,
+            is_idle=None):
+    """
+    Rewrite an offline qcow2 image to drop unused and discarded clusters
+
+    The copy is written next to the image, then renamed over it with the
+    original owner and mode.
+
+    Args:
+        path: Image path
+        compress: Write compressed clusters
+        backing_file: Keep this backing file (overlays); None flattens
+        domain: Domain name for the result
+        is_idle: Optional callable checked right before the swap; the copy
+            is discarded when it returns False
+
+    Returns:
+        MaintResult
+    """
+    result = MaintResult('compact', domain, path)
+    tmp = path + '.compact'
+    start = time.time()
+    try:
+        result.before = host_bytes(path)
+        st = os.stat(path)
+        cmd = ['qemu-img', 'convert', '-O', 'qcow2']
+        if compress:
+            cmd.append('-c')
+        if backing_file:
+            header = read_qcow2_header(path) or {}
+            if header.get('backing_file') == backing_file:
+                fmt = backing_format(path, header)
+            else:
+                fmt = image_format(_backing_path(path, backing_file))
+            cmd += ['-B', backing_file, '-F', fmt]
+        _run(cmd + [path, tmp])
+        if is_idle is not None and not is_idle():
+            raise OSError("domain started during compaction")
+        os.chown(tmp, st.st_uid, st.st_gid)
+        os.chmod(tmp, st.st_mode)
+        os.rename(tmp, path)
+        result.after = host_bytes(path)
+    except (OSError, libvirt.libvirtError) as e:
+        result.error = str(e)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    result.seconds = round(time.time() - start, 3)
+    vm_oplog.log_event('disk_compact', domain, None, result.seconds,
+                       'error' if result.error else 'ok', result.error,
+                       path=path, reclaimed=result.reclaimed)
+    return result
+
+
+def flatten(dom, target, host=None, supervisor=None):
+    """
+    Merge a disk's backing chain into the disk itself
+
+    Running domains use blockPull (the job continues in the background);
+    stopped domains are rewritten with qemu-img.
+
+    Args:
+        dom: libvirt domain
+        target: Disk target (vda, ...)
+        host: Hypervisor hostname for operation events
+        supervisor: Optional vm_jobs.JobSupervisor that watches the
+            block job (result.job)
+
+    Returns:
+        MaintResult
+    """
+    disk = dict((d['target'], d) for d in vm_domxml.disks(dom.XMLDesc(0)))[target]
+    if not dom.isActive():
+        result = compact(disk['source'], domain=dom.name(),
+                         is_idle=lambda: not dom.isActive())
+        result.action = 'flatten'
+        return result
+    result = MaintResult('flatten', dom.name(), disk['source'])
+    start = time.time()
+    try:
+        with vm_oplog.operation('disk_flatten', dom, host, disk=target):
+            dom.blockPull(target, 0, 0)
+        if supervisor is not None:
+            result.job = supervisor.watch('disk_flatten', dom, target)
+    except libvirt.libvirtError as e:
+        result.error = str(e)
+    result.seconds = round(time.time() - start, 3)
+    return result
+
+
+def rebase(dom, target, base, host=None, supervisor=None):
+    """
+    Point a disk overlay at a different backing image
+
+    Running domains use blockRebase, which copies the data between the
+    new base and the overlay; stopped domains use "qemu-img rebase".
+
+    Args:
+        dom: libvirt domain
+        target: Disk target (vda, ...)
+        base: New backing image path
+        host: Hypervisor hostname for operation events
+        supervisor: Optional vm_jobs.JobSupervisor that watches the
+            block job (result.job)
+
+    Returns:
+        MaintResult
+    """
+    disk = dict((d['target'], d) for d in vm_domxml.disks(dom.XMLDesc(0)))[target]
+    result = MaintResult('rebase', dom.name(), disk['source'])
+    start = time.time()
+    try:
+        with vm_oplog.operation('disk_rebase', dom, host, disk=target,
+                                base=base):
+            if dom.isActive():
+                dom.blockRebase(target, base, 0, 0)
+                if supervisor is not None:
+                    result.job = supervisor.watch('disk_rebase', dom, target)
+            else:
+                result.before = host_bytes(disk['source'])
+                _run(['qemu-img', 'rebase', '-b', base,
+                      '-F', image_format(_backing_path(disk['source'], base)),
+                      disk['source']])
+                result.after = host_bytes(disk['source'])
+    except (libvirt.libvirtError, OSError) as e:
+        result.error = str(e)
+    result.seconds = round(time.time() - start, 3)
+    return result
+
+
+# =============================================================================
+# BACKGROUND QUEUE
+# =============================================================================
+
+class MaintenanceQueue(object):
+    """
+    Bounded queue of maintenance jobs run by background worker threads
+
+    submit() blocks when the queue is full, so a large batch never piles
+    up more than QUEUE_SIZE pending jobs.
+    """
+
+    def __init__(self, workers=QUEUE_WORKERS, size=QUEUE_SIZE, progress=None):
+        self.jobs = queue.Queue(size)
+        self.results = []
+        self.progress = progress
+        self._lock = threading.Lock()
+        self._threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs), which must return a MaintResult"""
+        self.jobs.put((func, args, kwargs))
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            func, args, kwargs = job
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                # A dead worker would leave submit() and join() blocked
+                result = MaintResult(func.__name__, kwargs.get('domain'),
+                                     args[0] if args else None)
+                result.error = str(e) or e.__class__.__name__
+            with self._lock:
+                self.results.append(result)
+            if self.progress:
+                self.progress(result)
+
+    def join(self):
+        """Wait for all queued jobs and stop the workers"""
+        for _ in self._threads:
+            self.jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        return self.results
+
+
+def compact_candidates(conn, entries, compress=False, workers=QUEUE_WORKERS,
+                       progress=None):
+    """
+    Compact every flagged image that is not in use by a running domain
+
+    Args:
+        conn: libvirt connection
+        entries: Output of survey()
+        compress: Write compressed images
+        workers: Images converted at once
+        progress: Optional callable(result) invoked as jobs finish
+
+    Returns:
+        List of MaintResult
+    """
+    jobs = MaintenanceQueue(workers, progress=progress)
+    for entry in entries:
+        if not entry['reason'] or entry['active']:
+            continue
+        is_idle = None
+        if entry['domain']:
+            dom = conn.lookupByName(entry['domain'])
+            is_idle = lambda dom=dom: not dom.isActive()
+        backing = None
+        if entry['format'] == 'qcow2':
+            try:
+                backing = (read_qcow2_header(entry['path']) or {}).get(
+                    'backing_file')
+            except (IOError, OSError):
+                pass
+        jobs.submit(compact, entry['path'], compress, backing,
+                    entry['domain'], is_idle)
+    return jobs.join()
+
+
+def format_results(results):
+    """
+    Format maintenance results with the space reclaimed
+
+    Returns:
+        List of lines
+    """
+    mb = 1048576.0
+    lines = ["%-8s %-20s %10s %10s %10s %8s" %
+             ("Action", "Domain", "Before MB", "After MB", "Freed MB", "Seconds")]
+    lines.append("-" * 72)
+    total = 0
+    for r in results:
+        total += r.reclaimed
+        lines.append("%-8s %-20s %10s %10s %10.1f %8.1f" %
+                     (r.action, (r.domain or "(none)")[:20],
+                      "%.1f" % (r.before / mb) if r.before is not None else "-",
+                      "%.1f" % (r.after / mb) if r.after is not None else "-",
+                      r.reclaimed / mb, r.seconds or 0))
+        if r.error:
+            lines.append("    %s" % r.error)
+    lines.append("Total reclaimed: %.1f MB in %.1f s" %
+                 (total / mb, sum(r.seconds or 0 for r in results)))
+    return lines
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Disk image maintenance")
+    parser.add_argument("action",
+                        choices=["survey", "trim", "compact", "flatten", "rebase"])
+    parser.add_argument("domain", nargs="?", help="Domain for flatten/rebase")
+    parser.add_argument("--uri", default="qemu:///system")
+    parser.add_argument("--disk", default="vda")
+    parser.add_argument("--base", help="New backing image for rebase")
+    parser.add_argument("--compress", action="store_true")
+    parser.add_argument("--workers", type=int, default=QUEUE_WORKERS)
+    parser.add_argument("--wait", action="store_true",
+                        help="Wait for flatten/rebase block jobs to finish, "
+                             "aborting them after the configured timeout")
+    args = parser.parse_args(argv)
+
+    if args.action in ("flatten", "rebase") and not args.domain:
+        parser.error("%s needs a domain" % args.action)
+    if args.action == "rebase" and not args.base:
+        parser.error("rebase needs --base")
+
+    try:
+        conn = vm_instrument.instrument(libvirt.open(args.uri))
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        return 1
+
+    host = conn.getHostname()
+    supervisor = vm_jobs.get_supervisor(conn, host) if args.wait else None
+    try:
+        if args.action == "survey":
+            for line in format_survey(survey(conn)):
+                print(line)
+            return 0
+        if args.action == "trim":
+            results = [trim(dom, host) for dom in conn.listAllDomains(
+                libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)]
+        elif args.action == "compact":
+            results = compact_candidates(conn, survey(conn), args.compress,
+                                         args.workers)
+        elif args.action == "flatten":
+            results = [flatten(conn.lookupByName(args.domain), args.disk, host,
+                               supervisor)]
+        else:
+            results = [rebase(conn.lookupByName(args.domain), args.disk,
+                              args.base, host, supervisor)]
+        for r in results:
+            if r.job is not None:
+                print("Waiting for the %s job on %s..." % (r.action, args.disk))
+                status = supervisor.wait(r.job)
+                r.seconds = r.job.seconds
+                if status != 'done':
+                    r.error = "block job %s" % status
+    except (KeyError, libvirt.libvirtError) as e:
+        print("Error: %s" % e)
+        return 1
+    finally:
+        conn.close()
+
+    for line in format_results(results):
+        print(line)
+    return 1 if any(r.error for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
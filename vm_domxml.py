@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Domain XML Helpers
+------------------
+Small parsers for the parts of libvirt domain XML the subsystems need
+"""
+
+import xml.etree.ElementTree as ET
+
+
+def disks(xml):
+    """
+    List the file- and block-backed disks of a domain
+
+    Args:
+        xml: Domain XML string
+
+    Returns:
+        List of dicts with target, source, format and device
+    """
+    result = []
+    for disk in ET.fromstring(xml).findall('./devices/disk'):
+        target = disk.find('target')
+        source = disk.find('source')
+        driver = disk.find('driver')
+        if target is None:
+            continue
+        path = None
+        if source is not None:
+            path = source.get('file') or source.get('dev')
+        result.append({
+            'target': target.get('dev'),
+            'source': path,
+            'format': driver.get('type') if driver is not None else None,
+            'device': disk.get('device', 'disk'),
+        })
+    return result
+
+
+def disk_targets(xml):
+    """Return the target names (vda, ...) of the hard disks of a domain"""
+    return [d['target'] for d in disks(xml) if d['device'] == 'disk']
+
+
+def interfaces(xml):
+    """
+    List the network interfaces of a domain
+
+    Args:
+        xml: Domain XML string
+
+    Returns:
+        List of dicts with mac, target, bridge, model and queues
+    """
+    result = []
+    for iface in ET.fromstring(xml).findall('./devices/interface'):
+        mac = iface.find('mac')
+        target = iface.find('target')
+        source = iface.find('source')
+        model = iface.find('model')
+        driver = iface.find('driver')
+        result.append({
+            'mac': mac.get('address') if mac is not None else None,
+            'target': target.get('dev') if target is not None else None,
+            'bridge': source.get('bridge') if source is not None else None,
+            'model': model.get('type') if model is not None else None,
+            'queues': int(driver.get('queues', 1)) if driver is not None else 1,
+        })
+    return result
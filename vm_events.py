@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Domain Events
+-------------
+libvirt event loop and per-connection event dispatch
+
+start_event_loop() must be called before a connection is opened for
+that connection to deliver events. EventDispatcher registers a single
+libvirt callback per event ID and fans events out to any number of
+subscribers.
+
+Subscribers run in the event loop thread: they must return quickly and
+hand any real work to another thread.
+"""
+
+import threading
+
+import libvirt
+
+import vm_instrument
+
+_loop_thread = None
+_dispatchers = {}
+_dispatchers_lock = threading.Lock()
+
+# =============================================================================
+# EVENT LOOP
+# =============================================================================
+
+def start_event_loop():
+    """Register the default libvirt event loop and run it in a daemon thread"""
+    global _loop_thread
+    if _loop_thread is not None:
+        return
+    libvirt.virEventRegisterDefaultImpl()
+
+    def run():
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    _loop_thread = threading.Thread(target=run, name="libvirt-events")
+    _loop_thread.daemon = True
+    _loop_thread.start()
+
+
+def event_loop_running():
+    """Return True when start_event_loop() has been called"""
+    return _loop_thread is not None
+
+
+# =============================================================================
+# DISPATCH
+# =============================================================================
+
+class EventDispatcher(object):
+    """
+    Fan out domain events of one connection to subscribers
+
+    Subscribers are called as func(dom, *payload), where payload is the
+    event-specific part of the libvirt callback arguments (for lifecycle
+    events: event, detail).
+    """
+
+    def __init__(self, conn):
+        """
+        Initialize the dispatcher
+
+        Args:
+            conn: libvirt connection (instrumented proxies are unwrapped)
+        """
+        self.conn = vm_instrument.unwrap(conn)
+        self._lock = threading.Lock()
+        self._callback_ids = {}
+        self._subscribers = {}
+        self._next_token = 0
+
+    def subscribe(self, event_id, func):
+        """
+        Subscribe to a domain event ID
+
+        Args:
+            event_id: libvirt.VIR_DOMAIN_EVENT_ID_* constant
+            func: Callable invoked as func(dom, *payload)
+
+        Returns:
+            Token for unsubscribe()
+        """
+        with self._lock:
+            if event_id not in self._callback_ids:
+                self._callback_ids[event_id] = self.conn.domainEventRegisterAny(
+                    None, event_id, self._make_callback(event_id), None)
+                self._subscribers[event_id] = {}
+            self._next_token += 1
+            token = (event_id, self._next_token)
+            self._subscribers[event_id][token] = func
+            return token
+
+    def unsubscribe(self, token):
+        """Remove a subscription returned by subscribe()"""
+        with self._lock:
+            self._subscribers.get(token[0], {}).pop(token, None)
+
+    def _make_callback(self, event_id):
+        """Build the libvirt callback for one event ID"""
+        def callback(conn, dom, *args):
+            # The last argument is the opaque value passed at registration
+            payload = args[:-1]
+            with self._lock:
+                subscribers = list(self._subscribers[event_id].values())
+            for func in subscribers:
+                try:
+                    func(dom, *payload)
+                except Exception:
+                    pass
+        return callback
+
+    def close(self):
+        """Deregister all libvirt callbacks"""
+        with self._lock:
+            for callback_id in self._callback_ids.values():
+                try:
+                    self.conn.domainEventDeregisterAny(callback_id)
+                except libvirt.libvirtError:
+                    pass
+            self._callback_ids = {}
+            self._subscribers = {}
+
+
+def get_dispatcher(conn):
+    """
+    Return the shared dispatcher of a connection
+
+    Args:
+        conn: libvirt connection
+
+    Returns:
+        EventDispatcher, or None when the event loop is not running
+    """
+    if not event_loop_running():
+        return None
+    raw = vm_instrument.unwrap(conn)
+    with _dispatchers_lock:
+        dispatcher = _dispatchers.get(id(raw))
+        if dispatcher is None:
+            dispatcher = _dispatchers[id(raw)] = EventDispatcher(raw)
+        return dispatcher
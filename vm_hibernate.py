@@ -0,0 +1,351 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Fleet Hibernation
+-----------------
+Managed save of all running VMs before host maintenance, and prioritized
+restore afterwards
+
+hibernate() writes a managed save image for every running domain with a
+bounded number of saves in flight, largest guests first. A manifest
+records each VM's priority, save time and image size. restore() starts
+the saved domains group by group in priority order (see the "priorities"
+section of vm_manager.json), which resumes them from their images.
+
+Save image compression is a libvirtd setting (save_image_format in
+qemu.conf); it can be inspected and changed with --format.
+
+Examples:
+    python vm_hibernate.py save --concurrency 2
+    python vm_hibernate.py restore
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+import libvirt
+
+import vm_config
+import vm_instrument
+import vm_jobs
+import vm_oplog
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+MANIFEST_FILE = 'vm_hibernate.json'
+MANAGED_SAVE_DIR = '/var/lib/libvirt/qemu/save'
+QEMU_CONF = '/etc/libvirt/qemu.conf'
+
+SAVE_CONCURRENCY = 2
+RESTORE_CONCURRENCY = 4
+
+SAVE_IMAGE_FORMATS = ('raw', 'gzip', 'bzip2', 'xz', 'lzop')
+
+_FORMAT_RE = re.compile(r'^\s*save_image_format\s*=\s*"([^"]*)"', re.M)
+
+# =============================================================================
+# SAVE IMAGE FORMAT
+# =============================================================================
+
+def read_save_image_format(path=QEMU_CONF):
+    """
+    Return the save image format configured for libvirtd
+
+    Args:
+        path: qemu.conf location
+
+    Returns:
+        Format name ("raw" when unset)
+    """
+    try:
+        with open(path) as f:
+            match = _FORMAT_RE.search(f.read())
+    except IOError:
+        return 'raw'
+    return match.group(1) if match else 'raw'
+
+
+def set_save_image_format(fmt, path=QEMU_CONF):
+    """
+    Set save_image_format in qemu.conf
+
+    libvirtd must be restarted for the change to take effect.
+
+    Args:
+        fmt: One of SAVE_IMAGE_FORMATS
+        path: qemu.conf location
+    """
+    if fmt not in SAVE_IMAGE_FORMATS:
+        raise ValueError("Unknown save image format: %s" % fmt)
+    with open(path) as f:
+        text = f.read()
+    line = 'save_image_format = "%s"' % fmt
+    if _FORMAT_RE.search(text):
+        text = _FORMAT_RE.sub(line, text)
+    else:
+        text = text.rstrip('\n') + '\n' + line + '\n'
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+# =============================================================================
+# HIBERNATE AND RESTORE
+# =============================================================================
+
+class HibernateResult(object):
+    """Outcome of saving or restoring one domain"""
+
+    def __init__(self, name, uuid, priority):
+        self.name = name
+        self.uuid = uuid
+        self.priority = priority
+        self.outcome = None      # saved, restored or failed
+        self.seconds = None
+        self.image_bytes = None
+        self.error = None
+
+    def to_dict(self):
+        """Return the result as a plain dict"""
+        return dict(self.__dict__)
+
+
+def _image_size(name):
+    """Return the size of a domain's managed save image, if readable"""
+    try:
+        return os.path.getsize(os.path.join(MANAGED_SAVE_DIR, name + '.save'))
+    except OSError:
+        return None
+
+
+def hibernate(conn, concurrency=SAVE_CONCURRENCY, manifest=MANIFEST_FILE,
+              host=None, progress=None):
+    """
+    Managed-save every running domain
+
+    Saves are I/O bound, so at most concurrency run at once; the largest
+    guests are started first to shorten the total time.
+
+    Args:
+        conn: libvirt connection
+        concurrency: Maximum saves in flight
+        manifest: Path of the manifest to write
+        host: Hypervisor hostname for operation events
+        progress: Optional callable(result) invoked as saves finish
+
+    Returns:
+        List of HibernateResult
+    """
+    stats = conn.getAllDomainStats(
+        libvirt.VIR_DOMAIN_STATS_BALLOON,
+        libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+    stats.sort(key=lambda s: -s[1].get('balloon.current', 0))
+    if not stats:
+        return []
+    supervisor = vm_jobs.get_supervisor(conn, host)
+
+    def save(dom):
+        result = HibernateResult(dom.name(), dom.UUIDString(),
+                                 vm_config.vm_priority(dom.name()))
+        start = time.time()
+        try:
+            with supervisor.track('managed_save', dom):
+                dom.managedSave(0)
+            result.outcome = 'saved'
+            result.image_bytes = _image_size(result.name)
+        except libvirt.libvirtError as e:
+            result.outcome = 'failed'
+            result.error = str(e)
+        result.seconds = round(time.time() - start, 3)
+        vm_oplog.log_event('hibernate', dom, host, result.seconds,
+                           'error' if result.error else 'ok', result.error,
+                           image_bytes=result.image_bytes)
+        return result
+
+    results = []
+    pool = ThreadPool(min(concurrency, len(stats)))
+    try:
+        for result in pool.imap_unordered(save, [s[0] for s in stats]):
+            results.append(result)
+            if progress:
+                progress(result)
+    finally:
+        pool.close()
+
+    with open(manifest, 'w') as f:
+        json.dump({'saved_at': time.time(), 'host': host,
+                   'format': read_save_image_format(),
+                   'vms': [r.to_dict() for r in results
+                           if r.outcome == 'saved']},
+                  f, indent=2, sort_keys=True)
+    return results
+
+
+def restore_order(names, manifest_vms=None):
+    """
+    Group VM names into restore waves by priority
+
+    Args:
+        names: VM names to restore
+        manifest_vms: Dict of name -> manifest entry; its priority is used
+            when present, otherwise the configured priority
+
+    Returns:
+        List of (priority, [names]) sorted by priority
+    """
+    manifest_vms = manifest_vms or {}
+    groups = {}
+    for name in names:
+        entry = manifest_vms.get(name)
+        priority = entry['priority'] if entry else vm_config.vm_priority(name)
+        groups.setdefault(priority, []).append(name)
+    return [(p, sorted(groups[p])) for p in sorted(groups)]
+
+
+def restore(conn, concurrency=RESTORE_CONCURRENCY, manifest=MANIFEST_FILE,
+            host=None, progress=None):
+    """
+    Start all domains that have a managed save image, in priority order
+
+    Each priority group is restored in parallel (bounded by concurrency)
+    and must finish before the next group starts.
+
+    Args:
+        conn: libvirt connection
+        concurrency: Maximum restores in flight
+        manifest: Path of the manifest written by hibernate()
+        host: Hypervisor hostname for operation events
+        progress: Optional callable(result) invoked as restores finish
+
+    Returns:
+        List of HibernateResult
+    """
+    manifest_vms = {}
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            manifest_vms = dict((v['name'], v) for v in json.load(f)['vms'])
+
+    domains = {}
+    for dom in conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE):
+        if dom.hasManagedSaveImage(0):
+            domains[dom.name()] = dom
+    if not domains:
+        return []
+
+    def start(item):
+        priority, dom = item
+        result = HibernateResult(dom.name(), dom.UUIDString(), priority)
+        result.image_bytes = _image_size(result.name)
+        begin = time.time()
+        try:
+            dom.create()
+            result.outcome = 'restored'
+        except libvirt.libvirtError as e:
+            result.outcome = 'failed'
+            result.error = str(e)
+        result.seconds = round(time.time() - begin, 3)
+        vm_oplog.log_event('restore', dom, host, result.seconds,
+                           'error' if result.error else 'ok', result.error)
+        return result
+
+    results = []
+    pool = ThreadPool(min(concurrency, len(domains)))
+    try:
+        for priority, names in restore_order(domains, manifest_vms):
+            items = [(priority, domains[n]) for n in names]
+            for result in pool.imap_unordered(start, items):
+                results.append(result)
+                if progress:
+                    progress(result)
+    finally:
+        pool.close()
+    return results
+
+
+def format_results(results):
+    """
+    Format hibernate or restore results as a text table
+
+    Returns:
+        List of lines
+    """
+    lines = ["%-30s %8s %-9s %9s %12s" %
+             ("Name", "Priority", "Outcome", "Seconds", "Image MB")]
+    lines.append("-" * 72)
+    for r in sorted(results, key=lambda r: (r.priority, r.name)):
+        size = "%.1f" % (r.image_bytes / 1048576.0) if r.image_bytes else "-"
+        lines.append("%-30s %8d %-9s %9.2f %12s" %
+                     (r.name[:30], r.priority, r.outcome, r.seconds, size))
+        if r.error:
+            lines.append("    %s" % r.error)
+    return lines
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def _concurrency(value):
+    """argparse type: a positive number of operations in flight"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return number
+
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Managed save and prioritized restore of all VMs")
+    parser.add_argument("action", choices=["save", "restore", "format"])
+    parser.add_argument("--uri", default="qemu:///system")
+    parser.add_argument("--concurrency", type=_concurrency)
+    parser.add_argument("--manifest", default=MANIFEST_FILE)
+    parser.add_argument("--format", choices=SAVE_IMAGE_FORMATS,
+                        help="With 'format': set save_image_format in %s"
+                             % QEMU_CONF)
+    args = parser.parse_args(argv)
+
+    if args.action == "format":
+        if args.format:
+            try:
+                set_save_image_format(args.format)
+            except (IOError, ValueError) as e:
+                print("Error: %s" % e)
+                return 1
+            print("save_image_format set to %s; restart libvirtd to apply"
+                  % args.format)
+        else:
+            print("save_image_format: %s" % read_save_image_format())
+        return 0
+
+    try:
+        conn = vm_instrument.instrument(libvirt.open(args.uri))
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        return 1
+
+    host = conn.getHostname()
+    start = time.time()
+    if args.action == "save":
+        print("Save image format: %s" % read_save_image_format())
+        results = hibernate(conn, args.concurrency or SAVE_CONCURRENCY,
+                            args.manifest, host)
+    else:
+        results = restore(conn, args.concurrency or RESTORE_CONCURRENCY,
+                          args.manifest, host)
+    for line in format_results(results):
+        print(line)
+    print("\n%d VMs in %.1f s" % (len(results), time.time() - start))
+    conn.close()
+    return 1 if any(r.outcome == 'failed' for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,445 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Inventory History
+-----------------
+Export the domain inventory to SQLite and keep its change history
+
+Each sync records, per host, the name, state, vCPUs, memory, disk and
+interface count of every domain. Only rows that changed are written: a
+row with an unchanged state and the same XML digest (SHA-1 of the
+domain XML) is skipped, and every changed field is appended to the
+changes table. That table answers historical questions:
+
+    when did web1 change size          changes NAME --field vcpus
+    how many VMs ran on this host      running --since 2026-09-01
+
+States come from one bulk stats call. The domain XML is only fetched
+for new domains, domains whose state changed, domains touched by a
+lifecycle event (when the event loop runs) and on a periodic full sync,
+so a sync of a quiet fleet is one libvirt call and a one-row
+transaction (the syncs table). The database uses WAL mode and writes
+each sync in one transaction.
+
+Example:
+    python vm_history.py sync --db vm_history.db
+    python vm_history.py changes web1 --field memory_mb
+"""
+
+import argparse
+import hashlib
+import sqlite3
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import libvirt
+
+import vm_domxml
+import vm_events
+import vm_instrument
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+DB_FILE = 'vm_history.db'
+SYNC_INTERVAL = 60
+# Every domain's XML is re-read at least this often
+FULL_SYNC_INTERVAL = 3600
+
+# Fields compared and recorded, in column order
+FIELDS = ('name', 'state', 'vcpus', 'memory_mb', 'disks', 'interfaces')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS domains (
+    host TEXT NOT NULL,
+    uuid TEXT NOT NULL,
+    name TEXT,
+    state INTEGER,
+    vcpus INTEGER,
+    memory_mb INTEGER,
+    disks INTEGER,
+    interfaces INTEGER,
+    xml_digest TEXT,
+    first_seen REAL,
+    updated REAL,
+    removed REAL,
+    PRIMARY KEY (host, uuid)
+);
+CREATE TABLE IF NOT EXISTS changes (
+    ts REAL NOT NULL,
+    host TEXT NOT NULL,
+    uuid TEXT NOT NULL,
+    name TEXT,
+    field TEXT NOT NULL,
+    old TEXT,
+    new TEXT
+);
+CREATE INDEX IF NOT EXISTS changes_by_domain ON changes (uuid, ts);
+CREATE INDEX IF NOT EXISTS changes_by_host ON changes (host, field, ts);
+CREATE TABLE IF NOT EXISTS syncs (
+    ts REAL NOT NULL,
+    host TEXT NOT NULL,
+    domains INTEGER,
+    fetched INTEGER,
+    changed INTEGER,
+    removed INTEGER,
+    seconds REAL
+);
+"""
+
+_MEMORY_UNITS = {'b': 1.0 / 1048576, 'bytes': 1.0 / 1048576, 'KB': 1000.0 / 1048576,
+                 'k': 1.0 / 1024, 'KiB': 1.0 / 1024, 'MB': 1e6 / 1048576,
+                 'M': 1, 'MiB': 1, 'GB': 1e9 / 1048576, 'G': 1024, 'GiB': 1024}
+
+
+def connect(path=DB_FILE):
+    """
+    Open the history database, creating the schema if needed
+
+    Returns:
+        sqlite3 connection in autocommit mode (transactions are explicit)
+    """
+    db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+# =============================================================================
+# DOMAIN SUMMARY
+# =============================================================================
+
+def digest(xml):
+    """Return the SHA-1 hex digest of a domain XML"""
+    return hashlib.sha1(xml.encode('utf-8')).hexdigest()
+
+
+def summarize(xml):
+    """
+    Extract the configuration summary of a domain XML
+
+    Returns:
+        Dict with vcpus, memory_mb, disks and interfaces
+    """
+    root = ET.fromstring(xml)
+    vcpu = root.find('vcpu')
+    vcpus = int(vcpu.get('current') or vcpu.text) if vcpu is not None else 0
+    memory = root.find('currentMemory')
+    if memory is None:
+        memory = root.find('memory')
+    memory_mb = 0
+    if memory is not None:
+        unit = _MEMORY_UNITS.get(memory.get('unit', 'KiB'), 1.0 / 1024)
+        memory_mb = int(int(memory.text) * unit)
+    return {
+        'vcpus': vcpus,
+        'memory_mb': memory_mb,
+        'disks': len([d for d in vm_domxml.disks(xml) if d['device'] == 'disk']),
+        'interfaces': len(vm_domxml.interfaces(xml)),
+    }
+
+
+# =============================================================================
+# EXPORTER
+# =============================================================================
+
+class SyncResult(object):
+    """Counts of one sync"""
+
+    def __init__(self):
+        self.domains = 0
+        self.fetched = 0        # domain XMLs read
+        self.changed = 0        # rows written
+        self.removed = 0
+        self.seconds = None
+
+
+class HistoryExporter(object):
+    """Write the inventory of one host to the history database"""
+
+    def __init__(self, conn, db, host=None, full_interval=FULL_SYNC_INTERVAL):
+        """
+        Initialize the exporter
+
+        Args:
+            conn: libvirt connection
+            db: Connection from connect()
+            host: Host name stored with the rows (default: the hypervisor's)
+            full_interval: Seconds between syncs that read every XML
+        """
+        self.conn = conn
+        self.db = db
+        self.host = host or conn.getHostname()
+        self.full_interval = full_interval
+        self._dirty = set()
+        self._dirty_lock = threading.Lock()
+        # uuid -> (row tuple in FIELDS order, xml digest)
+        self._rows = {}
+        for row in db.execute(
+                "SELECT uuid, %s, xml_digest FROM domains "
+                "WHERE host = ? AND removed IS NULL" % ", ".join(FIELDS),
+                (self.host,)):
+            self._rows[row[0]] = (tuple(row[1:-1]), row[-1])
+        # A sync that read every XML was a full one
+        last = db.execute("SELECT MAX(ts) FROM syncs WHERE host = ? AND "
+                          "fetched = domains", (self.host,)).fetchone()[0]
+        self._last_full = last or 0
+
+        dispatcher = vm_events.get_dispatcher(conn)
+        if dispatcher is not None:
+            dispatcher.subscribe(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                 self._on_lifecycle)
+
+    def _on_lifecycle(self, dom, event, detail):
+        """Re-read the XML of a domain that was defined, started, ..."""
+        with self._dirty_lock:
+            self._dirty.add(dom.UUIDString())
+
+    def sync(self, full=False):
+        """
+        Write the rows that changed since the last sync
+
+        Args:
+            full: Re-read every domain XML
+
+        Returns:
+            SyncResult
+        """
+        result = SyncResult()
+        start = time.time()
+        if start - self._last_full >= self.full_interval:
+            full = True
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, set()
+
+        stats = self.conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE, 0)
+        result.domains = len(stats)
+        inserts, updates, changes = [], [], []
+        seen = set()
+        for dom, values in stats:
+            uuid = dom.UUIDString()
+            seen.add(uuid)
+            old_row, old_digest = self._rows.get(uuid, (None, None))
+            state = values.get('state.state')
+            if not (full or old_row is None or uuid in dirty or
+                    state != old_row[1]):
+                continue
+            try:
+                xml = dom.XMLDesc(0)
+            except libvirt.libvirtError:
+                continue        # undefined since the stats call
+            result.fetched += 1
+            new_digest = digest(xml)
+            if old_row is not None and new_digest == old_digest and \
+                    state == old_row[1]:
+                continue
+            summary = old_row and dict(zip(FIELDS, old_row))
+            if new_digest != old_digest:
+                summary = summarize(xml)
+            row = (dom.name(), state, summary['vcpus'], summary['memory_mb'],
+                   summary['disks'], summary['interfaces'])
+            for field, old, new in zip(FIELDS, old_row or (None,) * len(FIELDS),
+                                       row):
+                if old != new:
+                    changes.append((start, self.host, uuid, row[0], field,
+                                    None if old is None else str(old), str(new)))
+            params = row + (new_digest, start, self.host, uuid)
+            (inserts if old_row is None else updates).append(params)
+            self._rows[uuid] = (row, new_digest)
+
+        removed = [uuid for uuid in self._rows if uuid not in seen]
+        for uuid in removed:
+            row = self._rows.pop(uuid)[0]
+            changes.append((start, self.host, uuid, row[0], 'state',
+                            str(row[1]), None))
+        result.changed = len(inserts) + len(updates)
+        result.removed = len(removed)
+
+        self._write(inserts, updates, changes, removed, start, result)
+        if full:
+            self._last_full = start
+        return result
+
+    def _write(self, inserts, updates, changes, removed, now, result):
+        """Apply one sync in a single transaction"""
+        columns = ", ".join("%s = ?" % f for f in FIELDS)
+        self.db.execute("BEGIN")
+        try:
+            # A domain seen again after removal keeps its first_seen
+            self.db.executemany(
+                "INSERT OR IGNORE INTO domains (%s, xml_digest, first_seen, "
+                "host, uuid) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                % ", ".join(FIELDS), inserts)
+            self.db.executemany(
+                "UPDATE domains SET %s, xml_digest = ?, updated = ?, "
+                "removed = NULL WHERE host = ? AND uuid = ?" % columns,
+                inserts + updates)
+            self.db.executemany(
+                "UPDATE domains SET removed = ? WHERE host = ? AND uuid = ?",
+                [(now, self.host, uuid) for uuid in removed])
+            self.db.executemany(
+                "INSERT INTO changes VALUES (?, ?, ?, ?, ?, ?, ?)", changes)
+            result.seconds = round(time.time() - now, 4)
+            self.db.execute("INSERT INTO syncs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (now, self.host, result.domains, result.fetched,
+                             result.changed, result.removed, result.seconds))
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def run_forever(self, stop, interval=SYNC_INTERVAL, report=None):
+        """
+        Sync every interval seconds until stop is set
+
+        Args:
+            stop: threading.Event
+            interval: Seconds between syncs
+            report: Optional callable(SyncResult)
+        """
+        while not stop.is_set():
+            result = self.sync()
+            if report:
+                report(result)
+            stop.wait(interval)
+
+
+# =============================================================================
+# QUERIES
+# =============================================================================
+
+def changes_of(db, name, field=None):
+    """
+    Return the recorded changes of a domain, oldest first
+
+    Args:
+        db: Connection from connect()
+        name: Domain name or UUID
+        field: Only changes of this field
+
+    Returns:
+        List of (ts, host, field, old, new)
+    """
+    sql = ("SELECT ts, host, field, old, new FROM changes WHERE uuid IN "
+           "(SELECT uuid FROM changes WHERE name = ? OR uuid = ?)")
+    params = [name, name]
+    if field:
+        sql += " AND field = ?"
+        params.append(field)
+    return db.execute(sql + " ORDER BY ts", params).fetchall()
+
+
+def running_between(db, host, since, until):
+    """
+    Return the domains that were running on a host at any time in a period
+
+    Args:
+        db: Connection from connect()
+        host: Host name
+        since, until: Period as Unix timestamps
+
+    Returns:
+        Sorted list of domain names
+    """
+    running = str(libvirt.VIR_DOMAIN_RUNNING)
+    rows = db.execute("""
+        SELECT DISTINCT uuid FROM changes
+        WHERE host = ? AND field = 'state' AND new = ? AND ts BETWEEN ? AND ?
+        UNION
+        SELECT c.uuid FROM changes c
+        WHERE c.host = ? AND c.field = 'state' AND c.new = ? AND c.ts = (
+            SELECT MAX(ts) FROM changes d
+            WHERE d.host = c.host AND d.uuid = c.uuid AND d.field = 'state'
+              AND d.ts < ?)
+        """, (host, running, since, until, host, running, since)).fetchall()
+    names = []
+    for (uuid,) in rows:
+        name = db.execute("SELECT name FROM domains WHERE host = ? AND uuid = ?",
+                          (host, uuid)).fetchone()
+        names.append(name[0] if name else uuid)
+    return sorted(names)
+
+
+def _timestamp(text):
+    """Parse YYYY-MM-DD[ HH:MM] as local time"""
+    fmt = "%Y-%m-%d %H:%M" if " " in text else "%Y-%m-%d"
+    return time.mktime(time.strptime(text, fmt))
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Inventory history in SQLite")
+    parser.add_argument("action", choices=["sync", "changes", "running"])
+    parser.add_argument("name", nargs="?", help="Domain for changes")
+    parser.add_argument("--db", default=DB_FILE)
+    parser.add_argument("--uri", default="qemu:///system")
+    parser.add_argument("--full", action="store_true",
+                        help="Re-read every domain XML")
+    parser.add_argument("--interval", type=float,
+                        help="Keep syncing every this many seconds")
+    parser.add_argument("--field", choices=FIELDS)
+    parser.add_argument("--host", help="Host for running (default: the URI's)")
+    parser.add_argument("--since", help="YYYY-MM-DD[ HH:MM]")
+    parser.add_argument("--until", help="YYYY-MM-DD[ HH:MM] (default: now)")
+    args = parser.parse_args(argv)
+
+    db = connect(args.db)
+    if args.action == "changes":
+        if not args.name:
+            parser.error("changes needs a domain name")
+        for ts, host, field, old, new in changes_of(db, args.name, args.field):
+            print("%s  %-16s %-10s %s -> %s" % (
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)),
+                host[:16], field, old or "-", new or "-"))
+        return 0
+    if args.action == "running" and not args.since:
+        parser.error("running needs --since")
+
+    conn = None
+    if args.action == "sync" or not args.host:
+        try:
+            conn = vm_instrument.instrument(libvirt.open(args.uri))
+        except libvirt.libvirtError as e:
+            print("Error: %s" % e)
+            return 1
+    try:
+        if args.action == "running":
+            host = args.host or conn.getHostname()
+            until = _timestamp(args.until) if args.until else time.time()
+            names = running_between(db, host, _timestamp(args.since), until)
+            for name in names:
+                print(name)
+            print("%d VMs ran on %s" % (len(names), host))
+            return 0
+
+        exporter = HistoryExporter(conn, db)
+
+        def report(result):
+            print("%d domains, %d XML read, %d rows written, %d removed "
+                  "in %.1f ms" % (result.domains, result.fetched, result.changed,
+                                  result.removed, result.seconds * 1000))
+
+        if args.interval:
+            stop = threading.Event()
+            try:
+                exporter.run_forever(stop, args.interval, report)
+            except KeyboardInterrupt:
+                stop.set()
+        else:
+            report(exporter.sync(args.full))
+        return 0
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
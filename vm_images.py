@@ -0,0 +1,507 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Image Library
+-------------
+Index of installation ISOs and golden (base) disk images
+
+The library directories are scanned into a small JSON index holding the
+size, mtime, inode and SHA-256 of every image. The index is updated
+incrementally: a file whose size, mtime and inode are unchanged keeps
+its hash, so only new or modified images are read. Hashes are computed
+from sliding read-only mmap windows, which streams the file through the
+page cache without copying it into Python buffers.
+
+Identical images (same size and hash) can be deduplicated: each copy is
+replaced by a reflink of the first one (shared extents, copy-on-write)
+or, where the filesystem cannot clone, a hardlink. Library images are
+meant to be read-only; hardlinked copies share one inode.
+
+create_vm looks images up by name in the index instead of asking for a
+path.
+
+Configuration ("images" section of vm_manager.json):
+
+    "images": {
+        "dirs": ["/ISO", "/var/lib/libvirt/images/base"],
+        "index": "vm_images.json"
+    }
+
+Examples:
+    python vm_images.py import /mnt/hgfs/shared/rhel-server-7.2-x86_64-dvd.iso
+    python vm_images.py update
+    python vm_images.py list --kind iso
+    python vm_images.py dedupe --dry-run
+"""
+
+import argparse
+import errno
+import fcntl
+import fnmatch
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+import vm_config
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+ISO_DIR = '/ISO'
+BASE_DIR = '/var/lib/libvirt/images/base'
+INDEX_FILE = 'vm_images.json'
+INDEX_VERSION = 1
+
+KINDS = {'.iso': 'iso', '.qcow2': 'base', '.img': 'base', '.raw': 'base'}
+
+# Bytes mapped at a time while hashing (a multiple of the page size)
+HASH_WINDOW = 64 << 20
+HASH_WORKERS = 2
+
+# ioctl that clones a whole file (Linux, btrfs/XFS)
+FICLONE = 0x40049409
+
+
+def images_config(config=None):
+    """Return the "images" section with defaults filled in"""
+    cfg = vm_config.section('images', config)
+    return {
+        'dirs': list(cfg.get('dirs', [ISO_DIR, BASE_DIR])),
+        'index': cfg.get('index', INDEX_FILE),
+    }
+
+
+# =============================================================================
+# HASHING
+# =============================================================================
+
+def file_hash(path, window=HASH_WINDOW):
+    """
+    Return the SHA-256 hex digest of a file read through mmap windows
+
+    Args:
+        path: File to hash
+        window: Bytes mapped at a time
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset < size:
+            length = min(window, size - offset)
+            m = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ,
+                          offset=offset)
+            try:
+                digest.update(m)
+            finally:
+                m.close()
+            offset += length
+    return digest.hexdigest()
+
+
+# =============================================================================
+# INDEX
+# =============================================================================
+
+def kind_of(path):
+    """Return "iso" or "base" for a library file, None for other files"""
+    return KINDS.get(os.path.splitext(path)[1].lower())
+
+
+def _entry(path, st, sha256):
+    return {
+        'name': os.path.basename(path),
+        'kind': kind_of(path),
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'dev': st.st_dev,
+        'ino': st.st_ino,
+        'sha256': sha256,
+    }
+
+
+def load_index(path=None):
+    """
+    Read the index
+
+    Returns:
+        Dict of image path -> entry (empty when there is no index)
+    """
+    path = path or images_config()['index']
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('version') != INDEX_VERSION:
+        return {}
+    return data['images']
+
+
+def save_index(images, path=None):
+    """Atomically write the index"""
+    path = path or images_config()['index']
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'version': INDEX_VERSION, 'updated': time.time(),
+                   'images': images}, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def scan(dirs):
+    """
+    List library files with their stat results
+
+    Returns:
+        Dict of path -> os.stat_result
+    """
+    found = {}
+    for top in dirs:
+        for root, _, files in os.walk(top):
+            for name in files:
+                path = os.path.join(root, name)
+                if kind_of(path) is None:
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found[path] = st
+    return found
+
+
+def _unchanged(entry, st):
+    return (entry is not None and entry['size'] == st.st_size and
+            entry['mtime'] == st.st_mtime and entry['ino'] == st.st_ino and
+            entry['dev'] == st.st_dev)
+
+
+def update_index(dirs=None, path=None, workers=HASH_WORKERS, progress=None):
+    """
+    Bring the index up to date with the library directories
+
+    Args:
+        dirs: Directories to scan (default: configuration)
+        path: Index file (default: configuration)
+        workers: Files hashed at once
+        progress: Optional callable(path) called before hashing a file
+
+    Returns:
+        (images, counts) where counts has "hashed", "kept" and "removed"
+    """
+    cfg = images_config()
+    dirs = dirs or cfg['dirs']
+    path = path or cfg['index']
+    old = load_index(path)
+    found = scan(dirs)
+
+    images = {}
+    stale = []
+    for p, st in found.items():
+        if _unchanged(old.get(p), st):
+            images[p] = old[p]
+        else:
+            stale.append(p)
+
+    def rehash(p):
+        if progress:
+            progress(p)
+        try:
+            st = os.stat(p)
+            return p, _entry(p, st, file_hash(p))
+        except (IOError, OSError):
+            return p, None
+
+    if stale:
+        pool = ThreadPool(min(workers, len(stale)))
+        try:
+            for p, entry in pool.imap_unordered(rehash, sorted(stale)):
+                if entry is not None:
+                    images[p] = entry
+        finally:
+            pool.close()
+
+    save_index(images, path)
+    counts = {'hashed': len(stale), 'kept': len(found) - len(stale),
+              'removed': len(set(old) - set(found))}
+    return images, counts
+
+
+def find(images, name, kind=None):
+    """
+    Look up images by name
+
+    A name matches an image's file name, its file name without the
+    extension, or a glob pattern on the file name.
+
+    Args:
+        images: Index from load_index()
+        name: Name or pattern
+        kind: Only "iso" or "base" images
+
+    Returns:
+        Sorted list of matching paths
+    """
+    matches = []
+    for path, entry in images.items():
+        if kind and entry['kind'] != kind:
+            continue
+        base = entry['name']
+        if name in (base, os.path.splitext(base)[0]) or \
+                fnmatch.fnmatch(base, name):
+            matches.append(path)
+    return sorted(matches)
+
+
+def resolve(images, name, kind=None):
+    """
+    Return the path of exactly one image
+
+    Args:
+        images: Index from load_index()
+        name: Image name or pattern (see find()), or a path containing "/"
+        kind: Only "iso" or "base" images
+
+    Raises:
+        ValueError: The path does not exist, or the name matches no image
+            or several images
+    """
+    if '/' in name:
+        if not os.path.isfile(name):
+            raise ValueError("file not found: %s" % name)
+        return name
+    matches = find(images, name, kind)
+    if not matches:
+        raise ValueError("no %s image named %s in the library" %
+                         (kind or "library", name))
+    if len(matches) > 1:
+        raise ValueError("%s matches %d images: %s" %
+                         (name, len(matches), ", ".join(matches)))
+    return matches[0]
+
+
+def import_image(source, directory=ISO_DIR, move=False):
+    """
+    Copy or move a file into a library directory
+
+    Returns:
+        Path of the image in the library
+
+    Raises:
+        ValueError: Not an ISO or disk image, or the name is taken
+    """
+    if kind_of(source) is None:
+        raise ValueError("%s is not an ISO or disk image" % source)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    dest = os.path.join(directory, os.path.basename(source))
+    if os.path.exists(dest):
+        raise ValueError("%s already exists" % dest)
+    if move:
+        shutil.move(source, dest)
+    else:
+        shutil.copy2(source, dest)
+    return dest
+
+
+# =============================================================================
+# DEDUPLICATION
+# =============================================================================
+
+def duplicates(images):
+    """
+    Group identical images that are still separate files
+
+    Returns:
+        List of path lists; the first path of each group is kept
+    """
+    groups = {}
+    for path, entry in images.items():
+        groups.setdefault((entry['size'], entry['sha256']), []).append(path)
+    result = []
+    for paths in groups.values():
+        if len(paths) < 2:
+            continue
+        # Oldest first, so the original is the one kept
+        paths.sort(key=lambda p: (images[p]['mtime'], p))
+        inodes = set((images[p]['dev'], images[p]['ino']) for p in paths)
+        if len(inodes) > 1:
+            result.append(paths)
+    return sorted(result)
+
+
+def _reflink(source, dest):
+    """Clone source into a new file dest; raises IOError if unsupported"""
+    with open(source, 'rb') as src:
+        with open(dest, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source, dest)
+
+
+def link_duplicate(keep, path, mode='auto'):
+    """
+    Replace path with a reflink or hardlink of keep
+
+    Args:
+        keep: Image that stays
+        path: Identical image to replace
+        mode: "reflink", "hardlink" or "auto" (reflink, then hardlink)
+
+    Returns:
+        Method used: "reflink" or "hardlink"
+
+    Raises:
+        OSError/IOError: Neither method works (e.g. different filesystems)
+    """
+    tmp = path + '.dedupe'
+    methods = ['reflink', 'hardlink'] if mode == 'auto' else [mode]
+    error = None
+    for method in methods:
+        try:
+            if method == 'reflink':
+                _reflink(keep, tmp)
+            else:
+                os.link(keep, tmp)
+            os.rename(tmp, path)
+            return method
+        except (IOError, OSError) as e:
+            error = e
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                               errno.EXDEV, errno.EPERM):
+                break
+    raise error
+
+
+def dedupe(images, mode='auto', dry_run=False, path=None):
+    """
+    Deduplicate identical images and update the index
+
+    Args:
+        images: Index from update_index()
+        mode: See link_duplicate()
+        dry_run: Only report what would be linked
+        path: Index file to rewrite
+
+    Returns:
+        List of (path, kept path, method or error, bytes saved)
+    """
+    results = []
+    for group in duplicates(images):
+        keep = group[0]
+        for dup in group[1:]:
+            entry = images[dup]
+            if dry_run:
+                results.append((dup, keep, 'planned', entry['size']))
+                continue
+            try:
+                # Both sides must still hold the hashed content, or the
+                # duplicate would be replaced by different data
+                if not _unchanged(images[keep], os.stat(keep)):
+                    results.append((dup, keep,
+                                    'kept image changed since indexed', 0))
+                    continue
+                if not _unchanged(entry, os.stat(dup)):
+                    results.append((dup, keep, 'changed since indexed', 0))
+                    continue
+                method = link_duplicate(keep, dup, mode)
+            except (IOError, OSError) as e:
+                results.append((dup, keep, str(e), 0))
+                continue
+            images[dup] = _entry(dup, os.stat(dup), entry['sha256'])
+            results.append((dup, keep, method, entry['size']))
+    if not dry_run:
+        save_index(images, path)
+    return results
+
+
+# =============================================================================
+# OUTPUT
+# =============================================================================
+
+def format_images(images, kind=None):
+    """
+    Format the index as a text table
+
+    Returns:
+        List of lines
+    """
+    lines = ["%-40s %-5s %10s  %-12s  %s" % ("Name", "Kind", "Size MB",
+                                             "SHA-256", "Path")]
+    lines.append("-" * 100)
+    for path in sorted(images, key=lambda p: (images[p]['kind'],
+                                              images[p]['name'])):
+        entry = images[path]
+        if kind and entry['kind'] != kind:
+            continue
+        lines.append("%-40s %-5s %10.0f  %-12s  %s" % (
+            entry['name'][:40], entry['kind'], entry['size'] / 1048576.0,
+            entry['sha256'][:12], path))
+    return lines
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="ISO and base image library")
+    parser.add_argument("action",
+                        choices=["update", "list", "find", "dedupe", "import"])
+    parser.add_argument("arg", nargs="?", help="Name for find, file for import")
+    parser.add_argument("--kind", choices=["iso", "base"])
+    parser.add_argument("--mode", choices=["auto", "reflink", "hardlink"],
+                        default="auto")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--move", action="store_true",
+                        help="Move instead of copying on import")
+    args = parser.parse_args(argv)
+
+    if args.action in ("find", "import") and not args.arg:
+        parser.error("%s needs an argument" % args.action)
+
+    try:
+        if args.action == "import":
+            directory = BASE_DIR if kind_of(args.arg) == 'base' else ISO_DIR
+            print("Imported %s" % import_image(args.arg, directory, args.move))
+        if args.action in ("update", "dedupe", "import"):
+            def show(path):
+                print("Hashing %s" % path)
+            images, counts = update_index(progress=show)
+            print("%(hashed)d hashed, %(kept)d unchanged, %(removed)d removed"
+                  % counts)
+        else:
+            images = load_index()
+
+        if args.action == "list":
+            for line in format_images(images, args.kind):
+                print(line)
+        elif args.action == "find":
+            matches = find(images, args.arg, args.kind)
+            for path in matches:
+                print(path)
+            return 0 if matches else 1
+        elif args.action == "dedupe":
+            results = dedupe(images, args.mode, args.dry_run)
+            for dup, keep, method, saved in results:
+                print("%-10s %s -> %s" % (method[:10] if saved else "skipped",
+                                          dup, keep))
+                if not saved:
+                    print("           %s" % method)
+            print("%.0f MB %s" % (sum(r[3] for r in results) / 1048576.0,
+                                  "reclaimable" if args.dry_run else "reclaimed"))
+    except (IOError, OSError, ValueError) as e:
+        print("Error: %s" % e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+libvirt Call Instrumentation
+----------------------------
+Per-method call counts and latency histograms for libvirt API calls
+
+instrument() wraps a libvirt connection in a proxy that times every
+method call. Domains returned by the connection (lookupByName,
+listAllDomains, defineXML, ...) are wrapped as well, so calls such as
+dom.state() or dom.XMLDesc() are recorded under "dom.<method>".
+
+Instrumentation is enabled with VM_MANAGER_INSTRUMENT=1. When disabled,
+instrument() returns the connection untouched, so there is no overhead.
+Setting VM_MANAGER_METRICS_PORT additionally serves the statistics in
+Prometheus text format on 127.0.0.1.
+"""
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import libvirt
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+ENABLED = os.environ.get('VM_MANAGER_INSTRUMENT', '0') not in ('', '0')
+METRICS_PORT = int(os.environ.get('VM_MANAGER_METRICS_PORT', '0') or 0)
+
+# Histogram bucket upper bounds in milliseconds
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500,
+              1000, 2500, 5000, 10000)
+
+# Methods answered from the local object without an RPC
+LOCAL_METHODS = frozenset([
+    'name', 'UUID', 'UUIDString', 'connect', 'getConnect', 'c_pointer',
+])
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+# =============================================================================
+# STATISTICS
+# =============================================================================
+
+class MethodStats(object):
+    """Call count, error count and latency histogram of one method"""
+
+    __slots__ = ('count', 'errors', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def observe(self, seconds, error=False):
+        """Record one call"""
+        ms = seconds * 1000.0
+        self.count += 1
+        self.total += seconds
+        if ms > self.max:
+            self.max = ms
+        if error:
+            self.errors += 1
+        index = 0
+        for bound in BUCKETS_MS:
+            if ms <= bound:
+                break
+            index += 1
+        self.buckets[index] += 1
+
+    def percentile(self, pct):
+        """
+        Estimate a latency percentile from the histogram
+
+        Args:
+            pct: Percentile between 0 and 100
+
+        Returns:
+            Upper bound in milliseconds of the bucket holding the percentile
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * pct / 100.0
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                if index < len(BUCKETS_MS):
+                    return min(float(BUCKETS_MS[index]), self.max)
+                return self.max
+        return self.max
+
+    def to_dict(self):
+        """Return the statistics as a plain dict"""
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total_ms': round(self.total * 1000.0, 3),
+            'avg_ms': round(self.total * 1000.0 / self.count, 3)
+                      if self.count else 0.0,
+            'max_ms': round(self.max, 3),
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'buckets': list(self.buckets),
+        }
+
+
+class RPCStats(object):
+    """Thread-safe registry of MethodStats keyed by "conn.x" / "dom.x" """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.methods = {}
+
+    def observe(self, key, seconds, error=False):
+        """Record one call of a method"""
+        with self._lock:
+            stats = self.methods.get(key)
+            if stats is None:
+                stats = self.methods[key] = MethodStats()
+            stats.observe(seconds, error)
+
+    def total_calls(self):
+        """Return the number of calls recorded across all methods"""
+        with self._lock:
+            return sum(s.count for s in self.methods.values())
+
+    def snapshot(self):
+        """Return a dict of method -> statistics dict"""
+        with self._lock:
+            return dict((k, s.to_dict()) for k, s in self.methods.items())
+
+    def reset(self):
+        """Forget all recorded calls"""
+        with self._lock:
+            self.methods = {}
+
+
+# Process-wide registry used by default
+STATS = RPCStats()
+
+# =============================================================================
+# PROXIES
+# =============================================================================
+
+class InstrumentedProxy(object):
+    """
+    Proxy that times every method call of a libvirt object
+
+    Wrapped callables are cached on the proxy so that repeated calls only
+    pay for the timing itself.
+    """
+
+    def __init__(self, target, kind, stats):
+        """
+        Initialize the proxy
+
+        Args:
+            target: libvirt object (virConnect or virDomain)
+            kind: Key prefix, "conn" or "dom"
+            stats: RPCStats registry to record into
+        """
+        self.__dict__['__wrapped__'] = target
+        self.__dict__['_kind'] = kind
+        self.__dict__['_stats'] = stats
+
+    def __getattr__(self, name):
+        attr = getattr(self.__wrapped__, name)
+        if name in LOCAL_METHODS or name.startswith('_') or not callable(attr):
+            return attr
+        wrapper = _timed(attr, self._kind + '.' + name, self._stats)
+        self.__dict__[name] = wrapper
+        return wrapper
+
+    def __setattr__(self, name, value):
+        setattr(self.__wrapped__, name, value)
+
+    def __eq__(self, other):
+        return unwrap(self) == unwrap(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.__wrapped__)
+
+    def __repr__(self):
+        return '<instrumented %r>' % (self.__wrapped__,)
+
+
+def _timed(func, key, stats):
+    """Build a wrapper that records the duration of each call of func"""
+    def wrapper(*args, **kwargs):
+        start = _timer()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            stats.observe(key, _timer() - start, True)
+            raise
+        stats.observe(key, _timer() - start)
+        return wrap_result(result, stats)
+    wrapper.__name__ = getattr(func, '__name__', key)
+    return wrapper
+
+
+def wrap_result(result, stats):
+    """
+    Wrap domains contained in an API result
+
+    Handles a single domain, lists of domains and the (domain, stats)
+    tuples returned by getAllDomainStats.
+    """
+    if isinstance(result, libvirt.virDomain):
+        return InstrumentedProxy(result, 'dom', stats)
+    if isinstance(result, list) and result:
+        first = result[0]
+        if isinstance(first, libvirt.virDomain):
+            return [InstrumentedProxy(d, 'dom', stats) for d in result]
+        if isinstance(first, tuple) and first and \
+                isinstance(first[0], libvirt.virDomain):
+            return [(InstrumentedProxy(t[0], 'dom', stats),) + tuple(t[1:])
+                    for t in result]
+    return result
+
+
+def unwrap(obj):
+    """Return the raw libvirt object behind any number of proxies"""
+    while True:
+        try:
+            obj = obj.__dict__['__wrapped__']
+        except (AttributeError, KeyError):
+            return obj
+
+
+def instrument(conn, stats=None, enabled=None):
+    """
+    Wrap a libvirt connection for call instrumentation
+
+    Args:
+        conn: libvirt.virConnect (or None)
+        stats: RPCStats registry, defaults to the process-wide STATS
+        enabled: Override the VM_MANAGER_INSTRUMENT setting
+
+    Returns:
+        The instrumented proxy, or conn itself when disabled
+    """
+    if enabled is None:
+        enabled = ENABLED
+    if not enabled or conn is None:
+        return conn
+    return InstrumentedProxy(conn, 'conn', stats or STATS)
+
+
+# =============================================================================
+# REPORTING
+# =============================================================================
+
+def format_report(stats=None):
+    """
+    Format the recorded statistics as a text table
+
+    Returns:
+        List of lines, slowest total time first
+    """
+    snap = (stats or STATS).snapshot()
+    lines = ["%-32s %8s %6s %10s %9s %9s %9s %9s" %
+             ("Method", "Calls", "Errors", "Total ms", "Avg ms",
+              "p50 ms", "p95 ms", "Max ms")]
+    lines.append("-" * 98)
+    for key in sorted(snap, key=lambda k: -snap[k]['total_ms']):
+        s = snap[key]
+        lines.append("%-32s %8d %6d %10.1f %9.3f %9.3f %9.3f %9.3f" %
+                     (key[:32], s['count'], s['errors'], s['total_ms'],
+                      s['avg_ms'], s['p50_ms'], s['p95_ms'], s['max_ms']))
+    return lines
+
+
+def write_report(path, stats=None):
+    """Write the recorded statistics to a JSON file"""
+    with open(path, 'w') as f:
+        json.dump({'generated': time.time(),
+                   'methods': (stats or STATS).snapshot()},
+                  f, indent=2, sort_keys=True)
+
+
+def render_prometheus(stats=None):
+    """
+    Render the recorded statistics in Prometheus text exposition format
+
+    Returns:
+        Exposition text
+    """
+    snap = (stats or STATS).snapshot()
+    out = ["# HELP vm_manager_libvirt_call_seconds Latency of libvirt API calls",
+           "# TYPE vm_manager_libvirt_call_seconds histogram"]
+    for key in sorted(snap):
+        s = snap[key]
+        cumulative = 0
+        for bound, n in zip(BUCKETS_MS + ('+Inf',), s['buckets']):
+            cumulative += n
+            le = bound if bound == '+Inf' else repr(bound / 1000.0)
+            out.append('vm_manager_libvirt_call_seconds_bucket'
+                       '{method="%s",le="%s"} %d' % (key, le, cumulative))
+        out.append('vm_manager_libvirt_call_seconds_sum{method="%s"} %.6f' %
+                   (key, s['total_ms'] / 1000.0))
+        out.append('vm_manager_libvirt_call_seconds_count{method="%s"} %d' %
+                   (key, s['count']))
+    out.append("# HELP vm_manager_libvirt_call_errors_total "
+               "Failed libvirt API calls")
+    out.append("# TYPE vm_manager_libvirt_call_errors_total counter")
+    for key in sorted(snap):
+        out.append('vm_manager_libvirt_call_errors_total{method="%s"} %d' %
+                   (key, snap[key]['errors']))
+    return "\n".join(out) + "\n"
+
+
+# Extra exposition sources registered by other subsystems
+_metric_sources = []
+
+
+def register_metrics(source):
+    """
+    Add a callable returning extra Prometheus text to the metrics endpoint
+
+    Args:
+        source: Callable taking no arguments and returning exposition text
+    """
+    _metric_sources.append(source)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Serve /metrics in Prometheus text format"""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus() + "".join(s() for s in _metric_sources)
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def start_metrics_server(port=None, addr='127.0.0.1'):
+    """
+    Serve /metrics from a background thread
+
+    Args:
+        port: TCP port, defaults to VM_MANAGER_METRICS_PORT
+        addr: Listen address
+
+    Returns:
+        The HTTPServer instance, or None when no port is configured or the
+        port is already taken (another instance or the watchdog)
+    """
+    port = port or METRICS_PORT
+    if not port:
+        return None
+    try:
+        server = HTTPServer((addr, port), _MetricsHandler)
+    except socket.error as e:
+        sys.stderr.write("Warning: metrics not served on %s:%s: %s\n" %
+                         (addr, port, e))
+        return None
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
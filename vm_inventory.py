@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Domain Inventory
+----------------
+Cached view of all domains, kept current by events and bulk stats
+
+refresh() reads state, vCPUs, memory and CPU time of every domain with a
+single getAllDomainStats call. Between refreshes, lifecycle events update
+the state of the affected row immediately, so a display only has to
+redraw rows whose version changed.
+
+The inventory can be saved to a snapshot file (vm_inventory.json) and
+loaded from it before any connection exists, so the last known fleet can
+be shown at once and reconciled by the first refresh.
+"""
+
+import json
+import os
+import threading
+import time
+
+import libvirt
+
+import vm_events
+
+# Stats read on each refresh
+STATS = (libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_BALLOON |
+         libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL)
+
+REFRESH_INTERVAL = 5.0
+
+SNAPSHOT_FILE = 'vm_inventory.json'
+SNAPSHOT_FIELDS = ('uuid', 'name', 'state', 'vcpus', 'memory_mb')
+
+# State a lifecycle event leaves a domain in
+EVENT_STATES = {
+    libvirt.VIR_DOMAIN_EVENT_STARTED: libvirt.VIR_DOMAIN_RUNNING,
+    libvirt.VIR_DOMAIN_EVENT_RESUMED: libvirt.VIR_DOMAIN_RUNNING,
+    libvirt.VIR_DOMAIN_EVENT_SUSPENDED: libvirt.VIR_DOMAIN_PAUSED,
+    libvirt.VIR_DOMAIN_EVENT_STOPPED: libvirt.VIR_DOMAIN_SHUTOFF,
+    libvirt.VIR_DOMAIN_EVENT_SHUTDOWN: libvirt.VIR_DOMAIN_SHUTDOWN,
+    libvirt.VIR_DOMAIN_EVENT_CRASHED: libvirt.VIR_DOMAIN_CRASHED,
+}
+
+
+class DomainRow(object):
+    """Cached facts about one domain"""
+
+    def __init__(self, uuid, name):
+        self.uuid = uuid
+        self.name = name
+        self.state = libvirt.VIR_DOMAIN_NOSTATE
+        self.vcpus = 0
+        self.memory_mb = 0
+        self.cpu_time = None
+        self.cpu_pct = None
+        self.version = 0
+
+    def to_dict(self):
+        """Return the row as a plain dict"""
+        return dict(self.__dict__)
+
+
+class Inventory(object):
+    """
+    All domains of a connection, refreshed in bulk and patched by events
+
+    Every change bumps the inventory version and stamps it on the changed
+    row, so callers can ask for what changed since they last looked.
+    """
+
+    def __init__(self, conn=None, snapshot_path=None):
+        """
+        Initialize the inventory
+
+        Args:
+            conn: libvirt connection, or None to attach() one later
+            snapshot_path: Snapshot file written after the first refresh
+                and on stop(); None disables snapshots
+        """
+        self.conn = None
+        self.host = None
+        self.snapshot_path = snapshot_path
+        self.snapshot_at = None
+        self.version = 0
+        self.refreshed_at = None
+        self._rows = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stale = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._token = None
+        if conn is not None:
+            self.attach(conn)
+
+    def attach(self, conn):
+        """Use a connection for refreshes and subscribe to its events"""
+        self.conn = conn
+        dispatcher = vm_events.get_dispatcher(conn)
+        if dispatcher is not None:
+            self._token = dispatcher.subscribe(
+                libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._on_lifecycle)
+
+    def _bump(self, row):
+        """Mark a row changed (lock held)"""
+        self.version += 1
+        row.version = self.version
+
+    def _on_lifecycle(self, dom, event, detail):
+        with self._lock:
+            row = self._rows.get(dom.UUIDString())
+            if row is None or event not in EVENT_STATES:
+                # Defined, undefined or unknown domain: reload everything
+                self._stale.set()
+                return
+            row.state = EVENT_STATES[event]
+            if row.state != libvirt.VIR_DOMAIN_RUNNING:
+                row.cpu_pct = None
+            self._bump(row)
+
+    def refresh(self):
+        """Reload every domain with one bulk stats call"""
+        with self._refresh_lock:
+            # Events arriving from here on mark the next refresh
+            self._stale.clear()
+            now = time.time()
+            stats = self.conn.getAllDomainStats(STATS, 0)
+            with self._lock:
+                seen = set()
+                elapsed = now - self.refreshed_at if self.refreshed_at else None
+                for dom, values in stats:
+                    uuid = dom.UUIDString()
+                    seen.add(uuid)
+                    row = self._rows.get(uuid)
+                    if row is None:
+                        row = self._rows[uuid] = DomainRow(uuid, dom.name())
+                    before = (row.name, row.state, row.vcpus, row.memory_mb,
+                              row.cpu_pct)
+                    self._update_row(row, dom, values, elapsed)
+                    if before != (row.name, row.state, row.vcpus,
+                                  row.memory_mb, row.cpu_pct):
+                        self._bump(row)
+                for uuid in set(self._rows) - seen:
+                    del self._rows[uuid]
+                    self.version += 1
+                first = self.refreshed_at is None
+                self.refreshed_at = now
+            if first and self.snapshot_path:
+                self.host = self.conn.getHostname()
+                self.save_snapshot()
+
+    @staticmethod
+    def _update_row(row, dom, values, elapsed):
+        """Fill a row from one domain's bulk stats"""
+        row.name = dom.name()
+        row.state = values.get('state.state', row.state)
+        row.vcpus = values.get('vcpu.current', values.get('vcpu.maximum', 0))
+        memory = values.get('balloon.current', values.get('balloon.maximum', 0))
+        row.memory_mb = memory // 1024
+        cpu_time = values.get('cpu.time')
+        if (cpu_time is not None and row.cpu_time is not None and elapsed and
+                row.state == libvirt.VIR_DOMAIN_RUNNING and row.vcpus):
+            row.cpu_pct = round(100.0 * (cpu_time - row.cpu_time) / 1e9 /
+                                elapsed / row.vcpus, 1)
+        else:
+            row.cpu_pct = None
+        row.cpu_time = cpu_time
+
+    def rows(self):
+        """Return a snapshot of all rows sorted by name"""
+        with self._lock:
+            rows = [self._copy(r) for r in self._rows.values()]
+        return sorted(rows, key=lambda r: r.name)
+
+    @staticmethod
+    def _copy(row):
+        """Return an independent copy of a row"""
+        copy = DomainRow(row.uuid, row.name)
+        copy.__dict__.update(row.__dict__)
+        return copy
+
+    def find(self, name):
+        """Return a snapshot of the row with a name, or None"""
+        with self._lock:
+            for row in self._rows.values():
+                if row.name == name:
+                    return self._copy(row)
+        return None
+
+    def save_snapshot(self, path=None):
+        """
+        Atomically write the current rows to the snapshot file
+
+        Args:
+            path: Snapshot file, defaults to snapshot_path
+        """
+        path = path or self.snapshot_path
+        with self._lock:
+            rows = [dict((k, getattr(r, k)) for k in SNAPSHOT_FIELDS)
+                    for r in self._rows.values()]
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'saved_at': time.time(), 'host': self.host,
+                           'rows': rows}, f)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass
+
+    def load_snapshot(self, path=None):
+        """
+        Fill the inventory from a snapshot file
+
+        Args:
+            path: Snapshot file, defaults to snapshot_path
+
+        Returns:
+            True when a snapshot was loaded
+        """
+        path = path or self.snapshot_path
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        with self._lock:
+            for item in data.get('rows', []):
+                row = DomainRow(item['uuid'], item['name'])
+                for key in SNAPSHOT_FIELDS:
+                    setattr(row, key, item.get(key, getattr(row, key)))
+                self._rows[row.uuid] = row
+                self._bump(row)
+            self.host = data.get('host')
+            self.snapshot_at = data.get('saved_at')
+        return True
+
+    def invalidate(self):
+        """Ask the background refresh to run now"""
+        self._stale.set()
+
+    def start(self, interval=REFRESH_INTERVAL):
+        """Refresh in a background thread every interval, or sooner when stale"""
+        if self._thread is not None:
+            return
+
+        def run():
+            while not self._stop.is_set():
+                try:
+                    self.refresh()
+                except libvirt.libvirtError:
+                    pass
+                self._stale.wait(interval)
+
+        self._thread = threading.Thread(target=run, name="inventory")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background refresh and event subscription"""
+        self._stop.set()
+        self._stale.set()
+        if self._token is not None:
+            dispatcher = vm_events.get_dispatcher(self.conn)
+            if dispatcher is not None:
+                dispatcher.unsubscribe(self._token)
+            self._token = None
+        if self.snapshot_path and self.refreshed_at is not None:
+            self.save_snapshot()
@@ -0,0 +1,466 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Block I/O QoS
+-------------
+Per-disk I/O limits, blkio weights and automatic noisy-neighbour
+throttling
+
+Static limits (setBlockIoTune: IOPS / bandwidth with burst) and blkio
+weights are applied to both the live and the persistent configuration.
+
+The automatic mode samples block statistics of all running domains in one
+bulk call per interval. A disk whose IOPS stays above share_factor times
+the fair share (total IOPS / busy disks) for sustain intervals is capped
+on the live configuration for hold seconds, then its previous limits are
+restored. FairShareThrottler.decide() is a pure function of two samples,
+so policies can be replayed from recorded statistics.
+
+Configuration (vm_manager.json):
+    "io_qos": {
+        "vms": {
+            "db*": {"weight": 800},
+            "batch*": {"weight": 200,
+                       "limits": {"total_iops_sec": 500,
+                                  "total_iops_sec_max": 1000,
+                                  "total_iops_sec_max_length": 10}}
+        },
+        "auto": {"interval": 5, "share_factor": 2.0, "sustain": 3,
+                 "hold": 60, "min_iops": 200}
+    }
+
+Examples:
+    python vm_ioqos.py apply              # apply configured policies
+    python vm_ioqos.py auto --record s.jsonl
+    python vm_ioqos.py replay s.jsonl     # dry-run the policy offline
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import libvirt
+
+import vm_config
+import vm_domxml
+import vm_instrument
+import vm_oplog
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+IOTUNE_KEYS = (
+    'total_bytes_sec', 'read_bytes_sec', 'write_bytes_sec',
+    'total_iops_sec', 'read_iops_sec', 'write_iops_sec',
+    'total_bytes_sec_max', 'read_bytes_sec_max', 'write_bytes_sec_max',
+    'total_iops_sec_max', 'read_iops_sec_max', 'write_iops_sec_max',
+    'total_bytes_sec_max_length', 'read_bytes_sec_max_length',
+    'write_bytes_sec_max_length', 'total_iops_sec_max_length',
+    'read_iops_sec_max_length', 'write_iops_sec_max_length',
+)
+# Keys touched by the automatic IOPS cap
+_IOPS_KEYS = tuple(k for k in IOTUNE_KEYS if '_iops_' in k)
+
+MIN_WEIGHT = 100
+MAX_WEIGHT = 1000
+
+AUTO_DEFAULTS = {
+    'interval': 5.0,        # seconds between samples
+    'share_factor': 2.0,    # throttle above this multiple of the fair share
+    'sustain': 3,           # consecutive intervals over the share
+    'hold': 60.0,           # seconds a throttle stays in place
+    'min_iops': 200.0,      # never throttle a disk below this rate
+    'busy_iops': 10.0,      # disks below this rate do not count as busy
+}
+
+# =============================================================================
+# STATIC LIMITS
+# =============================================================================
+
+def _flags(dom):
+    """Affect the persistent config, and the live one if the VM runs"""
+    flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+    if dom.isActive():
+        flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+    return flags
+
+
+def set_limits(dom, disk, limits):
+    """
+    Set I/O limits of one disk on the live and persistent configuration
+
+    Args:
+        dom: libvirt domain
+        disk: Disk target name (vda, ...)
+        limits: Dict of IOTUNE_KEYS -> value; 0 removes a limit
+
+    Raises:
+        ValueError: Unknown limit name
+    """
+    unknown = set(limits) - set(IOTUNE_KEYS)
+    if unknown:
+        raise ValueError("Unknown I/O limits: %s" % ", ".join(sorted(unknown)))
+    params = dict((k, int(v)) for k, v in limits.items())
+    dom.setBlockIoTune(disk, params, _flags(dom))
+
+
+def set_weight(dom, weight):
+    """
+    Set the blkio weight of a domain on the live and persistent configuration
+
+    Args:
+        dom: libvirt domain
+        weight: Weight between MIN_WEIGHT and MAX_WEIGHT
+
+    Raises:
+        ValueError: Weight out of range
+    """
+    weight = int(weight)
+    if not MIN_WEIGHT <= weight <= MAX_WEIGHT:
+        raise ValueError("blkio weight must be between %d and %d" %
+                         (MIN_WEIGHT, MAX_WEIGHT))
+    dom.setBlkioParameters({'weight': weight}, _flags(dom))
+
+
+def get_qos(dom):
+    """
+    Read the current weight and per-disk limits of a domain
+
+    Returns:
+        Dict with "weight" and "disks" (target -> non-zero limits)
+    """
+    flags = libvirt.VIR_DOMAIN_AFFECT_CURRENT
+    disks = {}
+    for target in vm_domxml.disk_targets(dom.XMLDesc(0)):
+        tune = dom.blockIoTune(target, flags)
+        disks[target] = dict((k, v) for k, v in tune.items()
+                             if k in IOTUNE_KEYS and v)
+    return {'weight': dom.blkioParameters(flags).get('weight'),
+            'disks': disks}
+
+
+def policy_for(name, config=None):
+    """Return the configured QoS policy of a VM, or None"""
+    return vm_config.match_name(
+        name, vm_config.section('io_qos', config).get('vms', {}))
+
+
+def apply_policy(dom, policy):
+    """
+    Apply a policy dict ({"weight": n, "limits": {...}}) to every disk
+
+    Args:
+        dom: libvirt domain
+        policy: Policy dict
+    """
+    if policy.get('weight'):
+        set_weight(dom, policy['weight'])
+    limits = policy.get('limits')
+    if limits:
+        for target in vm_domxml.disk_targets(dom.XMLDesc(0)):
+            set_limits(dom, target, limits)
+
+
+def apply_configured(conn, host=None, config=None):
+    """
+    Apply the configured policies to every matching domain
+
+    Returns:
+        List of (name, error or None)
+    """
+    results = []
+    for dom in conn.listAllDomains():
+        policy = policy_for(dom.name(), config)
+        if not policy:
+            continue
+        try:
+            with vm_oplog.operation('io_qos', dom, host):
+                apply_policy(dom, policy)
+            results.append((dom.name(), None))
+        except (libvirt.libvirtError, ValueError) as e:
+            results.append((dom.name(), str(e)))
+    return results
+
+
+# =============================================================================
+# SAMPLING
+# =============================================================================
+
+def sample_block_stats(conn):
+    """
+    Read the block counters of all running domains in one call
+
+    Returns:
+        Dict with "ts" and "disks": key "<vm>/<disk>" ->
+        [rd_reqs, wr_reqs, rd_bytes, wr_bytes]
+    """
+    stats = conn.getAllDomainStats(
+        libvirt.VIR_DOMAIN_STATS_BLOCK,
+        libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+    disks = {}
+    for dom, values in stats:
+        name = dom.name()
+        for i in range(values.get('block.count', 0)):
+            prefix = 'block.%d.' % i
+            target = values.get(prefix + 'name')
+            if target is None:
+                continue
+            disks['%s/%s' % (name, target)] = [
+                values.get(prefix + 'rd.reqs', 0),
+                values.get(prefix + 'wr.reqs', 0),
+                values.get(prefix + 'rd.bytes', 0),
+                values.get(prefix + 'wr.bytes', 0),
+            ]
+    return {'ts': time.time(), 'disks': disks}
+
+
+def rates(prev, cur):
+    """
+    Compute per-disk IOPS and bytes/s between two samples
+
+    Returns:
+        Dict of key -> (iops, bytes_per_sec)
+    """
+    interval = float(cur['ts'] - prev['ts'])
+    if interval <= 0:
+        return {}
+    result = {}
+    for key, c in cur['disks'].items():
+        p = prev['disks'].get(key)
+        if p is None:
+            continue
+        reqs = (c[0] - p[0]) + (c[1] - p[1])
+        nbytes = (c[2] - p[2]) + (c[3] - p[3])
+        if reqs < 0 or nbytes < 0:
+            continue    # counters reset (domain restarted)
+        result[key] = (reqs / interval, nbytes / interval)
+    return result
+
+
+# =============================================================================
+# FAIR-SHARE POLICY
+# =============================================================================
+
+class FairShareThrottler(object):
+    """
+    Decide which disks to throttle from consecutive block samples
+
+    decide() only depends on its inputs and the throttler's own state, so
+    recorded samples can be replayed to evaluate a policy.
+    """
+
+    def __init__(self, policy=None):
+        """
+        Initialize the throttler
+
+        Args:
+            policy: Overrides of AUTO_DEFAULTS
+        """
+        self.policy = dict(AUTO_DEFAULTS)
+        self.policy.update(policy or {})
+        self.strikes = {}
+        self.throttled = {}     # key -> release time
+
+    def decide(self, prev, cur):
+        """
+        Compare two samples and return throttle decisions
+
+        Args:
+            prev: Earlier sample from sample_block_stats()
+            cur: Later sample
+
+        Returns:
+            List of ("throttle", key, iops_cap) and ("release", key, None)
+        """
+        p = self.policy
+        now = cur['ts']
+        actions = []
+
+        for key, release_at in list(self.throttled.items()):
+            if now >= release_at or key not in cur['disks']:
+                del self.throttled[key]
+                actions.append(('release', key, None))
+
+        current = rates(prev, cur)
+        busy = [iops for iops, _ in current.values() if iops >= p['busy_iops']]
+        if len(busy) < 2:
+            self.strikes = {}
+            return actions
+        fair_share = sum(busy) / len(busy)
+        limit = max(fair_share * p['share_factor'], p['min_iops'])
+
+        for key, (iops, _) in current.items():
+            if key in self.throttled:
+                continue
+            if iops > limit:
+                self.strikes[key] = self.strikes.get(key, 0) + 1
+            else:
+                self.strikes.pop(key, None)
+            if self.strikes.get(key, 0) >= p['sustain']:
+                del self.strikes[key]
+                self.throttled[key] = now + p['hold']
+                actions.append(('throttle', key, int(limit)))
+        return actions
+
+
+def _iops_cap(cap):
+    """
+    Return blockIoTune parameters capping total IOPS
+
+    libvirt rejects a total limit next to per-direction limits, so the
+    read/write IOPS limits and all IOPS burst settings are cleared.
+    """
+    params = dict.fromkeys(_IOPS_KEYS, 0)
+    params['total_iops_sec'] = cap
+    return params
+
+
+class AutoThrottler(object):
+    """Apply FairShareThrottler decisions to live domains"""
+
+    def __init__(self, conn, policy=None, host=None, record=None):
+        """
+        Initialize the auto throttler
+
+        Args:
+            conn: libvirt connection
+            policy: Overrides of AUTO_DEFAULTS
+            host: Hypervisor hostname for operation events
+            record: Optional file object receiving samples as JSON lines
+        """
+        self.conn = conn
+        self.throttler = FairShareThrottler(policy)
+        self.host = host
+        self.record = record
+        self.saved = {}     # key -> live limits before throttling
+
+    def run(self, iterations=None, report=None):
+        """
+        Sample, decide and act every interval
+
+        Args:
+            iterations: Stop after this many intervals (None: forever)
+            report: Optional callable(action, key, cap)
+        """
+        prev = self._sample()
+        count = 0
+        while iterations is None or count < iterations:
+            time.sleep(self.throttler.policy['interval'])
+            cur = self._sample()
+            for action, key, cap in self.throttler.decide(prev, cur):
+                self._apply(action, key, cap)
+                if report:
+                    report(action, key, cap)
+            prev = cur
+            count += 1
+
+    def _sample(self):
+        sample = sample_block_stats(self.conn)
+        if self.record:
+            self.record.write(json.dumps(sample) + "\n")
+            self.record.flush()
+        return sample
+
+    def _apply(self, action, key, cap):
+        """Set or undo a temporary live IOPS cap"""
+        name, disk = key.rsplit('/', 1)
+        live = libvirt.VIR_DOMAIN_AFFECT_LIVE
+        try:
+            dom = self.conn.lookupByName(name)
+            if action == 'throttle':
+                previous = dom.blockIoTune(disk, live)
+                self.saved[key] = dict((k, v) for k, v in previous.items()
+                                       if k in IOTUNE_KEYS)
+                dom.setBlockIoTune(disk, _iops_cap(cap), live)
+            else:
+                # Every saved key, zeros included, so the cap is cleared
+                restore = dict.fromkeys(_IOPS_KEYS, 0)
+                restore.update(self.saved.pop(key, {}))
+                dom.setBlockIoTune(disk, restore, live)
+            vm_oplog.log_event('io_' + action, dom, self.host, disk=disk,
+                               iops_cap=cap)
+        except libvirt.libvirtError as e:
+            vm_oplog.log_event('io_' + action, None, self.host, result='error',
+                               error=str(e), name=name, disk=disk)
+
+
+def replay(path, policy=None):
+    """
+    Run the fair-share policy over recorded samples
+
+    Args:
+        path: JSON lines file written with --record
+        policy: Overrides of AUTO_DEFAULTS
+
+    Returns:
+        List of (timestamp, action, key, cap)
+    """
+    throttler = FairShareThrottler(policy)
+    decisions = []
+    prev = None
+    with open(path) as f:
+        for line in f:
+            cur = json.loads(line)
+            if prev is not None:
+                for action, key, cap in throttler.decide(prev, cur):
+                    decisions.append((cur['ts'], action, key, cap))
+            prev = cur
+    return decisions
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Block I/O QoS management")
+    parser.add_argument("action", choices=["apply", "auto", "replay"])
+    parser.add_argument("file", nargs="?", help="Recorded samples for replay")
+    parser.add_argument("--uri", default="qemu:///system")
+    parser.add_argument("--record", help="Append samples to this file")
+    args = parser.parse_args(argv)
+
+    policy = vm_config.section('io_qos').get('auto')
+    if args.action == "replay":
+        if not args.file:
+            parser.error("replay needs a samples file")
+        for ts, action, key, cap in replay(args.file, policy):
+            print("%s %-8s %-30s %s" % (time.strftime(
+                "%H:%M:%S", time.localtime(ts)), action, key, cap or ""))
+        return 0
+
+    try:
+        conn = vm_instrument.instrument(libvirt.open(args.uri))
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        return 1
+
+    host = conn.getHostname()
+    if args.action == "apply":
+        results = apply_configured(conn, host)
+        for name, error in results:
+            print("%-30s %s" % (name, error or "ok"))
+        conn.close()
+        return 1 if any(error for _, error in results) else 0
+
+    def report(action, key, cap):
+        print("%s %-8s %-30s %s" % (time.strftime("%H:%M:%S"), action, key,
+                                    cap or ""))
+
+    record = open(args.record, 'a') if args.record else None
+    try:
+        AutoThrottler(conn, policy, host, record).run(report=report)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if record:
+            record.close()
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,430 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Job Supervisor
+--------------
+Track long-running domain operations and abort the ones that hang
+
+Operations register with the shared supervisor of their connection:
+
+    track()   a blocking call (managed save, suspend, ...) for as long as
+              it runs; progress comes from dom.jobInfo()
+    watch()   work that continues after the call returns: a block job
+              (blockPull, blockRebase, blockCopy; blockJobInfo) or a
+              requested shutdown (domain state)
+    adopt()   jobs already running on the host that this tool did not
+              start (another client, a previous session)
+
+One background thread polls every registered job. Jobs younger than
+POLL_AFTER are not polled, so quick operations cost no extra calls.
+A job running past its timeout is aborted: abortJob for calls,
+blockJobAbort for block jobs. abortJob only cancels asynchronous domain
+jobs (save, dump, migration), so calls tracked with abortable=False
+(suspend, resume) and shutdowns are only marked timed out and left to
+the operator.
+
+Configuration ("jobs" section of vm_manager.json), timeouts in seconds
+keyed by operation name or pattern:
+
+    "jobs": {"timeouts": {"suspend": 60, "disk_*": 7200}}
+
+Example:
+    python vm_jobs.py --uri qemu:///system
+"""
+
+import argparse
+import collections
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import libvirt
+
+import vm_config
+import vm_domxml
+import vm_instrument
+import vm_oplog
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+POLL_INTERVAL = 1.0
+# Jobs are only polled once they have run this long
+POLL_AFTER = 2.0
+DEFAULT_TIMEOUT = 600
+TIMEOUTS = {
+    'shutdown': 300,
+    'suspend': 60,
+    'resume': 60,
+    'managed_save': 1800,
+    'disk_*': 7200,
+    'storage_move': 6 * 3600,
+}
+# Finished jobs kept for the in-flight view
+HISTORY = 20
+
+# Job kinds
+CALL = 'call'
+DOMAIN = 'domain'
+BLOCK = 'block'
+SHUTDOWN = 'shutdown'
+
+# jobInfo() fields
+_JOB_TYPE, _JOB_ELAPSED, _JOB_DATA_TOTAL, _JOB_DATA_PROCESSED = 0, 1, 3, 4
+
+
+def timeouts(config=None):
+    """Return operation timeouts: TIMEOUTS overridden by the "jobs" section"""
+    result = dict(TIMEOUTS)
+    result.update(vm_config.section('jobs', config).get('timeouts', {}))
+    return result
+
+
+# =============================================================================
+# JOBS
+# =============================================================================
+
+class Job(object):
+    """One supervised operation"""
+
+    def __init__(self, job_id, op, kind, dom, disk, timeout, abortable=True):
+        self.id = job_id
+        self.op = op
+        self.kind = kind
+        self.dom = dom
+        self.name = dom.name()
+        self.disk = disk
+        self.timeout = timeout
+        self.abortable = abortable and kind != SHUTDOWN
+        self.started = time.time()
+        self.status = 'running'  # running, done, failed, aborted, timed out
+        self.processed = None
+        self.total = None
+        self.error = None
+        # Set when the job leaves the job table
+        self.seconds = None
+        self.finished = threading.Event()
+
+    def elapsed(self):
+        """Return the seconds the job has been running"""
+        return time.time() - self.started
+
+    def percent(self):
+        """Return the progress in percent, or None when unknown"""
+        if self.total:
+            return 100.0 * self.processed / self.total
+        return None
+
+
+class JobSupervisor(object):
+    """Poll registered jobs and enforce their timeouts"""
+
+    def __init__(self, conn, config=None, host=None,
+                 poll_interval=POLL_INTERVAL):
+        """
+        Initialize the supervisor
+
+        Args:
+            conn: libvirt connection
+            config: Configuration dict (default: vm_manager.json)
+            host: Hypervisor hostname for operation events
+            poll_interval: Seconds between polls
+        """
+        self.conn = conn
+        self.timeouts = timeouts(config)
+        self.host = host
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._jobs = collections.OrderedDict()
+        self._history = collections.deque(maxlen=HISTORY)
+        self._next_id = 1
+        self._thread = None
+
+    def timeout_for(self, op):
+        """Return the timeout of an operation"""
+        return vm_config.match_name(op, self.timeouts, DEFAULT_TIMEOUT)
+
+    # ---------------------------------------------------------------- register
+
+    def _register(self, op, kind, dom, disk, timeout, abortable=True):
+        with self._lock:
+            job = Job(self._next_id, op, kind, dom, disk,
+                      timeout if timeout is not None else self.timeout_for(op),
+                      abortable)
+            self._next_id += 1
+            self._jobs[job.id] = job
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='job-supervisor')
+                self._thread.daemon = True
+                self._thread.start()
+        return job
+
+    @contextmanager
+    def track(self, op, dom, timeout=None, abortable=True):
+        """
+        Supervise a blocking call for the duration of a with block
+
+        Args:
+            op: Operation name
+            dom: libvirt domain
+            timeout: Seconds before abortJob, default from configuration
+            abortable: False for calls that start no domain job abortJob
+                can cancel (suspend, resume); they are only reported
+
+        Yields:
+            Job
+        """
+        job = self._register(op, CALL, dom, None, timeout, abortable)
+        try:
+            yield job
+        except Exception as e:
+            self._finish(job, 'failed' if job.status == 'running' else job.status,
+                         job.error or str(e))
+            raise
+        self._finish(job, 'done' if job.status == 'running' else job.status,
+                     job.error)
+
+    def watch(self, op, dom, disk=None, timeout=None):
+        """
+        Supervise work that continues after the call returned
+
+        Args:
+            op: Operation name
+            dom: libvirt domain
+            disk: Disk target of a block job; None for a shutdown
+            timeout: Seconds before the job is aborted
+
+        Returns:
+            Job; job.finished is set when it ends
+        """
+        return self._register(op, BLOCK if disk else SHUTDOWN, dom, disk,
+                              timeout)
+
+    def wait(self, job, timeout=None):
+        """Wait for a job to end and return its status"""
+        job.finished.wait(timeout)
+        return job.status
+
+    def abort(self, job_id):
+        """
+        Abort a job by hand
+
+        Returns:
+            True when the job was running and can be aborted
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or not job.abortable:
+            return False
+        self._abort(job, 'aborted')
+        return True
+
+    def adopt(self, timeout=0):
+        """
+        Register domain and block jobs of running domains that are not
+        supervised yet
+
+        Args:
+            timeout: Timeout of adopted jobs (0 = none)
+
+        Returns:
+            List of new Job
+        """
+        with self._lock:
+            known = set((j.dom.UUIDString(), j.disk) for j in self._jobs.values())
+        adopted = []
+        for dom in self.conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE):
+            uuid = dom.UUIDString()
+            info = dom.jobInfo()
+            if info[_JOB_TYPE] != libvirt.VIR_DOMAIN_JOB_NONE and \
+                    (uuid, None) not in known:
+                job = self._register('domain_job', DOMAIN, dom, None, timeout)
+                job.started -= info[_JOB_ELAPSED] / 1000.0
+                adopted.append(job)
+            for disk in vm_domxml.disks(dom.XMLDesc(0)):
+                if (uuid, disk['target']) in known:
+                    continue
+                if dom.blockJobInfo(disk['target'], 0):
+                    adopted.append(self._register('block_job', BLOCK, dom,
+                                                  disk['target'], timeout))
+        for job in adopted:
+            self._poll(job)
+        return adopted
+
+    def jobs(self):
+        """Return running jobs followed by recently finished ones"""
+        with self._lock:
+            return list(self._jobs.values()) + list(reversed(self._history))
+
+    # ----------------------------------------------------------------- polling
+
+    def _run(self):
+        while True:
+            with self._lock:
+                jobs = list(self._jobs.values())
+                if not jobs:
+                    self._thread = None
+                    return
+            for job in jobs:
+                if job.elapsed() >= POLL_AFTER:
+                    self._poll(job)
+            time.sleep(self.poll_interval)
+
+    def _poll(self, job):
+        """Refresh one job and enforce its timeout"""
+        try:
+            if job.kind == BLOCK:
+                info = job.dom.blockJobInfo(job.disk, 0)
+                if not info:
+                    self._finish(job, 'done')
+                    return
+                job.processed, job.total = info.get('cur'), info.get('end')
+            elif job.kind == SHUTDOWN:
+                if not job.dom.isActive():
+                    self._finish(job, 'done')
+                    return
+            else:
+                info = job.dom.jobInfo()
+                if info[_JOB_TYPE] != libvirt.VIR_DOMAIN_JOB_NONE:
+                    job.processed = info[_JOB_DATA_PROCESSED]
+                    job.total = info[_JOB_DATA_TOTAL]
+                elif job.kind == DOMAIN:
+                    self._finish(job, 'done')
+                    return
+        except libvirt.libvirtError as e:
+            if job.kind != CALL:
+                self._finish(job, 'failed', str(e))
+                return
+        if job.status == 'running' and job.timeout and \
+                job.elapsed() > job.timeout:
+            self._abort(job, 'timed out')
+
+    def _abort(self, job, status):
+        """Cancel a job; calls end when their with block exits"""
+        job.status = status
+        if not job.abortable:
+            job.error = "still running, cannot be aborted"
+            vm_oplog.log_event('job_timeout', job.dom, self.host, job.elapsed(),
+                               'error', job.error, job_op=job.op, disk=job.disk)
+            if job.kind != CALL:
+                self._finish(job, status, job.error)
+            return
+        try:
+            if job.kind == BLOCK:
+                job.dom.blockJobAbort(job.disk, 0)
+            else:
+                job.dom.abortJob()
+        except libvirt.libvirtError as e:
+            job.error = str(e)
+        vm_oplog.log_event('job_abort', job.dom, self.host, job.elapsed(),
+                           'error', status, job_op=job.op, disk=job.disk)
+        if job.kind != CALL:
+            self._finish(job, status, job.error)
+
+    def _finish(self, job, status, error=None):
+        with self._lock:
+            if self._jobs.pop(job.id, None) is None:
+                return
+            job.status = status
+            job.error = error
+            job.seconds = round(job.elapsed(), 3)
+            self._history.append(job)
+        job.finished.set()
+
+
+_supervisors = {}
+_supervisors_lock = threading.Lock()
+
+
+def get_supervisor(conn, host=None):
+    """
+    Return the shared supervisor of a connection
+
+    Args:
+        conn: libvirt connection
+        host: Hypervisor hostname for operation events
+    """
+    raw = vm_instrument.unwrap(conn)
+    with _supervisors_lock:
+        supervisor = _supervisors.get(id(raw))
+        if supervisor is None:
+            supervisor = _supervisors[id(raw)] = JobSupervisor(conn, host=host)
+        return supervisor
+
+
+# =============================================================================
+# OUTPUT
+# =============================================================================
+
+def format_jobs(jobs):
+    """
+    Format jobs as a text table
+
+    Returns:
+        List of lines
+    """
+    lines = ["%4s %-22s %-14s %-5s %-10s %8s %7s %7s" % (
+        "ID", "Name", "Operation", "Disk", "Status", "Elapsed", "Timeout",
+        "Done")]
+    lines.append("-" * 82)
+    for job in jobs:
+        # Aborted calls stay in the table until their with block exits
+        elapsed = job.elapsed() if job.seconds is None else job.seconds
+        percent = job.percent()
+        lines.append("%4d %-22s %-14s %-5s %-10s %7.0fs %6.0fs %7s%s" % (
+            job.id, job.name[:22], job.op[:14], job.disk or "-", job.status,
+            elapsed, job.timeout or 0,
+            "-" if percent is None else "%.0f%%" % percent,
+            "  " + job.error if job.error else ""))
+    return lines
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point: list running jobs of all domains"""
+    parser = argparse.ArgumentParser(
+        description="Show and abort running domain and block jobs")
+    parser.add_argument("--uri", default="qemu:///system")
+    parser.add_argument("--abort-after", type=float,
+                        help="Abort jobs running longer than this many seconds")
+    args = parser.parse_args(argv)
+
+    try:
+        conn = vm_instrument.instrument(libvirt.open(args.uri))
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        return 1
+
+    try:
+        supervisor = get_supervisor(conn, conn.getHostname())
+        supervisor.adopt()
+        jobs = supervisor.jobs()
+        if not jobs:
+            print("No running jobs")
+            return 0
+        for line in format_jobs(jobs):
+            print(line)
+        if args.abort_after:
+            for job in jobs:
+                if job.status == 'running' and job.elapsed() > args.abort_after:
+                    if supervisor.abort(job.id):
+                        print("Aborted job %d (%s)" % (job.id, job.name))
+                    else:
+                        print("Job %d (%s) cannot be aborted" %
+                              (job.id, job.name))
+        return 0
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        return 1
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
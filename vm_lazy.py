@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy Imports
+------------
+Defer importing a subsystem until it is first used
+
+    vm_boot = vm_lazy.LazyModule("vm_boot")
+    ...
+    vm_boot.boot_fleet(conn)    # imported here, on first attribute access
+
+Startup then only pays for the modules the first screen needs.
+"""
+
+import importlib
+import threading
+
+_lock = threading.Lock()
+
+
+class LazyModule(object):
+    """Module stand-in that imports the real module on first attribute access"""
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        """Import the module once and return it"""
+        module = self.__dict__['_module']
+        if module is None:
+            with _lock:
+                module = self.__dict__['_module']
+                if module is None:
+                    module = importlib.import_module(self.__dict__['_name'])
+                    self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__['_module'] is not None else "not loaded"
+        return "<lazy module '%s' (%s)>" % (self.__dict__['_name'], state)
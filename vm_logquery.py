@@ -0,0 +1,214 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Operation Log Query
+-------------------
+Stream the structured VM manager logs and aggregate operation events
+
+Examples:
+    # Average start latency per host over the last hour
+    python vm_logquery.py --op start --since 1h --group-by host
+
+    # Failed operations per VM today
+    python vm_logquery.py --result error --since 1d --group-by name
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+LOG_FILE = 'vm_manager.log'
+
+TIME_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# =============================================================================
+# INPUT
+# =============================================================================
+
+def parse_since(text):
+    """
+    Convert a relative time like "90s", "15m", "1h" or "7d" to an epoch
+
+    Args:
+        text: Relative time specification
+
+    Returns:
+        Epoch timestamp in seconds
+    """
+    unit = text[-1].lower()
+    if unit not in TIME_UNITS:
+        raise ValueError("Invalid time unit in %r (use s, m, h or d)" % text)
+    return time.time() - float(text[:-1]) * TIME_UNITS[unit]
+
+
+def log_files(base):
+    """
+    List a log file and its rotated backups, oldest first
+
+    Args:
+        base: Path of the active log file
+
+    Returns:
+        List of existing file paths
+    """
+    rotated = [p for p in glob.glob(base + ".*") if p[len(base) + 1:].isdigit()]
+    rotated.sort(key=lambda p: int(p[len(base) + 1:]), reverse=True)
+    if os.path.exists(base):
+        rotated.append(base)
+    return rotated
+
+
+def iter_events(paths, op=None, since=None, filters=None):
+    """
+    Stream matching operation events from log files
+
+    Lines are pre-filtered with a substring test so that non-matching
+    records are never JSON-decoded.
+
+    Args:
+        paths: Log files to read
+        op: Only yield events for this operation
+        since: Only yield events newer than this epoch
+        filters: Dict of field -> required value
+
+    Yields:
+        Event dicts
+    """
+    needle = '"op":"%s"' % op if op else '"op":'
+    filters = filters or {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if needle not in line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if since is not None and event.get("ts", 0) < since:
+                    continue
+                if any(event.get(k) != v for k, v in filters.items()):
+                    continue
+                yield event
+
+
+# =============================================================================
+# AGGREGATION
+# =============================================================================
+
+def percentile(values, pct):
+    """Return the pct percentile of a sorted list"""
+    if not values:
+        return 0.0
+    index = int(round((len(values) - 1) * pct / 100.0))
+    return values[index]
+
+
+def aggregate(events, group_by=None, field="duration_ms"):
+    """
+    Aggregate a numeric field of events per group
+
+    Args:
+        events: Iterable of event dicts
+        group_by: Event field to group on, or None for a single group
+        field: Numeric field to summarize
+
+    Returns:
+        Dict of group -> {count, errors, avg, p50, p95, max}
+    """
+    groups = {}
+    counts = {}
+    errors = {}
+    for event in events:
+        key = event.get(group_by, "-") if group_by else "all"
+        values = groups.setdefault(key, [])
+        counts[key] = counts.get(key, 0) + 1
+        if event.get("result") == "error":
+            errors[key] = errors.get(key, 0) + 1
+        value = event.get(field)
+        if value is not None:
+            values.append(value)
+
+    summary = {}
+    for key, values in groups.items():
+        values.sort()
+        summary[key] = {
+            "count": counts[key],
+            "errors": errors.get(key, 0),
+            "avg": sum(values) / len(values) if values else 0.0,
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "max": values[-1] if values else 0.0,
+        }
+    return summary
+
+
+def print_summary(summary, group_by, field):
+    """Print an aggregation result as a table"""
+    label = group_by or "group"
+    print("%-30s %8s %7s %10s %10s %10s %10s" %
+          (label, "count", "errors", "avg", "p50", "p95", "max"))
+    print("-" * 91)
+    for key in sorted(summary, key=lambda k: str(k)):
+        row = summary[key]
+        print("%-30s %8d %7d %10.2f %10.2f %10.2f %10.2f" %
+              (str(key)[:30], row["count"], row["errors"], row["avg"],
+               row["p50"], row["p95"], row["max"]))
+    print("(%s)" % field)
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Query structured VM manager operation logs")
+    parser.add_argument("files", nargs="*",
+                        help="Log files (default: %s and its backups)" % LOG_FILE)
+    parser.add_argument("--op", help="Operation name (start, shutdown, ...)")
+    parser.add_argument("--since", help="Relative window, e.g. 15m, 1h, 7d")
+    parser.add_argument("--host", help="Only events from this host")
+    parser.add_argument("--name", help="Only events for this VM")
+    parser.add_argument("--result", choices=["ok", "error"])
+    parser.add_argument("--group-by", choices=["host", "op", "name", "uuid",
+                                               "result"])
+    parser.add_argument("--field", default="duration_ms",
+                        help="Numeric field to summarize")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the summary as JSON")
+    args = parser.parse_args(argv)
+
+    paths = args.files or log_files(LOG_FILE)
+    if not paths:
+        print("No log files found")
+        return 1
+
+    filters = {}
+    for key in ("host", "name", "result"):
+        if getattr(args, key):
+            filters[key] = getattr(args, key)
+
+    try:
+        since = parse_since(args.since) if args.since else None
+    except ValueError as e:
+        print("Error: %s" % e)
+        return 1
+
+    events = iter_events(paths, args.op, since, filters)
+    summary = aggregate(events, args.group_by, args.field)
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    elif not summary:
+        print("No matching events")
+    else:
+        print_summary(summary, args.group_by, args.field)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Network QoS
+-----------
+Per-interface bandwidth shaping and virtio-net multiqueue for guests on
+the bridge
+
+Bandwidth limits (<bandwidth> inbound/outbound average, peak and burst)
+are applied with setInterfaceParameters to the live and persistent
+configuration, either per VM or through a named policy class. Directions
+are from the guest's point of view: inbound is traffic received by the
+guest. Averages and peaks are in KiB/s, bursts in KiB.
+
+Configuration (vm_manager.json):
+    "net_qos": {
+        "classes": {"gold": {"inbound.average": 125000, ...}},
+        "vms": {"web*": "gold", "batch*": "bronze"}
+    }
+
+Examples:
+    python vm_netqos.py apply         # apply configured classes
+    python vm_netqos.py rates         # measured per-interface rates
+"""
+
+import argparse
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+import libvirt
+
+import vm_config
+import vm_domxml
+import vm_instrument
+import vm_oplog
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+BANDWIDTH_KEYS = (
+    'inbound.average', 'inbound.peak', 'inbound.burst',
+    'outbound.average', 'outbound.peak', 'outbound.burst',
+)
+
+# Built-in classes; the "classes" config section overrides or adds to them
+DEFAULT_CLASSES = {
+    'gold': {'inbound.average': 125000, 'inbound.peak': 250000,
+             'inbound.burst': 65536, 'outbound.average': 125000,
+             'outbound.peak': 250000, 'outbound.burst': 65536},
+    'silver': {'inbound.average': 37500, 'inbound.peak': 75000,
+               'inbound.burst': 16384, 'outbound.average': 37500,
+               'outbound.peak': 75000, 'outbound.burst': 16384},
+    'bronze': {'inbound.average': 12500, 'inbound.peak': 25000,
+               'inbound.burst': 4096, 'outbound.average': 12500,
+               'outbound.peak': 25000, 'outbound.burst': 4096},
+}
+
+# Upper bound for virtio-net queue pairs
+MAX_QUEUES = 8
+
+# =============================================================================
+# BANDWIDTH
+# =============================================================================
+
+def classes(config=None):
+    """Return all policy classes (built-in merged with configured)"""
+    result = dict(DEFAULT_CLASSES)
+    result.update(vm_config.section('net_qos', config).get('classes', {}))
+    return result
+
+
+def class_for(name, config=None):
+    """Return the configured class name of a VM, or None"""
+    return vm_config.match_name(
+        name, vm_config.section('net_qos', config).get('vms', {}))
+
+
+def set_bandwidth(dom, mac, params):
+    """
+    Set bandwidth limits of one interface
+
+    Args:
+        dom: libvirt domain
+        mac: Interface MAC address
+        params: Dict of BANDWIDTH_KEYS -> value; 0 removes a limit
+
+    Raises:
+        ValueError: Unknown parameter name
+    """
+    unknown = set(params) - set(BANDWIDTH_KEYS)
+    if unknown:
+        raise ValueError("Unknown bandwidth parameters: %s" %
+                         ", ".join(sorted(unknown)))
+    flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+    if dom.isActive():
+        flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+    dom.setInterfaceParameters(mac, dict((k, int(v))
+                                         for k, v in params.items()), flags)
+
+
+def set_all_interfaces(dom, params):
+    """Set the same bandwidth limits on every interface of a domain"""
+    for iface in vm_domxml.interfaces(dom.XMLDesc(0)):
+        set_bandwidth(dom, iface['mac'], params)
+
+
+def apply_class(dom, class_name, config=None):
+    """
+    Apply a policy class to every interface of a domain
+
+    Raises:
+        ValueError: Unknown class
+    """
+    all_classes = classes(config)
+    if class_name not in all_classes:
+        raise ValueError("Unknown network class: %s" % class_name)
+    set_all_interfaces(dom, all_classes[class_name])
+
+
+def get_bandwidth(dom):
+    """
+    Read the bandwidth limits of every interface
+
+    Returns:
+        Dict of MAC -> non-zero limits
+    """
+    result = {}
+    for iface in vm_domxml.interfaces(dom.XMLDesc(0)):
+        params = dom.interfaceParameters(iface['mac'], 0)
+        result[iface['mac']] = dict((k, v) for k, v in params.items()
+                                    if k in BANDWIDTH_KEYS and v)
+    return result
+
+
+def apply_configured(conn, host=None, config=None):
+    """
+    Apply configured classes to every matching domain
+
+    Returns:
+        List of (name, class, error or None)
+    """
+    results = []
+    for dom in conn.listAllDomains():
+        class_name = class_for(dom.name(), config)
+        if not class_name:
+            continue
+        try:
+            with vm_oplog.operation('net_qos', dom, host, net_class=class_name):
+                apply_class(dom, class_name, config)
+            results.append((dom.name(), class_name, None))
+        except (libvirt.libvirtError, ValueError) as e:
+            results.append((dom.name(), class_name, str(e)))
+    return results
+
+
+# =============================================================================
+# MULTIQUEUE
+# =============================================================================
+
+def queues_for(vcpus):
+    """Return the virtio-net queue count matching a vCPU count"""
+    return max(1, min(int(vcpus), MAX_QUEUES))
+
+
+def set_multiqueue(conn, dom, queues=None):
+    """
+    Set virtio-net queues on every virtio interface of the persistent config
+
+    Takes effect at the next guest start; inside the guest the queues are
+    enabled with "ethtool -L <dev> combined <n>".
+
+    Args:
+        conn: libvirt connection
+        dom: libvirt domain
+        queues: Queue count, defaults to the domain's maximum vCPUs
+
+    Returns:
+        Number of interfaces changed
+    """
+    if queues is None:
+        queues = queues_for(dom.vcpusFlags(
+            libvirt.VIR_DOMAIN_AFFECT_CONFIG | libvirt.VIR_DOMAIN_VCPU_MAXIMUM))
+    root = ET.fromstring(dom.XMLDesc(
+        libvirt.VIR_DOMAIN_XML_INACTIVE | libvirt.VIR_DOMAIN_XML_SECURE))
+    changed = 0
+    for iface in root.findall('./devices/interface'):
+        model = iface.find('model')
+        if model is None or model.get('type') != 'virtio':
+            continue
+        driver = iface.find('driver')
+        # No queues attribute means one queue pair
+        current = driver.get('queues', '1') if driver is not None else '1'
+        if current == str(queues):
+            continue
+        if driver is None:
+            driver = ET.SubElement(iface, 'driver')
+        if not driver.get('name'):
+            driver.set('name', 'vhost')
+        if queues > 1:
+            driver.set('queues', str(queues))
+        elif 'queues' in driver.attrib:
+            del driver.attrib['queues']
+        changed += 1
+    if changed:
+        conn.defineXML(ET.tostring(root).decode('utf-8'))
+    return changed
+
+
+# =============================================================================
+# RATES
+# =============================================================================
+
+def sample_net_stats(conn):
+    """
+    Read the interface counters of all running domains in one call
+
+    Returns:
+        Dict with "ts" and "ifaces": key "<vm>/<dev>" ->
+        [rx_bytes, tx_bytes, rx_pkts, tx_pkts]
+    """
+    stats = conn.getAllDomainStats(
+        libvirt.VIR_DOMAIN_STATS_INTERFACE,
+        libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+    ifaces = {}
+    for dom, values in stats:
+        name = dom.name()
+        for i in range(values.get('net.count', 0)):
+            prefix = 'net.%d.' % i
+            ifaces['%s/%s' % (name, values.get(prefix + 'name'))] = [
+                values.get(prefix + 'rx.bytes', 0),
+                values.get(prefix + 'tx.bytes', 0),
+                values.get(prefix + 'rx.pkts', 0),
+                values.get(prefix + 'tx.pkts', 0),
+            ]
+    return {'ts': time.time(), 'ifaces': ifaces}
+
+
+def rates(prev, cur):
+    """
+    Compute per-interface rates between two samples
+
+    Returns:
+        Dict of key -> (rx KiB/s, tx KiB/s, rx pkt/s, tx pkt/s)
+    """
+    interval = float(cur['ts'] - prev['ts'])
+    if interval <= 0:
+        return {}
+    result = {}
+    for key, c in cur['ifaces'].items():
+        p = prev['ifaces'].get(key)
+        if p is None or any(c[i] < p[i] for i in range(4)):
+            continue
+        result[key] = ((c[0] - p[0]) / 1024.0 / interval,
+                       (c[1] - p[1]) / 1024.0 / interval,
+                       (c[2] - p[2]) / interval,
+                       (c[3] - p[3]) / interval)
+    return result
+
+
+def rate_report(conn, interval=5.0, config=None):
+    """
+    Measure interface rates and compare them with the configured classes
+
+    Args:
+        conn: libvirt connection
+        interval: Seconds between the two samples
+        config: Configuration dict
+
+    Returns:
+        List of lines
+    """
+    prev = sample_net_stats(conn)
+    time.sleep(interval)
+    current = rates(prev, sample_net_stats(conn))
+    all_classes = classes(config)
+
+    lines = ["%-32s %-8s %11s %11s %8s %8s" %
+             ("Interface", "Class", "In KiB/s", "Out KiB/s", "In %", "Out %")]
+    lines.append("-" * 84)
+    for key in sorted(current):
+        rx, tx, _, _ = current[key]
+        class_name = class_for(key.rsplit('/', 1)[0], config)
+        limits = all_classes.get(class_name, {})
+        in_pct = ("%.0f%%" % (100.0 * rx / limits['inbound.average'])
+                  if limits.get('inbound.average') else "-")
+        out_pct = ("%.0f%%" % (100.0 * tx / limits['outbound.average'])
+                   if limits.get('outbound.average') else "-")
+        lines.append("%-32s %-8s %11.1f %11.1f %8s %8s" %
+                     (key[:32], class_name or "-", rx, tx, in_pct, out_pct))
+    return lines
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Network QoS management")
+    parser.add_argument("action", choices=["apply", "rates", "multiqueue"])
+    parser.add_argument("--uri", default="qemu:///system")
+    parser.add_argument("--interval", type=float, default=5.0)
+    args = parser.parse_args(argv)
+
+    try:
+        conn = vm_instrument.instrument(libvirt.open(args.uri))
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        return 1
+
+    status = 0
+    try:
+        if args.action == "apply":
+            for name, class_name, error in apply_configured(
+                    conn, conn.getHostname()):
+                print("%-30s %-8s %s" % (name, class_name, error or "ok"))
+                status = 1 if error else status
+        elif args.action == "multiqueue":
+            for dom in conn.listAllDomains():
+                changed = set_multiqueue(conn, dom)
+                print("%-30s %s" % (dom.name(), "updated (next boot)"
+                                    if changed else "unchanged"))
+        else:
+            for line in rate_report(conn, args.interval):
+                print(line)
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        status = 1
+    finally:
+        conn.close()
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Operation Logging
+-----------------
+Structured, asynchronous logging for the KVM VM Manager
+
+Every log record is written as one JSON object per line. Records are
+formatted in the calling thread and handed to a bounded queue; a single
+background thread writes them to a size-rotated log file, so VM
+operations never wait on disk I/O.
+
+Operation events carry the fields op, name, uuid, host, duration_ms and
+result, and can be queried with vm_logquery.py.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+QUEUE_CAPACITY = 10000
+
+# =============================================================================
+# FORMATTING
+# =============================================================================
+
+class JSONFormatter(logging.Formatter):
+    """Format log records as single-line JSON objects"""
+
+    def format(self, record):
+        """
+        Build the JSON line for a record
+
+        Args:
+            record: logging.LogRecord instance
+
+        Returns:
+            JSON string without trailing newline
+        """
+        entry = {
+            "ts": round(record.created, 3),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                  time.localtime(record.created)),
+            "level": record.levelname,
+            "msg": record.getMessage(),
+        }
+        event = getattr(record, "event", None)
+        if event:
+            entry.update(event)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"))
+
+
+# =============================================================================
+# ASYNCHRONOUS HANDLER
+# =============================================================================
+
+class AsyncQueueHandler(logging.Handler):
+    """
+    Logging handler that writes records from a background thread
+
+    Records are formatted by the caller and queued; when the queue is full
+    records are dropped and counted instead of blocking the caller.
+    """
+
+    def __init__(self, target, capacity=QUEUE_CAPACITY):
+        """
+        Initialize the handler
+
+        Args:
+            target: Handler that performs the actual write
+            capacity: Maximum number of queued records
+        """
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = queue.Queue(capacity)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._drain,
+                                        name="oplog-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        """Format the record and queue it for the writer thread"""
+        try:
+            # Freeze the message now so the writer never touches args
+            record.msg = self.format(record)
+            record.args = None
+            record.exc_info = None
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _drain(self):
+        """Writer thread main loop"""
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self.target.emit(record)
+            except Exception:
+                pass
+
+    def close(self):
+        """Flush queued records and stop the writer thread"""
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(5)
+        self.target.close()
+        logging.Handler.close(self)
+
+
+def setup_logging(log_file, level=logging.INFO,
+                  max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+    """
+    Configure the root logger for structured asynchronous output
+
+    Args:
+        log_file: Path of the active log file
+        level: Minimum log level
+        max_bytes: Rotate the file when it reaches this size
+        backup_count: Number of rotated files to keep
+
+    Returns:
+        The installed AsyncQueueHandler
+    """
+    target = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=max_bytes, backupCount=backup_count)
+    target.setFormatter(logging.Formatter("%(message)s"))
+
+    handler = AsyncQueueHandler(target)
+    handler.setFormatter(JSONFormatter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+    atexit.register(handler.close)
+    return handler
+
+
+# =============================================================================
+# OPERATION EVENTS
+# =============================================================================
+
+def log_event(op, dom=None, host=None, duration=None, result="ok",
+              error=None, **fields):
+    """
+    Emit a structured operation event
+
+    Args:
+        op: Operation name (start, shutdown, create, ...)
+        dom: libvirt domain the operation acted on, if any
+        host: Hypervisor hostname
+        duration: Duration in seconds, if measured
+        result: "ok" or "error"
+        error: Error text for failed operations
+        **fields: Additional event fields
+    """
+    event = {"op": op, "host": host, "result": result}
+    if dom is not None:
+        try:
+            event["name"] = dom.name()
+            event["uuid"] = dom.UUIDString()
+        except Exception:
+            pass
+    if duration is not None:
+        event["duration_ms"] = round(duration * 1000.0, 2)
+    if error is not None:
+        event["error"] = error
+    event.update(fields)
+
+    level = logging.ERROR if result == "error" else logging.INFO
+    logging.getLogger().log(level, "%s %s %s", op, event.get("name", "-"),
+                            result, extra={"event": event})
+
+
+@contextmanager
+def operation(op, dom=None, host=None, **fields):
+    """
+    Time a block of code and log it as an operation event
+
+    Exceptions are logged with result "error" and re-raised.
+
+    Args:
+        op: Operation name
+        dom: libvirt domain the operation acts on
+        host: Hypervisor hostname
+        **fields: Additional event fields
+    """
+    start = time.time()
+    try:
+        yield
+    except Exception as e:
+        log_event(op, dom, host, time.time() - start, "error", str(e),
+                  **fields)
+        raise
+    log_event(op, dom, host, time.time() - start, **fields)
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+"""
+libvirt Request Limiting
+------------------------
+Client-side protection of libvirtd from repetitive callers
+
+limit() wraps a libvirt connection (raw or instrumented) in a proxy
+that, per connection:
+
+    - answers read-only queries (lookupByName, state, info, ...) from a
+      short-lived cache, cleared by any change made through the proxy
+      and by lifecycle events
+    - coalesces identical queries already in flight: concurrent callers
+      share the result of one RPC (single-flight)
+    - passes every RPC that reaches libvirtd through a token bucket
+
+Domains returned by the connection are wrapped as well. Limiting is
+enabled with VM_MANAGER_RPC_LIMIT=1 and tuned with
+VM_MANAGER_RPC_RATE (RPCs per second), VM_MANAGER_RPC_BURST and
+VM_MANAGER_RPC_CACHE_TTL (seconds). When disabled, limit() returns the
+connection untouched.
+
+Wrap the instrumented connection, limit(instrument(conn)), so the call
+statistics count only the RPCs actually sent.
+"""
+
+import os
+import threading
+import time
+
+import libvirt
+
+import vm_events
+import vm_instrument
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+ENABLED = os.environ.get('VM_MANAGER_RPC_LIMIT', '0') not in ('', '0')
+RATE = float(os.environ.get('VM_MANAGER_RPC_RATE', '200') or 0)
+BURST = int(os.environ.get('VM_MANAGER_RPC_BURST', '50') or 1)
+CACHE_TTL = float(os.environ.get('VM_MANAGER_RPC_CACHE_TTL', '1.0') or 0)
+
+# Read-only queries: cached for CACHE_TTL and coalesced
+CACHED_METHODS = frozenset([
+    'conn.lookupByName', 'conn.lookupByUUIDString', 'conn.lookupByID',
+    'conn.getHostname', 'conn.getInfo', 'conn.getLibVersion',
+    'conn.getVersion', 'conn.getCapabilities', 'conn.listAllDomains',
+    'conn.getFreeMemory',
+    'dom.state', 'dom.info', 'dom.isActive', 'dom.isPersistent',
+    'dom.XMLDesc', 'dom.autostart', 'dom.maxMemory', 'dom.vcpusFlags',
+    'dom.hasManagedSaveImage', 'dom.blockInfo', 'dom.blkioParameters',
+    'dom.blockIoTune', 'dom.schedulerParametersFlags',
+    'dom.interfaceParameters',
+])
+
+# Time-dependent queries: coalesced but never cached
+COALESCED_METHODS = frozenset([
+    'conn.getAllDomainStats', 'conn.domainListGetStats',
+    'dom.blockStats', 'dom.interfaceStats', 'dom.getCPUStats',
+    'dom.memoryStats', 'dom.interfaceAddresses', 'dom.jobInfo',
+    'dom.jobStats', 'dom.blockJobInfo',
+])
+
+# Calls that neither reach libvirtd nor change anything
+LOCAL_METHODS = vm_instrument.LOCAL_METHODS | frozenset([
+    'domainEventRegisterAny', 'domainEventDeregisterAny', 'close',
+])
+
+# =============================================================================
+# BUILDING BLOCKS
+# =============================================================================
+
+class TokenBucket(object):
+    """Thread-safe token bucket; callers wait for their token in turn"""
+
+    def __init__(self, rate, burst):
+        """
+        Initialize the bucket
+
+        Args:
+            rate: Tokens added per second (0 disables the limit)
+            burst: Bucket capacity
+        """
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until it is available
+
+        Returns:
+            Seconds waited (0.0 when a token was free)
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            # Reserve the token now; a negative balance queues later callers
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class _Flight(object):
+    """One query in progress that other callers can wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class LimiterStats(object):
+    """Counters of one limiter"""
+
+    FIELDS = ('calls', 'rpcs', 'cache_hits', 'coalesced', 'throttled')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def add(self, field, n=1):
+        """Increment a counter"""
+        with self._lock:
+            self.counts[field] += n
+
+    def add_wait(self, seconds):
+        """Record a throttled call and its delay"""
+        with self._lock:
+            self.counts['throttled'] += 1
+            self.wait_seconds += seconds
+
+    def snapshot(self):
+        """Return the counters as a plain dict"""
+        with self._lock:
+            snap = dict(self.counts)
+            snap['throttle_wait_ms'] = round(self.wait_seconds * 1000.0, 3)
+        return snap
+
+    def reset(self):
+        """Zero all counters"""
+        with self._lock:
+            self.counts = dict.fromkeys(self.FIELDS, 0)
+            self.wait_seconds = 0.0
+
+
+class Limiter(object):
+    """Cache, in-flight table and token bucket shared by one connection"""
+
+    def __init__(self, rate=RATE, burst=BURST, ttl=CACHE_TTL):
+        self.ttl = ttl
+        self.bucket = TokenBucket(rate, burst)
+        self.stats = LimiterStats()
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._flights = {}
+        self._token = None
+
+    def clear(self):
+        """Forget every cached result"""
+        with self._lock:
+            self._cache = {}
+
+    def call(self, key, cacheable, func, args, kwargs):
+        """
+        Run a query with caching and coalescing
+
+        Args:
+            key: Hashable identity of the query
+            cacheable: Keep the result for ttl seconds
+            func: Bound method performing the RPC
+            args, kwargs: Call arguments
+
+        Returns:
+            The (possibly shared) result
+        """
+        with self._lock:
+            if cacheable:
+                entry = self._cache.get(key)
+                if entry is not None and entry[0] > time.time():
+                    self.stats.add('cache_hits')
+                    return entry[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            self.stats.add('coalesced')
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self.send(func, args, kwargs)
+            if cacheable and self.ttl > 0:
+                with self._lock:
+                    self._cache[key] = (time.time() + self.ttl, flight.result)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def send(self, func, args, kwargs):
+        """Send one RPC after taking a token"""
+        waited = self.bucket.acquire()
+        if waited:
+            self.stats.add_wait(waited)
+        self.stats.add('rpcs')
+        return func(*args, **kwargs)
+
+    def _on_lifecycle(self, dom, event, detail):
+        self.clear()
+
+    def render_metrics(self):
+        """
+        Render the counters in Prometheus text format
+
+        Returns:
+            Exposition text
+        """
+        snap = self.stats.snapshot()
+        out = ["# HELP vm_manager_rpc_limiter_total libvirt requests by "
+               "outcome in the client-side limiter",
+               "# TYPE vm_manager_rpc_limiter_total counter"]
+        for field in LimiterStats.FIELDS:
+            out.append('vm_manager_rpc_limiter_total{outcome="%s"} %d' %
+                       (field, snap[field]))
+        out.append("# HELP vm_manager_rpc_throttle_wait_seconds_total "
+                   "Time spent waiting for the rate limit")
+        out.append("# TYPE vm_manager_rpc_throttle_wait_seconds_total counter")
+        out.append("vm_manager_rpc_throttle_wait_seconds_total %.6f" %
+                   (snap['throttle_wait_ms'] / 1000.0))
+        return "\n".join(out) + "\n"
+
+
+# =============================================================================
+# PROXIES
+# =============================================================================
+
+class LimitedProxy(object):
+    """
+    Proxy routing the calls of a libvirt object through a Limiter
+
+    Like vm_instrument.InstrumentedProxy it keeps the target under
+    __wrapped__, so vm_instrument.unwrap() sees through it.
+    """
+
+    def __init__(self, target, kind, limiter):
+        """
+        Initialize the proxy
+
+        Args:
+            target: libvirt object (virConnect or virDomain), maybe a proxy
+            kind: "conn" or "dom"
+            limiter: Limiter shared by the connection
+        """
+        self.__dict__['__wrapped__'] = target
+        self.__dict__['_kind'] = kind
+        self.__dict__['_limiter'] = limiter
+        self.__dict__['_ident'] = (
+            vm_instrument.unwrap(target).UUIDString() if kind == 'dom' else None)
+
+    def __getattr__(self, name):
+        attr = getattr(self.__wrapped__, name)
+        if name in LOCAL_METHODS or name.startswith('_') or not callable(attr):
+            return attr
+        wrapper = _limited(attr, self._kind + '.' + name, self._ident,
+                           self._limiter)
+        self.__dict__[name] = wrapper
+        return wrapper
+
+    def __setattr__(self, name, value):
+        setattr(self.__wrapped__, name, value)
+
+    def __eq__(self, other):
+        return vm_instrument.unwrap(self) == vm_instrument.unwrap(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(vm_instrument.unwrap(self))
+
+    def __repr__(self):
+        return '<limited %r>' % (self.__wrapped__,)
+
+
+def _limited(func, method, ident, limiter):
+    """Build the wrapper applying the limiter to one method"""
+    cacheable = method in CACHED_METHODS
+    coalesced = cacheable or method in COALESCED_METHODS
+
+    def wrapper(*args, **kwargs):
+        limiter.stats.add('calls')
+        if not coalesced:
+            # A change: later queries must see its effect
+            limiter.clear()
+            return wrap_result(limiter.send(func, args, kwargs), limiter)
+        try:
+            key = (method, ident, args, tuple(sorted(kwargs.items())))
+            hash(key)
+        except TypeError:
+            return wrap_result(limiter.send(func, args, kwargs), limiter)
+        return wrap_result(limiter.call(key, cacheable, func, args, kwargs),
+                           limiter)
+    wrapper.__name__ = getattr(func, '__name__', method)
+    return wrapper
+
+
+def _is_domain(obj):
+    return isinstance(vm_instrument.unwrap(obj), libvirt.virDomain)
+
+
+def wrap_result(result, limiter):
+    """Wrap domains contained in an API result (see vm_instrument)"""
+    if isinstance(result, LimitedProxy):
+        return result
+    if _is_domain(result):
+        return LimitedProxy(result, 'dom', limiter)
+    if isinstance(result, list) and result:
+        first = result[0]
+        if _is_domain(first):
+            return [LimitedProxy(d, 'dom', limiter) for d in result]
+        if isinstance(first, tuple) and first and _is_domain(first[0]):
+            return [(LimitedProxy(t[0], 'dom', limiter),) + tuple(t[1:])
+                    for t in result]
+    return result
+
+
+def limit(conn, limiter=None, enabled=None):
+    """
+    Wrap a libvirt connection with caching, coalescing and a rate limit
+
+    Lifecycle events clear the cache when the event loop is running.
+
+    Args:
+        conn: libvirt connection, raw or instrumented (or None)
+        limiter: Limiter to use, defaults to a new one from the settings
+        enabled: Override the VM_MANAGER_RPC_LIMIT setting
+
+    Returns:
+        The limited proxy, or conn itself when disabled
+    """
+    if enabled is None:
+        enabled = ENABLED
+    if not enabled or conn is None:
+        return conn
+    limiter = limiter or Limiter()
+    dispatcher = vm_events.get_dispatcher(conn)
+    if dispatcher is not None:
+        limiter._token = dispatcher.subscribe(
+            libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, limiter._on_lifecycle)
+    return LimitedProxy(conn, 'conn', limiter)
+
+
+def limiter_of(conn):
+    """Return the Limiter of a limited connection, or None"""
+    while conn is not None:
+        limiter = getattr(conn, '__dict__', {}).get('_limiter')
+        if limiter is not None:
+            return limiter
+        conn = getattr(conn, '__dict__', {}).get('__wrapped__')
+    return None
+
+
+def format_report(limiter):
+    """
+    Format the counters of a limiter
+
+    Returns:
+        List of lines
+    """
+    snap = limiter.stats.snapshot()
+    calls = snap['calls'] or 1
+    return [
+        "Calls made:         %8d" % snap['calls'],
+        "RPCs sent:          %8d  (%.0f%%)" % (snap['rpcs'],
+                                               100.0 * snap['rpcs'] / calls),
+        "Cache hits:         %8d" % snap['cache_hits'],
+        "Coalesced:          %8d" % snap['coalesced'],
+        "Throttled:          %8d  (%.1f ms waited)" % (snap['throttled'],
+                                                       snap['throttle_wait_ms']),
+    ]
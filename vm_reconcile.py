@@ -0,0 +1,605 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Desired-State Reconciler
+------------------------
+Converge the fleet towards a declarative description
+
+The desired state is a JSON file (vm_fleet.json by default):
+
+    {
+        "defaults": {"vcpus": 1, "memory_mb": 1024, "disk_gb": 10},
+        "prune": false,
+        "vms": {
+            "web1": {"vcpus": 2, "memory_mb": 2048, "state": "running",
+                     "cpu_class": "gold", "net_class": "silver"},
+            "batch1": {"state": "shutoff",
+                       "io_policy": {"weight": 200}}
+        }
+    }
+
+state is one of running, paused or shutoff (default running). With
+"prune", domains missing from the file are removed (their disks are
+kept).
+
+A plan is computed in one pass over the cached inventory (vm_inventory),
+indexed by name, so it costs O(N) dictionary lookups and no libvirt
+calls. Only the listed changes are applied, one worker per VM with a
+concurrency limit; the steps of one VM run in order (create, resize,
+tune, state).
+
+Tuning (cpu_class, net_class, io_policy) cannot be read back in bulk,
+so the reconciler remembers what it applied per domain UUID in
+vm_reconcile_state.json and re-applies only when the file changes.
+
+With --watch the reconciler keeps running: lifecycle events and changes
+of the desired-state file trigger a new plan from the cache instead of
+a full rescan.
+
+Examples:
+    python vm_reconcile.py                    # show the plan
+    python vm_reconcile.py --apply            # apply it once
+    python vm_reconcile.py --watch            # keep converging
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import libvirt
+
+import vm_cpusched
+import vm_events
+import vm_inventory
+import vm_ioqos
+import vm_netqos
+import vm_resize
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+FLEET_FILE = 'vm_fleet.json'
+STATE_FILE = 'vm_reconcile_state.json'
+MAIN_MODULE = 'LAB2b_Python_Script_Kherroubi_Bousdjira_SQ1'
+
+MAX_CONCURRENT = 8
+# Seconds a requested state change may take before it is requested again
+SETTLE_TIMEOUT = 120
+# Seconds before the steps of a VM are retried after a failure
+RETRY_AFTER = 60
+# Wait after an event so a burst of events yields one plan
+DEBOUNCE = 0.5
+# Plan at least this often, and check the file for changes this often
+RESYNC_INTERVAL = 60
+FILE_CHECK_INTERVAL = 2
+
+DEFAULTS = {'vcpus': 1, 'memory_mb': 1024, 'disk_gb': 10, 'state': 'running',
+            'iso': None}
+
+STATES = {
+    'running': libvirt.VIR_DOMAIN_RUNNING,
+    'paused': libvirt.VIR_DOMAIN_PAUSED,
+    'shutoff': libvirt.VIR_DOMAIN_SHUTOFF,
+}
+
+TUNING_KEYS = ('cpu_class', 'net_class', 'io_policy')
+
+# Steps that change the run state (settled by the state changing)
+STATE_STEPS = frozenset(['start', 'stop', 'pause', 'resume', 'restart',
+                         'delete'])
+
+# =============================================================================
+# DESIRED STATE
+# =============================================================================
+
+def load_desired(path=FLEET_FILE):
+    """
+    Read and validate a desired-state file
+
+    Args:
+        path: JSON file
+
+    Returns:
+        (specs, prune) where specs is a dict of name -> spec with defaults
+        filled in
+
+    Raises:
+        ValueError: Invalid JSON or an invalid VM entry
+        IOError: The file cannot be read
+    """
+    with open(path) as f:
+        data = json.load(f)
+    defaults = dict(DEFAULTS)
+    defaults.update(data.get('defaults', {}))
+
+    specs = {}
+    for name, entry in (data.get('vms') or {}).items():
+        spec = dict(defaults)
+        spec.update(entry or {})
+        if spec['state'] not in STATES:
+            raise ValueError("%s: state must be one of %s" %
+                             (name, ", ".join(sorted(STATES))))
+        for key in ('vcpus', 'memory_mb', 'disk_gb'):
+            try:
+                spec[key] = int(spec[key])
+            except (TypeError, ValueError):
+                raise ValueError("%s: %s must be a number" % (name, key))
+        specs[name] = spec
+    return specs, bool(data.get('prune'))
+
+
+# =============================================================================
+# PLANNING
+# =============================================================================
+
+class Action(object):
+    """One step towards the desired state of a VM"""
+
+    __slots__ = ('name', 'step', 'uuid', 'detail')
+
+    def __init__(self, name, step, uuid=None, detail=None):
+        self.name = name
+        self.step = step
+        self.uuid = uuid
+        self.detail = detail
+
+    def describe(self):
+        """Return a short human-readable description"""
+        if self.step == 'resize':
+            return "resize to %s vCPUs, %s MB" % (self.detail['vcpus'],
+                                                  self.detail['memory_mb'])
+        if self.step == 'tune':
+            return "tune %s" % ", ".join(
+                "%s=%s" % (k, json.dumps(v, sort_keys=True))
+                for k, v in sorted(self.detail.items()))
+        if self.step == 'create':
+            return "create (%d vCPUs, %d MB, %d GB disk)" % (
+                self.detail['vcpus'], self.detail['memory_mb'],
+                self.detail['disk_gb'])
+        return self.step
+
+
+def _state_steps(actual, wanted):
+    """Return the steps leading from one run state to another"""
+    if actual == wanted:
+        return []
+    if actual == libvirt.VIR_DOMAIN_CRASHED:
+        return ['restart'] if wanted == libvirt.VIR_DOMAIN_RUNNING else ['stop']
+    if actual == libvirt.VIR_DOMAIN_SHUTDOWN:
+        # Already on its way down
+        return [] if wanted == libvirt.VIR_DOMAIN_SHUTOFF else ['start']
+    if wanted == libvirt.VIR_DOMAIN_RUNNING:
+        return ['resume'] if actual == libvirt.VIR_DOMAIN_PAUSED else ['start']
+    if wanted == libvirt.VIR_DOMAIN_PAUSED:
+        return ['pause'] if actual == libvirt.VIR_DOMAIN_RUNNING else ['start', 'pause']
+    return ['stop']
+
+
+def plan(specs, rows, applied=None, prune=False, skip=()):
+    """
+    Compute the actions that bring the fleet to the desired state
+
+    Runs in one pass over specs and rows with dictionary lookups only.
+
+    Args:
+        specs: Dict of name -> spec (from load_desired)
+        rows: Inventory rows (vm_inventory.DomainRow)
+        applied: Dict of uuid -> tuning applied earlier
+        prune: Remove domains that are not in specs
+        skip: Names with changes still in progress
+
+    Returns:
+        List of Action, grouped by VM in execution order
+    """
+    applied = applied or {}
+    by_name = dict((row.name, row) for row in rows)
+    actions = []
+
+    for name, spec in specs.items():
+        if name in skip:
+            continue
+        row = by_name.get(name)
+        tuning = dict((k, spec[k]) for k in TUNING_KEYS if spec.get(k))
+        if row is None:
+            actions.append(Action(name, 'create', None, spec))
+            if tuning:
+                actions.append(Action(name, 'tune', None, tuning))
+            for step in _state_steps(libvirt.VIR_DOMAIN_SHUTOFF,
+                                     STATES[spec['state']]):
+                actions.append(Action(name, step))
+            continue
+
+        # Sizes read as 0 are unknown (no stats yet) and left alone
+        if ((row.vcpus and row.vcpus != spec['vcpus']) or
+                (row.memory_mb and row.memory_mb != spec['memory_mb'])):
+            actions.append(Action(name, 'resize', row.uuid,
+                                  {'vcpus': spec['vcpus'],
+                                   'memory_mb': spec['memory_mb']}))
+        done = applied.get(row.uuid, {})
+        changed = dict((k, v) for k, v in tuning.items() if done.get(k) != v)
+        if changed:
+            actions.append(Action(name, 'tune', row.uuid, changed))
+        for step in _state_steps(row.state, STATES[spec['state']]):
+            actions.append(Action(name, step, row.uuid))
+
+    if prune:
+        for name, row in by_name.items():
+            if name not in specs and name not in skip:
+                actions.append(Action(name, 'delete', row.uuid))
+    return actions
+
+
+def format_plan(actions):
+    """
+    Format a plan for display
+
+    Returns:
+        List of lines
+    """
+    if not actions:
+        return ["Nothing to do: the fleet matches the desired state"]
+    lines = []
+    for action in actions:
+        lines.append("  %-30s %s" % (action.name[:30], action.describe()))
+    vms = len(set(a.name for a in actions))
+    lines.append("\n%d change(s) on %d VM(s)" % (len(actions), vms))
+    return lines
+
+
+# =============================================================================
+# RECONCILER
+# =============================================================================
+
+class Reconciler(object):
+    """
+    Plan against the cached inventory and apply with a concurrency limit
+
+    Steps that were issued but are not yet visible in the inventory (a
+    guest still shutting down, a resize before the next refresh) are
+    remembered, so repeated plans do not issue them again. A VM whose
+    step failed is left alone for RETRY_AFTER seconds.
+    """
+
+    def __init__(self, manager, inventory, path=FLEET_FILE,
+                 workers=MAX_CONCURRENT, state_path=STATE_FILE):
+        """
+        Initialize the reconciler
+
+        Args:
+            manager: Connected VMManager (its core operations are used)
+            inventory: vm_inventory.Inventory of the same connection
+            path: Desired-state file
+            workers: VMs changed at once
+            state_path: File remembering applied tuning
+        """
+        self.manager = manager
+        self.inventory = inventory
+        self.path = path
+        self.workers = workers
+        self.state_path = state_path
+        self.specs = {}
+        self.prune = False
+        self.loaded_mtime = None
+        self.applied = self._load_applied()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._failed = {}
+        self._wake = threading.Event()
+
+    def _load_applied(self):
+        """Read the applied tuning record"""
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_applied(self):
+        """Atomically write the applied tuning record"""
+        with self._lock:
+            data = json.dumps(self.applied, sort_keys=True)
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, self.state_path)
+
+    def load(self):
+        """
+        Re-read the desired-state file when it changed
+
+        Returns:
+            True when the file was (re)loaded
+
+        Raises:
+            ValueError, IOError: See load_desired
+        """
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self.loaded_mtime:
+            return False
+        self.specs, self.prune = load_desired(self.path)
+        self.loaded_mtime = mtime
+        return True
+
+    def _in_progress(self, rows_by_name):
+        """Return names whose issued steps are not yet reflected"""
+        now = time.time()
+        busy = set()
+        with self._lock:
+            for name, (issued_at, state_before, steps) in list(self._pending.items()):
+                row = rows_by_name.get(name)
+                if now - issued_at > SETTLE_TIMEOUT:
+                    settled = True
+                elif 'delete' in steps:
+                    settled = row is None
+                elif steps & STATE_STEPS:
+                    settled = row is not None and row.state != state_before
+                else:
+                    refreshed = self.inventory.refreshed_at or 0
+                    settled = row is not None and refreshed > issued_at
+                if settled:
+                    del self._pending[name]
+                else:
+                    busy.add(name)
+            for name, retry_at in list(self._failed.items()):
+                if now < retry_at:
+                    busy.add(name)
+                else:
+                    del self._failed[name]
+        return busy
+
+    def plan(self):
+        """
+        Plan from the cached inventory
+
+        Returns:
+            List of Action
+        """
+        rows = self.inventory.rows()
+        by_name = dict((row.name, row) for row in rows)
+        with self._lock:
+            applied = dict(self.applied)
+        return plan(self.specs, rows, applied, self.prune,
+                    self._in_progress(by_name))
+
+    def apply(self, actions, progress=None):
+        """
+        Apply a plan, one worker per VM
+
+        Args:
+            actions: Output of plan()
+            progress: Optional callable(action, error) per finished step
+
+        Returns:
+            List of (Action, error or None) for the steps attempted
+        """
+        groups = {}
+        order = []
+        for action in actions:
+            if action.name not in groups:
+                groups[action.name] = []
+                order.append(action.name)
+            groups[action.name].append(action)
+        if not order:
+            return []
+
+        pool = ThreadPool(min(self.workers, len(order)))
+        try:
+            outcomes = pool.map(lambda name: self._apply_vm(groups[name], progress),
+                                order)
+        finally:
+            pool.close()
+        self._save_applied()
+        # Refresh so resizes and new domains show up in the next plan
+        self.inventory.invalidate()
+        return [item for outcome in outcomes for item in outcome]
+
+    def _apply_vm(self, actions, progress):
+        """Run the steps of one VM in order, stopping at the first error"""
+        name = actions[0].name
+        row = self.inventory.find(name)
+        state_before = row.state if row else None
+        with self._lock:
+            self._pending[name] = (time.time(), state_before,
+                                   set(a.step for a in actions))
+
+        done = []
+        dom = None
+        for action in actions:
+            error = None
+            try:
+                if dom is None and action.step != 'create':
+                    dom = self.manager.conn.lookupByName(name)
+                dom = self._step(dom, action)
+            except (libvirt.libvirtError, OSError, ValueError) as e:
+                error = str(e)
+            done.append((action, error))
+            if progress:
+                progress(action, error)
+            if error:
+                with self._lock:
+                    self._pending.pop(name, None)
+                    self._failed[name] = time.time() + RETRY_AFTER
+                break
+        return done
+
+    def _step(self, dom, action):
+        """
+        Apply one step
+
+        Returns:
+            The domain (created by a "create" step)
+        """
+        m = self.manager
+        step = action.step
+        if step == 'create':
+            spec = action.detail
+            return m.define_domain(action.name, spec['memory_mb'], spec['vcpus'],
+                                   spec['disk_gb'], spec.get('iso'))
+        if step == 'start':
+            m.start_domain(dom)
+        elif step == 'stop':
+            m.shutdown_domain(dom)
+        elif step == 'pause':
+            m.suspend_domain(dom)
+        elif step == 'resume':
+            m.resume_domain(dom)
+        elif step == 'restart':
+            m.destroy_domain(dom)
+            m.start_domain(dom)
+        elif step == 'delete':
+            if dom.isActive():
+                m.destroy_domain(dom)
+            m.delete_domain(dom)
+        elif step == 'resize':
+            planned = vm_resize.plan(m.conn, [dom], action.detail['vcpus'],
+                                     action.detail['memory_mb'])
+            result = vm_resize.apply(planned, m.hostname, workers=1)[0]
+            if result.error:
+                raise ValueError(result.error)
+        elif step == 'tune':
+            self._tune(dom, action.detail)
+        return dom
+
+    def _tune(self, dom, tuning):
+        """Apply tuning classes and record them as applied"""
+        host = self.manager.hostname
+        if 'cpu_class' in tuning:
+            error = vm_cpusched.apply([dom], tuning['cpu_class'], host)[0][2]
+            if error:
+                raise ValueError(error)
+        if 'net_class' in tuning:
+            vm_netqos.apply_class(dom, tuning['net_class'])
+        if 'io_policy' in tuning:
+            vm_ioqos.apply_policy(dom, tuning['io_policy'])
+        with self._lock:
+            self.applied.setdefault(dom.UUIDString(), {}).update(tuning)
+
+    # -------------------------------------------------------------------------
+    # CONTINUOUS MODE
+    # -------------------------------------------------------------------------
+
+    def _on_lifecycle(self, dom, event, detail):
+        self._wake.set()
+
+    def run_forever(self, stop=None, progress=None, report=None):
+        """
+        Re-plan and apply on events, file changes and every RESYNC_INTERVAL
+
+        Args:
+            stop: threading.Event ending the loop
+            progress: Optional callable(action, error) per finished step
+            report: Optional callable(message) for loop notices
+        """
+        stop = stop or threading.Event()
+        dispatcher = vm_events.get_dispatcher(self.manager.conn)
+        token = None
+        if dispatcher is not None:
+            token = dispatcher.subscribe(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                         self._on_lifecycle)
+        last_plan = 0
+        try:
+            while not stop.is_set():
+                try:
+                    reloaded = self.load()
+                except (IOError, OSError, ValueError) as e:
+                    if report:
+                        report("Desired state not loaded: %s" % e)
+                    reloaded = False
+                if reloaded and report:
+                    report("Loaded %d VM(s) from %s" % (len(self.specs), self.path))
+
+                woken = self._wake.is_set()
+                if (reloaded or woken or
+                        time.time() - last_plan >= RESYNC_INTERVAL):
+                    if woken:
+                        time.sleep(DEBOUNCE)
+                    self._wake.clear()
+                    last_plan = time.time()
+                    if self.inventory.refreshed_at is not None and self.specs:
+                        actions = self.plan()
+                        if actions:
+                            self.apply(actions, progress)
+                self._wake.wait(FILE_CHECK_INTERVAL)
+        finally:
+            if token is not None:
+                dispatcher.unsubscribe(token)
+
+
+def format_step(action, error):
+    """Format the outcome of one applied step"""
+    return "  %-30s %-40s %s" % (action.name[:30], action.describe()[:40],
+                                 "FAILED: %s" % error if error else "ok")
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Converge the VM fleet towards a desired-state file")
+    parser.add_argument("file", nargs="?", default=FLEET_FILE)
+    parser.add_argument("--uri", default="qemu:///system")
+    parser.add_argument("--apply", action="store_true",
+                        help="Apply the plan instead of only showing it")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep applying on events and file changes")
+    parser.add_argument("--workers", type=int, default=MAX_CONCURRENT)
+    args = parser.parse_args(argv)
+
+    manager = importlib.import_module(MAIN_MODULE).VMManager()
+    try:
+        manager.open_connection(args.uri)
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        return 1
+
+    def show(action, error):
+        print(format_step(action, error))
+
+    def notice(message):
+        print(message)
+
+    inventory = vm_inventory.Inventory(manager.conn)
+    reconciler = Reconciler(manager, inventory, args.file, args.workers)
+    status = 0
+    try:
+        reconciler.load()
+        inventory.refresh()
+        start = time.time()
+        actions = reconciler.plan()
+        for line in format_plan(actions):
+            print(line)
+        print("Planned %d VM(s) in %.1f ms" %
+              (len(inventory.rows()), (time.time() - start) * 1000.0))
+
+        if args.apply or args.watch:
+            for action, error in reconciler.apply(actions, show):
+                if error:
+                    status = 1
+        if args.watch:
+            inventory.start()
+            print("Watching for events and changes to %s (Ctrl-C to stop)" %
+                  args.file)
+            try:
+                reconciler.run_forever(progress=show, report=notice)
+            except KeyboardInterrupt:
+                pass
+    except (IOError, OSError, ValueError, libvirt.libvirtError) as e:
+        print("Error: %s" % e)
+        status = 1
+    finally:
+        inventory.stop()
+        manager.close()
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,311 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Live Resize
+-----------
+Change the vCPU count and memory of running or stopped VMs
+
+vCPUs are hot-plugged with setVcpusFlags (live and persistent) up to the
+domain's maximum vCPU count; the guest agent is then asked to bring the
+new CPUs online. Memory is changed with setMemoryFlags up to the
+domain's maximum memory, which the balloon driver gives back to or takes
+from the guest. New VMs are defined with headroom for both (see
+headroom() and the "resize" section of vm_manager.json).
+
+Requests are validated against the domain maxima and the host's CPU
+count and free memory before anything is changed; a request for many VMs
+is checked as a whole.
+
+Examples:
+    python vm_resize.py "web*" --vcpus +2
+    python vm_resize.py "db1,db2" --memory 8192
+"""
+
+import argparse
+import sys
+from multiprocessing.pool import ThreadPool
+
+import libvirt
+
+import vm_config
+import vm_instrument
+import vm_oplog
+import vm_select
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# Maximum size of new VMs as a multiple of their initial size
+VCPU_HEADROOM = 2
+MEMORY_HEADROOM = 2
+
+MIN_MEMORY_MB = 256
+HOST_RESERVE_MB = 1024
+RESIZE_WORKERS = 4
+
+
+def resize_config(config=None):
+    """Return the "resize" section with defaults filled in"""
+    cfg = vm_config.section('resize', config)
+    return {
+        'vcpu_headroom': int(cfg.get('vcpu_headroom', VCPU_HEADROOM)),
+        'memory_headroom': float(cfg.get('memory_headroom', MEMORY_HEADROOM)),
+        'host_reserve_mb': int(cfg.get('host_reserve_mb', HOST_RESERVE_MB)),
+    }
+
+
+def headroom(vcpus, memory_mb, host_cpus, config=None):
+    """
+    Return the maximum vCPUs and memory to define for a new VM
+
+    Args:
+        vcpus: Initial vCPU count
+        memory_mb: Initial memory in MB
+        host_cpus: Number of host CPUs
+        config: Configuration dict
+
+    Returns:
+        (max_vcpus, max_memory_mb)
+    """
+    cfg = resize_config(config)
+    max_vcpus = max(vcpus, min(vcpus * cfg['vcpu_headroom'], host_cpus))
+    max_memory = int(memory_mb * cfg['memory_headroom'])
+    return max_vcpus, max(memory_mb, max_memory)
+
+
+# =============================================================================
+# PLANNING
+# =============================================================================
+
+class ResizeResult(object):
+    """Requested and applied size of one domain"""
+
+    def __init__(self, name, vcpus, memory_mb):
+        self.name = name
+        self.old_vcpus = self.new_vcpus = vcpus
+        self.old_memory_mb = self.new_memory_mb = memory_mb
+        self.error = None
+        self.warning = None
+
+    @property
+    def changed(self):
+        """True when the target size differs from the current one"""
+        return (self.new_vcpus != self.old_vcpus or
+                self.new_memory_mb != self.old_memory_mb)
+
+
+def resolve(spec, current):
+    """
+    Resolve an absolute ("4") or relative ("+2", "-1024") size
+
+    Args:
+        spec: Size string, or None to keep the current value
+        current: Current value
+
+    Returns:
+        Target value
+
+    Raises:
+        ValueError: Not a number
+    """
+    if spec is None or spec == '':
+        return current
+    spec = str(spec).strip()
+    if spec[0] in '+-':
+        return current + int(spec)
+    return int(spec)
+
+
+def plan(conn, domains, vcpus=None, memory=None, config=None):
+    """
+    Compute and validate the target size of each domain
+
+    Args:
+        conn: libvirt connection
+        domains: libvirt domains
+        vcpus: vCPU size spec (see resolve)
+        memory: Memory size spec in MB
+        config: Configuration dict
+
+    Returns:
+        List of (dom, ResizeResult); invalid requests have error set
+    """
+    host_cpus = conn.getInfo()[2]
+    free_mb = conn.getFreeMemory() // 1048576
+    budget_mb = free_mb - resize_config(config)['host_reserve_mb']
+
+    planned = []
+    for dom in domains:
+        live = dom.isActive()
+        flags = (libvirt.VIR_DOMAIN_AFFECT_LIVE if live
+                 else libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+        current_vcpus = dom.vcpusFlags(flags)
+        max_vcpus = dom.vcpusFlags(libvirt.VIR_DOMAIN_AFFECT_CONFIG |
+                                   libvirt.VIR_DOMAIN_VCPU_MAXIMUM)
+        current_mb = dom.info()[2] // 1024
+        max_mb = dom.maxMemory() // 1024
+
+        result = ResizeResult(dom.name(), current_vcpus, current_mb)
+        try:
+            result.new_vcpus = resolve(vcpus, current_vcpus)
+            result.new_memory_mb = resolve(memory, current_mb)
+        except ValueError:
+            result.error = "invalid size"
+            planned.append((dom, result))
+            continue
+
+        if result.new_vcpus < 1 or result.new_vcpus > max_vcpus:
+            result.error = "vCPUs must be 1-%d" % max_vcpus
+        elif result.new_vcpus > host_cpus:
+            result.error = "host has only %d CPUs" % host_cpus
+        elif not MIN_MEMORY_MB <= result.new_memory_mb <= max_mb:
+            result.error = "memory must be %d-%d MB" % (MIN_MEMORY_MB, max_mb)
+        elif live and result.new_memory_mb > current_mb:
+            growth = result.new_memory_mb - current_mb
+            if growth > budget_mb:
+                result.error = ("not enough free host memory (%d MB left)"
+                                % max(budget_mb, 0))
+            else:
+                budget_mb -= growth
+        planned.append((dom, result))
+    return planned
+
+
+# =============================================================================
+# APPLY
+# =============================================================================
+
+def set_vcpus(dom, vcpus, agent=True):
+    """
+    Set the vCPU count of a domain, live and persistent
+
+    Args:
+        dom: libvirt domain
+        vcpus: New vCPU count
+        agent: Bring hot-plugged vCPUs online through the guest agent
+
+    Returns:
+        Warning string or None
+    """
+    if not dom.isActive():
+        dom.setVcpusFlags(vcpus, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+        return None
+    dom.setVcpusFlags(vcpus, libvirt.VIR_DOMAIN_AFFECT_LIVE |
+                      libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+    if agent:
+        try:
+            dom.setVcpusFlags(vcpus, libvirt.VIR_DOMAIN_VCPU_GUEST)
+        except libvirt.libvirtError as e:
+            return "guest agent did not online vCPUs: %s" % e
+    return None
+
+
+def set_memory(dom, memory_mb):
+    """Set the memory of a domain in MB, live and persistent"""
+    flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+    if dom.isActive():
+        flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+    dom.setMemoryFlags(memory_mb * 1024, flags)
+
+
+def apply(planned, host=None, workers=RESIZE_WORKERS, agent=True):
+    """
+    Apply planned resizes that passed validation
+
+    Args:
+        planned: Output of plan()
+        host: Hypervisor hostname for operation events
+        workers: Domains resized in parallel
+        agent: Online new vCPUs through the guest agent
+
+    Returns:
+        List of ResizeResult
+    """
+    def resize(item):
+        dom, result = item
+        if result.error or not result.changed:
+            return result
+        try:
+            with vm_oplog.operation('resize', dom, host,
+                                    vcpus=result.new_vcpus,
+                                    memory_mb=result.new_memory_mb):
+                if result.new_vcpus != result.old_vcpus:
+                    result.warning = set_vcpus(dom, result.new_vcpus, agent)
+                if result.new_memory_mb != result.old_memory_mb:
+                    set_memory(dom, result.new_memory_mb)
+        except libvirt.libvirtError as e:
+            result.error = str(e)
+        return result
+
+    if not planned:
+        return []
+    pool = ThreadPool(min(workers, len(planned)))
+    try:
+        return pool.map(resize, planned)
+    finally:
+        pool.close()
+
+
+def format_results(results):
+    """
+    Format resize results as a text table
+
+    Returns:
+        List of lines
+    """
+    lines = ["%-30s %-12s %-18s %s" % ("Name", "vCPUs", "Memory MB", "Status")]
+    lines.append("-" * 72)
+    for r in results:
+        status = r.error or ("resized" if r.changed else "unchanged")
+        lines.append("%-30s %4d -> %-4d %7d -> %-7d  %s" %
+                     (r.name[:30], r.old_vcpus, r.new_vcpus,
+                      r.old_memory_mb, r.new_memory_mb, status))
+        if r.warning:
+            lines.append("    %s" % r.warning)
+    return lines
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Resize VMs live")
+    parser.add_argument("selector", help='e.g. "web*", "all state=running"')
+    parser.add_argument("--uri", default="qemu:///system")
+    parser.add_argument("--vcpus", help="Count, or +N / -N")
+    parser.add_argument("--memory", help="MB, or +N / -N")
+    parser.add_argument("--no-agent", action="store_true",
+                        help="Do not online vCPUs through the guest agent")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+
+    try:
+        conn = vm_instrument.instrument(libvirt.open(args.uri))
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        return 1
+
+    try:
+        planned = plan(conn, vm_select.select(conn, args.selector),
+                       args.vcpus, args.memory)
+        if args.dry_run:
+            results = [r for _, r in planned]
+        else:
+            results = apply(planned, conn.getHostname(),
+                            agent=not args.no_agent)
+    except (ValueError, libvirt.libvirtError) as e:
+        print("Error: %s" % e)
+        conn.close()
+        return 1
+
+    for line in format_results(results):
+        print(line)
+    conn.close()
+    return 1 if any(r.error for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Domain Selectors
+----------------
+Pick a set of domains from a short selector string
+
+A selector is a list of terms separated by commas or spaces:
+
+    web*,db1            names or glob patterns (any may match)
+    state=running       only domains in that state (running, paused, shutoff)
+    all                 every domain
+
+Name terms and state terms are combined: "web* state=running" selects
+the running domains whose names start with "web".
+"""
+
+import fnmatch
+import re
+
+import libvirt
+
+STATE_FLAGS = {
+    'running': libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE,
+    'active': libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE,
+    'paused': libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE,
+    'shutoff': libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE,
+    'inactive': libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE,
+}
+
+_STATE_CODES = {
+    'running': (libvirt.VIR_DOMAIN_RUNNING,),
+    'paused': (libvirt.VIR_DOMAIN_PAUSED,),
+}
+
+
+def parse(selector):
+    """
+    Split a selector into name patterns and a state
+
+    Args:
+        selector: Selector string
+
+    Returns:
+        (patterns, state); patterns is empty for "all", state may be None
+
+    Raises:
+        ValueError: Empty selector or unknown state
+    """
+    terms = [t for t in re.split(r'[,\s]+', selector or '') if t]
+    if not terms:
+        raise ValueError("Empty selector")
+    patterns = []
+    state = None
+    for term in terms:
+        if term.startswith('state='):
+            state = term[len('state='):]
+            if state not in STATE_FLAGS:
+                raise ValueError("Unknown state: %s" % state)
+        elif term != 'all':
+            patterns.append(term)
+    return patterns, state
+
+
+def select(conn, selector):
+    """
+    Return the domains matching a selector, sorted by name
+
+    Args:
+        conn: libvirt connection
+        selector: Selector string
+
+    Returns:
+        List of libvirt domains
+    """
+    patterns, state = parse(selector)
+    flags = STATE_FLAGS[state] if state else 0
+    result = []
+    for dom in conn.listAllDomains(flags):
+        name = dom.name()
+        if patterns and not any(fnmatch.fnmatchcase(name, p) for p in patterns):
+            continue
+        if state in _STATE_CODES and dom.state()[0] not in _STATE_CODES[state]:
+            continue
+        result.append(dom)
+    return sorted(result, key=lambda d: d.name())
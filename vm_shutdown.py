@@ -0,0 +1,286 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Shutdown Coordinator
+--------------------
+Stop every guest cleanly and quickly before a host power-off
+
+A graceful shutdown request is sent to all domains at once. Completion is
+detected from lifecycle events (with a coarse state poll as fallback when
+no event loop is running). Domains still running at the per-VM deadline
+are escalated to a managed save or a forced stop.
+
+Example:
+    # Before rebooting the host
+    python vm_shutdown.py --timeout 120 --escalate save
+"""
+
+import argparse
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import libvirt
+
+import vm_events
+import vm_instrument
+import vm_oplog
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+DEFAULT_TIMEOUT = 120
+MAX_WORKERS = 16
+POLL_INTERVAL = 2.0
+
+ESCALATE_DESTROY = 'destroy'
+ESCALATE_SAVE = 'save'
+
+SHUTDOWN_MODES = {
+    'default': 0,
+    'acpi': libvirt.VIR_DOMAIN_SHUTDOWN_ACPI_POWER_BTN,
+    'agent': libvirt.VIR_DOMAIN_SHUTDOWN_GUEST_AGENT,
+}
+
+# =============================================================================
+# COORDINATOR
+# =============================================================================
+
+class ShutdownResult(object):
+    """Outcome of stopping one domain"""
+
+    def __init__(self, name, uuid):
+        self.name = name
+        self.uuid = uuid
+        self.outcome = None      # shutdown, saved, destroyed or failed
+        self.seconds = None
+        self.error = None
+
+    def to_dict(self):
+        """Return the result as a plain dict"""
+        return {'name': self.name, 'uuid': self.uuid,
+                'outcome': self.outcome, 'seconds': self.seconds,
+                'error': self.error}
+
+
+class ShutdownCoordinator(object):
+    """Shut down many domains in parallel with per-VM deadlines"""
+
+    def __init__(self, conn, timeout=DEFAULT_TIMEOUT,
+                 escalation=ESCALATE_DESTROY, mode='default',
+                 workers=MAX_WORKERS, host=None):
+        """
+        Initialize the coordinator
+
+        Args:
+            conn: libvirt connection
+            timeout: Seconds to wait for each guest before escalating
+            escalation: ESCALATE_DESTROY or ESCALATE_SAVE
+            mode: Shutdown method, a key of SHUTDOWN_MODES
+            workers: Maximum concurrent libvirt calls
+            host: Hypervisor hostname for operation events
+        """
+        self.conn = conn
+        self.timeout = timeout
+        self.escalation = escalation
+        self.flags = SHUTDOWN_MODES[mode]
+        self.workers = workers
+        self.host = host
+
+    def run(self, domains=None, progress=None):
+        """
+        Shut down domains and wait for them to stop
+
+        Args:
+            domains: Domains to stop, defaults to all active domains
+            progress: Optional callable(result) invoked as domains finish
+
+        Returns:
+            List of ShutdownResult in input order
+        """
+        if domains is None:
+            domains = self.conn.listAllDomains(
+                libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        if not domains:
+            return []
+
+        entries = {}
+        for dom in domains:
+            entries[dom.UUIDString()] = {
+                'dom': dom,
+                'result': ShutdownResult(dom.name(), dom.UUIDString()),
+                'stopped': threading.Event(),
+                'sent': None,
+                'refused': False,
+            }
+        changed = threading.Event()
+
+        # Subscribe before sending so no stop event can be missed
+        dispatcher = vm_events.get_dispatcher(self.conn)
+        token = None
+        if dispatcher is not None:
+            def on_lifecycle(dom, event, detail):
+                entry = entries.get(dom.UUIDString())
+                if entry and event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+                    entry['stopped_at'] = time.time()
+                    entry['stopped'].set()
+                    changed.set()
+            token = dispatcher.subscribe(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                         on_lifecycle)
+
+        pool = ThreadPool(min(self.workers, len(entries)))
+        try:
+            pool.map(self._request_shutdown, entries.values())
+            self._wait(entries, changed if token is not None else None,
+                       progress)
+            late = [e for e in entries.values() if e['result'].outcome is None]
+            for entry in pool.imap_unordered(self._escalate, late):
+                if progress:
+                    progress(entry['result'])
+        finally:
+            pool.close()
+            if token is not None:
+                dispatcher.unsubscribe(token)
+
+        for entry in entries.values():
+            result = entry['result']
+            vm_oplog.log_event('host_shutdown', entry['dom'], self.host,
+                               result.seconds,
+                               'error' if result.outcome == 'failed' else 'ok',
+                               result.error, outcome=result.outcome)
+        return [entries[d.UUIDString()]['result'] for d in domains]
+
+    def _request_shutdown(self, entry):
+        """Send the graceful shutdown request to one domain"""
+        entry['sent'] = time.time()
+        try:
+            entry['dom'].shutdownFlags(self.flags)
+        except libvirt.libvirtError as e:
+            if not entry['dom'].isActive():
+                entry['stopped'].set()
+            else:
+                # Not accepted (e.g. no agent): escalate right away
+                entry['result'].error = str(e)
+                entry['refused'] = True
+
+    def _wait(self, entries, changed, progress):
+        """
+        Wait for stop events until each domain's deadline
+
+        Args:
+            entries: Dict of uuid -> entry
+            changed: Event set on every stop event, or None to poll states
+            progress: Optional callable(result)
+        """
+        waiting = dict(entries)
+        while waiting:
+            now = time.time()
+            for uuid, entry in list(waiting.items()):
+                stopped = entry['stopped'].is_set()
+                if not stopped and changed is None:
+                    stopped = not self._is_active(entry['dom'])
+                if stopped:
+                    result = entry['result']
+                    result.outcome = 'shutdown'
+                    stopped_at = entry.get('stopped_at') or time.time()
+                    result.seconds = round(stopped_at - entry['sent'], 3)
+                    result.error = None
+                    del waiting[uuid]
+                    if progress:
+                        progress(result)
+                elif entry['refused'] or now >= entry['sent'] + self.timeout:
+                    del waiting[uuid]
+            if not waiting:
+                break
+            # Sleep until the next stop event or the nearest deadline
+            deadline = min(e['sent'] + self.timeout for e in waiting.values())
+            delay = max(0.0, deadline - time.time())
+            if changed is not None:
+                changed.wait(delay)
+                changed.clear()
+            else:
+                time.sleep(min(delay, POLL_INTERVAL))
+
+    def _is_active(self, dom):
+        """Return whether a domain is still active, treating errors as gone"""
+        try:
+            return dom.isActive()
+        except libvirt.libvirtError:
+            return False
+
+    def _escalate(self, entry):
+        """Managed-save or destroy a domain that missed its deadline"""
+        dom = entry['dom']
+        result = entry['result']
+        try:
+            if self.escalation == ESCALATE_SAVE:
+                dom.managedSave(0)
+                result.outcome = 'saved'
+            else:
+                dom.destroy()
+                result.outcome = 'destroyed'
+            result.error = None
+        except libvirt.libvirtError as e:
+            if self._is_active(dom):
+                result.outcome = 'failed'
+                result.error = str(e)
+            else:
+                result.outcome = 'shutdown'
+        result.seconds = round(time.time() - entry['sent'], 3)
+        return entry
+
+
+def format_results(results):
+    """
+    Format shutdown results as a text table
+
+    Returns:
+        List of lines
+    """
+    lines = ["%-30s %-10s %9s  %s" % ("Name", "Outcome", "Seconds", "Error")]
+    lines.append("-" * 70)
+    for r in sorted(results, key=lambda r: r.seconds or 0):
+        lines.append("%-30s %-10s %9.2f  %s" %
+                     (r.name[:30], r.outcome, r.seconds or 0.0, r.error or ""))
+    return lines
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Shut down all running VMs before a host power-off")
+    parser.add_argument("--uri", default="qemu:///system")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="Seconds per VM before escalating")
+    parser.add_argument("--escalate", choices=[ESCALATE_DESTROY, ESCALATE_SAVE],
+                        default=ESCALATE_DESTROY)
+    parser.add_argument("--mode", choices=sorted(SHUTDOWN_MODES),
+                        default='default')
+    args = parser.parse_args(argv)
+
+    vm_events.start_event_loop()
+    try:
+        conn = vm_instrument.instrument(libvirt.open(args.uri))
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        return 1
+
+    coordinator = ShutdownCoordinator(conn, args.timeout, args.escalate,
+                                      args.mode, host=conn.getHostname())
+    start = time.time()
+    results = coordinator.run()
+    for line in format_results(results):
+        print(line)
+    print("\n%d VMs stopped in %.1f s" % (len(results), time.time() - start))
+    conn.close()
+    return 1 if any(r.outcome == 'failed' for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
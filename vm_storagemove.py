@@ -0,0 +1,558 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Live Storage Migration
+----------------------
+Move VM disks between directories or storage pools, live
+
+Running domains are moved with blockCopy: the disk is mirrored to the
+new location (at a limited bandwidth), and once the job reports ready
+(block job event, or the "ready" field of blockJobInfo) the domain
+pivots to the copy without a pause. Progress is read from
+blockJobInfo. The persistent definition is updated to the new path.
+Stopped domains are copied with qemu-img at idle I/O priority.
+
+The old image is kept unless asked otherwise, so a move can be undone
+by hand.
+
+The rebalancer samples per-disk I/O (bulk block stats) and proposes
+moving the busiest disks from overloaded locations to the least loaded
+ones that have room, then runs the moves with a concurrency cap.
+
+A location is a directory ("/mnt/ssd1/images") or the name of a libvirt
+storage pool of type dir.
+
+Examples:
+    python vm_storagemove.py move web1 /mnt/ssd1/images --bandwidth 100
+    python vm_storagemove.py rebalance default ssd1 ssd2 --apply
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from multiprocessing.pool import ThreadPool
+
+import libvirt
+
+import vm_diskmaint
+import vm_domxml
+import vm_events
+import vm_instrument
+import vm_jobs
+import vm_oplog
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+# Default copy bandwidth in MB/s (0 = unlimited)
+BANDWIDTH_MBPS = 100
+MOVE_WORKERS = 2
+POLL_INTERVAL = 1.0
+
+SAMPLE_INTERVAL = 10.0
+# Locations above the mean load by this fraction are relieved
+REBALANCE_TOLERANCE = 0.2
+MAX_MOVES = 10
+# Free space left at a destination after a move (fraction of its size)
+SPACE_RESERVE = 0.1
+
+BLOCK_COPY_BANDWIDTH = 'bandwidth'
+COPY_FLAGS = (libvirt.VIR_DOMAIN_BLOCK_COPY_TRANSIENT_JOB
+              if hasattr(libvirt, 'VIR_DOMAIN_BLOCK_COPY_TRANSIENT_JOB') else 4)
+ABORT_PIVOT = getattr(libvirt, 'VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT', 2)
+JOB_READY = getattr(libvirt, 'VIR_DOMAIN_BLOCK_JOB_READY', 3)
+
+# =============================================================================
+# LOCATIONS
+# =============================================================================
+
+def resolve_location(conn, location):
+    """
+    Return the directory of a location
+
+    Args:
+        conn: libvirt connection
+        location: Directory path or storage pool name
+
+    Returns:
+        Directory path
+
+    Raises:
+        libvirt.libvirtError: Unknown pool
+        ValueError: The pool has no target directory
+    """
+    if location.startswith('/'):
+        return location.rstrip('/') or '/'
+    pool = conn.storagePoolLookupByName(location)
+    path = ET.fromstring(pool.XMLDesc(0)).findtext('./target/path')
+    if not path:
+        raise ValueError("pool %s has no target directory" % location)
+    return path
+
+
+def free_bytes(directory):
+    """Return the bytes available to unprivileged files in a directory"""
+    st = os.statvfs(directory)
+    return st.f_bavail * st.f_frsize
+
+
+# =============================================================================
+# MOVING ONE DISK
+# =============================================================================
+
+class MoveResult(object):
+    """Outcome of moving one disk"""
+
+    def __init__(self, name, target, source, destination):
+        self.name = name
+        self.target = target
+        self.source = source
+        self.destination = destination
+        self.outcome = None      # moved, failed or cancelled
+        self.bytes = 0
+        self.seconds = None
+        self.error = None
+
+
+def _disk_xml(path, fmt):
+    return ("<disk type='file' device='disk'><driver type='%s'/>"
+            "<source file='%s'/></disk>" % (fmt or 'qcow2', path))
+
+
+def _repoint_definition(conn, dom, old_path, new_path):
+    """Change a disk path in the persistent definition of a domain"""
+    if not dom.isPersistent():
+        return
+    root = ET.fromstring(dom.XMLDesc(
+        libvirt.VIR_DOMAIN_XML_INACTIVE | libvirt.VIR_DOMAIN_XML_SECURE))
+    for source in root.findall('./devices/disk/source'):
+        if source.get('file') == old_path:
+            source.set('file', new_path)
+    conn.defineXML(ET.tostring(root).decode('utf-8'))
+
+
+def move_disk(conn, dom, target, directory, bandwidth_mbps=BANDWIDTH_MBPS,
+              delete_source=False, progress=None, host=None, cancel=None):
+    """
+    Move one disk of a domain into a directory
+
+    Args:
+        conn: libvirt connection
+        dom: libvirt domain
+        target: Disk target (vda, ...)
+        directory: Destination directory
+        bandwidth_mbps: Copy bandwidth in MB/s for running domains
+        delete_source: Remove the old image after a successful move
+        progress: Optional callable(result, copied_bytes, total_bytes)
+        host: Hypervisor hostname for operation events
+        cancel: Optional threading.Event that aborts the copy
+
+    Returns:
+        MoveResult
+    """
+    disk = dict((d['target'], d) for d in vm_domxml.disks(dom.XMLDesc(0))).get(target)
+    source = disk['source'] if disk else None
+    destination = os.path.join(directory, os.path.basename(source or target))
+    result = MoveResult(dom.name(), target, source, destination)
+    if not source:
+        result.outcome = 'failed'
+        result.error = "no file-backed disk %s" % target
+        return result
+    start = time.time()
+    try:
+        if os.path.abspath(source) == os.path.abspath(destination):
+            raise ValueError("already in %s" % directory)
+        if os.path.exists(destination):
+            raise ValueError("%s already exists" % destination)
+        with vm_oplog.operation('storage_move', dom, host, disk=target,
+                                source=source, destination=destination):
+            if dom.isActive():
+                _copy_live(conn, dom, target, destination, disk['format'],
+                           bandwidth_mbps, result, progress, cancel,
+                           vm_jobs.get_supervisor(conn, host))
+            else:
+                _copy_offline(source, destination, disk['format'])
+            _repoint_definition(conn, dom, source, destination)
+        result.outcome = 'moved'
+        if delete_source:
+            os.remove(source)
+    except (libvirt.libvirtError, OSError, ValueError) as e:
+        result.outcome = 'cancelled' if cancel and cancel.is_set() else 'failed'
+        result.error = str(e)
+    result.seconds = round(time.time() - start, 3)
+    return result
+
+
+def _copy_live(conn, dom, target, destination, fmt, bandwidth_mbps, result,
+               progress, cancel, supervisor):
+    """
+    Mirror a disk with blockCopy, wait until the job is ready and pivot
+
+    cur == end in blockJobInfo does not mean the mirror is ready: pivoting
+    before the ready state fails. Readiness comes from the block job
+    event when the event loop runs, otherwise from the "ready" field of
+    blockJobInfo. When neither is available (event loop not started,
+    older libvirt), the pivot is attempted once the copy is in sync and
+    retried on later polls while libvirt rejects it.
+
+    The copy is registered with the job supervisor, which aborts it when
+    it runs past the "storage_move" timeout.
+    """
+    ready = threading.Event()
+    uuid = dom.UUIDString()
+
+    def on_block_job(event_dom, disk, job_type, status):
+        if status == JOB_READY and disk == target and \
+                event_dom.UUIDString() == uuid:
+            ready.set()
+
+    dispatcher = vm_events.get_dispatcher(conn)
+    token = None
+    if dispatcher is not None:
+        try:
+            token = dispatcher.subscribe(
+                libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2, on_block_job)
+        except libvirt.libvirtError:
+            pass
+
+    params = {}
+    if bandwidth_mbps:
+        params[BLOCK_COPY_BANDWIDTH] = int(bandwidth_mbps * 1024 * 1024)
+    try:
+        _mirror(dom, target, destination, fmt, params, result, progress,
+                cancel, supervisor, ready)
+    finally:
+        if token is not None:
+            dispatcher.unsubscribe(token)
+
+
+def _mirror(dom, target, destination, fmt, params, result, progress, cancel,
+            supervisor, ready):
+    """Run the blockCopy job of _copy_live until it pivoted"""
+    dom.blockCopy(target, _disk_xml(destination, fmt), params, COPY_FLAGS)
+    job = supervisor.watch('storage_move', dom, target)
+    try:
+        while True:
+            info = dom.blockJobInfo(target, 0)
+            if not info:
+                if job.status != 'running':
+                    raise ValueError("copy job %s" % job.status)
+                raise libvirt.libvirtError("copy job of %s disappeared" % target)
+            result.bytes = info.get('cur', 0)
+            if progress:
+                progress(result, info.get('cur', 0), info.get('end', 0))
+            synced = info.get('end') and info['cur'] == info['end']
+            if ready.is_set() or info.get('ready'):
+                dom.blockJobAbort(target, ABORT_PIVOT)
+                break
+            if synced and 'ready' not in info:
+                # Ready state unknown yet: a premature pivot is rejected
+                try:
+                    dom.blockJobAbort(target, ABORT_PIVOT)
+                    break
+                except libvirt.libvirtError:
+                    pass
+            if cancel is not None and cancel.is_set():
+                raise ValueError("cancelled")
+            ready.wait(POLL_INTERVAL)
+    except Exception:
+        # Drop the mirror; the domain keeps using the original image
+        try:
+            dom.blockJobAbort(target, 0)
+        except libvirt.libvirtError:
+            pass
+        if os.path.exists(destination):
+            os.remove(destination)
+        raise
+
+
+def _copy_offline(source, destination, fmt):
+    """Copy an image of a stopped domain with qemu-img at idle priority"""
+    tmp = destination + '.tmp'
+    cmd = vm_diskmaint.NICE_PREFIX + ['qemu-img', 'convert', '-O', fmt or 'qcow2',
+                                      source, tmp]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    if proc.returncode != 0:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise OSError("qemu-img convert failed: %s" %
+                      err.decode('utf-8', 'replace').strip())
+    os.rename(tmp, destination)
+
+
+def move_domain(conn, dom, directory, **kwargs):
+    """
+    Move every file-backed hard disk of a domain (see move_disk)
+
+    Returns:
+        List of MoveResult
+    """
+    return [move_disk(conn, dom, d['target'], directory, **kwargs)
+            for d in vm_domxml.disks(dom.XMLDesc(0))
+            if d['device'] == 'disk' and d['source'] and
+            os.path.dirname(d['source']) != directory]
+
+
+def run_moves(conn, moves, workers=MOVE_WORKERS, **kwargs):
+    """
+    Run planned moves with at most workers copies at once
+
+    Args:
+        conn: libvirt connection
+        moves: List of (domain name, target, directory)
+        workers: Concurrency cap
+        **kwargs: Passed to move_disk
+
+    Returns:
+        List of MoveResult in input order
+    """
+    def run(move):
+        name, target, directory = move
+        try:
+            dom = conn.lookupByName(name)
+        except libvirt.libvirtError as e:
+            result = MoveResult(name, target, None, directory)
+            result.outcome = 'failed'
+            result.error = str(e)
+            return result
+        return move_disk(conn, dom, target, directory, **kwargs)
+
+    if not moves:
+        return []
+    pool = ThreadPool(min(workers, len(moves)))
+    try:
+        return pool.map(run, moves)
+    finally:
+        pool.close()
+
+
+# =============================================================================
+# REBALANCER
+# =============================================================================
+
+def sample_disk_io(conn, interval=SAMPLE_INTERVAL):
+    """
+    Measure per-disk I/O of running domains
+
+    Args:
+        conn: libvirt connection
+        interval: Seconds between the two samples
+
+    Returns:
+        List of dicts with name, target, path, iops, bytes_per_s and
+        physical (image size on the host)
+    """
+    def read():
+        disks = {}
+        for dom, values in conn.getAllDomainStats(
+                libvirt.VIR_DOMAIN_STATS_BLOCK,
+                libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_RUNNING):
+            for i in range(values.get('block.count', 0)):
+                prefix = 'block.%d.' % i
+                path = values.get(prefix + 'path')
+                if not path:
+                    continue
+                disks[(dom.name(), values.get(prefix + 'name'))] = {
+                    'path': path,
+                    'reqs': values.get(prefix + 'rd.reqs', 0) +
+                            values.get(prefix + 'wr.reqs', 0),
+                    'bytes': values.get(prefix + 'rd.bytes', 0) +
+                             values.get(prefix + 'wr.bytes', 0),
+                    'physical': values.get(prefix + 'physical',
+                                           values.get(prefix + 'allocation', 0)),
+                }
+        return disks
+
+    before = read()
+    start = time.time()
+    time.sleep(interval)
+    after = read()
+    elapsed = max(time.time() - start, 1e-6)
+
+    samples = []
+    for key, cur in after.items():
+        prev = before.get(key)
+        if prev is None:
+            continue
+        samples.append({
+            'name': key[0],
+            'target': key[1],
+            'path': cur['path'],
+            'iops': round(max(0, cur['reqs'] - prev['reqs']) / elapsed, 1),
+            'bytes_per_s': max(0, cur['bytes'] - prev['bytes']) / elapsed,
+            'physical': cur['physical'],
+        })
+    return samples
+
+
+def plan_rebalance(samples, directories, free=None,
+                   tolerance=REBALANCE_TOLERANCE, max_moves=MAX_MOVES):
+    """
+    Propose disk moves that even out IOPS across locations
+
+    Each step takes the busiest location above mean * (1 + tolerance)
+    and moves the disk whose IOPS is closest to half the gap to the
+    least loaded location with enough free space.
+
+    Args:
+        samples: Output of sample_disk_io()
+        directories: Candidate location directories
+        free: Dict of directory -> free bytes (default: statvfs)
+        tolerance: Allowed load above the mean
+        max_moves: Upper bound on moves
+
+    Returns:
+        List of (sample, source directory, destination directory)
+    """
+    directories = list(directories)
+    if free is None:
+        free = dict((d, free_bytes(d)) for d in directories)
+    else:
+        free = dict(free)
+    load = dict.fromkeys(directories, 0.0)
+    disks = dict((d, []) for d in directories)
+    for s in samples:
+        location = os.path.dirname(s['path'])
+        if location in load:
+            load[location] += s['iops']
+            disks[location].append(s)
+
+    mean = sum(load.values()) / len(load) if load else 0.0
+    moves = []
+    moved = set()
+    while len(moves) < max_moves and len(load) > 1:
+        busiest = max(load, key=load.get)
+        if load[busiest] <= mean * (1 + tolerance):
+            break
+        best = None
+        for s in disks[busiest]:
+            if (s['name'], s['target']) in moved or s['iops'] <= 0:
+                continue
+            for dest in sorted(load, key=load.get):
+                if dest == busiest:
+                    continue
+                gap = load[busiest] - load[dest]
+                if s['iops'] >= gap:
+                    continue
+                if free[dest] - s['physical'] < SPACE_RESERVE * s['physical']:
+                    continue
+                score = abs(s['iops'] - gap / 2.0)
+                if best is None or score < best[0]:
+                    best = (score, s, dest)
+                break
+        if best is None:
+            break
+        _, s, dest = best
+        disks[busiest].remove(s)
+        disks[dest].append(s)
+        load[busiest] -= s['iops']
+        load[dest] += s['iops']
+        free[dest] -= s['physical']
+        moved.add((s['name'], s['target']))
+        moves.append((s, busiest, dest))
+    return moves
+
+
+def format_results(results):
+    """
+    Format move results as a text table
+
+    Returns:
+        List of lines
+    """
+    lines = ["%-24s %-5s %-10s %9s  %s" % ("Name", "Disk", "Outcome",
+                                           "Seconds", "Destination / error")]
+    lines.append("-" * 80)
+    for r in results:
+        lines.append("%-24s %-5s %-10s %9.1f  %s" % (
+            r.name[:24], r.target, r.outcome, r.seconds or 0.0,
+            r.error or r.destination))
+    return lines
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def _print_progress(result, cur, end):
+    if end:
+        sys.stdout.write("\r  %-24s %-5s %5.1f%%" %
+                         (result.name[:24], result.target, 100.0 * cur / end))
+        sys.stdout.flush()
+
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Move VM disks, live")
+    sub = parser.add_subparsers(dest="action")
+    move = sub.add_parser("move", help="Move the disks of one VM")
+    move.add_argument("name")
+    move.add_argument("location", help="Directory or storage pool")
+    move.add_argument("--disk", help="Only this disk target (vda, ...)")
+    move.add_argument("--delete-source", action="store_true")
+    rebalance = sub.add_parser("rebalance", help="Spread disk I/O")
+    rebalance.add_argument("locations", nargs="+",
+                           help="Directories or storage pools to balance")
+    rebalance.add_argument("--interval", type=float, default=SAMPLE_INTERVAL)
+    rebalance.add_argument("--apply", action="store_true")
+    for p in (move, rebalance):
+        p.add_argument("--uri", default="qemu:///system")
+        p.add_argument("--bandwidth", type=float, default=BANDWIDTH_MBPS,
+                       help="Copy bandwidth in MB/s (0 = unlimited)")
+        p.add_argument("--workers", type=int, default=MOVE_WORKERS)
+    args = parser.parse_args(argv)
+
+    try:
+        conn = vm_instrument.instrument(libvirt.open(args.uri))
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        return 1
+
+    host = conn.getHostname()
+    try:
+        if args.action == "move":
+            directory = resolve_location(conn, args.location)
+            dom = conn.lookupByName(args.name)
+            kwargs = dict(bandwidth_mbps=args.bandwidth, host=host,
+                          delete_source=args.delete_source,
+                          progress=_print_progress)
+            if args.disk:
+                results = [move_disk(conn, dom, args.disk, directory, **kwargs)]
+            else:
+                results = move_domain(conn, dom, directory, **kwargs)
+        else:
+            directories = [resolve_location(conn, l) for l in args.locations]
+            print("Sampling disk I/O for %.0f s..." % args.interval)
+            moves = plan_rebalance(sample_disk_io(conn, args.interval),
+                                   directories)
+            if not moves:
+                print("Locations are balanced")
+                return 0
+            for s, src, dest in moves:
+                print("  %-24s %-5s %8.0f IOPS  %s -> %s" %
+                      (s['name'][:24], s['target'], s['iops'], src, dest))
+            if not args.apply:
+                return 0
+            results = run_moves(conn, [(s['name'], s['target'], dest)
+                                       for s, _, dest in moves],
+                                args.workers, bandwidth_mbps=args.bandwidth,
+                                host=host)
+        print("")
+        for line in format_results(results):
+            print(line)
+        return 1 if any(r.outcome != 'moved' for r in results) else 0
+    except (libvirt.libvirtError, ValueError, KeyError) as e:
+        print("Error: %s" % e)
+        return 1
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+"""
+Full-Screen Interface
+---------------------
+curses interface over the cached domain inventory
+
+The VM table is drawn from vm_inventory and only the lines whose row
+changed are rewritten, so nothing flickers and little is sent over slow
+links. Actions run in worker threads; the table keeps updating while
+they are in flight and their outcome appears in the status line.
+
+Keys:
+    Up/Down j/k PgUp/PgDn Home/End   move the selection
+    s start    S shut down    F force off    p pause    r resume
+    D delete   / filter       R refresh now  q quit
+    m classic menu (create, console, IP, fleet and tuning screens)
+
+The table is first drawn from the inventory snapshot of the previous
+run while the connection is opened in the background; the first refresh
+then reconciles it.
+
+The classic numbered menu is still available with --classic, or from
+inside the interface with "m": curses is suspended while it runs, and
+leaving it with "q" returns to the table.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import curses
+except ImportError:
+    curses = None
+
+import libvirt
+
+import vm_inventory
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+ACTION_WORKERS = 4
+INPUT_TIMEOUT_MS = 200
+
+ROW_FORMAT = "%-30s %-14s %5s %9s %6s  %s"
+
+HELP = ("s start  S shutdown  F force off  p pause  r resume  "
+        "D delete  / filter  R refresh  m menu  q quit")
+
+# When set, startup timestamps are written here and the interface exits
+# as soon as the inventory is reconciled (used by vm_bench.py --startup)
+STARTUP_REPORT = os.environ.get('VM_MANAGER_STARTUP_REPORT')
+
+_startup_marks = {}
+
+
+def mark(name):
+    """Record the first time a startup milestone is reached"""
+    _startup_marks.setdefault(name, time.time())
+
+
+def available():
+    """Return True when the full-screen interface can run"""
+    return curses is not None and sys.stdout.isatty()
+
+
+# =============================================================================
+# BACKGROUND ACTIONS
+# =============================================================================
+
+class ActionRunner(object):
+    """Run VM actions in worker threads and collect their outcomes"""
+
+    def __init__(self, workers=ACTION_WORKERS):
+        self.busy = {}
+        self._pool = ThreadPool(workers)
+        self._done = queue.Queue()
+        self._lock = threading.Lock()
+
+    def submit(self, name, label, func, *args):
+        """
+        Queue an action on a VM
+
+        Args:
+            name: VM name (one action per VM at a time)
+            label: Text shown while the action runs
+            func: Callable doing the work
+
+        Returns:
+            False when the VM already has an action in flight
+        """
+        with self._lock:
+            if name in self.busy:
+                return False
+            self.busy[name] = label
+
+        def run():
+            # Reported when func raises something unexpected
+            error = "unexpected error"
+            try:
+                func(*args)
+                error = None
+            except (libvirt.libvirtError, OSError) as e:
+                error = str(e)
+            finally:
+                with self._lock:
+                    self.busy.pop(name, None)
+                self._done.put((name, label, error))
+
+        self._pool.apply_async(run)
+        return True
+
+    def completed(self):
+        """Return (name, label, error) for every action finished since last call"""
+        done = []
+        while True:
+            try:
+                done.append(self._done.get_nowait())
+            except queue.Empty:
+                return done
+
+    def label(self, name):
+        """Return the running action of a VM, or None"""
+        with self._lock:
+            return self.busy.get(name)
+
+    def close(self):
+        """Stop accepting actions; running ones finish in the background"""
+        self._pool.close()
+
+
+# =============================================================================
+# SCREEN
+# =============================================================================
+
+class App(object):
+    """VM table with keyboard selection and background actions"""
+
+    def __init__(self, stdscr, manager, inventory, runner, menu=None):
+        self.stdscr = stdscr
+        self.manager = manager
+        self.inventory = inventory
+        self.runner = runner
+        self.menu = menu
+        self.selected = 0
+        self.top = 0
+        self.filter = ""
+        self.message = "Connecting..."
+        self._drawn = {}
+        self._rows = []
+
+        self.colors = {}
+        if curses.has_colors():
+            curses.start_color()
+            try:
+                curses.use_default_colors()
+                background = -1
+            except curses.error:
+                background = curses.COLOR_BLACK
+            for pair, color in enumerate((curses.COLOR_GREEN, curses.COLOR_YELLOW,
+                                          curses.COLOR_RED, curses.COLOR_CYAN), 1):
+                curses.init_pair(pair, color, background)
+            self.colors = {
+                libvirt.VIR_DOMAIN_RUNNING: curses.color_pair(1),
+                libvirt.VIR_DOMAIN_PAUSED: curses.color_pair(2),
+                libvirt.VIR_DOMAIN_SHUTDOWN: curses.color_pair(2),
+                libvirt.VIR_DOMAIN_CRASHED: curses.color_pair(3),
+                'header': curses.color_pair(4) | curses.A_BOLD,
+            }
+        try:
+            curses.curs_set(0)
+        except curses.error:
+            pass
+        stdscr.timeout(INPUT_TIMEOUT_MS)
+        stdscr.keypad(1)
+
+    # -------------------------------------------------------------------------
+    # DRAWING
+    # -------------------------------------------------------------------------
+
+    def _line(self, y, key, text, attr=0):
+        """Rewrite one screen line if its content key changed"""
+        if self._drawn.get(y) == key:
+            return
+        height, width = self.stdscr.getmaxyx()
+        try:
+            self.stdscr.move(y, 0)
+            self.stdscr.clrtoeol()
+            self.stdscr.addnstr(y, 0, text, width - 1, attr)
+        except curses.error:
+            pass
+        self._drawn[y] = key
+
+    def draw(self):
+        """Update the parts of the screen that changed"""
+        height, width = self.stdscr.getmaxyx()
+        table_height = max(height - 4, 1)
+        rows = self._rows
+
+        self.selected = max(0, min(self.selected, len(rows) - 1))
+        if self.selected < self.top:
+            self.top = self.selected
+        elif self.selected >= self.top + table_height:
+            self.top = self.selected - table_height + 1
+
+        running = sum(1 for r in rows if r.state == libvirt.VIR_DOMAIN_RUNNING)
+        cached = ""
+        if self.inventory.refreshed_at is None and self.inventory.snapshot_at:
+            cached = "   (cached %s)" % time.strftime(
+                "%H:%M", time.localtime(self.inventory.snapshot_at))
+        header = " KVM Virtual Machine Manager - %s   %d VMs, %d running%s%s" % (
+            self.manager.hostname or self.inventory.host or "...", len(rows),
+            running, "   filter: %s" % self.filter if self.filter else "", cached)
+        self._line(0, header, header, self.colors.get('header', curses.A_BOLD))
+        columns = ROW_FORMAT % ("Name", "State", "vCPUs", "Memory MB", "CPU %", "")
+        self._line(1, columns, columns, curses.A_UNDERLINE)
+
+        for i in range(table_height):
+            index = self.top + i
+            if index >= len(rows):
+                self._line(2 + i, None, "")
+                continue
+            row = rows[index]
+            busy = self.runner.label(row.name)
+            selected = index == self.selected
+            key = (row.uuid, row.version, selected, busy)
+            text = ROW_FORMAT % (
+                row.name[:30], self.manager.get_vm_state(row.state),
+                row.vcpus, row.memory_mb,
+                "%.0f" % row.cpu_pct if row.cpu_pct is not None else "-",
+                (busy + "...") if busy else "")
+            attr = self.colors.get(row.state, 0)
+            if selected:
+                attr |= curses.A_REVERSE
+            self._line(2 + i, key, text, attr)
+
+        self._line(height - 2, ('msg', self.message), " " + self.message)
+        self._line(height - 1, ('help', HELP), " " + HELP, curses.A_DIM)
+        self.stdscr.noutrefresh()
+        curses.doupdate()
+
+    def reset(self):
+        """Forget what is on screen so everything is redrawn"""
+        self._drawn = {}
+        self.stdscr.erase()
+
+    # -------------------------------------------------------------------------
+    # INPUT
+    # -------------------------------------------------------------------------
+
+    def prompt(self, text):
+        """Read a line of text on the status line"""
+        height, width = self.stdscr.getmaxyx()
+        self.stdscr.move(height - 2, 0)
+        self.stdscr.clrtoeol()
+        self.stdscr.addnstr(height - 2, 0, " " + text, width - 1, curses.A_BOLD)
+        curses.echo()
+        try:
+            curses.curs_set(1)
+        except curses.error:
+            pass
+        self.stdscr.timeout(-1)
+        try:
+            raw = self.stdscr.getstr(height - 2, min(len(text) + 1, width - 1), 60)
+        finally:
+            curses.noecho()
+            try:
+                curses.curs_set(0)
+            except curses.error:
+                pass
+            self.stdscr.timeout(INPUT_TIMEOUT_MS)
+            self._drawn.pop(height - 2, None)
+        if not isinstance(raw, str):
+            raw = raw.decode('utf-8', 'replace')
+        return raw.strip()
+
+    def current(self):
+        """Return the selected row, or None"""
+        if 0 <= self.selected < len(self._rows):
+            return self._rows[self.selected]
+        return None
+
+    def act(self, row, label, method, allowed, *args):
+        """Queue a VM action if the VM is in one of the allowed states"""
+        if row.state not in allowed:
+            self.message = "'%s' is %s" % (row.name,
+                                           self.manager.get_vm_state(row.state).lower())
+            return
+        conn = self.manager.conn
+        if conn is None:
+            self.message = "Not connected yet"
+            return
+
+        def work():
+            method(conn.lookupByUUIDString(row.uuid), *args)
+
+        if self.runner.submit(row.name, label, work):
+            self.message = "%s '%s'..." % (label.capitalize(), row.name)
+        else:
+            self.message = "'%s' is busy" % row.name
+
+    def classic(self):
+        """Suspend curses, run the classic menu and resume"""
+        if self.menu is None:
+            self.message = "Classic menu not available"
+            return
+        if not self.manager.connected:
+            self.message = "Not connected yet"
+            return
+        curses.def_prog_mode()
+        curses.endwin()
+        try:
+            self.menu()
+        finally:
+            curses.reset_prog_mode()
+            self.stdscr.clear()
+            self.reset()
+            self.inventory.invalidate()
+        self.message = "Back from the classic menu"
+
+    def handle(self, key):
+        """
+        Handle one key press
+
+        Returns:
+            False to quit
+        """
+        height = self.stdscr.getmaxyx()[0]
+        page = max(height - 5, 1)
+        row = self.current()
+        running = (libvirt.VIR_DOMAIN_RUNNING,)
+        stopped = (libvirt.VIR_DOMAIN_SHUTOFF, libvirt.VIR_DOMAIN_CRASHED)
+
+        if key in (ord('q'), ord('Q')):
+            return False
+        elif key in (curses.KEY_DOWN, ord('j')):
+            self.selected += 1
+        elif key in (curses.KEY_UP, ord('k')):
+            self.selected -= 1
+        elif key == curses.KEY_NPAGE:
+            self.selected += page
+        elif key == curses.KEY_PPAGE:
+            self.selected -= page
+        elif key == curses.KEY_HOME:
+            self.selected = 0
+        elif key == curses.KEY_END:
+            self.selected = len(self._rows) - 1
+        elif key == curses.KEY_RESIZE:
+            self.reset()
+        elif key == ord('/'):
+            self.filter = self.prompt("Filter: ")
+            self.selected = 0
+            self.reset()
+        elif key == ord('R'):
+            self.inventory.invalidate()
+            self.message = "Refreshing..."
+        elif key == ord('m'):
+            self.classic()
+        elif row is None:
+            return True
+        elif key == ord('s'):
+            self.act(row, "start", self.manager.start_domain, stopped)
+        elif key == ord('S'):
+            self.act(row, "shutdown", self.manager.shutdown_domain, running)
+        elif key == ord('F'):
+            if self.prompt("Force off '%s'? (y/N): " % row.name).lower() == "y":
+                self.act(row, "force off", self.manager.destroy_domain,
+                         running + (libvirt.VIR_DOMAIN_PAUSED,))
+        elif key == ord('p'):
+            self.act(row, "pause", self.manager.suspend_domain, running)
+        elif key == ord('r'):
+            self.act(row, "resume", self.manager.resume_domain,
+                     (libvirt.VIR_DOMAIN_PAUSED,))
+        elif key == ord('D'):
+            if self.prompt("Type '%s' to delete it: " % row.name) != row.name:
+                self.message = "Deletion cancelled"
+            else:
+                disks = self.prompt("Delete its disk files too? (y/N): ").lower() == "y"
+                self.act(row, "delete", self.manager.delete_domain, stopped, disks)
+        return True
+
+    def run(self, errors):
+        """
+        Main loop: collect finished actions, redraw, handle a key
+
+        Args:
+            errors: Queue of connection errors from the background connect
+        """
+        while True:
+            try:
+                self.message = "Connection failed: %s" % errors.get_nowait()
+            except queue.Empty:
+                pass
+            if self.manager.connected and self.message == "Connecting...":
+                self.message = "Connected to %s" % self.manager.hostname
+            for name, label, error in self.runner.completed():
+                if error:
+                    self.message = "%s '%s' failed: %s" % (label.capitalize(),
+                                                           name, error)
+                else:
+                    self.message = "%s '%s' done" % (label.capitalize(), name)
+                self.inventory.invalidate()
+            self._rows = [r for r in self.inventory.rows()
+                          if self.filter in r.name]
+            self.draw()
+            mark('first_render')
+            if self.inventory.refreshed_at is not None:
+                mark('reconciled')
+                if STARTUP_REPORT:
+                    _write_startup_report()
+                    return
+            key = self.stdscr.getch()
+            if key != -1 and not self.handle(key):
+                return
+
+
+def _write_startup_report():
+    """Write the startup milestones to STARTUP_REPORT"""
+    with open(STARTUP_REPORT, 'w') as f:
+        json.dump(_startup_marks, f)
+
+
+def _connect(manager, inventory, uri, errors):
+    """Open the connection and start reconciling the inventory"""
+    try:
+        manager.open_connection(uri)
+    except libvirt.libvirtError as e:
+        errors.put(str(e))
+        return
+    mark('connected')
+    inventory.attach(manager.conn)
+    inventory.start()
+
+
+def _main(stdscr, manager, uri, menu):
+    inventory = vm_inventory.Inventory(snapshot_path=vm_inventory.SNAPSHOT_FILE)
+    inventory.load_snapshot()
+    runner = ActionRunner()
+    errors = queue.Queue()
+    app = App(stdscr, manager, inventory, runner, menu)
+    app.draw()
+    mark('first_render')
+
+    thread = threading.Thread(target=_connect, name="connect",
+                              args=(manager, inventory, uri, errors))
+    thread.daemon = True
+    thread.start()
+    try:
+        app.run(errors)
+    finally:
+        inventory.stop()
+        runner.close()
+
+
+def run(manager, uri="qemu:///system", menu=None):
+    """
+    Run the full-screen interface until the user quits
+
+    The window appears before the connection is made; the manager is
+    connected in the background.
+
+    Args:
+        manager: Unconnected VMManager
+        uri: libvirt connection URI
+        menu: Optional callable running the classic menu on the terminal
+            until the user leaves it ("m" key)
+    """
+    curses.wrapper(_main, manager, uri, menu)
@@ -0,0 +1,494 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Domain Event Stream
+-------------------
+Tail every domain event and fan it out to local subscribers
+
+The stream subscribes to all domain event IDs this libvirt knows
+(lifecycle, reboot, I/O error, block job, balloon change, agent
+lifecycle, ...) and turns each event into a flat record:
+
+    {"ts": 1792358021.93, "event": "lifecycle", "domain": "web1",
+     "uuid": "...", "type": "STOPPED", "detail": "SHUTDOWN"}
+
+Records go to any number of sinks: the console, files they are appended
+to as JSON lines, and clients of a Unix socket. Every sink has its own
+bounded queue and delivery thread. The libvirt callback only puts the
+record on each queue without blocking; when a queue is full the record
+is dropped for that sink and counted, so a slow consumer never stalls
+the event loop or the other sinks.
+
+Examples:
+    python vm_watch.py
+    python vm_watch.py --file /var/log/vm_events.jsonl --socket /run/vm_events.sock
+    socat - UNIX-CONNECT:/run/vm_events.sock
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import libvirt
+
+import vm_events
+import vm_instrument
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+QUEUE_SIZE = 1000
+SOCKET_BACKLOG = 8
+# Seconds a socket client may block a send before it is disconnected
+CLIENT_SEND_TIMEOUT = 5.0
+
+# Event ID suffix -> (record name, payload field names)
+EVENTS = (
+    ('LIFECYCLE', 'lifecycle', ('type', 'detail')),
+    ('REBOOT', 'reboot', ()),
+    ('RTC_CHANGE', 'rtc_change', ('utc_offset',)),
+    ('WATCHDOG', 'watchdog', ('action',)),
+    ('IO_ERROR', 'io_error', ('path', 'alias', 'action')),
+    ('IO_ERROR_REASON', 'io_error_reason', ('path', 'alias', 'action', 'reason')),
+    ('GRAPHICS', 'graphics', ('phase', 'local', 'remote', 'auth', 'subject')),
+    ('CONTROL_ERROR', 'control_error', ()),
+    ('BLOCK_JOB', 'block_job', ('disk', 'type', 'status')),
+    ('BLOCK_JOB_2', 'block_job_2', ('disk', 'type', 'status')),
+    ('DISK_CHANGE', 'disk_change', ('old_path', 'new_path', 'alias', 'reason')),
+    ('TRAY_CHANGE', 'tray_change', ('alias', 'reason')),
+    ('PMWAKEUP', 'pm_wakeup', ('reason',)),
+    ('PMSUSPEND', 'pm_suspend', ('reason',)),
+    ('PMSUSPEND_DISK', 'pm_suspend_disk', ('reason',)),
+    ('BALLOON_CHANGE', 'balloon_change', ('actual_kb',)),
+    ('DEVICE_REMOVED', 'device_removed', ('alias',)),
+    ('DEVICE_ADDED', 'device_added', ('alias',)),
+    ('DEVICE_REMOVAL_FAILED', 'device_removal_failed', ('alias',)),
+    ('TUNABLE', 'tunable', ('params',)),
+    ('AGENT_LIFECYCLE', 'agent_lifecycle', ('state', 'reason')),
+    ('MIGRATION_ITERATION', 'migration_iteration', ('iteration',)),
+    ('JOB_COMPLETED', 'job_completed', ('params',)),
+    ('METADATA_CHANGE', 'metadata_change', ('type', 'uri')),
+    ('BLOCK_THRESHOLD', 'block_threshold', ('disk', 'path', 'threshold',
+                                            'excess')),
+    ('MEMORY_FAILURE', 'memory_failure', ('recipient', 'action', 'flags')),
+    ('MEMORY_DEVICE_SIZE_CHANGE', 'memory_device_size_change',
+     ('alias', 'size')),
+)
+
+# Fields printed before the payload on the console
+_HEAD = ('ts', 'event', 'domain', 'uuid')
+
+
+def available_events():
+    """
+    Return the events this libvirt binding can deliver
+
+    Returns:
+        List of (event ID, record name, payload field names)
+    """
+    result = []
+    for suffix, name, fields in EVENTS:
+        event_id = getattr(libvirt, 'VIR_DOMAIN_EVENT_ID_' + suffix, None)
+        if event_id is not None:
+            result.append((event_id, name, fields))
+    return result
+
+
+def _constant_names(prefix, single_word=False):
+    """
+    Map the values of libvirt constants starting with prefix to names
+
+    Args:
+        prefix: Constant name prefix, stripped from the names
+        single_word: Only names without "_" after the prefix
+    """
+    names = {}
+    for attr in dir(libvirt):
+        name = attr[len(prefix):]
+        if not attr.startswith(prefix) or name == 'LAST' or \
+                name.endswith('_LAST') or (single_word and '_' in name):
+            continue
+        value = getattr(libvirt, attr)
+        if isinstance(value, int):
+            names[value] = name
+    return names
+
+
+_LIFECYCLE_TYPES = None
+_LIFECYCLE_DETAILS = {}
+
+
+def lifecycle_names(event, detail):
+    """Return the names of a lifecycle event and its detail code"""
+    global _LIFECYCLE_TYPES
+    if _LIFECYCLE_TYPES is None:
+        # Only the lifecycle types, not VIR_DOMAIN_EVENT_ID_* or details
+        _LIFECYCLE_TYPES = _constant_names('VIR_DOMAIN_EVENT_', True)
+    type_name = _LIFECYCLE_TYPES.get(event, str(event))
+    details = _LIFECYCLE_DETAILS.get(type_name)
+    if details is None:
+        details = _LIFECYCLE_DETAILS[type_name] = _constant_names(
+            'VIR_DOMAIN_EVENT_%s_' % type_name)
+    return type_name, details.get(detail, str(detail))
+
+
+def make_record(name, fields, dom, payload):
+    """
+    Build the record of one event
+
+    Args:
+        name: Record name from EVENTS
+        fields: Payload field names
+        dom: libvirt domain
+        payload: Event-specific callback arguments
+    """
+    record = {'ts': round(time.time(), 3), 'event': name,
+              'domain': dom.name(), 'uuid': dom.UUIDString()}
+    record.update(zip(fields, payload))
+    if name == 'lifecycle':
+        record['type'], record['detail'] = lifecycle_names(record['type'],
+                                                           record['detail'])
+    return record
+
+
+def format_line(record):
+    """Format a record as one "key=value" console line"""
+    ts = time.strftime("%H:%M:%S", time.localtime(record['ts']))
+    rest = " ".join("%s=%s" % (k, json.dumps(v) if isinstance(v, (dict, list))
+                                else v)
+                    for k, v in sorted(record.items()) if k not in _HEAD)
+    return "%s.%03d %-16s %-20s %s" % (ts, int(record['ts'] * 1000) % 1000,
+                                       record['event'], record['domain'], rest)
+
+
+# =============================================================================
+# SINKS
+# =============================================================================
+
+class Sink(object):
+    """
+    A subscriber with its own bounded queue and delivery thread
+
+    Subclasses implement write(record) and optionally close_output().
+    """
+
+    def __init__(self, name, size=QUEUE_SIZE):
+        self.name = name
+        self.queue = queue.Queue(size)
+        self.delivered = 0
+        self.dropped = 0
+        self.closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='event-sink-%s' % name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def offer(self, record):
+        """Queue a record without blocking; drop it when the queue is full"""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self.write(record)
+                self.delivered += 1
+            except (IOError, OSError, socket.error):
+                self.closed = True
+                break
+        self.close_output()
+
+    def write(self, record):
+        """Deliver one record"""
+        raise NotImplementedError
+
+    def close_output(self):
+        """Release the output once delivery has stopped"""
+
+    def close(self):
+        """Stop delivery after the queued records"""
+        try:
+            self.queue.put(None, timeout=1)
+        except queue.Full:
+            pass
+        self._thread.join(5)
+
+
+class ConsoleSink(Sink):
+    """Print records as key=value lines (or JSON lines)"""
+
+    def __init__(self, stream=None, as_json=False, size=QUEUE_SIZE):
+        self.stream = stream or sys.stdout
+        self.as_json = as_json
+        Sink.__init__(self, 'console', size)
+
+    def write(self, record):
+        self.stream.write((json.dumps(record, sort_keys=True) if self.as_json
+                           else format_line(record)) + "\n")
+        self.stream.flush()
+
+
+class FileSink(Sink):
+    """Append records to a file as JSON lines"""
+
+    def __init__(self, path, size=QUEUE_SIZE):
+        self.path = path
+        self.file = open(path, 'a')
+        Sink.__init__(self, 'file:%s' % path, size)
+
+    def write(self, record):
+        self.file.write(json.dumps(record, sort_keys=True) + "\n")
+        # Flush once the backlog is written, not after every record
+        if self.queue.empty():
+            self.file.flush()
+
+    def close_output(self):
+        self.file.close()
+
+
+class _ClientSink(Sink):
+    """One connected socket client"""
+
+    def __init__(self, conn, size=QUEUE_SIZE):
+        self.conn = conn
+        self.conn.settimeout(CLIENT_SEND_TIMEOUT)
+        Sink.__init__(self, 'client', size)
+
+    def write(self, record):
+        self.conn.sendall((json.dumps(record, sort_keys=True) + "\n")
+                          .encode('utf-8'))
+
+    def close_output(self):
+        try:
+            self.conn.close()
+        except socket.error:
+            pass
+
+
+class SocketSink(object):
+    """
+    Unix socket that streams JSON lines to every connected client
+
+    Each client gets its own queue, so a slow client only loses its own
+    records. Clients that stop reading for CLIENT_SEND_TIMEOUT are
+    disconnected.
+    """
+
+    def __init__(self, path, size=QUEUE_SIZE):
+        self.name = 'socket:%s' % path
+        self.path = path
+        self.size = size
+        self.closed = False
+        self._clients = []
+        # Counts of disconnected clients
+        self._delivered = 0
+        self._dropped = 0
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            os.remove(path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(SOCKET_BACKLOG)
+        self._thread = threading.Thread(target=self._accept,
+                                        name='event-socket')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except socket.error:
+                break
+            with self._lock:
+                self._clients.append(_ClientSink(conn, self.size))
+
+    @property
+    def delivered(self):
+        with self._lock:
+            return self._delivered + sum(c.delivered for c in self._clients)
+
+    @property
+    def dropped(self):
+        with self._lock:
+            return self._dropped + sum(c.dropped for c in self._clients)
+
+    def _forget(self, clients):
+        """Drop clients from the list, keeping their counts"""
+        for client in clients:
+            self._clients.remove(client)
+            self._delivered += client.delivered
+            self._dropped += client.dropped
+
+    def offer(self, record):
+        """Queue a record for every connected client"""
+        with self._lock:
+            self._forget([c for c in self._clients if c.closed])
+            clients = list(self._clients)
+        for client in clients:
+            client.offer(record)
+
+    def close(self):
+        """Disconnect all clients and remove the socket"""
+        self._server.close()
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.close()
+        with self._lock:
+            self._forget(clients)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# =============================================================================
+# STREAM
+# =============================================================================
+
+class EventStream(object):
+    """Subscribe to all domain events of a connection and feed the sinks"""
+
+    def __init__(self, conn, sinks=None):
+        """
+        Initialize the stream
+
+        Args:
+            conn: libvirt connection opened after start_event_loop()
+            sinks: Initial sinks
+        """
+        self.conn = conn
+        self.sinks = list(sinks or [])
+        self.counts = {}
+        self._tokens = []
+
+    def add_sink(self, sink):
+        """Start delivering to another sink"""
+        self.sinks = self.sinks + [sink]
+
+    def start(self):
+        """
+        Subscribe to every available event ID
+
+        Returns:
+            Number of event IDs subscribed
+
+        Raises:
+            RuntimeError: The event loop is not running
+        """
+        dispatcher = vm_events.get_dispatcher(self.conn)
+        if dispatcher is None:
+            raise RuntimeError("the libvirt event loop is not running")
+        for event_id, name, fields in available_events():
+            try:
+                self._tokens.append(dispatcher.subscribe(
+                    event_id, self._handler(name, fields)))
+            except libvirt.libvirtError:
+                pass        # not supported by this daemon
+        return len(self._tokens)
+
+    def _handler(self, name, fields):
+        """Build the subscriber of one event ID; runs in the event loop"""
+        def handle(dom, *payload):
+            record = make_record(name, fields, dom, payload)
+            self.counts[name] = self.counts.get(name, 0) + 1
+            for sink in self.sinks:
+                sink.offer(record)
+        return handle
+
+    def stop(self):
+        """Unsubscribe and flush and close every sink"""
+        dispatcher = vm_events.get_dispatcher(self.conn)
+        if dispatcher is not None:
+            for token in self._tokens:
+                dispatcher.unsubscribe(token)
+        self._tokens = []
+        for sink in self.sinks:
+            sink.close()
+
+    def format_stats(self):
+        """
+        Format per-sink delivery counts
+
+        Returns:
+            List of lines
+        """
+        lines = ["%-40s %10s %10s" % ("Sink", "Delivered", "Dropped")]
+        for sink in self.sinks:
+            lines.append("%-40s %10d %10d" % (sink.name[:40], sink.delivered,
+                                              sink.dropped))
+        return lines
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Print domain events as they happen and fan them out")
+    parser.add_argument("--uri", default="qemu:///system")
+    parser.add_argument("--json", action="store_true",
+                        help="Print JSON lines instead of key=value")
+    parser.add_argument("--quiet", action="store_true",
+                        help="Do not print events, only feed the sinks")
+    parser.add_argument("--file", action="append", default=[],
+                        help="Append events to this file (repeatable)")
+    parser.add_argument("--socket", help="Serve events on this Unix socket")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE)
+    args = parser.parse_args(argv)
+
+    vm_events.start_event_loop()
+    try:
+        conn = vm_instrument.instrument(libvirt.open(args.uri))
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        return 1
+
+    stream = EventStream(conn)
+    try:
+        if not args.quiet:
+            stream.add_sink(ConsoleSink(as_json=args.json, size=args.queue_size))
+        for path in args.file:
+            stream.add_sink(FileSink(path, args.queue_size))
+        if args.socket:
+            stream.add_sink(SocketSink(args.socket, args.queue_size))
+        subscribed = stream.start()
+    except (IOError, OSError, socket.error, RuntimeError) as e:
+        print("Error: %s" % e)
+        stream.stop()
+        conn.close()
+        return 1
+
+    sys.stderr.write("Watching %d event types on %s (Ctrl-C to stop)\n" %
+                     (subscribed, args.uri))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stream.stop()
+        conn.close()
+    for line in stream.format_stats():
+        sys.stderr.write(line + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
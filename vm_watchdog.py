@@ -0,0 +1,507 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Crash Watchdog
+--------------
+Restart crashed guests as soon as libvirt reports them
+
+The watchdog subscribes to lifecycle and watchdog-device events, so a
+crash is noticed when the event is delivered (milliseconds) rather than
+at the next poll. Recovery is triggered by:
+
+    CRASHED                      guest panic or QEMU crash
+    STOPPED (failed / crashed)   QEMU exited unexpectedly
+    WATCHDOG (any action but reset)
+                                 the guest stopped feeding its watchdog
+
+Recovery optionally takes a memory-only core dump first (while the
+crashed domain still exists), then destroys and starts the domain.
+Repeated crashes are restarted with exponential backoff; a domain that
+crashes more than max_restarts times within flap_window is left down
+until it is started by hand.
+
+Configuration ("watchdog" section of vm_manager.json):
+
+    "watchdog": {
+        "vms": ["*"],
+        "core_dump": ["db*"],
+        "dump_dir": "/var/lib/libvirt/qemu/dump",
+        "backoff_base": 5,
+        "backoff_max": 300,
+        "max_restarts": 5,
+        "flap_window": 600,
+        "stable_after": 300
+    }
+
+Example:
+    python vm_watchdog.py --uri qemu:///system
+"""
+
+import argparse
+import collections
+import heapq
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import libvirt
+
+import vm_config
+import vm_events
+import vm_instrument
+import vm_oplog
+
+# =============================================================================
+# CONFIGURATION
+# =============================================================================
+
+DUMP_DIR = '/var/lib/libvirt/qemu/dump'
+BACKOFF_BASE = 5
+BACKOFF_MAX = 300
+MAX_RESTARTS = 5
+FLAP_WINDOW = 600
+STABLE_AFTER = 300
+MAX_WORKERS = 8
+HISTORY_SIZE = 100
+
+# Watchdog device actions after which the guest is still hung or stopped;
+# VIR_DOMAIN_EVENT_WATCHDOG_RESET means QEMU already rebooted it
+WATCHDOG_ACTIONS = {
+    0: 'none',
+    1: 'pause',
+    2: 'reset',
+    3: 'poweroff',
+    4: 'shutdown',
+    5: 'debug',
+    6: 'inject-nmi',
+}
+WATCHDOG_RESET = 2
+
+# Memory-only ELF dump that leaves a crashed domain in place
+DUMP_FORMAT_RAW = 0
+DUMP_FLAGS = 1 | 16     # VIR_DUMP_CRASH | VIR_DUMP_MEMORY_ONLY
+
+STOPPED_FAILURES = (libvirt.VIR_DOMAIN_EVENT_STOPPED_CRASHED,
+                    libvirt.VIR_DOMAIN_EVENT_STOPPED_FAILED)
+
+
+def watchdog_config(config=None):
+    """Return the "watchdog" section with defaults filled in"""
+    cfg = vm_config.section('watchdog', config)
+    return {
+        'vms': list(cfg.get('vms', ['*'])),
+        'core_dump': list(cfg.get('core_dump', [])),
+        'dump_dir': cfg.get('dump_dir', DUMP_DIR),
+        'backoff_base': float(cfg.get('backoff_base', BACKOFF_BASE)),
+        'backoff_max': float(cfg.get('backoff_max', BACKOFF_MAX)),
+        'max_restarts': int(cfg.get('max_restarts', MAX_RESTARTS)),
+        'flap_window': float(cfg.get('flap_window', FLAP_WINDOW)),
+        'stable_after': float(cfg.get('stable_after', STABLE_AFTER)),
+    }
+
+
+def backoff(attempt, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    """
+    Return the delay before a restart
+
+    The first restart is immediate; each further one without the domain
+    staying up for stable_after doubles the delay, up to maximum.
+
+    Args:
+        attempt: Restarts already made in the current crash series
+        base: Delay of the second restart in seconds
+        maximum: Upper bound in seconds
+
+    Returns:
+        Delay in seconds
+    """
+    if attempt <= 0:
+        return 0.0
+    return min(base * 2 ** (attempt - 1), maximum)
+
+
+# =============================================================================
+# WATCHDOG
+# =============================================================================
+
+class RestartResult(object):
+    """Outcome of recovering one domain"""
+
+    def __init__(self, name, uuid, reason, detected_at):
+        self.name = name
+        self.uuid = uuid
+        self.reason = reason
+        self.detected_at = detected_at
+        self.outcome = None      # restarted, failed, flapping or gone
+        self.attempt = 0
+        self.delay = 0.0
+        self.dump = None
+        self.downtime_ms = None
+        self.error = None
+
+    def to_dict(self):
+        """Return the result as a plain dict"""
+        return dict(self.__dict__)
+
+
+class _Tracker(object):
+    """Crash history of one domain"""
+
+    def __init__(self):
+        self.restarts = collections.deque()
+        self.attempt = 0
+        self.last_restart = None
+        self.pending = False
+        self.restarting = False
+        self.flapping = False
+
+
+class Watchdog(object):
+    """
+    Event-driven crash detection and restart
+
+    Event callbacks only record the crash and queue it; recoveries run on
+    a small worker pool so one slow dump never delays another restart.
+    """
+
+    def __init__(self, conn, config=None, workers=MAX_WORKERS, host=None,
+                 on_result=None):
+        """
+        Initialize the watchdog
+
+        Args:
+            conn: libvirt connection (the event loop must be running)
+            config: Configuration dict, defaults to the loaded file
+            workers: Recoveries run at once
+            host: Hypervisor hostname for operation events
+            on_result: Optional callable(RestartResult) run after each recovery
+        """
+        self.conn = conn
+        self.cfg = watchdog_config(config)
+        self.workers = workers
+        self.host = host
+        self.on_result = on_result
+        self.history = collections.deque(maxlen=HISTORY_SIZE)
+        self.recovery = vm_instrument.MethodStats()
+        self._trackers = collections.defaultdict(_Tracker)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._queue = []
+        self._tokens = []
+        self._pool = None
+        self._thread = None
+        self._stopping = False
+
+    def watches(self, name):
+        """Return True when a VM is covered by the watchdog"""
+        return vm_config.match_name(
+            name, dict.fromkeys(self.cfg['vms'], True), False)
+
+    def wants_dump(self, name):
+        """Return True when a VM gets a core dump before its restart"""
+        return vm_config.match_name(
+            name, dict.fromkeys(self.cfg['core_dump'], True), False)
+
+    def start(self):
+        """
+        Subscribe to events and start the recovery thread
+
+        Domains already crashed when the watchdog starts are recovered too.
+
+        Raises:
+            RuntimeError: The libvirt event loop is not running
+        """
+        dispatcher = vm_events.get_dispatcher(self.conn)
+        if dispatcher is None:
+            raise RuntimeError("the libvirt event loop is not running")
+        self._stopping = False
+        self._tokens = [
+            dispatcher.subscribe(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                 self._on_lifecycle),
+            dispatcher.subscribe(libvirt.VIR_DOMAIN_EVENT_ID_WATCHDOG,
+                                 self._on_watchdog),
+        ]
+        self._pool = ThreadPool(self.workers)
+        self._thread = threading.Thread(target=self._run, name="watchdog")
+        self._thread.daemon = True
+        self._thread.start()
+
+        for dom in self.conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE):
+            try:
+                if dom.state()[0] == libvirt.VIR_DOMAIN_CRASHED:
+                    self._detected(dom, 'crashed')
+            except libvirt.libvirtError:
+                pass
+
+    def stop(self):
+        """Unsubscribe and wait for running recoveries to finish"""
+        dispatcher = vm_events.get_dispatcher(self.conn)
+        if dispatcher is not None:
+            for token in self._tokens:
+                dispatcher.unsubscribe(token)
+        self._tokens = []
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def reset(self, uuid):
+        """Clear the crash history of a domain, lifting a flapping hold"""
+        with self._lock:
+            self._trackers.pop(uuid, None)
+
+    def status(self):
+        """
+        Return the crash history of tracked domains
+
+        Returns:
+            Dict of uuid -> dict with restarts, attempt, flapping and pending
+        """
+        now = time.time()
+        with self._lock:
+            return dict((uuid, {
+                'restarts': sum(1 for t in tr.restarts
+                                if now - t < self.cfg['flap_window']),
+                'attempt': tr.attempt,
+                'flapping': tr.flapping,
+                'pending': tr.pending,
+            }) for uuid, tr in self._trackers.items())
+
+    # -------------------------------------------------------------------------
+    # DETECTION (event loop thread)
+    # -------------------------------------------------------------------------
+
+    def _on_lifecycle(self, dom, event, detail):
+        if event == libvirt.VIR_DOMAIN_EVENT_CRASHED:
+            self._detected(dom, 'crashed')
+        elif event == libvirt.VIR_DOMAIN_EVENT_STOPPED and detail in STOPPED_FAILURES:
+            self._detected(dom, 'failed')
+        elif event == libvirt.VIR_DOMAIN_EVENT_STARTED:
+            with self._lock:
+                tracker = self._trackers.get(dom.UUIDString())
+                if tracker is not None and tracker.flapping:
+                    # Started by hand: lift the hold and start a new history
+                    del self._trackers[dom.UUIDString()]
+
+    def _on_watchdog(self, dom, action):
+        if action != WATCHDOG_RESET:
+            self._detected(dom, 'watchdog-' + WATCHDOG_ACTIONS.get(action, str(action)))
+
+    def _detected(self, dom, reason):
+        """Queue a recovery with backoff, or hold a flapping domain"""
+        detected_at = time.time()
+        name = dom.name()
+        if not self.watches(name):
+            return
+        uuid = dom.UUIDString()
+        with self._cond:
+            tracker = self._trackers[uuid]
+            if tracker.pending or tracker.restarting or tracker.flapping:
+                return
+            window = self.cfg['flap_window']
+            while tracker.restarts and detected_at - tracker.restarts[0] > window:
+                tracker.restarts.popleft()
+            if (tracker.last_restart is not None and
+                    detected_at - tracker.last_restart > self.cfg['stable_after']):
+                tracker.attempt = 0
+
+            result = RestartResult(name, uuid, reason, detected_at)
+            result.attempt = tracker.attempt + 1
+            if len(tracker.restarts) >= self.cfg['max_restarts']:
+                tracker.flapping = True
+                result.outcome = 'flapping'
+                result.error = ("%d restarts within %d s, left down" %
+                                (len(tracker.restarts), window))
+            else:
+                result.delay = backoff(tracker.attempt, self.cfg['backoff_base'],
+                                       self.cfg['backoff_max'])
+                tracker.pending = True
+                heapq.heappush(self._queue, (detected_at + result.delay,
+                                             id(result), result))
+                self._cond.notify()
+        if result.outcome == 'flapping':
+            self._finish(result)
+
+    # -------------------------------------------------------------------------
+    # RECOVERY
+    # -------------------------------------------------------------------------
+
+    def _run(self):
+        """Hand queued recoveries to the pool when their backoff expires"""
+        with self._cond:
+            while not self._stopping:
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                due, _, result = self._queue[0]
+                delay = due - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._queue)
+                self._pool.apply_async(self._recover, (result,))
+
+    def _recover(self, result):
+        """Dump (optionally), destroy and start one domain"""
+        with self._lock:
+            tracker = self._trackers[result.uuid]
+            tracker.pending = False
+            tracker.restarting = True
+        try:
+            try:
+                dom = self.conn.lookupByUUIDString(result.uuid)
+            except libvirt.libvirtError as e:
+                result.outcome = 'gone'
+                result.error = str(e)
+                return
+
+            try:
+                if dom.isActive() and self.wants_dump(result.name):
+                    result.dump = self._dump(dom, result)
+                if dom.isActive():
+                    dom.destroy()
+                dom.create()
+                result.outcome = 'restarted'
+            except libvirt.libvirtError as e:
+                result.outcome = 'failed'
+                result.error = str(e)
+        finally:
+            now = time.time()
+            result.downtime_ms = round((now - result.detected_at) * 1000.0, 1)
+            with self._lock:
+                tracker.restarting = False
+                if result.outcome in ('restarted', 'failed'):
+                    tracker.restarts.append(now)
+                    tracker.attempt += 1
+                    tracker.last_restart = now
+            self._finish(result)
+
+    def _dump(self, dom, result):
+        """
+        Write a memory-only core dump of a crashed domain
+
+        Returns:
+            Dump path, or None when the dump failed (the restart goes ahead)
+        """
+        path = os.path.join(self.cfg['dump_dir'], "%s-%s.core" % (
+            result.name, time.strftime("%Y%m%d-%H%M%S",
+                                       time.localtime(result.detected_at))))
+        try:
+            dom.coreDumpWithFormat(path, DUMP_FORMAT_RAW, DUMP_FLAGS)
+            return path
+        except (libvirt.libvirtError, AttributeError) as e:
+            result.error = "core dump failed: %s" % e
+            return None
+
+    def _finish(self, result):
+        """Record, log and report a finished recovery"""
+        if result.outcome == 'restarted':
+            self.recovery.observe(result.downtime_ms / 1000.0)
+        self.history.append(result)
+        vm_oplog.log_event('watchdog_restart', None, self.host,
+                           (result.downtime_ms or 0) / 1000.0,
+                           'ok' if result.outcome == 'restarted' else 'error',
+                           result.error, name=result.name, uuid=result.uuid,
+                           reason=result.reason, outcome=result.outcome,
+                           attempt=result.attempt, dump=result.dump)
+        if self.on_result:
+            self.on_result(result)
+
+    def render_metrics(self):
+        """
+        Render recovery statistics in Prometheus text format
+
+        Returns:
+            Exposition text
+        """
+        snap = self.recovery.to_dict()
+        out = ["# HELP vm_manager_watchdog_recovery_seconds "
+               "Time from crash detection to the domain running again",
+               "# TYPE vm_manager_watchdog_recovery_seconds histogram"]
+        cumulative = 0
+        for bound, n in zip(vm_instrument.BUCKETS_MS + ('+Inf',), snap['buckets']):
+            cumulative += n
+            le = bound if bound == '+Inf' else repr(bound / 1000.0)
+            out.append('vm_manager_watchdog_recovery_seconds_bucket{le="%s"} %d' %
+                       (le, cumulative))
+        out.append('vm_manager_watchdog_recovery_seconds_sum %.6f' %
+                   (snap['total_ms'] / 1000.0))
+        out.append('vm_manager_watchdog_recovery_seconds_count %d' % snap['count'])
+        flapping = sum(1 for s in self.status().values() if s['flapping'])
+        out.append("# HELP vm_manager_watchdog_flapping Domains held down "
+                   "after too many restarts")
+        out.append("# TYPE vm_manager_watchdog_flapping gauge")
+        out.append("vm_manager_watchdog_flapping %d" % flapping)
+        return "\n".join(out) + "\n"
+
+
+def format_result(result):
+    """
+    Format one recovery as a line of output
+
+    Returns:
+        Text line
+    """
+    when = time.strftime("%H:%M:%S", time.localtime(result.detected_at))
+    downtime = ("%.0f ms" % result.downtime_ms
+                if result.downtime_ms is not None else "-")
+    line = "%s  %-24s %-18s %-9s #%-2d %10s" % (
+        when, result.name[:24], result.reason, result.outcome,
+        result.attempt, downtime)
+    if result.delay:
+        line += "  (backoff %g s)" % result.delay
+    if result.dump:
+        line += "  dump %s" % result.dump
+    if result.error:
+        line += "  %s" % result.error
+    return line
+
+
+# =============================================================================
+# MAIN PROGRAM
+# =============================================================================
+
+def main(argv=None):
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(
+        description="Restart crashed VMs as soon as they are reported")
+    parser.add_argument("--uri", default="qemu:///system")
+    args = parser.parse_args(argv)
+
+    vm_events.start_event_loop()
+    try:
+        conn = vm_instrument.instrument(libvirt.open(args.uri))
+    except libvirt.libvirtError as e:
+        print("Error: %s" % e)
+        return 1
+
+    def report(result):
+        print(format_result(result))
+        sys.stdout.flush()
+
+    watchdog = Watchdog(conn, host=conn.getHostname(), on_result=report)
+    vm_instrument.register_metrics(watchdog.render_metrics)
+    vm_instrument.start_metrics_server()
+    watchdog.start()
+    print("Watching %s for crashed VMs (Ctrl-C to stop)" % args.uri)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watchdog.stop()
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())